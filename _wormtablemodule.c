@@ -19,9 +19,16 @@
 
 #include <Python.h>
 #include <structmember.h>
+#include <pythread.h>
 #include <db.h>
 #include "halffloat.h"
 
+#ifndef _WIN32
+#include <sys/mman.h>
+#include <sys/stat.h>
+#define WT_HAVE_MMAP
+#endif
+
 #ifdef _WIN32
 #ifdef __MINGW32__
 #define fseeko fseeko64
@@ -66,6 +73,25 @@ on non-MSVC build systems. */
 #define MAX_ROW_SIZE 65536
 #define WT_MISSING_VALUE 1
 #define OFFSET_LEN_RECORD_SIZE 10
+/* Adjacent rows are read from the data file in runs of up to this size */
+#define WT_READ_RUN_SIZE (1 << 20)
+
+#define WT_FILTER_CMP 0
+#define WT_FILTER_MISSING 1
+#define WT_FILTER_CONTAINS 2
+#define WT_FILTER_AND 3
+#define WT_FILTER_OR 4
+#define WT_FILTER_NOT 5
+
+#define WT_FILTER_LT 0
+#define WT_FILTER_LE 1
+#define WT_FILTER_EQ 2
+#define WT_FILTER_NE 3
+#define WT_FILTER_GT 4
+#define WT_FILTER_GE 5
+
+#define WT_MIN(a, b) ((a) < (b) ? (a) : (b))
+#define WT_MAX(a, b) ((a) > (b) ? (a) : (b))
 
 /* This is the default defined by the linux fopen man pages. */
 #define WT_DB_FILE_PERMS 0666
@@ -105,14 +131,157 @@ typedef struct Column_t {
  * with Python. Ideally, all of the types would be fixed size for simplicity
  */
 
+/*
+ * State used when building an index by sorting. Records consisting of
+ * the index key and the primary key are accumulated in a buffer of bounded
+ * size, and are sorted and written to a temporary run file when it is
+ * full. The runs are then merged and inserted into the index in key order.
+ */
+typedef struct {
+    char *buffer;
+    size_t buffer_size;
+    size_t buffer_used;
+    char **records;
+    size_t num_records;
+    size_t max_records;
+    size_t max_record_size;
+    char *run_prefix;
+    PyObject *run_filenames;
+    FILE **runs;
+    char **run_records;
+    int num_run_records;
+    int *heap;
+    int num_runs;
+} IndexSorter;
+
+/*
+ * A single instruction in a row filter program. Comparisons, missing
+ * value tests and containment tests are the leaves of the expression,
+ * and the boolean operators combine the subexpressions that end just
+ * before them. Constants are held in the form most convenient for
+ * comparison with values from the column.
+ */
+typedef struct {
+    int type;
+    uint32_t column;            /* index into the filter's columns */
+    int32_t element;            /* element within the column, or -1 */
+    int cmp;
+    int constant_type;          /* WT_INT, WT_UINT, WT_FLOAT or WT_CHAR */
+    int64_t int_value;
+    uint64_t uint_value;
+    double float_value;
+    char *char_value;
+    Py_ssize_t char_size;
+} FilterInstruction;
+
+/*
+ * A compiled predicate over the columns of a table, evaluated against
+ * the native values decoded from each row. Columns are only decoded
+ * when an instruction needs them, and the boolean operators are short
+ * circuited, so rows that fail early cost little. The filter shares
+ * the column copies of the cursor for columns that are also in its
+ * projection, so that the values decoded by the filter need not be
+ * decoded again for rows that pass; other columns are copied so that
+ * no decoding state is shared with other cursors.
+ */
+typedef struct {
+    FilterInstruction *instructions;
+    uint32_t num_instructions;
+    uint32_t *starts;           /* first instruction of each subexpression */
+    uint32_t *read_columns;
+    Column **columns;
+    int *decoded;               /* true if the column is decoded for the row */
+    int *missing;
+    uint32_t num_columns;
+    /* filter column for each column in the cursor's projection, or -1 */
+    int32_t *projection;
+    int *projection_missing;
+    uint32_t projection_size;
+} RowFilter;
+
+/*
+ * Statistics for the non-missing elements of a column over the rows in
+ * a group. Sums, minima and maxima are held in the column's native type.
+ * Integer sums wrap modulo 2^64, and sum_carry counts the number of
+ * times they have wrapped so that the exact sum can be recovered.
+ */
+typedef struct {
+    uint64_t count;
+    int64_t sum_carry;
+    uint64_t uint_sum;
+    uint64_t uint_min;
+    uint64_t uint_max;
+    int64_t int_sum;
+    int64_t int_min;
+    int64_t int_max;
+    double float_sum;
+    double float_min;
+    double float_max;
+} ColumnStats;
+
+/*
+ * The location in the data file of a row requested by Table_get_rows,
+ * and its position in the caller's list of row ids.
+ */
+typedef struct {
+    uint64_t row_id;
+    uint64_t offset;
+    uint32_t len;
+    Py_ssize_t position;
+} RowLookup;
+
+/*
+ * An encoded key probed by an IndexRowIterator, and the Python value
+ * it was specified by.
+ */
+typedef struct {
+    char *key;
+    size_t offset;              /* offset of key in the key storage */
+    uint32_t key_size;
+    Py_ssize_t position;        /* position of the value in the probes */
+    PyObject *value;
+} ProbeKey;
+
+/*
+ * State used to aggregate the columns read by a cursor. The first
+ * num_group_columns columns define groups of consecutive rows with equal
+ * values, where the values of group column j are truncated to a multiple
+ * of bin_widths[j] if this is nonzero. Statistics are accumulated for
+ * the remaining columns over each group, and a tuple describing each
+ * group is appended to the results list when the group is complete.
+ */
+typedef struct {
+    Column **columns;
+    uint32_t num_columns;
+    uint32_t num_group_columns;
+    double *bin_widths;
+    /* copies of the element buffers of the group columns for the group */
+    void **group_values;
+    int *group_num_elements;
+    int *group_missing;
+    PyObject *group_key;
+    uint64_t num_rows;
+    ColumnStats *stats;
+    PyObject *results;
+} RowAggregator;
+
 typedef struct {
     PyObject_HEAD
     DB *db;
     PyObject *db_filename;
     FILE *data_file;
     PyObject *data_filename;
+    void *data_map;               /* read-only mapping of the data file */
+    uint64_t data_map_size;
     Column **columns;
     unsigned long long cache_size;
+    /* environment shared by the table and its indexes when opened for
+     * reading with env_cache_size > 0 or an env_home, and the number of
+     * open handles in it */
+    DB_ENV *env;
+    unsigned long long env_cache_size;
+    PyObject *env_home;
+    int env_handles;
     unsigned int fixed_region_size;
     unsigned int num_columns;
     void *row_buffer;
@@ -123,6 +292,12 @@ typedef struct {
     unsigned long long total_row_size;
     unsigned int min_row_size;
     unsigned int max_row_size;
+    /* indexes whose keys are sorted as rows are written */
+    PyObject *sort_indexes;
+    /* serialises reads from data_file while the GIL is released */
+    PyThread_type_lock io_lock;
+    /* number of calls using the table with the GIL released */
+    int num_users;
 } Table;
 
 
@@ -137,6 +312,10 @@ typedef struct {
     void *key_buffer;
     uint32_t key_buffer_size;
     double *bin_widths;
+    IndexSorter *sorter;
+    int shared_env;               /* true if db is in the table's env */
+    /* number of calls using the index with the GIL released */
+    int num_users;
 } Index;
 
 typedef struct {
@@ -150,6 +329,21 @@ typedef struct {
     uint32_t min_key_size;
     void *max_key;
     uint32_t max_key_size;
+    uint32_t batch_size;
+    /* private row buffer and copies of the read columns used for decoding */
+    void *row_buffer;
+    Column **columns;
+    RowFilter *filter;
+    /* copies of the index key columns, if the rows are read from the keys */
+    Column **key_columns;
+    /* sorted keys to look up instead of iterating over a range */
+    ProbeKey *probes;
+    char *probe_keys;
+    Py_ssize_t num_probes;
+    Py_ssize_t current_probe;
+    int probe_started;
+    /* true while a row is being read, when the GIL may be released */
+    int busy;
 } IndexRowIterator;
 
 
@@ -157,13 +351,27 @@ typedef struct {
     PyObject_HEAD
     Table *table;
     DBC *cursor;
+    int started;
     int completed;
     uint32_t *read_columns;
     uint32_t num_read_columns;
     void *min_key;
     uint32_t min_key_size;
+    uint64_t min_row_id;
     void *max_key;
     uint32_t max_key_size;
+    uint32_t batch_size;
+    /* private row buffer and copies of the read columns used for decoding */
+    void *row_buffer;
+    Column **columns;
+    Column *id_column;
+    RowFilter *filter;
+    /* state for sequential scans of the mapped data file */
+    int sequential;
+    uint64_t scan_offset;
+    uint64_t scan_row_id;
+    /* true while a row is being read, when the GIL may be released */
+    int busy;
 } TableRowIterator;
 
 
@@ -171,8 +379,56 @@ typedef struct {
     PyObject_HEAD
     Index *index;
     DBC *cursor;
+    /* true while a key is being read, when the GIL is released */
+    int busy;
 } IndexKeyIterator;
 
+/* The number of fixed fields in a VCF line, before the INFO field */
+#define VCF_NUM_FIXED_FIELDS 7
+#define VCF_INFO_FIELD 7
+#define VCF_FORMAT_FIELD 8
+#define VCF_REF_FIELD 3
+#define VCF_ALT_FIELD 4
+#define VCF_MISSING_VALUE "."
+/* REF and ALT values longer than this are truncated if requested */
+#define VCF_MAX_ALLELE_SIZE 254
+
+/* Maps the name of an INFO or FORMAT field to a column or key index */
+typedef struct {
+    char *name;
+    uint32_t value;
+} VCFField;
+
+/*
+ * Parses lines of a VCF file and appends the rows to a table that is open
+ * for writing, without creating Python objects for the values. Each line
+ * is copied and split in place, and the tokens for each column are then
+ * converted using Column_string_to_native in column order, exactly as if
+ * the row had been appended using insert_encoded_elements. Columns are
+ * identified by position, and position 0 (the row_id column) means that
+ * the field is not stored.
+ */
+typedef struct {
+    PyObject_HEAD
+    Table *table;
+    PyObject *names;                /* the bytes objects for the names */
+    uint32_t fixed_columns[VCF_NUM_FIXED_FIELDS];
+    VCFField *info_fields;          /* sorted by name */
+    uint32_t num_info_fields;
+    VCFField *format_keys;          /* sorted by name */
+    uint32_t num_format_keys;
+    uint32_t *genotype_columns;     /* num_samples * num_format_keys */
+    uint32_t num_samples;
+    int truncate;
+    /* buffers for the current line */
+    char *line;
+    size_t line_size;
+    char **values;                  /* the token for each table column */
+    int32_t *format;                /* format key index of each token */
+    char **tokens;
+    uint32_t max_tokens;
+} VCFRecordParser;
+
 
 static void
 handle_bdb_error(int err)
@@ -492,6 +748,22 @@ Column_get_max_num_elements(Column *self)
     return ret;
 }
 
+/*
+ * Returns the size of the native values in the element buffer of this
+ * Column.
+ */
+static size_t
+Column_get_native_element_size(Column *self)
+{
+    size_t ret = sizeof(uint64_t);
+    if (self->element_type == WT_CHAR) {
+        ret = sizeof(char);
+    } else if (self->element_type == WT_FLOAT) {
+        ret = sizeof(double);
+    }
+    return ret;
+}
+
 /**************************************
  *
  * Native values to Python conversion.
@@ -1673,6 +1945,200 @@ out:
     return ret;
 }
 
+/*
+ * Returns the struct module format character for the items in the
+ * specified buffer, ignoring any native byte order prefix.
+ */
+static const char *
+array_format(Py_buffer *buf)
+{
+    const char *format = buf->format == NULL ? "B" : buf->format;
+    if (format[0] == '@' || format[0] == '=') {
+        format++;
+    }
+    return format;
+}
+
+/*
+ * Checks that the specified buffer is suitable for holding an array of
+ * values from this column, and returns the number of rows it can hold.
+ * If the array is being used as input, any integer type is accepted for
+ * integer columns; otherwise, the type must be able to hold all values
+ * in the column. Returns -1 with the appropriate Python exception set if
+ * the buffer is not suitable.
+ */
+static Py_ssize_t
+Column_check_array(Column *self, Py_buffer *buf, int input)
+{
+    Py_ssize_t ret = -1;
+    const char *format = array_format(buf);
+    const char *types = "efd";
+    Py_ssize_t row_size;
+
+    if (Column_is_variable(self) || self->element_type == WT_CHAR) {
+        PyErr_Format(PyExc_ValueError,
+                "Column '%s' is not a fixed size numeric column",
+                PyBytes_AsString(self->name));
+        goto out;
+    }
+    if (input && self->element_type != WT_FLOAT) {
+        types = "BHILQbhilq";
+    } else if (self->element_type == WT_UINT) {
+        types = "BHILQ";
+    } else if (self->element_type == WT_INT) {
+        types = "bhilq";
+    }
+    if (format[0] == '\0' || format[1] != '\0'
+            || strchr(types, format[0]) == NULL
+            || (!input && self->element_type != WT_FLOAT
+                && buf->itemsize < self->element_size)) {
+        PyErr_Format(PyExc_TypeError,
+                "Array type '%s' unsuitable for column '%s'", buf->format,
+                PyBytes_AsString(self->name));
+        goto out;
+    }
+    row_size = buf->itemsize * self->num_elements;
+    if (buf->len % row_size != 0) {
+        PyErr_Format(PyExc_ValueError,
+                "Array size for column '%s' not a multiple of %d elements",
+                PyBytes_AsString(self->name), self->num_elements);
+        goto out;
+    }
+    ret = buf->len / row_size;
+out:
+    return ret;
+}
+
+/*
+ * Copies the native values in the element buffer into the specified row
+ * of an array buffer that has been checked using Column_check_array.
+ * Missing floating point values are stored as NaN and missing integer
+ * values as 0.
+ */
+static void
+Column_copy_array_elements(Column *self, Py_buffer *buf, Py_ssize_t row,
+        int missing)
+{
+    int j;
+    Py_ssize_t size = buf->itemsize;
+    char *dest = (char *) buf->buf + row * size * self->num_elements;
+    uint64_t *uint_elements = (uint64_t *) self->element_buffer;
+    int64_t *int_elements = (int64_t *) self->element_buffer;
+    double *float_elements = (double *) self->element_buffer;
+    union {
+        uint8_t u8; uint16_t u16; uint32_t u32; uint64_t u64;
+        int8_t i8; int16_t i16; int32_t i32; int64_t i64;
+        npy_half f2; float f4; double f8;
+    } v;
+    for (j = 0; j < self->num_elements; j++) {
+        if (self->element_type == WT_UINT) {
+            v.u64 = missing ? 0 : uint_elements[j];
+            if (size == 1) {
+                v.u8 = (uint8_t) v.u64;
+            } else if (size == 2) {
+                v.u16 = (uint16_t) v.u64;
+            } else if (size == 4) {
+                v.u32 = (uint32_t) v.u64;
+            }
+        } else if (self->element_type == WT_INT) {
+            v.i64 = missing ? 0 : int_elements[j];
+            if (size == 1) {
+                v.i8 = (int8_t) v.i64;
+            } else if (size == 2) {
+                v.i16 = (int16_t) v.i64;
+            } else if (size == 4) {
+                v.i32 = (int32_t) v.i64;
+            }
+        } else {
+            v.f8 = missing ? Py_NAN : float_elements[j];
+            if (size == 2) {
+                v.f2 = npy_double_to_half(v.f8);
+            } else if (size == 4) {
+                v.f4 = (float) v.f8;
+            }
+        }
+        memcpy(dest, &v, size);
+        dest += size;
+    }
+}
+
+/*
+ * Copies the values in the specified row of an array buffer that has
+ * been checked using Column_check_array into the element buffer, checking
+ * that integer values are in the range of the column.
+ */
+static int
+Column_array_to_native(Column *self, Py_buffer *buf, Py_ssize_t row)
+{
+    int ret = -1;
+    int j, in_range;
+    int is_signed = strchr("bhilq", array_format(buf)[0]) != NULL;
+    Py_ssize_t size = buf->itemsize;
+    char *src = (char *) buf->buf + row * size * self->num_elements;
+    uint64_t *uint_elements = (uint64_t *) self->element_buffer;
+    int64_t *int_elements = (int64_t *) self->element_buffer;
+    double *float_elements = (double *) self->element_buffer;
+    uint64_t max_uint_value = max_uint(self->element_size);
+    int64_t min_int_value = min_int(self->element_size);
+    int64_t max_int_value = max_int(self->element_size);
+    int64_t sv = 0;
+    uint64_t uv = 0;
+    union {
+        uint8_t u8; uint16_t u16; uint32_t u32; uint64_t u64;
+        int8_t i8; int16_t i16; int32_t i32; int64_t i64;
+        npy_half f2; float f4; double f8;
+    } v;
+
+    for (j = 0; j < self->num_elements; j++) {
+        memcpy(&v, src, size);
+        src += size;
+        if (self->element_type == WT_FLOAT) {
+            if (size == 2) {
+                v.f8 = npy_half_to_double(v.f2);
+            } else if (size == 4) {
+                v.f8 = v.f4;
+            }
+            float_elements[j] = v.f8;
+            continue;
+        }
+        if (is_signed) {
+            sv = size == 1 ? v.i8 : size == 2 ? v.i16 : size == 4 ? v.i32
+                : v.i64;
+            uv = (uint64_t) sv;
+        } else {
+            uv = size == 1 ? v.u8 : size == 2 ? v.u16 : size == 4 ? v.u32
+                : v.u64;
+            sv = (int64_t) uv;
+        }
+        if (self->element_type == WT_UINT) {
+            in_range = !(is_signed && sv < 0) && uv <= max_uint_value;
+            uint_elements[j] = uv;
+        } else {
+            in_range = !(!is_signed && uv > (uint64_t) max_int_value)
+                && sv >= min_int_value && sv <= max_int_value;
+            int_elements[j] = sv;
+        }
+        if (!in_range) {
+            if (self->element_type == WT_UINT) {
+                PyErr_Format(PyExc_OverflowError,
+                        "Values for column '%s' must be between %lld and %lld",
+                        PyBytes_AsString(self->name), 0ll,
+                        (long long) max_uint_value);
+            } else {
+                PyErr_Format(PyExc_OverflowError,
+                        "Values for column '%s' must be between %lld and %lld",
+                        PyBytes_AsString(self->name),
+                        (long long) min_int_value, (long long) max_int_value);
+            }
+            goto out;
+        }
+    }
+    self->num_buffered_elements = self->num_elements;
+    ret = 0;
+out:
+    return ret;
+}
+
 /*
  * Returns the number of bytes that this column occupies in the
  * fixed region of records.
@@ -1960,22 +2426,73 @@ static PyTypeObject ColumnType = {
  *==========================================================
  */
 
+/*
+ * Maps the data file into memory so that rows can be decoded in place
+ * rather than being read into the row buffer. If the mapping cannot be
+ * made we silently fall back to reading rows using stdio.
+ */
+static void
+Table_map_data_file(Table *self)
+{
+#ifdef WT_HAVE_MMAP
+    struct stat st;
+    void *p;
+    self->data_map = NULL;
+    self->data_map_size = 0;
+    if (fstat(fileno(self->data_file), &st) != 0) {
+        return;
+    }
+    if (st.st_size <= 0 || (uint64_t) st.st_size > (uint64_t) SIZE_MAX) {
+        return;
+    }
+    p = mmap(NULL, (size_t) st.st_size, PROT_READ, MAP_SHARED,
+            fileno(self->data_file), 0);
+    if (p == MAP_FAILED) {
+        return;
+    }
+    self->data_map = p;
+    self->data_map_size = (uint64_t) st.st_size;
+#endif
+}
+
+static void
+Table_unmap_data_file(Table *self)
+{
+#ifdef WT_HAVE_MMAP
+    if (self->data_map != NULL) {
+        munmap(self->data_map, (size_t) self->data_map_size);
+    }
+#endif
+    self->data_map = NULL;
+    self->data_map_size = 0;
+}
+
 static void
 Table_dealloc(Table* self)
 {
     uint32_t j;
+    Py_XDECREF(self->sort_indexes);
     Py_XDECREF(self->db_filename);
     Py_XDECREF(self->data_filename);
+    Py_XDECREF(self->env_home);
     /* make sure that the DB handles are closed. We can ignore errors here. */
     if (self->db != NULL) {
         self->db->close(self->db, 0);
     }
+    /* Indexes hold a reference to the table, so none can be open here */
+    if (self->env != NULL) {
+        self->env->close(self->env, 0);
+    }
+    Table_unmap_data_file(self);
     if (self->data_file != NULL) {
         fclose(self->data_file);
     }
     if (self->row_buffer != NULL) {
         PyMem_Free(self->row_buffer);
     }
+    if (self->io_lock != NULL) {
+        PyThread_free_lock(self->io_lock);
+    }
     if (self->columns != NULL) {
         /* columns must be decref'd but may be null */
         for (j = 0; j < self->num_columns; j++) {
@@ -2044,24 +2561,39 @@ Table_init(Table *self, PyObject *args, PyObject *kwds)
 {
     int ret = -1;
     static char *kwlist[] = {"db_filename", "data_filename", "columns",
-            "cache_size", NULL};
+            "cache_size", "env_cache_size", "env_home", NULL};
     Column *col;
     PyObject *db_filename = NULL;
     PyObject *data_filename = NULL;
     PyObject *columns = NULL;
+    PyObject *env_home = Py_None;
     uint32_t j;
     self->db = NULL;
+    self->env = NULL;
+    self->env_handles = 0;
+    self->env_cache_size = 0;
+    self->env_home = NULL;
     self->row_buffer = NULL;
     self->columns = NULL;
     self->db_filename = NULL;
+    self->data_map = NULL;
+    self->sort_indexes = NULL;
+    self->io_lock = NULL;
+    self->data_map_size = 0;
     self->cache_size = 0;
-    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O!O!O!K", kwlist,
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O!O!O!K|KO", kwlist,
             &PyBytes_Type, &db_filename,
             &PyBytes_Type, &data_filename,
             &PyList_Type,  &columns,
-            &self->cache_size)) {
+            &self->cache_size, &self->env_cache_size, &env_home)) {
         goto out;
     }
+    if (env_home != Py_None && !PyBytes_Check(env_home)) {
+        PyErr_SetString(PyExc_TypeError, "env_home must be bytes or None");
+        goto out;
+    }
+    self->env_home = env_home;
+    Py_INCREF(self->env_home);
     self->db_filename = db_filename;
     Py_INCREF(self->db_filename);
     self->data_filename = data_filename;
@@ -2087,6 +2619,11 @@ Table_init(Table *self, PyObject *args, PyObject *kwds)
     }
     self->row_buffer_size = MAX_ROW_SIZE;
     memset(self->row_buffer, 0, self->row_buffer_size);
+    self->io_lock = PyThread_allocate_lock();
+    if (self->io_lock == NULL) {
+        PyErr_NoMemory();
+        goto out;
+    }
     self->fixed_region_size = 0;
     for (j = 0; j < self->num_columns; j++) {
         col = self->columns[j];
@@ -2112,6 +2649,9 @@ static PyMemberDef Table_members[] = {
     {"db_filename", T_OBJECT_EX, offsetof(Table, db_filename), READONLY, "db_filename"},
     {"data_filename", T_OBJECT_EX, offsetof(Table, data_filename), READONLY, "data_filename"},
     {"cache_size", T_ULONGLONG, offsetof(Table, cache_size), READONLY, "cache_size"},
+    {"env_cache_size", T_ULONGLONG, offsetof(Table, env_cache_size), READONLY,
+            "env_cache_size"},
+    {"env_home", T_OBJECT_EX, offsetof(Table, env_home), READONLY, "env_home"},
     {"num_rows", T_ULONGLONG, offsetof(Table, num_rows), READONLY, "num_rows"},
     {"total_row_size", T_ULONGLONG, offsetof(Table, total_row_size), READONLY, "total_row_size"},
     {"min_row_size", T_UINT, offsetof(Table, min_row_size), READONLY, "min_row_size"},
@@ -2168,6 +2708,23 @@ out:
 }
 
 
+/*
+ * Returns 0 if no other thread is using the table with the GIL released.
+ * Otherwise -1 is returned with the appropriate Python exception set.
+ */
+static int
+Table_check_idle(Table *self)
+{
+    int ret = -1;
+    if (self->num_users > 0) {
+        PyErr_Format(WormtableError, "Table in use by another thread.");
+        goto out;
+    }
+    ret = 0;
+out:
+    return ret;
+}
+
 /*
  * Returns 0 if the table is opened in read mode. Otherwise
  * -1 is returned with the appropriate Python exception set.
@@ -2200,6 +2757,101 @@ out:
     return ret;
 }
 
+/*
+ * Returns true if the table and its indexes should be opened in a
+ * shared environment when the table is opened for reading.
+ */
+static int
+Table_uses_env(Table *self)
+{
+    return self->env_cache_size > 0 || self->env_home != Py_None;
+}
+
+/*
+ * Creates the Berkeley DB environment shared by the table and its
+ * indexes, which provides a single memory pool of env_cache_size bytes
+ * for all of the databases opened in it. If env_home is None, the
+ * environment is private to this process. Otherwise, its regions are
+ * backed by files in the env_home directory, and are shared with any
+ * other processes that open tables using the same env_home. Since the
+ * databases are only read, no locking is needed. The cache size is
+ * fixed by the process that creates the environment; if env_cache_size
+ * is 0, the table's cache_size is used.
+ */
+static int
+Table_open_env(Table *self)
+{
+    int ret = -1;
+    int db_ret;
+    Py_ssize_t gigabyte = 1024 * 1024 * 1024;
+    uint32_t gigs, bytes;
+    uint32_t flags = DB_CREATE|DB_INIT_MPOOL|DB_THREAD;
+    unsigned long long cache_size = self->env_cache_size;
+    char *home = NULL;
+
+    if (self->env_home == Py_None) {
+        flags |= DB_PRIVATE;
+    } else {
+        home = PyBytes_AsString(self->env_home);
+        if (home == NULL) {
+            goto out;
+        }
+    }
+    if (cache_size == 0) {
+        cache_size = self->cache_size;
+    }
+    db_ret = db_env_create(&self->env, 0);
+    if (db_ret != 0) {
+        handle_bdb_error(db_ret);
+        self->env = NULL;
+        goto out;
+    }
+    /* Disable DB error messages */
+    self->env->set_errcall(self->env, NULL);
+    gigs = (uint32_t) (cache_size / gigabyte);
+    bytes = (uint32_t) (cache_size % gigabyte);
+    db_ret = self->env->set_cachesize(self->env, gigs, bytes, 1);
+    if (db_ret != 0) {
+        handle_bdb_error(db_ret);
+        goto out;
+    }
+    /* Relative database filenames are resolved against the env home,
+     * or the current working directory for private environments. */
+    Py_BEGIN_ALLOW_THREADS
+    db_ret = self->env->open(self->env, home, flags, WT_DB_FILE_PERMS);
+    Py_END_ALLOW_THREADS
+    if (db_ret != 0) {
+        handle_bdb_error(db_ret);
+        goto out;
+    }
+    ret = 0;
+out:
+    if (ret != 0 && self->env != NULL) {
+        self->env->close(self->env, 0);
+        self->env = NULL;
+    }
+    return ret;
+}
+
+/*
+ * Releases a database handle in the shared environment, closing the
+ * environment when the last one is released. This allows indexes to
+ * be closed after the table. Returns the Berkeley DB error code from
+ * closing the environment, or 0.
+ */
+static int
+Table_release_env(Table *self)
+{
+    int ret = 0;
+    DB_ENV *env = self->env;
+    self->env_handles--;
+    if (self->env_handles == 0 && env != NULL) {
+        self->env = NULL;
+        ret = env->close(env, 0);
+    }
+    return ret;
+}
+
 static PyObject *
 Table_open(Table* self, PyObject *args)
 {
@@ -2211,6 +2863,7 @@ Table_open(Table* self, PyObject *args)
     Py_ssize_t gigabyte = 1024 * 1024 * 1024;
     uint32_t gigs, bytes;
     int db_ret, mode;
+    int close_db = 0;
     if (!PyArg_ParseTuple(args, "i", &mode)) {
         goto out;
     }
@@ -2218,7 +2871,9 @@ Table_open(Table* self, PyObject *args)
         flags = DB_CREATE|DB_TRUNCATE;
         data_mode = "wb";
     } else if (mode == WT_READ) {
-        flags = DB_RDONLY|DB_NOMMAP;
+        /* The handle is free-threaded, so that cursors can be used
+         * concurrently from several threads while the GIL is released */
+        flags = DB_RDONLY|DB_NOMMAP|DB_THREAD;
         data_mode = "rb";
     } else {
         PyErr_Format(PyExc_ValueError, "mode must be WT_READ or WT_WRITE.");
@@ -2233,18 +2888,34 @@ Table_open(Table* self, PyObject *args)
     if (db_name == NULL || data_name == NULL) {
         goto out;
     }
+    /* Close the DB handle and environment if we fail to open the DB */
+    close_db = 1;
+    if (mode == WT_READ && Table_uses_env(self)) {
+        if (self->env != NULL) {
+            PyErr_Format(WormtableError, "Table environment still in use.");
+            goto out;
+        }
+        if (Table_open_env(self) != 0) {
+            goto out;
+        }
+        self->env_handles = 1;
+    }
     /* Now we create the DB handle */
-    db_ret = db_create(&self->db, NULL, 0);
+    db_ret = db_create(&self->db, self->env, 0);
     if (db_ret != 0) {
         handle_bdb_error(db_ret);
+        self->db = NULL;
         goto out;
     }
-    gigs = (uint32_t) (self->cache_size / gigabyte);
-    bytes = (uint32_t) (self->cache_size % gigabyte);
-    db_ret = self->db->set_cachesize(self->db, gigs, bytes, 1);
-    if (db_ret != 0) {
-        handle_bdb_error(db_ret);
-        goto out;
+    if (self->env == NULL) {
+        /* Databases in an environment use its cache */
+        gigs = (uint32_t) (self->cache_size / gigabyte);
+        bytes = (uint32_t) (self->cache_size % gigabyte);
+        db_ret = self->db->set_cachesize(self->db, gigs, bytes, 1);
+        if (db_ret != 0) {
+            handle_bdb_error(db_ret);
+            goto out;
+        }
     }
     /* Disable DB error messages */
     self->db->set_errcall(self->db, NULL);
@@ -2252,10 +2923,9 @@ Table_open(Table* self, PyObject *args)
             WT_DB_FILE_PERMS);
     if (db_ret != 0) {
         handle_bdb_error(db_ret);
-        self->db->close(self->db, 0);
-        self->db = NULL;
         goto out;
     }
+    close_db = 0;
     /* Now open the data file */
     self->data_file = fopen(data_name, data_mode);
     if (self->data_file == NULL) {
@@ -2266,14 +2936,44 @@ Table_open(Table* self, PyObject *args)
         handle_io_error();
         goto out;
     }
-
+    if (mode == WT_READ) {
+        Table_map_data_file(self);
+    }
     Py_INCREF(Py_None);
     ret = Py_None;
 out:
+    if (close_db) {
+        if (self->db != NULL) {
+            self->db->close(self->db, 0);
+            self->db = NULL;
+        }
+        if (self->env != NULL) {
+            self->env->close(self->env, 0);
+            self->env = NULL;
+            self->env_handles = 0;
+        }
+    }
     return ret;
 }
 
 
+/*
+ * Raises an exception if another thread is using the table with the GIL
+ * released, so that it can be checked before the table is closed.
+ */
+static PyObject *
+Table_check_idle_method(Table* self)
+{
+    PyObject *ret = NULL;
+    if (Table_check_idle(self) != 0) {
+        goto out;
+    }
+    Py_INCREF(Py_None);
+    ret = Py_None;
+out:
+    return ret;
+}
+
 static PyObject *
 Table_close(Table* self)
 {
@@ -2284,12 +2984,21 @@ Table_close(Table* self)
         PyErr_SetString(WormtableError, "table closed");
         goto out;
     }
+    if (Table_check_idle(self) != 0) {
+        goto out;
+    }
+    Py_CLEAR(self->sort_indexes);
     db_ret = db->close(db, 0);
     self->db = NULL;
+    if (self->env != NULL && db_ret == 0) {
+        /* The environment is closed when the last index is closed */
+        db_ret = Table_release_env(self);
+    }
     if (db_ret != 0) {
         handle_bdb_error(db_ret);
         goto out;
     }
+    Table_unmap_data_file(self);
     if (self->data_file != NULL) {
         io_ret = fclose(self->data_file);
         self->data_file = NULL;
@@ -2343,22 +3052,44 @@ out:
     return ret;
 }
 
-static PyObject *
-Table_insert_encoded_elements(Table* self, PyObject *args)
+/*
+ * Parses the specified string value for the specified column and inserts
+ * it into the current row.
+ */
+static int
+Table_insert_encoded(Table *self, Column *column, char *v)
 {
-    PyObject *ret = NULL;
-    Column *column = NULL;
-    PyBytesObject *value = NULL;
-    char *v;
-    int  m, col_index;
-    if (!PyArg_ParseTuple(args, "iO!", &col_index, &PyBytes_Type,
-            &value)) {
+    int ret = -1;
+    int m;
+    if (column->string_to_native(column, v) < 0) {
         goto out;
     }
-    if (Table_check_column_index(self, col_index) != 0) {
+    m = Column_update_row(column, self->row_buffer, self->current_row_size);
+    if (m < 0) {
         goto out;
     }
-    if (col_index == 0) {
+    self->current_row_size += m;
+    ret = 0;
+out:
+    return ret;
+}
+
+static PyObject *
+Table_insert_encoded_elements(Table* self, PyObject *args)
+{
+    PyObject *ret = NULL;
+    Column *column = NULL;
+    PyBytesObject *value = NULL;
+    char *v;
+    int col_index;
+    if (!PyArg_ParseTuple(args, "iO!", &col_index, &PyBytes_Type,
+            &value)) {
+        goto out;
+    }
+    if (Table_check_column_index(self, col_index) != 0) {
+        goto out;
+    }
+    if (col_index == 0) {
         PyErr_Format(WormtableError, "Cannot update ID column.");
         goto out;
     }
@@ -2367,14 +3098,9 @@ Table_insert_encoded_elements(Table* self, PyObject *args)
     }
     column = self->columns[col_index];
     v = PyBytes_AsString((PyObject *) value);
-    if (column->string_to_native(column, v) < 0) {
-        goto out;
-    }
-    m = Column_update_row(column, self->row_buffer, self->current_row_size);
-    if (m < 0) {
+    if (Table_insert_encoded(self, column, v) != 0) {
         goto out;
     }
-    self->current_row_size += m;
     Py_INCREF(Py_None);
     ret = Py_None;
 out:
@@ -2393,16 +3119,23 @@ Table_update_row_stats(Table *self, uint32_t row_size)
     }
 }
 
-/* Retrieves the row from the data file identified by data into the
- * row buffer such that it is ready for reading. Also copy the specified
- * key into the buffer so that we can read the col_id column also.
+/* Retrieves the row from the data file identified by data and sets row
+ * to point to it such that it is ready for reading. When the data file is
+ * mapped into memory, row points directly into the mapping; otherwise, the
+ * row is read into the specified row buffer, which must be at least
+ * row_buffer_size bytes long. The specified key is always copied
+ * into the row buffer so that we can read the col_id column also (see
+ * Table_extract_elements). The GIL is released while reading from the
+ * data file.
  */
 static int
-Table_retrieve_row(Table *self, DBT *key, DBT *data)
+Table_retrieve_row(Table *self, DBT *key, DBT *data, void *row_buffer,
+        void **row)
 {
     int ret = -1;
+    int io_ok, err;
     char *v;
-    char *rb = (char *) self->row_buffer;
+    char *rb = (char *) row_buffer;
     Column *id_col = self->columns[0];
     uint32_t key_size = id_col->element_size;
     uint64_t offset = 0;
@@ -2416,59 +3149,387 @@ Table_retrieve_row(Table *self, DBT *key, DBT *data)
         PyErr_Format(PyExc_SystemError, "offset/len record size mismatch");
         goto out;
     }
-    memcpy(self->row_buffer, key->data, key->size);
+    memcpy(rb, key->data, key->size);
     v = (char *) data->data;
     offset = unpack_uint(v, sizeof(offset));
     v += sizeof(offset);
     len = unpack_uint(v, sizeof(len));
-    /* Now read this record from the file and put it in the row buffer */
-    if (fseeko(self->data_file, (off_t) offset, SEEK_SET) != 0) {
-        handle_io_error();
+    if (self->data_map != NULL) {
+        if (offset + len > self->data_map_size) {
+            PyErr_Format(PyExc_SystemError, "row outside data file");
+            goto out;
+        }
+        /* The key is not stored in the data file, so the row starts
+         * key_size bytes before the offset. These bytes are never read.
+         */
+        *row = (char *) self->data_map + offset - key_size;
+    } else {
+        /* Read this record from the file and put it in the row buffer */
+        v = rb + key_size;
+        self->num_users++;
+        Py_BEGIN_ALLOW_THREADS
+        PyThread_acquire_lock(self->io_lock, WAIT_LOCK);
+        io_ok = fseeko(self->data_file, (off_t) offset, SEEK_SET) == 0
+                && fread(v, len, 1, self->data_file) == 1;
+        err = errno;
+        PyThread_release_lock(self->io_lock);
+        Py_END_ALLOW_THREADS
+        self->num_users--;
+        if (!io_ok) {
+            errno = err;
+            handle_io_error();
+            goto out;
+        }
+        *row = rb;
+    }
+    ret = 0;
+out:
+    return ret;
+}
+
+/*
+ * Extracts the elements for the specified column from a row returned
+ * by Table_retrieve_row. The row_id column is read from the copy of the
+ * key in the row buffer, since it is not stored in the data file.
+ */
+static int
+Table_extract_elements(Table *self, Column *col, void *row_buffer, void *row)
+{
+    void *src = col->position == 0 ? row_buffer : row;
+    return Column_extract_elements(col, src);
+}
+
+/*
+ * Returns a new Column object with the same type and position within
+ * rows as the specified column, but with its own element buffer. This
+ * allows a cursor to decode rows without sharing state with other cursors
+ * on the same table.
+ */
+static Column *
+Table_copy_column(Table *self, Column *col)
+{
+    Column *ret = NULL;
+    Column *copy = NULL;
+
+    copy = (Column *) PyObject_CallFunction((PyObject *) &ColumnType,
+            "OOiii", col->name, col->description, col->element_type,
+            col->element_size, col->num_elements);
+    if (copy == NULL) {
         goto out;
     }
-    v = rb + key_size;
-    if (fread(v, len, 1, self->data_file) != 1) {
-        handle_io_error();
+    copy->position = col->position;
+    copy->fixed_region_offset = col->fixed_region_offset;
+    ret = copy;
+out:
+    return ret;
+}
+
+static void
+Table_free_columns(Column **columns, uint32_t num_columns)
+{
+    uint32_t j;
+    for (j = 0; j < num_columns; j++) {
+        Py_XDECREF(columns[j]);
+    }
+    PyMem_Free(columns);
+}
+
+/*
+ * Returns an array of copies of the columns at the specified positions
+ * in the table (see Table_copy_column). The array must be freed using
+ * Table_free_columns.
+ */
+static Column **
+Table_copy_columns(Table *self, uint32_t *columns, uint32_t num_columns)
+{
+    Column **ret = NULL;
+    Column **copies = NULL;
+    uint32_t j;
+
+    copies = PyMem_Malloc(num_columns * sizeof(Column *));
+    if (copies == NULL) {
+        PyErr_NoMemory();
+        goto out;
+    }
+    memset(copies, 0, num_columns * sizeof(Column *));
+    for (j = 0; j < num_columns; j++) {
+        copies[j] = Table_copy_column(self, self->columns[columns[j]]);
+        if (copies[j] == NULL) {
+            goto out;
+        }
+    }
+    ret = copies;
+    copies = NULL;
+out:
+    if (copies != NULL) {
+        Table_free_columns(copies, num_columns);
+    }
+    return ret;
+}
+
+/*
+ * Decodes column j of the specified columns from a row returned by
+ * Table_retrieve_row, unless decoded is not NULL and decoded[j] is
+ * non-negative. In this case the column has already been decoded, and
+ * decoded[j] is true if its value is missing. Returns WT_MISSING_VALUE
+ * if the value is missing, 0 if not and a negative value on error.
+ */
+static int
+Table_decode_column(Table *self, Column **columns, int *decoded,
+        uint32_t j, void *row_buffer, void *row)
+{
+    int ret;
+    if (decoded != NULL && decoded[j] >= 0) {
+        ret = decoded[j] ? WT_MISSING_VALUE : 0;
+    } else {
+        ret = Table_extract_elements(self, columns[j], row_buffer, row);
+    }
+    return ret;
+}
+
+/*
+ * Returns a tuple containing the values of the specified columns in a
+ * row returned by Table_retrieve_row. The columns are decoded using their
+ * own element buffers, so these should be private to the caller. See
+ * Table_decode_column for the meaning of decoded, which may be NULL.
+ */
+static PyObject *
+Table_get_row_tuple(Table *self, void *row_buffer, void *row,
+        Column **columns, int *decoded, uint32_t num_columns)
+{
+    PyObject *ret = NULL;
+    PyObject *t = NULL;
+    PyObject *value;
+    Column *col;
+    uint32_t j;
+    int wt_ret;
+
+    t = PyTuple_New(num_columns);
+    if (t == NULL) {
+        PyErr_NoMemory();
+        goto out;
+    }
+    for (j = 0; j < num_columns; j++) {
+        col = columns[j];
+        wt_ret = Table_decode_column(self, columns, decoded, j, row_buffer,
+                row);
+        if (wt_ret < 0) {
+            Py_DECREF(t);
+            goto out;
+        }
+        value = Column_get_python_elements(col, wt_ret == WT_MISSING_VALUE);
+        if (value == NULL) {
+            Py_DECREF(t);
+            goto out;
+        }
+        PyTuple_SET_ITEM(t, j, value);
+    }
+    ret = t;
+out:
+    return ret;
+}
+
+/*
+ * Gets the array buffers from the specified lists of arrays and masks for
+ * the specified columns, returning the number of rows they can hold. The
+ * masks may be None. If input is true the arrays are read from and
+ * need not be writable. The buffers must be released using
+ * Table_release_arrays.
+ */
+static Py_ssize_t
+Table_get_arrays(Table *self, uint32_t *columns, uint32_t num_columns,
+        PyObject *arrays, PyObject *masks, Py_buffer *array_bufs,
+        Py_buffer *mask_bufs, int input)
+{
+    Py_ssize_t ret = -1;
+    Py_ssize_t num_rows = 0;
+    Py_ssize_t n;
+    PyObject *v;
+    uint32_t j;
+    int flags = PyBUF_FORMAT|PyBUF_C_CONTIGUOUS;
+
+    if (!input) {
+        flags |= PyBUF_WRITABLE;
+    }
+    for (j = 0; j < num_columns; j++) {
+        array_bufs[j].obj = NULL;
+        mask_bufs[j].obj = NULL;
+    }
+    if (PyList_GET_SIZE(arrays) != num_columns
+            || PyList_GET_SIZE(masks) != num_columns) {
+        PyErr_SetString(PyExc_ValueError,
+                "An array and mask must be provided for each column");
         goto out;
     }
+    for (j = 0; j < num_columns; j++) {
+        v = PyList_GET_ITEM(arrays, j);
+        if (PyObject_GetBuffer(v, &array_bufs[j], flags) != 0) {
+            array_bufs[j].obj = NULL;
+            goto out;
+        }
+        n = Column_check_array(self->columns[columns[j]], &array_bufs[j],
+                input);
+        if (n < 0) {
+            goto out;
+        }
+        if (j > 0 && n != num_rows) {
+            PyErr_SetString(PyExc_ValueError, "Arrays must be the same length");
+            goto out;
+        }
+        num_rows = n;
+        v = PyList_GET_ITEM(masks, j);
+        if (v != Py_None) {
+            if (PyObject_GetBuffer(v, &mask_bufs[j], flags) != 0) {
+                mask_bufs[j].obj = NULL;
+                goto out;
+            }
+            if (mask_bufs[j].itemsize != 1 || mask_bufs[j].len != num_rows) {
+                PyErr_SetString(PyExc_ValueError,
+                        "Masks must be byte arrays of the same length");
+                goto out;
+            }
+        }
+    }
+    ret = num_rows;
+out:
+    return ret;
+}
+
+static void
+Table_release_arrays(Table *self, uint32_t num_columns,
+        Py_buffer *array_bufs, Py_buffer *mask_bufs)
+{
+    uint32_t j;
+    for (j = 0; j < num_columns; j++) {
+        if (array_bufs[j].obj != NULL) {
+            PyBuffer_Release(&array_bufs[j]);
+        }
+        if (mask_bufs[j].obj != NULL) {
+            PyBuffer_Release(&mask_bufs[j]);
+        }
+    }
+}
+
+/*
+ * Copies the values of the specified columns in a row returned by
+ * Table_retrieve_row into the specified position of the arrays. See
+ * Table_decode_column for the meaning of decoded, which may be NULL.
+ */
+static int
+Table_copy_row_to_arrays(Table *self, void *row_buffer, void *row,
+        Column **columns, int *decoded, uint32_t num_columns,
+        Py_buffer *array_bufs, Py_buffer *mask_bufs, Py_ssize_t index)
+{
+    int ret = -1;
+    int wt_ret;
+    uint32_t j;
+    Column *col;
+    for (j = 0; j < num_columns; j++) {
+        col = columns[j];
+        wt_ret = Table_decode_column(self, columns, decoded, j, row_buffer,
+                row);
+        if (wt_ret < 0) {
+            goto out;
+        }
+        Column_copy_array_elements(col, &array_bufs[j], index,
+                wt_ret == WT_MISSING_VALUE);
+        if (mask_bufs[j].obj != NULL) {
+            ((char *) mask_bufs[j].buf)[index] = wt_ret == WT_MISSING_VALUE;
+        }
+    }
+    ret = 0;
+out:
+    return ret;
+}
+
+/*
+ * Computes the length of the specified row in the data file from the
+ * addresses of the variable length columns in its fixed region. Rows are
+ * written back to back, with the variable region directly following the
+ * fixed region, so the row ends with the furthest variable column.
+ */
+static int
+Table_get_row_length(Table *self, void *row, uint32_t *len)
+{
+    int ret = -1;
+    char *v = (char *) row;
+    Column *col;
+    uint32_t j, offset, num_elements, end;
+    uint32_t key_size = self->columns[0]->element_size;
+    end = self->fixed_region_size;
+    for (j = 1; j < self->num_columns; j++) {
+        col = self->columns[j];
+        if (Column_is_variable(col)) {
+            if (Column_unpack_variable_elements_address(col,
+                    v + col->fixed_region_offset, &offset,
+                    &num_elements) < 0) {
+                goto out;
+            }
+            if (offset != 0 && offset + num_elements * col->element_size
+                    > end) {
+                end = offset + num_elements * col->element_size;
+            }
+        }
+    }
+    if (end > MAX_ROW_SIZE) {
+        PyErr_SetString(PyExc_SystemError, "Row overflow");
+        goto out;
+    }
+    *len = end - key_size;
     ret = 0;
 out:
     return ret;
 }
 
 static int
-Table_retrieve_row_by_id(Table *self, uint64_t row_id)
+Table_retrieve_row_by_id(Table *self, uint64_t row_id, void *row_buffer,
+        void **row)
 {
     int ret = -1;
     int db_ret;
     unsigned char key_buffer[sizeof(row_id)];
+    char record[OFFSET_LEN_RECORD_SIZE];
     Column *id_col = self->columns[0];
+    DB *db = self->db;
     DBT key, data;
 
     memset(&key, 0, sizeof(DBT));
     memset(&data, 0, sizeof(DBT));
     key.data = key_buffer;
     key.size = id_col->element_size;
+    data.data = record;
+    data.ulen = OFFSET_LEN_RECORD_SIZE;
+    data.flags = DB_DBT_USERMEM;
     if (Column_set_row_id(id_col, row_id) != 0) {
         goto out;
     }
     if (Column_update_row(id_col, key_buffer, 0) != 0) {
         goto out;
     }
-    db_ret = self->db->get(self->db, NULL, &key, &data, 0);
+    self->num_users++;
+    Py_BEGIN_ALLOW_THREADS
+    db_ret = db->get(db, NULL, &key, &data, 0);
+    Py_END_ALLOW_THREADS
+    self->num_users--;
     if (db_ret != 0) {
         handle_bdb_error(db_ret);
         goto out;
     }
-    ret = Table_retrieve_row(self, &key, &data);
+    ret = Table_retrieve_row(self, &key, &data, row_buffer, row);
 out:
     return ret;
 }
 
-static PyObject *
-Table_commit_row(Table* self)
+static int Table_sort_index_keys(Table *self);
+
+/*
+ * Writes the row in the row buffer to the data file, stores its location
+ * in the database and resets the row buffer for the next row.
+ */
+static int
+Table_write_row(Table *self)
 {
-    PyObject *ret = NULL;
+    int ret = -1;
     size_t io_ret;
     int db_ret;
     char *v;
@@ -2480,9 +3541,6 @@ Table_commit_row(Table* self)
     DBT key, data;
     Column *id_col = self->columns[0];
     uint32_t key_size = id_col->element_size;
-    if (Table_check_write_mode(self) != 0) {
-        goto out;
-    }
     if (Column_set_row_id(id_col, (uint64_t) self->num_rows) != 0) {
         goto out;
     }
@@ -2490,6 +3548,11 @@ Table_commit_row(Table* self)
             != 0) {
         goto out;
     }
+    if (self->sort_indexes != NULL) {
+        if (Table_sort_index_keys(self) != 0) {
+            goto out;
+        }
+    }
     /* write the data row */
     offset = (uint64_t) ftello(self->data_file);
     len = self->current_row_size - key_size;
@@ -2520,48 +3583,267 @@ Table_commit_row(Table* self)
     self->current_row_size = self->fixed_region_size;
     self->num_rows++;
     Table_update_row_stats(self, len);
+    ret = 0;
+out:
+    return ret;
+}
+
+static PyObject *
+Table_commit_row(Table* self)
+{
+    PyObject *ret = NULL;
+    if (Table_check_write_mode(self) != 0) {
+        goto out;
+    }
+    if (Table_write_row(self) != 0) {
+        goto out;
+    }
     Py_INCREF(Py_None);
     ret = Py_None;
 out:
     return ret;
 }
 
+static PyTypeObject TableType;
+
+/*
+ * Appends all of the rows in the specified table, which must have the same
+ * columns and be open for reading, to this table. The rows are copied
+ * without decoding them, and are given new row ids following those
+ * already in this table.
+ */
 static PyObject *
-Table_get_num_rows(Table* self)
+Table_append_table(Table* self, PyObject *args)
 {
-    int db_ret;
-    int wt_ret;
-    Column *id_col = self->columns[0];
-    uint64_t max_key = 0;
     PyObject *ret = NULL;
+    Table *source = NULL;
     DBC *cursor = NULL;
     DBT key, data;
-    if (Table_check_read_mode(self) != 0) {
+    Column *c1, *c2;
+    void *row;
+    char *rb;
+    uint32_t j, key_size;
+    uint16_t len;
+    int db_ret;
+
+    if (!PyArg_ParseTuple(args, "O!", &TableType, &source)) {
         goto out;
     }
-    db_ret = self->db->cursor(self->db, NULL, &cursor, 0);
+    if (Table_check_write_mode(self) != 0) {
+        goto out;
+    }
+    if (Table_check_read_mode(source) != 0) {
+        goto out;
+    }
+    if (source->num_columns != self->num_columns) {
+        PyErr_SetString(PyExc_ValueError, "Tables must have the same columns");
+        goto out;
+    }
+    for (j = 0; j < self->num_columns; j++) {
+        c1 = self->columns[j];
+        c2 = source->columns[j];
+        if (c1->element_type != c2->element_type
+                || c1->element_size != c2->element_size
+                || c1->num_elements != c2->num_elements) {
+            PyErr_SetString(PyExc_ValueError,
+                    "Tables must have the same columns");
+            goto out;
+        }
+    }
+    key_size = self->columns[0]->element_size;
+    rb = (char *) self->row_buffer;
+    db_ret = source->db->cursor(source->db, NULL, &cursor, 0);
     if (db_ret != 0) {
         handle_bdb_error(db_ret);
+        cursor = NULL;
         goto out;
     }
-    /* retrieve the last key from the DB */
     memset(&key, 0, sizeof(DBT));
     memset(&data, 0, sizeof(DBT));
-    db_ret = cursor->get(cursor, &key, &data, DB_LAST);
-    if (db_ret == 0) {
-        if (key.size != id_col->element_size) {
-            PyErr_Format(PyExc_SystemError, "key size mismatch");
+    source->num_users++;
+    Py_BEGIN_ALLOW_THREADS
+    db_ret = cursor->get(cursor, &key, &data, DB_NEXT);
+    Py_END_ALLOW_THREADS
+    source->num_users--;
+    while (db_ret == 0) {
+        /* The row is read into our row buffer unless it is mapped */
+        if (Table_retrieve_row(source, &key, &data, rb, &row) != 0) {
             goto out;
         }
-        wt_ret = Column_extract_elements(id_col, key.data);
-        if (wt_ret > 0) {
-            PyErr_Format(PyExc_SystemError, "Missing value in id column.");
+        len = unpack_uint((char *) data.data + sizeof(uint64_t),
+                sizeof(len));
+        if (key_size + len > self->row_buffer_size) {
+            PyErr_SetString(PyExc_SystemError, "Row overflow");
             goto out;
         }
-        if (wt_ret < 0) {
-            goto out;
+        if (row != rb) {
+            memcpy(rb + key_size, (char *) row + key_size, len);
         }
-        if (Column_get_row_id(id_col, &max_key) != 0) {
+        self->current_row_size = key_size + len;
+        if (Table_write_row(self) != 0) {
+            goto out;
+        }
+        source->num_users++;
+        Py_BEGIN_ALLOW_THREADS
+        db_ret = cursor->get(cursor, &key, &data, DB_NEXT);
+        Py_END_ALLOW_THREADS
+        source->num_users--;
+    }
+    if (db_ret != DB_NOTFOUND) {
+        handle_bdb_error(db_ret);
+        goto out;
+    }
+    Py_INCREF(Py_None);
+    ret = Py_None;
+out:
+    if (cursor != NULL) {
+        cursor->close(cursor);
+    }
+    return ret;
+}
+
+static PyObject *
+Table_insert_arrays(Table* self, PyObject *args)
+{
+    PyObject *ret = NULL;
+    PyObject *columns = NULL;
+    PyObject *arrays = NULL;
+    PyObject *masks = NULL;
+    Py_buffer *array_bufs = NULL;
+    Py_buffer *mask_bufs = NULL;
+    uint32_t *col_indexes = NULL;
+    uint32_t num_columns = 0;
+    uint32_t j;
+    Py_ssize_t num_rows, k;
+    int m, col_index;
+    int started = 0;
+    Column *col;
+
+    if (!PyArg_ParseTuple(args, "O!O!O!", &PyList_Type, &columns,
+            &PyList_Type, &arrays, &PyList_Type, &masks)) {
+        goto out;
+    }
+    if (Table_check_write_mode(self) != 0) {
+        goto out;
+    }
+    num_columns = PyList_GET_SIZE(columns);
+    col_indexes = PyMem_Malloc((num_columns + 1) * sizeof(uint32_t));
+    array_bufs = PyMem_Malloc((num_columns + 1) * sizeof(Py_buffer));
+    mask_bufs = PyMem_Malloc((num_columns + 1) * sizeof(Py_buffer));
+    if (col_indexes == NULL || array_bufs == NULL || mask_bufs == NULL) {
+        PyErr_NoMemory();
+        goto out;
+    }
+    for (j = 0; j < num_columns; j++) {
+        array_bufs[j].obj = NULL;
+        mask_bufs[j].obj = NULL;
+    }
+    for (j = 0; j < num_columns; j++) {
+        col_index = (int) PyLong_AsLong(PyList_GET_ITEM(columns, j));
+        if (col_index == -1 && PyErr_Occurred()) {
+            goto out;
+        }
+        if (Table_check_column_index(self, col_index) != 0) {
+            goto out;
+        }
+        if (col_index == 0) {
+            PyErr_Format(WormtableError, "Cannot update ID column.");
+            goto out;
+        }
+        col_indexes[j] = (uint32_t) col_index;
+    }
+    num_rows = Table_get_arrays(self, col_indexes, num_columns, arrays,
+            masks, array_bufs, mask_bufs, 1);
+    if (num_rows < 0) {
+        goto out;
+    }
+    /* Check all values first so that we don't append a partial block */
+    for (j = 0; j < num_columns; j++) {
+        col = self->columns[col_indexes[j]];
+        for (k = 0; k < num_rows; k++) {
+            if (mask_bufs[j].obj != NULL && ((char *) mask_bufs[j].buf)[k]) {
+                continue;
+            }
+            if (Column_array_to_native(col, &array_bufs[j], k) != 0
+                    || col->verify_elements(col) != 0) {
+                goto out;
+            }
+        }
+    }
+    /* From here on the row buffer holds values from this call */
+    started = 1;
+    for (k = 0; k < num_rows; k++) {
+        for (j = 0; j < num_columns; j++) {
+            if (mask_bufs[j].obj != NULL && ((char *) mask_bufs[j].buf)[k]) {
+                continue;
+            }
+            col = self->columns[col_indexes[j]];
+            if (Column_array_to_native(col, &array_bufs[j], k) != 0) {
+                goto out;
+            }
+            m = Column_update_row(col, self->row_buffer,
+                    self->current_row_size);
+            if (m < 0) {
+                goto out;
+            }
+            self->current_row_size += m;
+        }
+        if (Table_write_row(self) != 0) {
+            goto out;
+        }
+    }
+    ret = PyLong_FromSsize_t(num_rows);
+out:
+    if (ret == NULL && started) {
+        /* Discard any partially inserted row */
+        memset(self->row_buffer, 0, self->current_row_size);
+        self->current_row_size = self->fixed_region_size;
+    }
+    if (array_bufs != NULL && mask_bufs != NULL) {
+        Table_release_arrays(self, num_columns, array_bufs, mask_bufs);
+    }
+    PyMem_Free(col_indexes);
+    PyMem_Free(array_bufs);
+    PyMem_Free(mask_bufs);
+    return ret;
+}
+
+static PyObject *
+Table_get_num_rows(Table* self)
+{
+    int db_ret;
+    int wt_ret;
+    Column *id_col = self->columns[0];
+    uint64_t max_key = 0;
+    PyObject *ret = NULL;
+    DBC *cursor = NULL;
+    DBT key, data;
+    if (Table_check_read_mode(self) != 0) {
+        goto out;
+    }
+    db_ret = self->db->cursor(self->db, NULL, &cursor, 0);
+    if (db_ret != 0) {
+        handle_bdb_error(db_ret);
+        goto out;
+    }
+    /* retrieve the last key from the DB */
+    memset(&key, 0, sizeof(DBT));
+    memset(&data, 0, sizeof(DBT));
+    db_ret = cursor->get(cursor, &key, &data, DB_LAST);
+    if (db_ret == 0) {
+        if (key.size != id_col->element_size) {
+            PyErr_Format(PyExc_SystemError, "key size mismatch");
+            goto out;
+        }
+        wt_ret = Column_extract_elements(id_col, key.data);
+        if (wt_ret > 0) {
+            PyErr_Format(PyExc_SystemError, "Missing value in id column.");
+            goto out;
+        }
+        if (wt_ret < 0) {
+            goto out;
+        }
+        if (Column_get_row_id(id_col, &max_key) != 0) {
             goto out;
         }
         max_key++;
@@ -2594,13 +3876,21 @@ Table_get_row(Table* self, PyObject *args)
     int wt_ret;
     unsigned long long row_id = 0;
     uint32_t j;
+    void *row = NULL;
+    void *row_buffer = NULL;
     if (!PyArg_ParseTuple(args, "K", &row_id)) {
         goto out;
     }
     if (Table_check_read_mode(self) != 0) {
         goto out;
     }
-    if (Table_retrieve_row_by_id(self, (uint64_t) row_id) != 0) {
+    row_buffer = PyMem_Malloc(self->row_buffer_size);
+    if (row_buffer == NULL) {
+        PyErr_NoMemory();
+        goto out;
+    }
+    if (Table_retrieve_row_by_id(self, (uint64_t) row_id, row_buffer, &row)
+            != 0) {
         goto out;
     }
     t = PyTuple_New(self->num_columns);
@@ -2610,7 +3900,7 @@ Table_get_row(Table* self, PyObject *args)
     }
     for (j = 0; j < self->num_columns; j++) {
         col = self->columns[j];
-        wt_ret = Column_extract_elements(col, self->row_buffer);
+        wt_ret = Table_extract_elements(self, col, row_buffer, row);
         if (wt_ret < 0) {
             Py_DECREF(t);
             goto out;
@@ -2624,21 +3914,301 @@ Table_get_row(Table* self, PyObject *args)
     }
     ret = t;
 out:
+    PyMem_Free(row_buffer);
     return ret;
 }
 
+static int
+row_lookup_compare(const void *a, const void *b)
+{
+    const RowLookup *ra = (const RowLookup *) a;
+    const RowLookup *rb = (const RowLookup *) b;
+    return (ra->row_id > rb->row_id) - (ra->row_id < rb->row_id);
+}
+
+/*
+ * Finds the location in the data file of each of the specified rows,
+ * which are sorted by row_id, using a single cursor on the primary DB.
+ * Consecutive row ids are found by stepping the cursor forward. This
+ * does not use the Python API, and so can be called without the GIL.
+ * Returns 0 or a Berkeley DB error code.
+ */
+static int
+Table_locate_rows(Table *self, RowLookup *lookups, Py_ssize_t num_rows)
+{
+    int db_ret = 0;
+    Py_ssize_t k;
+    DBC *cursor = NULL;
+    DBT key, data;
+    uint32_t key_size = self->columns[0]->element_size;
+    unsigned char key_buffer[sizeof(uint64_t)];
+    unsigned char found_key[sizeof(uint64_t)];
+    char record[OFFSET_LEN_RECORD_SIZE];
+    char *v;
+    int stepped;
+
+    db_ret = self->db->cursor(self->db, NULL, &cursor, 0);
+    if (db_ret != 0) {
+        goto out;
+    }
+    for (k = 0; k < num_rows; k++) {
+        if (k > 0 && lookups[k].row_id == lookups[k - 1].row_id) {
+            lookups[k].offset = lookups[k - 1].offset;
+            lookups[k].len = lookups[k - 1].len;
+            continue;
+        }
+        pack_uint(lookups[k].row_id, key_buffer, key_size);
+        memset(&key, 0, sizeof(DBT));
+        memset(&data, 0, sizeof(DBT));
+        data.data = record;
+        data.ulen = OFFSET_LEN_RECORD_SIZE;
+        data.flags = DB_DBT_USERMEM;
+        stepped = 0;
+        if (k > 0 && lookups[k].row_id == lookups[k - 1].row_id + 1) {
+            key.data = found_key;
+            key.ulen = sizeof(found_key);
+            key.flags = DB_DBT_USERMEM;
+            db_ret = cursor->get(cursor, &key, &data, DB_NEXT);
+            stepped = db_ret == 0 && key.size == key_size
+                && memcmp(found_key, key_buffer, key_size) == 0;
+        }
+        if (!stepped) {
+            memset(&key, 0, sizeof(DBT));
+            key.data = key_buffer;
+            key.size = key_size;
+            db_ret = cursor->get(cursor, &key, &data, DB_SET);
+            if (db_ret != 0) {
+                goto out;
+            }
+        }
+        if (data.size != OFFSET_LEN_RECORD_SIZE) {
+            db_ret = EINVAL;
+            goto out;
+        }
+        v = record;
+        lookups[k].offset = unpack_uint(v, sizeof(uint64_t));
+        v += sizeof(uint64_t);
+        lookups[k].len = (uint32_t) unpack_uint(v, sizeof(uint16_t));
+    }
+out:
+    if (cursor != NULL) {
+        cursor->close(cursor);
+    }
+    return db_ret;
+}
+
+/*
+ * Reads the rows from the data file for the specified run of lookups into
+ * the specified buffer, which must have room for key_size bytes followed
+ * by the rows. Returns 0 on success and -1 on error.
+ */
+static int
+Table_read_row_run(Table *self, RowLookup *lookups, Py_ssize_t num_rows,
+        char *buffer)
+{
+    int ret = -1;
+    int io_ok, err;
+    uint32_t key_size = self->columns[0]->element_size;
+    uint64_t start = lookups[0].offset;
+    uint64_t size = lookups[num_rows - 1].offset
+            + lookups[num_rows - 1].len - start;
+
+    self->num_users++;
+    Py_BEGIN_ALLOW_THREADS
+    PyThread_acquire_lock(self->io_lock, WAIT_LOCK);
+    io_ok = fseeko(self->data_file, (off_t) start, SEEK_SET) == 0
+            && fread(buffer + key_size, size, 1, self->data_file) == 1;
+    err = errno;
+    PyThread_release_lock(self->io_lock);
+    Py_END_ALLOW_THREADS
+    self->num_users--;
+    if (!io_ok) {
+        errno = err;
+        handle_io_error();
+        goto out;
+    }
+    ret = 0;
+out:
+    return ret;
+}
 
+/*
+ * Returns a list of tuples containing the values of the specified columns
+ * for each of the specified row ids, in the order given. The row ids are
+ * sorted and located using a single cursor, and when the data file is not
+ * mapped into memory, rows that are adjacent in the data file are read
+ * in runs using a single read.
+ */
+static PyObject *
+Table_get_rows(Table* self, PyObject *args)
+{
+    PyObject *ret = NULL;
+    PyObject *row_ids = NULL;
+    PyObject *columns = NULL;
+    PyObject *rows = NULL;
+    PyObject *t = NULL;
+    PyObject *v;
+    RowLookup *lookups = NULL;
+    Column **read_columns = NULL;
+    uint32_t *positions = NULL;
+    uint32_t num_columns = 0;
+    uint32_t j;
+    uint32_t key_size;
+    Py_ssize_t num_rows, k, l, run_end;
+    unsigned long long row_id;
+    long position;
+    void *row_buffer = NULL;
+    char *run_buffer = NULL;
+    char *row;
+    int db_ret;
 
+    if (!PyArg_ParseTuple(args, "O!O!", &PyList_Type, &row_ids,
+            &PyList_Type, &columns)) {
+        goto out;
+    }
+    if (Table_check_read_mode(self) != 0) {
+        goto out;
+    }
+    key_size = self->columns[0]->element_size;
+    num_columns = (uint32_t) PyList_GET_SIZE(columns);
+    num_rows = PyList_GET_SIZE(row_ids);
+    positions = PyMem_Malloc((num_columns + 1) * sizeof(uint32_t));
+    lookups = PyMem_Malloc((num_rows + 1) * sizeof(RowLookup));
+    row_buffer = PyMem_Malloc(self->row_buffer_size);
+    if (positions == NULL || lookups == NULL || row_buffer == NULL) {
+        PyErr_NoMemory();
+        goto out;
+    }
+    for (j = 0; j < num_columns; j++) {
+        position = PyLong_AsLong(PyList_GET_ITEM(columns, j));
+        if (position == -1 && PyErr_Occurred()) {
+            goto out;
+        }
+        if (position < 0 || position >= self->num_columns) {
+            PyErr_SetString(PyExc_ValueError, "Column positions out of bounds");
+            goto out;
+        }
+        positions[j] = (uint32_t) position;
+    }
+    for (k = 0; k < num_rows; k++) {
+        row_id = PyLong_AsUnsignedLongLong(PyList_GET_ITEM(row_ids, k));
+        if (row_id == (unsigned long long) -1 && PyErr_Occurred()) {
+            goto out;
+        }
+        if (row_id >= self->num_rows) {
+            PyErr_SetString(PyExc_IndexError, "row id out of range");
+            goto out;
+        }
+        lookups[k].row_id = (uint64_t) row_id;
+        lookups[k].position = k;
+    }
+    read_columns = Table_copy_columns(self, positions, num_columns);
+    if (read_columns == NULL) {
+        goto out;
+    }
+    rows = PyList_New(num_rows);
+    if (rows == NULL) {
+        goto out;
+    }
+    qsort(lookups, num_rows, sizeof(RowLookup), row_lookup_compare);
+    self->num_users++;
+    Py_BEGIN_ALLOW_THREADS
+    db_ret = Table_locate_rows(self, lookups, num_rows);
+    Py_END_ALLOW_THREADS
+    self->num_users--;
+    if (db_ret != 0) {
+        handle_bdb_error(db_ret);
+        goto out;
+    }
+    if (self->data_map == NULL) {
+        run_buffer = PyMem_Malloc(key_size
+                + WT_MAX(WT_READ_RUN_SIZE, MAX_ROW_SIZE));
+        if (run_buffer == NULL) {
+            PyErr_NoMemory();
+            goto out;
+        }
+    }
+    k = 0;
+    while (k < num_rows) {
+        /* Find the run of rows starting at k that are adjacent in the
+         * data file. When the data file is mapped, each row is a run. */
+        run_end = k + 1;
+        if (run_buffer != NULL) {
+            while (run_end < num_rows
+                    && (lookups[run_end].offset == lookups[run_end - 1].offset
+                        || lookups[run_end].offset
+                            == lookups[run_end - 1].offset
+                            + lookups[run_end - 1].len)
+                    && lookups[run_end].offset + lookups[run_end].len
+                        - lookups[k].offset <= WT_READ_RUN_SIZE) {
+                run_end++;
+            }
+            if (Table_read_row_run(self, lookups + k, run_end - k,
+                        run_buffer) != 0) {
+                goto out;
+            }
+        }
+        for (l = k; l < run_end; l++) {
+            if (l > 0 && lookups[l].row_id == lookups[l - 1].row_id) {
+                /* A repeated row id; use the same tuple again */
+                v = PyList_GET_ITEM(rows, lookups[l - 1].position);
+                Py_INCREF(v);
+                PyList_SET_ITEM(rows, lookups[l].position, v);
+                continue;
+            }
+            /* See Table_retrieve_row; the key bytes before the row's offset
+             * are not read, and the key is held in the row buffer. */
+            if (run_buffer != NULL) {
+                row = run_buffer + (lookups[l].offset - lookups[k].offset);
+            } else {
+                if (lookups[l].offset + lookups[l].len
+                        > self->data_map_size) {
+                    PyErr_Format(PyExc_SystemError, "row outside data file");
+                    goto out;
+                }
+                row = (char *) self->data_map + lookups[l].offset - key_size;
+            }
+            pack_uint(lookups[l].row_id, row_buffer, key_size);
+            t = Table_get_row_tuple(self, row_buffer, row, read_columns,
+                    NULL, num_columns);
+            if (t == NULL) {
+                goto out;
+            }
+            PyList_SET_ITEM(rows, lookups[l].position, t);
+        }
+        k = run_end;
+    }
+    ret = rows;
+    rows = NULL;
+out:
+    Py_XDECREF(rows);
+    if (read_columns != NULL) {
+        Table_free_columns(read_columns, num_columns);
+    }
+    PyMem_Free(positions);
+    PyMem_Free(lookups);
+    PyMem_Free(row_buffer);
+    PyMem_Free(run_buffer);
+    return ret;
+}
 
 static PyMethodDef Table_methods[] = {
     {"get_num_rows", (PyCFunction) Table_get_num_rows, METH_NOARGS,
             "Returns the number of rows in the table" },
     {"get_row", (PyCFunction) Table_get_row, METH_VARARGS,
             "Return the jth row as a tuple" },
+    {"get_rows", (PyCFunction) Table_get_rows, METH_VARARGS,
+            "Return the specified columns of the specified rows as tuples" },
     {"open", (PyCFunction) Table_open, METH_VARARGS, "Open the table" },
     {"close", (PyCFunction) Table_close, METH_NOARGS, "Close the table" },
+    {"check_idle", (PyCFunction) Table_check_idle_method, METH_NOARGS,
+            "Raise an error if the table is in use by another thread" },
+    {"insert_arrays", (PyCFunction) Table_insert_arrays, METH_VARARGS,
+            "Insert rows from lists of column positions, arrays and masks." },
     {"commit_row", (PyCFunction) Table_commit_row, METH_NOARGS,
             "Commit a row to the table in write mode." },
+    {"append_table", (PyCFunction) Table_append_table, METH_VARARGS,
+            "Append all rows of another table with the same columns." },
     {"insert_elements", (PyCFunction) Table_insert_elements, METH_VARARGS,
             "insert element values encoded as native Python objects." },
     {"insert_encoded_elements", (PyCFunction) Table_insert_encoded_elements,
@@ -2694,15 +4264,24 @@ static PyTypeObject TableType = {
  *==========================================================
  */
 
+static void IndexSorter_free(IndexSorter *self);
+
 static void
 Index_dealloc(Index* self)
 {
-    Py_XDECREF(self->table);
+    if (self->sorter != NULL) {
+        IndexSorter_free(self->sorter);
+        PyMem_Free(self->sorter);
+    }
     Py_XDECREF(self->db_filename);
     /* make sure that the DB handles are closed. We can ignore errors here. */
     if (self->db != NULL) {
         self->db->close(self->db, 0);
+        if (self->shared_env) {
+            Table_release_env(self->table);
+        }
     }
+    Py_XDECREF(self->table);
     if (self->columns != NULL) {
         PyMem_Free(self->columns);
     }
@@ -2721,7 +4300,9 @@ Index_init(Index *self, PyObject *args, PyObject *kwds)
     int j;
     long k;
     int ret = -1;
-    static char *kwlist[] = {"table", "db_filename", "columns", "cache_size", NULL};
+    int table_mode = WT_READ;
+    static char *kwlist[] = {"table", "db_filename", "columns", "cache_size",
+        "table_mode", NULL};
     PyObject *v;
     Column *col;
     PyObject *db_filename = NULL;
@@ -2735,18 +4316,34 @@ Index_init(Index *self, PyObject *args, PyObject *kwds)
     self->bin_widths = NULL;
     self->key_buffer = NULL;
     self->columns = NULL;
-    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O!O!O!K", kwlist,
+    self->sorter = NULL;
+    self->shared_env = 0;
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O!O!O!K|i", kwlist,
             &TableType, &table,
             &PyBytes_Type, &db_filename,
             &PyList_Type,  &columns,
-            &self->cache_size)) {
+            &self->cache_size, &table_mode)) {
         goto out;
     }
     self->table = table;
     Py_INCREF(self->table);
     self->db_filename = db_filename;
     Py_INCREF(self->db_filename);
-    if (Table_check_read_mode(self->table) != 0) {
+    /*
+     * Indexes are normally created on tables open for reading. An index
+     * may also be created on a table open for writing, but can then only
+     * be used to sort its keys as rows are written.
+     */
+    if (table_mode == WT_WRITE) {
+        if (Table_check_write_mode(self->table) != 0) {
+            goto out;
+        }
+    } else if (table_mode == WT_READ) {
+        if (Table_check_read_mode(self->table) != 0) {
+            goto out;
+        }
+    } else {
+        PyErr_Format(PyExc_ValueError, "mode must be WT_READ or WT_WRITE.");
         goto out;
     }
     self->num_columns = PyList_GET_SIZE(columns);
@@ -2840,6 +4437,23 @@ out:
 }
 
 
+/*
+ * Returns 0 if no other thread is using the index with the GIL released.
+ * Otherwise -1 is returned with the appropriate Python exception set.
+ */
+static int
+Index_check_idle(Index *self)
+{
+    int ret = -1;
+    if (self->num_users > 0) {
+        PyErr_Format(WormtableError, "Index in use by another thread.");
+        goto out;
+    }
+    ret = 0;
+out:
+    return ret;
+}
+
 /*
  * Returns 0 if the table is opened in read mode. Otherwise
  * -1 is returned with the appropriate Python exception set.
@@ -2875,7 +4489,7 @@ out:
  * secondary key. This has valid memory associated with it.
  */
 static int
-Index_fill_key(Index *self, void *row, DBT *skey)
+Index_fill_key(Index *self, void *row_buffer, void *row, DBT *skey)
 {
     int ret = -1;
     int wt_ret;
@@ -2887,7 +4501,7 @@ Index_fill_key(Index *self, void *row, DBT *skey)
     for (j = 0; j < self->num_columns; j++) {
         col = self->table->columns[self->columns[j]];
         len = 0;
-        wt_ret = Column_extract_elements(col, row);
+        wt_ret = Table_extract_elements(self->table, col, row_buffer, row);
         if (wt_ret < 0) {
             ret = wt_ret;
             goto out;
@@ -3074,23 +4688,107 @@ out:
     return ret;
 }
 
-static PyObject *
-Index_get_num_rows(Index *self, PyObject *args)
+/*
+ * Returns true if the values of all of the specified table columns can be
+ * recovered from the keys of this index. This is the case for the row_id
+ * column, which is the primary key, and for key columns that are not
+ * binned.
+ */
+static int
+Index_covers_columns(Index *self, uint32_t *columns, uint32_t num_columns)
 {
-    PyObject *ret = NULL;
-    int db_ret, key_size;
-    db_recno_t count = 0;
-    DB *db = NULL;
-    DBC *cursor = NULL;
-    DBT key, data;
-    key_size = Index_set_key(self, args, self->key_buffer);
-    if (key_size < 0) {
-        goto out;
+    int covered = 1;
+    uint32_t j, k;
+    for (j = 0; j < num_columns && covered; j++) {
+        covered = columns[j] == 0;
+        for (k = 0; k < self->num_columns && !covered; k++) {
+            covered = columns[j] == self->columns[k]
+                    && self->bin_widths[k] == 0.0;
+        }
     }
-    if (Index_check_read_mode(self) != 0) {
+    return covered;
+}
+
+/*
+ * Reconstructs a row in the specified row buffer from the specified
+ * secondary and primary keys, so that it can be read in the same way as
+ * a row returned by Table_retrieve_row. Only the row_id and key columns
+ * are set; all other columns are missing. The key columns are decoded
+ * using the specified copies of the index key columns.
+ */
+static int
+Index_key_to_row(Index *self, Column **key_columns, DBT *skey, DBT *pkey,
+        void *row_buffer)
+{
+    int ret = -1;
+    Table *table = self->table;
+    char *rb = (char *) row_buffer;
+    char *kb = (char *) skey->data;
+    uint32_t j, offset, row_size;
+    Column *col;
+    int m, missing_value, wt_ret;
+
+    if (pkey->size != table->columns[0]->element_size) {
+        PyErr_Format(PyExc_SystemError, "table key record size mismatch");
         goto out;
     }
-    memset(&key, 0, sizeof(DBT));
+    memset(rb, 0, table->fixed_region_size);
+    memcpy(rb, pkey->data, pkey->size);
+    row_size = table->fixed_region_size;
+    offset = 0;
+    for (j = 0; j < self->num_columns; j++) {
+        col = key_columns[j];
+        missing_value = 0;
+        if (Column_is_variable(col)) {
+            if (offset >= skey->size) {
+                PyErr_SetString(PyExc_SystemError, "Key buffer overflow");
+                goto out;
+            }
+            missing_value = kb[offset] == 0;
+            offset++;
+        }
+        wt_ret = Column_extract_key(col, kb, offset, skey->size);
+        if (wt_ret < 0) {
+            goto out;
+        }
+        offset += col->num_buffered_elements * col->element_size;
+        if (Column_is_variable(col)) {
+            /* skip the sentinel */
+            offset += col->element_size;
+        } else {
+            missing_value = wt_ret == WT_MISSING_VALUE;
+        }
+        /* missing values are stored as zeros in rows */
+        if (!missing_value) {
+            m = Column_update_row(col, rb, row_size);
+            if (m < 0) {
+                goto out;
+            }
+            row_size += m;
+        }
+    }
+    ret = 0;
+out:
+    return ret;
+}
+
+static PyObject *
+Index_get_num_rows(Index *self, PyObject *args)
+{
+    PyObject *ret = NULL;
+    int db_ret, key_size;
+    db_recno_t count = 0;
+    DB *db = NULL;
+    DBC *cursor = NULL;
+    DBT key, data;
+    key_size = Index_set_key(self, args, self->key_buffer);
+    if (key_size < 0) {
+        goto out;
+    }
+    if (Index_check_read_mode(self) != 0) {
+        goto out;
+    }
+    memset(&key, 0, sizeof(DBT));
     memset(&data, 0, sizeof(DBT));
     db = self->db;
     if (db == NULL) {
@@ -3264,13 +4962,19 @@ Index_set_bin_widths(Index* self, PyObject *args)
     if (!PyArg_ParseTuple(args, "O!", &PyList_Type, &bin_widths)) {
         goto out;
     }
-    if (Table_check_read_mode(self->table) != 0) {
+    if (self->table->db == NULL) {
+        PyErr_Format(WormtableError, "Table closed.");
         goto out;
     }
     if (self->db != NULL) {
         PyErr_Format(WormtableError, "Cannot set bin_widths after open()");
         goto out;
     }
+    if (self->sorter != NULL) {
+        PyErr_Format(WormtableError,
+                "Cannot set bin_widths after start_key_sort()");
+        goto out;
+    }
     if (PyList_GET_SIZE(bin_widths) != self->num_columns) {
         PyErr_Format(PyExc_ValueError,
                 "Number of bins must equal to the number of columns");
@@ -3318,227 +5022,1305 @@ out:
     return ret;
 }
 
-static PyObject *
-Index_build(Index* self, PyObject *args)
-{
-    int db_ret;
-    PyObject *ret = NULL;
-    PyObject *arglist, *result;
-    PyObject *progress_callback = NULL;
-    Column *id_col;
-    uint32_t primary_key_size;
-    DBC *cursor = NULL;
-    DB *pdb = NULL;
-    DB *sdb = NULL;
-    DBT pkey, pdata, skey, sdata;
-    uint32_t truncate_count;
-    uint64_t callback_interval = 1000;
-    uint64_t records_processed = 0;
+/*
+ * Index sorting. Records are stored as the key size and data size as
+ * native uint32_t values followed by the key and data. Records are ordered
+ * in the same way as Berkeley DB's default comparison functions for keys and
+ * sorted duplicates, so that they are inserted into the index in order.
+ */
 
-    if (!PyArg_ParseTuple(args, "|OK", &progress_callback,
-            &callback_interval)) {
-        progress_callback = NULL;
-        goto out;
+#define SORT_RECORD_HEADER_SIZE (2 * sizeof(uint32_t))
+/*
+ * The maximum number of runs merged at once. Run files are only open
+ * while they are being merged, and if there are more runs than this they
+ * are merged in several passes, so that the number of open files is
+ * bounded however small the sort buffer is.
+ */
+#define SORT_MAX_MERGE_RUNS 64
+
+static int
+sort_record_compare(const char *a, const char *b)
+{
+    int ret;
+    uint32_t a_key_size, b_key_size, a_data_size, b_data_size;
+    memcpy(&a_key_size, a, sizeof(uint32_t));
+    memcpy(&b_key_size, b, sizeof(uint32_t));
+    memcpy(&a_data_size, a + sizeof(uint32_t), sizeof(uint32_t));
+    memcpy(&b_data_size, b + sizeof(uint32_t), sizeof(uint32_t));
+    a += SORT_RECORD_HEADER_SIZE;
+    b += SORT_RECORD_HEADER_SIZE;
+    ret = memcmp(a, b, WT_MIN(a_key_size, b_key_size));
+    if (ret == 0) {
+        ret = (a_key_size > b_key_size) - (a_key_size < b_key_size);
+    }
+    if (ret == 0) {
+        ret = memcmp(a + a_key_size, b + b_key_size,
+                WT_MIN(a_data_size, b_data_size));
+    }
+    if (ret == 0) {
+        ret = (a_data_size > b_data_size) - (a_data_size < b_data_size);
     }
-    Py_XINCREF(progress_callback);
-    if (Index_check_write_mode(self) != 0) {
+    return ret;
+}
+
+static int
+sort_record_pointer_compare(const void *a, const void *b)
+{
+    return sort_record_compare(*((char **) a), *((char **) b));
+}
+
+static size_t
+sort_record_size(const char *record)
+{
+    uint32_t key_size, data_size;
+    memcpy(&key_size, record, sizeof(uint32_t));
+    memcpy(&data_size, record + sizeof(uint32_t), sizeof(uint32_t));
+    return SORT_RECORD_HEADER_SIZE + key_size + data_size;
+}
+
+/*
+ * Frees the memory used by the specified sorter and removes the run files.
+ */
+static void
+IndexSorter_free(IndexSorter *self)
+{
+    int j;
+    for (j = 0; j < self->num_runs; j++) {
+        if (self->runs[j] != NULL) {
+            fclose(self->runs[j]);
+        }
+        remove(PyBytes_AsString(PyList_GET_ITEM(self->run_filenames, j)));
+    }
+    for (j = 0; j < self->num_run_records; j++) {
+        PyMem_Free(self->run_records[j]);
+    }
+    Py_XDECREF(self->run_filenames);
+    PyMem_Free(self->run_prefix);
+    PyMem_Free(self->buffer);
+    PyMem_Free(self->records);
+    PyMem_Free(self->runs);
+    PyMem_Free(self->run_records);
+    PyMem_Free(self->heap);
+    memset(self, 0, sizeof(IndexSorter));
+}
+
+/*
+ * Initialises the specified sorter to use a buffer of the specified size
+ * for records of up to max_record_size bytes. Run files are stored in
+ * files beginning with the specified prefix. The buffer is always large
+ * enough to hold several records.
+ */
+static int
+IndexSorter_init(IndexSorter *self, size_t buffer_size,
+        size_t max_record_size, const char *run_prefix)
+{
+    int ret = -1;
+    memset(self, 0, sizeof(IndexSorter));
+    self->max_record_size = max_record_size;
+    self->buffer_size = WT_MAX(buffer_size,
+            4 * (max_record_size + sizeof(char *)));
+    self->buffer = PyMem_Malloc(self->buffer_size);
+    self->run_prefix = PyMem_Malloc(strlen(run_prefix) + 1);
+    self->run_filenames = PyList_New(0);
+    if (self->buffer == NULL || self->run_prefix == NULL
+            || self->run_filenames == NULL) {
+        PyErr_NoMemory();
         goto out;
     }
-    if (progress_callback != NULL) {
-        if (!PyCallable_Check(progress_callback)) {
-            PyErr_SetString(PyExc_TypeError, "progress_callback must be callable");
-            goto out;
-        }
-    }
-    if (callback_interval == 0) {
-        PyErr_SetString(PyExc_ValueError, "callback interval cannot be 0");
+    strcpy(self->run_prefix, run_prefix);
+    ret = 0;
+out:
+    return ret;
+}
+
+/*
+ * Adds the specified run file to the list of runs. Run files are only
+ * opened while they are written or merged. The file is removed when the
+ * sorter is freed.
+ */
+static int
+IndexSorter_add_run(IndexSorter *self, PyObject *filename)
+{
+    int ret = -1;
+    FILE **runs = NULL;
+
+    if (!PyBytes_Check(filename)) {
+        PyErr_SetString(PyExc_TypeError, "File names must be bytes");
         goto out;
     }
-    id_col = self->table->columns[0];
-    primary_key_size = id_col->element_size;
-    pdb = self->table->db;
-    sdb = self->db;
-    db_ret = pdb->cursor(pdb, NULL, &cursor, 0);
-    if (db_ret != 0) {
-        handle_bdb_error(db_ret);
-        cursor = NULL;
+    runs = PyMem_Realloc(self->runs, (self->num_runs + 1) * sizeof(FILE *));
+    if (runs == NULL) {
+        PyErr_NoMemory();
         goto out;
     }
-    memset(&pkey, 0, sizeof(DBT));
-    memset(&pdata, 0, sizeof(DBT));
-    memset(&skey, 0, sizeof(DBT));
-    memset(&sdata, 0, sizeof(DBT));
-    skey.data = self->key_buffer;
-    sdata.data = self->table->row_buffer;
-    sdata.size = primary_key_size;
-    while ((db_ret = cursor->get(cursor, &pkey, &pdata, DB_NEXT)) == 0) {
-        if (Table_retrieve_row(self->table, &pkey, &pdata) != 0) {
-            goto out;
-        }
-        if (Index_fill_key(self, self->table->row_buffer, &skey) < 0 ) {
-            goto out;
-        }
-        db_ret = sdb->put(sdb, NULL, &skey, &sdata, 0);
-        if (db_ret != 0) {
-            handle_bdb_error(db_ret);
-            goto out;
-        }
-        /* Invoke the callback if necessary */
-        records_processed++;
-        if (records_processed % callback_interval == 0) {
-            if (progress_callback != NULL) {
-                arglist = Py_BuildValue("(K)", records_processed);
-                if (arglist == NULL) {
-                    goto out;
-                }
-                result = PyObject_CallObject(progress_callback, arglist);
-                Py_DECREF(arglist);
-                if (result == NULL) {
-                    goto out;
-                }
-                Py_DECREF(result);
-                /* Anything might have happened in the mean time, so
-                 * check the state of the DBs again!
-                 */
-                if (Index_check_write_mode(self) != 0) {
-                    goto out;
-                }
-            }
-        }
-    }
-    if (db_ret != DB_NOTFOUND) {
-        handle_bdb_error(db_ret);
+    self->runs = runs;
+    if (PyList_Append(self->run_filenames, filename) != 0) {
         goto out;
     }
-    db_ret = cursor->close(cursor);
-    cursor = NULL;
-    if (db_ret != 0) {
-        handle_bdb_error(db_ret);
+    self->runs[self->num_runs] = NULL;
+    self->num_runs++;
+    ret = 0;
+out:
+    return ret;
+}
+
+/*
+ * Opens the specified run file with the specified mode.
+ */
+static int
+IndexSorter_open_run(IndexSorter *self, int run, const char *mode)
+{
+    int ret = -1;
+    char *name = PyBytes_AsString(PyList_GET_ITEM(self->run_filenames, run));
+
+    self->runs[run] = fopen(name, mode);
+    if (self->runs[run] == NULL) {
+        PyErr_SetFromErrnoWithFilename(PyExc_IOError, name);
         goto out;
     }
-    Py_INCREF(Py_None);
-    ret = Py_None;
+    ret = 0;
 out:
-    Py_XDECREF(progress_callback);
-    if (cursor != NULL) {
-        /* ignore errors in this case, as we're already handling one */
-        if (self->table != NULL) {
-            if (self->table->db != NULL) {
-                cursor->close(cursor);
-            }
-        }
-        if (self->db != NULL) {
-            sdb = self->db;
-            db_ret = sdb->truncate(sdb, NULL, &truncate_count, 0);
+    return ret;
+}
+
+/*
+ * Closes the specified run file, if it is open.
+ */
+static int
+IndexSorter_close_run(IndexSorter *self, int run)
+{
+    int ret = 0;
+    if (self->runs[run] != NULL) {
+        if (fclose(self->runs[run]) != 0) {
+            handle_io_error();
+            ret = -1;
         }
+        self->runs[run] = NULL;
     }
     return ret;
 }
 
+/*
+ * Closes the run files and returns a new reference to the list of their
+ * names, such that they are no longer removed when the sorter is freed.
+ */
 static PyObject *
-Index_open(Index* self, PyObject *args)
+IndexSorter_detach_runs(IndexSorter *self)
 {
-    PyObject *ret = NULL;
-    char *db_name = NULL;
-    uint32_t flags = 0;
-    Py_ssize_t gigabyte = 1024 * 1024 * 1024;
-    uint32_t gigs, bytes;
-    int db_ret, mode;
-    DB *pdb;
-    if (!PyArg_ParseTuple(args, "i", &mode)) {
-        goto out;
+    PyObject *ret = self->run_filenames;
+    int j;
+    for (j = 0; j < self->num_runs; j++) {
+        if (self->runs[j] != NULL) {
+            fclose(self->runs[j]);
+            self->runs[j] = NULL;
+        }
     }
-    if (Table_check_read_mode(self->table) != 0) {
+    self->run_filenames = NULL;
+    self->num_runs = 0;
+    return ret;
+}
+
+/*
+ * Sorts the records in the buffer and writes them to a new run file.
+ */
+static int
+IndexSorter_write_run(IndexSorter *self)
+{
+    int ret = -1;
+    size_t j, size;
+    PyObject *filename = NULL;
+    FILE *f;
+
+    qsort(self->records, self->num_records, sizeof(char *),
+            sort_record_pointer_compare);
+    filename = PyBytes_FromFormat("%s.sort_%d", self->run_prefix,
+            self->num_runs);
+    if (filename == NULL) {
         goto out;
     }
-    pdb = self->table->db;
-    if (mode == WT_WRITE) {
-        flags = DB_CREATE|DB_TRUNCATE;
-    } else if (mode == WT_READ) {
-        flags = DB_RDONLY|DB_NOMMAP;
-    } else {
-        PyErr_Format(PyExc_ValueError, "mode must be WT_READ or WT_WRITE.");
+    if (IndexSorter_add_run(self, filename) != 0) {
         goto out;
     }
-    if (self->db != NULL) {
-        PyErr_Format(WormtableError, "Index already open.");
+    if (IndexSorter_open_run(self, self->num_runs - 1, "wb") != 0) {
         goto out;
     }
-    db_name = PyBytes_AsString(self->db_filename);
-    if (db_name == NULL) {
-        goto out;
+    f = self->runs[self->num_runs - 1];
+    for (j = 0; j < self->num_records; j++) {
+        size = sort_record_size(self->records[j]);
+        if (fwrite(self->records[j], size, 1, f) != 1) {
+            handle_io_error();
+            goto out;
+        }
     }
-    /* Now we create the DB handle */
-    db_ret = db_create(&self->db, NULL, 0);
-    if (db_ret != 0) {
-        handle_bdb_error(db_ret);
+    if (IndexSorter_close_run(self, self->num_runs - 1) != 0) {
         goto out;
     }
-    gigs = (uint32_t) (self->cache_size / gigabyte);
-    bytes = (uint32_t) (self->cache_size % gigabyte);
-    db_ret = self->db->set_cachesize(self->db, gigs, bytes, 1);
-    if (db_ret != 0) {
-        handle_bdb_error(db_ret);
-        goto out;
+    self->num_records = 0;
+    self->buffer_used = 0;
+    ret = 0;
+out:
+    Py_XDECREF(filename);
+    return ret;
+}
+
+/*
+ * Adds a record with the specified key and data to the sorter.
+ */
+static int
+IndexSorter_add(IndexSorter *self, DBT *key, DBT *data)
+{
+    int ret = -1;
+    char **records;
+    char *record;
+    size_t size = SORT_RECORD_HEADER_SIZE + key->size + data->size;
+    size_t used = self->buffer_used + size
+            + (self->num_records + 1) * sizeof(char *);
+
+    if (used > self->buffer_size) {
+        if (IndexSorter_write_run(self) != 0) {
+            goto out;
+        }
     }
-    db_ret = self->db->set_flags(self->db, DB_DUPSORT);
-    if (db_ret != 0) {
-        handle_bdb_error(db_ret);
-        goto out;
+    if (self->num_records == self->max_records) {
+        self->max_records = WT_MAX(2 * self->max_records, 1024);
+        records = PyMem_Realloc(self->records,
+                self->max_records * sizeof(char *));
+        if (records == NULL) {
+            PyErr_NoMemory();
+            goto out;
+        }
+        self->records = records;
+    }
+    record = self->buffer + self->buffer_used;
+    memcpy(record, &key->size, sizeof(uint32_t));
+    memcpy(record + sizeof(uint32_t), &data->size, sizeof(uint32_t));
+    memcpy(record + SORT_RECORD_HEADER_SIZE, key->data, key->size);
+    memcpy(record + SORT_RECORD_HEADER_SIZE + key->size, data->data,
+            data->size);
+    self->records[self->num_records] = record;
+    self->num_records++;
+    self->buffer_used += size;
+    ret = 0;
+out:
+    return ret;
+}
+
+/*
+ * Reads the next record from the specified run file into the specified
+ * record buffer. Returns 1 if a record was read, 0 at the end of the run
+ * and -1 on error.
+ */
+static int
+IndexSorter_read_record(IndexSorter *self, FILE *f, char *record)
+{
+    int ret = -1;
+    size_t size;
+
+    if (fread(record, SORT_RECORD_HEADER_SIZE, 1, f) != 1) {
+        if (ferror(f)) {
+            handle_io_error();
+            goto out;
+        }
+        ret = 0;
+        goto out;
     }
-    db_ret = self->db->set_bt_compress(self->db, NULL, NULL);
-    if (db_ret != 0) {
-        handle_bdb_error(db_ret);
+    size = sort_record_size(record) - SORT_RECORD_HEADER_SIZE;
+    if (size > self->max_record_size - SORT_RECORD_HEADER_SIZE
+            || fread(record + SORT_RECORD_HEADER_SIZE, size, 1, f) != 1) {
+        PyErr_SetString(WormtableError, "Corrupt index sort file");
         goto out;
     }
-    /* Disable DB error messages */
-    self->db->set_errcall(self->db, NULL);
-    db_ret = self->db->open(self->db, NULL, db_name, NULL, DB_BTREE, flags,
-            WT_DB_FILE_PERMS);
+    ret = 1;
+out:
+    return ret;
+}
+
+static int
+IndexSorter_heap_less(IndexSorter *self, int j, int k)
+{
+    return sort_record_compare(self->run_records[self->heap[j]],
+            self->run_records[self->heap[k]]) < 0;
+}
+
+static void
+IndexSorter_sift_down(IndexSorter *self, int j, int heap_size)
+{
+    int child, tmp;
+    while ((child = 2 * j + 1) < heap_size) {
+        if (child + 1 < heap_size && IndexSorter_heap_less(self, child + 1,
+                    child)) {
+            child++;
+        }
+        if (!IndexSorter_heap_less(self, child, j)) {
+            break;
+        }
+        tmp = self->heap[j];
+        self->heap[j] = self->heap[child];
+        self->heap[child] = tmp;
+        j = child;
+    }
+}
+
+static int
+IndexSorter_insert_record(IndexSorter *self, DB *db, char *record)
+{
+    int ret = -1;
+    int db_ret;
+    uint32_t key_size, data_size;
+    DBT key, data;
+    memcpy(&key_size, record, sizeof(uint32_t));
+    memcpy(&data_size, record + sizeof(uint32_t), sizeof(uint32_t));
+    memset(&key, 0, sizeof(DBT));
+    memset(&data, 0, sizeof(DBT));
+    key.data = record + SORT_RECORD_HEADER_SIZE;
+    key.size = key_size;
+    data.data = record + SORT_RECORD_HEADER_SIZE + key_size;
+    data.size = data_size;
+    Py_BEGIN_ALLOW_THREADS
+    db_ret = db->put(db, NULL, &key, &data, 0);
+    Py_END_ALLOW_THREADS
     if (db_ret != 0) {
         handle_bdb_error(db_ret);
-        self->db->close(self->db, 0);
-        self->db = NULL;
         goto out;
     }
-    if (mode == WT_READ) {
-        db_ret = pdb->associate(pdb, NULL, self->db, NULL, 0);
-        if (db_ret != 0) {
-            handle_bdb_error(db_ret);
+    ret = 0;
+out:
+    return ret;
+}
+
+/*
+ * Merges the n runs starting at first, inserting the records into the
+ * specified database if it is not NULL, and otherwise writing them to
+ * the specified file. The run files are open only during the merge.
+ */
+static int
+IndexSorter_merge_runs(IndexSorter *self, int first, int n, DB *db,
+        FILE *dest)
+{
+    int ret = -1;
+    int j, run, wt_ret, heap_size;
+    size_t size;
+    char *record;
+
+    heap_size = 0;
+    for (j = 0; j < n; j++) {
+        if (IndexSorter_open_run(self, first + j, "rb") != 0) {
             goto out;
         }
+        wt_ret = IndexSorter_read_record(self, self->runs[first + j],
+                self->run_records[j]);
+        if (wt_ret < 0) {
+            goto out;
+        }
+        if (wt_ret == 1) {
+            self->heap[heap_size] = j;
+            heap_size++;
+        }
     }
-    Py_INCREF(Py_None);
-    ret = Py_None;
+    for (j = heap_size / 2 - 1; j >= 0; j--) {
+        IndexSorter_sift_down(self, j, heap_size);
+    }
+    while (heap_size > 0) {
+        j = self->heap[0];
+        record = self->run_records[j];
+        if (db != NULL) {
+            if (IndexSorter_insert_record(self, db, record) != 0) {
+                goto out;
+            }
+        } else {
+            size = sort_record_size(record);
+            if (fwrite(record, size, 1, dest) != 1) {
+                handle_io_error();
+                goto out;
+            }
+        }
+        wt_ret = IndexSorter_read_record(self, self->runs[first + j], record);
+        if (wt_ret < 0) {
+            goto out;
+        }
+        if (wt_ret == 0) {
+            heap_size--;
+            self->heap[0] = self->heap[heap_size];
+        }
+        IndexSorter_sift_down(self, 0, heap_size);
+    }
+    ret = 0;
+out:
+    for (run = first; run < first + n; run++) {
+        if (IndexSorter_close_run(self, run) != 0) {
+            ret = -1;
+        }
+    }
+    return ret;
+}
+
+/*
+ * Inserts all the records in the sorter into the specified database in
+ * sorted order. If all records fit into the buffer, they are inserted
+ * directly; otherwise, the buffer is written as the final run and the
+ * runs are merged, in several passes if there are more than
+ * SORT_MAX_MERGE_RUNS of them.
+ */
+static int
+IndexSorter_finish(IndexSorter *self, DB *db)
+{
+    int ret = -1;
+    int j, n, first, run;
+    size_t k;
+    PyObject *filename = NULL;
+
+    if (self->num_runs == 0 && self->buffer != NULL) {
+        qsort(self->records, self->num_records, sizeof(char *),
+                sort_record_pointer_compare);
+        for (k = 0; k < self->num_records; k++) {
+            if (IndexSorter_insert_record(self, db, self->records[k]) != 0) {
+                goto out;
+            }
+        }
+        ret = 0;
+        goto out;
+    }
+    if (self->num_records > 0) {
+        if (IndexSorter_write_run(self) != 0) {
+            goto out;
+        }
+    }
+    /* Free the buffer before we allocate the merge buffers */
+    PyMem_Free(self->buffer);
+    self->buffer = NULL;
+    n = WT_MIN(self->num_runs, SORT_MAX_MERGE_RUNS);
+    self->run_records = PyMem_Malloc(n * sizeof(char *));
+    self->heap = PyMem_Malloc(n * sizeof(int));
+    if (self->run_records == NULL || self->heap == NULL) {
+        PyErr_NoMemory();
+        goto out;
+    }
+    for (j = 0; j < n; j++) {
+        self->run_records[j] = PyMem_Malloc(self->max_record_size);
+        if (self->run_records[j] == NULL) {
+            PyErr_NoMemory();
+            goto out;
+        }
+        self->num_run_records++;
+    }
+    first = 0;
+    while (self->num_runs - first > SORT_MAX_MERGE_RUNS) {
+        /* Merge the oldest runs into a new run at the end */
+        filename = PyBytes_FromFormat("%s.sort_%d", self->run_prefix,
+                self->num_runs);
+        if (filename == NULL) {
+            goto out;
+        }
+        if (IndexSorter_add_run(self, filename) != 0) {
+            goto out;
+        }
+        Py_DECREF(filename);
+        filename = NULL;
+        run = self->num_runs - 1;
+        if (IndexSorter_open_run(self, run, "wb") != 0) {
+            goto out;
+        }
+        if (IndexSorter_merge_runs(self, first, SORT_MAX_MERGE_RUNS, NULL,
+                    self->runs[run]) != 0) {
+            goto out;
+        }
+        if (IndexSorter_close_run(self, run) != 0) {
+            goto out;
+        }
+        for (j = first; j < first + SORT_MAX_MERGE_RUNS; j++) {
+            remove(PyBytes_AsString(PyList_GET_ITEM(self->run_filenames, j)));
+        }
+        first += SORT_MAX_MERGE_RUNS;
+    }
+    if (IndexSorter_merge_runs(self, first, self->num_runs - first, db,
+                NULL) != 0) {
+        goto out;
+    }
+    ret = 0;
 out:
+    Py_XDECREF(filename);
     return ret;
 }
 
+static PyTypeObject IndexType;
+
+/*
+ * Builds this index, along with any other indexes on the same table in the
+ * specified list, in a single pass over the table. If sort_buffer_size is
+ * greater than zero, the keys for each index are sorted before they are
+ * inserted, using an equal share of the buffer for each index.
+ */
 static PyObject *
-Index_close(Index* self)
+Index_build(Index* self, PyObject *args, PyObject *kwds)
 {
-    PyObject *ret = NULL;
     int db_ret;
-    DB *db = self->db;
-    if (db == NULL) {
-        PyErr_SetString(WormtableError, "index closed");
+    PyObject *ret = NULL;
+    PyObject *arglist, *result;
+    PyObject *progress_callback = NULL;
+    PyObject *others = NULL;
+    PyObject *v;
+    Index **indexes = NULL;
+    Index *index;
+    IndexSorter *sorters = NULL;
+    int num_indexes = 0;
+    int num_sorters = 0;
+    int started = 0;
+    int j;
+    Column *id_col;
+    uint32_t primary_key_size;
+    DBC *cursor = NULL;
+    DB *pdb = NULL;
+    DB *sdb = NULL;
+    DBT pkey, pdata, skey, sdata;
+    void *row = NULL;
+    void *row_buffer = NULL;
+    uint32_t truncate_count;
+    uint64_t callback_interval = 1000;
+    uint64_t records_processed = 0;
+    Py_ssize_t sort_buffer_size = 0;
+    static char *kwlist[] = {"progress_callback", "callback_interval",
+        "sort_buffer_size", "indexes", NULL};
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "|OKnO!", kwlist,
+            &progress_callback, &callback_interval, &sort_buffer_size,
+            &PyList_Type, &others)) {
+        progress_callback = NULL;
         goto out;
     }
-    db_ret = db->close(db, 0);
-    self->db = NULL;
+    Py_XINCREF(progress_callback);
+    num_indexes = 1 + (others == NULL ? 0 : (int) PyList_GET_SIZE(others));
+    indexes = PyMem_Malloc(num_indexes * sizeof(Index *));
+    sorters = PyMem_Malloc(num_indexes * sizeof(IndexSorter));
+    if (indexes == NULL || sorters == NULL) {
+        num_indexes = 0;
+        PyErr_NoMemory();
+        goto out;
+    }
+    indexes[0] = self;
+    Py_INCREF(self);
+    for (j = 1; j < num_indexes; j++) {
+        v = PyList_GET_ITEM(others, j - 1);
+        if (!PyObject_TypeCheck(v, &IndexType)) {
+            num_indexes = j;
+            PyErr_SetString(PyExc_TypeError, "Must be Index objects");
+            goto out;
+        }
+        Py_INCREF(v);
+        indexes[j] = (Index *) v;
+    }
+    for (j = 0; j < num_indexes; j++) {
+        if (Index_check_write_mode(indexes[j]) != 0) {
+            goto out;
+        }
+        if (indexes[j]->table != self->table) {
+            PyErr_SetString(PyExc_ValueError,
+                    "Indexes must be on the same table");
+            goto out;
+        }
+    }
+    if (sort_buffer_size < 0) {
+        PyErr_SetString(PyExc_ValueError, "sort buffer size cannot be negative");
+        goto out;
+    }
+    if (progress_callback != NULL) {
+        if (!PyCallable_Check(progress_callback)) {
+            PyErr_SetString(PyExc_TypeError, "progress_callback must be callable");
+            goto out;
+        }
+    }
+    if (callback_interval == 0) {
+        PyErr_SetString(PyExc_ValueError, "callback interval cannot be 0");
+        goto out;
+    }
+    id_col = self->table->columns[0];
+    primary_key_size = id_col->element_size;
+    pdb = self->table->db;
+    row_buffer = PyMem_Malloc(self->table->row_buffer_size);
+    if (row_buffer == NULL) {
+        PyErr_NoMemory();
+        goto out;
+    }
+    if (sort_buffer_size > 0) {
+        for (j = 0; j < num_indexes; j++) {
+            index = indexes[j];
+            num_sorters++;
+            if (IndexSorter_init(&sorters[j],
+                        (size_t) sort_buffer_size / num_indexes,
+                        index->key_buffer_size + primary_key_size
+                        + SORT_RECORD_HEADER_SIZE,
+                        PyBytes_AsString(index->db_filename)) != 0) {
+                goto out;
+            }
+        }
+    }
+    /* The table and indexes must not be closed while we release the GIL */
+    self->table->num_users++;
+    for (j = 0; j < num_indexes; j++) {
+        indexes[j]->num_users++;
+    }
+    started = 1;
+    db_ret = pdb->cursor(pdb, NULL, &cursor, 0);
+    if (db_ret != 0) {
+        handle_bdb_error(db_ret);
+        cursor = NULL;
+        goto out;
+    }
+    memset(&pkey, 0, sizeof(DBT));
+    memset(&pdata, 0, sizeof(DBT));
+    memset(&skey, 0, sizeof(DBT));
+    memset(&sdata, 0, sizeof(DBT));
+    sdata.data = row_buffer;
+    sdata.size = primary_key_size;
+    while (1) {
+        Py_BEGIN_ALLOW_THREADS
+        db_ret = cursor->get(cursor, &pkey, &pdata, DB_NEXT);
+        Py_END_ALLOW_THREADS
+        if (db_ret != 0) {
+            break;
+        }
+        if (Table_retrieve_row(self->table, &pkey, &pdata, row_buffer, &row)
+                != 0) {
+            goto out;
+        }
+        for (j = 0; j < num_indexes; j++) {
+            index = indexes[j];
+            skey.data = index->key_buffer;
+            if (Index_fill_key(index, row_buffer, row, &skey) < 0 ) {
+                goto out;
+            }
+            if (num_sorters > 0) {
+                if (IndexSorter_add(&sorters[j], &skey, &sdata) != 0) {
+                    goto out;
+                }
+            } else {
+                sdb = index->db;
+                Py_BEGIN_ALLOW_THREADS
+                db_ret = sdb->put(sdb, NULL, &skey, &sdata, 0);
+                Py_END_ALLOW_THREADS
+                if (db_ret != 0) {
+                    handle_bdb_error(db_ret);
+                    goto out;
+                }
+            }
+        }
+        /* Invoke the callback if necessary */
+        records_processed++;
+        if (records_processed % callback_interval == 0) {
+            if (progress_callback != NULL) {
+                arglist = Py_BuildValue("(K)", records_processed);
+                if (arglist == NULL) {
+                    goto out;
+                }
+                result = PyObject_CallObject(progress_callback, arglist);
+                Py_DECREF(arglist);
+                if (result == NULL) {
+                    goto out;
+                }
+                Py_DECREF(result);
+                /* Anything might have happened in the mean time, so
+                 * check the state of the DBs again!
+                 */
+                for (j = 0; j < num_indexes; j++) {
+                    if (Index_check_write_mode(indexes[j]) != 0) {
+                        goto out;
+                    }
+                }
+            }
+        }
+    }
+    if (db_ret != DB_NOTFOUND) {
+        handle_bdb_error(db_ret);
+        goto out;
+    }
+    db_ret = cursor->close(cursor);
+    cursor = NULL;
     if (db_ret != 0) {
         handle_bdb_error(db_ret);
         goto out;
     }
+    for (j = 0; j < num_sorters; j++) {
+        if (Index_check_write_mode(indexes[j]) != 0) {
+            goto out;
+        }
+        if (IndexSorter_finish(&sorters[j], indexes[j]->db) != 0) {
+            goto out;
+        }
+    }
     Py_INCREF(Py_None);
     ret = Py_None;
 out:
-    return ret;
-}
-
-
+    Py_XDECREF(progress_callback);
+    for (j = 0; j < num_sorters; j++) {
+        IndexSorter_free(&sorters[j]);
+    }
+    if (cursor != NULL) {
+        /* ignore errors in this case, as we're already handling one */
+        if (self->table != NULL) {
+            if (self->table->db != NULL) {
+                cursor->close(cursor);
+            }
+        }
+    }
+    if (started) {
+        self->table->num_users--;
+    }
+    for (j = 0; j < num_indexes; j++) {
+        if (started) {
+            indexes[j]->num_users--;
+        }
+        if (ret == NULL && started && indexes[j]->db != NULL) {
+            sdb = indexes[j]->db;
+            db_ret = sdb->truncate(sdb, NULL, &truncate_count, 0);
+        }
+        Py_DECREF(indexes[j]);
+    }
+    PyMem_Free(indexes);
+    PyMem_Free(sorters);
+    PyMem_Free(row_buffer);
+    return ret;
+}
+
+/*
+ * Extracts the keys for the rows with min_row_id <= row_id < max_row_id
+ * and writes them in sorted runs to files beginning with the specified
+ * prefix. If a list of other indexes on the same table is given, their
+ * keys are extracted in the same pass over the rows, and the sort buffer
+ * is shared equally among the indexes. Returns a list containing the
+ * list of file names for this index followed by those for each of the
+ * other indexes. This only requires the table to be open for reading, so
+ * that keys can be extracted by several processes at once. The runs are
+ * inserted into the indexes using merge_keys.
+ */
+static PyObject *
+Index_sort_keys(Index* self, PyObject *args)
+{
+    int db_ret, wt_ret;
+    PyObject *ret = NULL;
+    PyObject *prefix = NULL;
+    PyObject *others = NULL;
+    PyObject *run_prefix = NULL;
+    PyObject *files = NULL;
+    PyObject *v;
+    Py_ssize_t sort_buffer_size = 0;
+    unsigned long long min_row_id, max_row_id;
+    uint64_t row_id;
+    Column *id_col;
+    uint32_t primary_key_size;
+    DBC *cursor = NULL;
+    DB *pdb = NULL;
+    DBT pkey, pdata, skey, sdata;
+    void *row = NULL;
+    void *row_buffer = NULL;
+    unsigned char key_buffer[sizeof(uint64_t)];
+    Index **indexes = NULL;
+    IndexSorter *sorters = NULL;
+    int num_indexes = 0;
+    int num_sorters = 0;
+    int j;
+    uint32_t flags = DB_SET_RANGE;
+
+    if (!PyArg_ParseTuple(args, "O!nKK|O!", &PyBytes_Type, &prefix,
+            &sort_buffer_size, &min_row_id, &max_row_id, &PyList_Type,
+            &others)) {
+        goto out;
+    }
+    num_indexes = 1 + (others == NULL ? 0 : (int) PyList_GET_SIZE(others));
+    indexes = PyMem_Malloc(num_indexes * sizeof(Index *));
+    sorters = PyMem_Malloc(num_indexes * sizeof(IndexSorter));
+    if (indexes == NULL || sorters == NULL) {
+        num_indexes = 0;
+        PyErr_NoMemory();
+        goto out;
+    }
+    indexes[0] = self;
+    Py_INCREF(self);
+    for (j = 1; j < num_indexes; j++) {
+        v = PyList_GET_ITEM(others, j - 1);
+        if (!PyObject_TypeCheck(v, &IndexType)) {
+            num_indexes = j;
+            PyErr_SetString(PyExc_TypeError, "Must be Index objects");
+            goto out;
+        }
+        Py_INCREF(v);
+        indexes[j] = (Index *) v;
+    }
+    for (j = 0; j < num_indexes; j++) {
+        if (indexes[j]->table != self->table) {
+            PyErr_SetString(PyExc_ValueError,
+                    "Indexes must be on the same table");
+            goto out;
+        }
+    }
+    if (Table_check_read_mode(self->table) != 0) {
+        goto out;
+    }
+    if (sort_buffer_size < 0) {
+        PyErr_SetString(PyExc_ValueError, "sort buffer size cannot be negative");
+        goto out;
+    }
+    id_col = self->table->columns[0];
+    primary_key_size = id_col->element_size;
+    pdb = self->table->db;
+    row_buffer = PyMem_Malloc(self->table->row_buffer_size);
+    if (row_buffer == NULL) {
+        PyErr_NoMemory();
+        goto out;
+    }
+    for (j = 0; j < num_indexes; j++) {
+        /* Each index has its own runs, named after its position */
+        run_prefix = PyBytes_FromFormat("%s.%d", PyBytes_AS_STRING(prefix),
+                j);
+        if (run_prefix == NULL) {
+            goto out;
+        }
+        num_sorters++;
+        if (IndexSorter_init(&sorters[j],
+                    (size_t) sort_buffer_size / num_indexes,
+                    indexes[j]->key_buffer_size + primary_key_size
+                    + SORT_RECORD_HEADER_SIZE,
+                    PyBytes_AS_STRING(run_prefix)) != 0) {
+            goto out;
+        }
+        Py_DECREF(run_prefix);
+        run_prefix = NULL;
+    }
+    db_ret = pdb->cursor(pdb, NULL, &cursor, 0);
+    if (db_ret != 0) {
+        handle_bdb_error(db_ret);
+        cursor = NULL;
+        goto out;
+    }
+    memset(&pkey, 0, sizeof(DBT));
+    memset(&pdata, 0, sizeof(DBT));
+    memset(&skey, 0, sizeof(DBT));
+    memset(&sdata, 0, sizeof(DBT));
+    if (Column_set_row_id(id_col, (uint64_t) min_row_id) != 0) {
+        goto out;
+    }
+    if (Column_update_row(id_col, key_buffer, 0) != 0) {
+        goto out;
+    }
+    pkey.data = key_buffer;
+    pkey.size = primary_key_size;
+    sdata.data = row_buffer;
+    sdata.size = primary_key_size;
+    while (1) {
+        self->table->num_users++;
+        Py_BEGIN_ALLOW_THREADS
+        db_ret = cursor->get(cursor, &pkey, &pdata, flags);
+        Py_END_ALLOW_THREADS
+        self->table->num_users--;
+        if (db_ret != 0) {
+            break;
+        }
+        flags = DB_NEXT;
+        if (Table_retrieve_row(self->table, &pkey, &pdata, row_buffer, &row)
+                != 0) {
+            goto out;
+        }
+        wt_ret = Table_extract_elements(self->table, id_col, row_buffer, row);
+        if (wt_ret < 0) {
+            goto out;
+        }
+        if (Column_get_row_id(id_col, &row_id) != 0) {
+            goto out;
+        }
+        if (row_id >= max_row_id) {
+            break;
+        }
+        for (j = 0; j < num_indexes; j++) {
+            skey.data = indexes[j]->key_buffer;
+            if (Index_fill_key(indexes[j], row_buffer, row, &skey) < 0 ) {
+                goto out;
+            }
+            if (IndexSorter_add(&sorters[j], &skey, &sdata) != 0) {
+                goto out;
+            }
+        }
+    }
+    if (db_ret != 0 && db_ret != DB_NOTFOUND) {
+        handle_bdb_error(db_ret);
+        goto out;
+    }
+    files = PyList_New(num_indexes);
+    if (files == NULL) {
+        goto out;
+    }
+    for (j = 0; j < num_indexes; j++) {
+        if (sorters[j].num_records > 0) {
+            if (IndexSorter_write_run(&sorters[j]) != 0) {
+                goto out;
+            }
+        }
+    }
+    for (j = 0; j < num_indexes; j++) {
+        PyList_SET_ITEM(files, j, IndexSorter_detach_runs(&sorters[j]));
+    }
+    ret = files;
+    files = NULL;
+out:
+    if (cursor != NULL) {
+        cursor->close(cursor);
+    }
+    for (j = 0; j < num_sorters; j++) {
+        IndexSorter_free(&sorters[j]);
+    }
+    for (j = 0; j < num_indexes; j++) {
+        Py_DECREF(indexes[j]);
+    }
+    Py_XDECREF(run_prefix);
+    Py_XDECREF(files);
+    PyMem_Free(indexes);
+    PyMem_Free(sorters);
+    PyMem_Free(row_buffer);
+    return ret;
+}
+
+/*
+ * Merges the sorted runs in the specified files written by sort_keys and
+ * inserts the keys into the index. The files are removed afterwards.
+ */
+static PyObject *
+Index_merge_keys(Index* self, PyObject *args)
+{
+    PyObject *ret = NULL;
+    PyObject *filenames = NULL;
+    PyObject *filename;
+    PyObject *prefix = NULL;
+    Py_ssize_t j;
+    IndexSorter sorter;
+    IndexSorter *sorter_p = NULL;
+    uint32_t truncate_count;
+    uint32_t primary_key_size;
+    int wt_ret;
+
+    if (!PyArg_ParseTuple(args, "O!", &PyList_Type, &filenames)) {
+        goto out;
+    }
+    if (Index_check_write_mode(self) != 0) {
+        goto out;
+    }
+    primary_key_size = self->table->columns[0]->element_size;
+    /* Runs from intermediate merge passes are named after the first run */
+    if (PyList_GET_SIZE(filenames) > 0) {
+        filename = PyList_GET_ITEM(filenames, 0);
+        if (!PyBytes_Check(filename)) {
+            PyErr_SetString(PyExc_TypeError, "File names must be bytes");
+            goto out;
+        }
+        prefix = PyBytes_FromFormat("%s.merge", PyBytes_AS_STRING(filename));
+    } else {
+        prefix = PyBytes_FromString("");
+    }
+    if (prefix == NULL) {
+        goto out;
+    }
+    sorter_p = &sorter;
+    if (IndexSorter_init(sorter_p, 0, self->key_buffer_size
+                + primary_key_size + SORT_RECORD_HEADER_SIZE,
+                PyBytes_AS_STRING(prefix)) != 0) {
+        goto out;
+    }
+    for (j = 0; j < PyList_GET_SIZE(filenames); j++) {
+        filename = PyList_GET_ITEM(filenames, j);
+        if (IndexSorter_add_run(sorter_p, filename) != 0) {
+            goto out;
+        }
+    }
+    self->num_users++;
+    wt_ret = IndexSorter_finish(sorter_p, self->db);
+    self->num_users--;
+    if (wt_ret != 0) {
+        if (self->db != NULL) {
+            self->db->truncate(self->db, NULL, &truncate_count, 0);
+        }
+        goto out;
+    }
+    Py_INCREF(Py_None);
+    ret = Py_None;
+out:
+    if (sorter_p != NULL) {
+        IndexSorter_free(sorter_p);
+    }
+    Py_XDECREF(prefix);
+    return ret;
+}
+
+/*
+ * Adds the keys for the row in the table's row buffer to the sorters of
+ * the indexes that have been attached using start_key_sort.
+ */
+static int
+Table_sort_index_keys(Table *self)
+{
+    int ret = -1;
+    Py_ssize_t j;
+    Index *index;
+    DBT skey, sdata;
+
+    memset(&skey, 0, sizeof(DBT));
+    memset(&sdata, 0, sizeof(DBT));
+    sdata.data = self->row_buffer;
+    sdata.size = self->columns[0]->element_size;
+    for (j = 0; j < PyList_GET_SIZE(self->sort_indexes); j++) {
+        index = (Index *) PyList_GET_ITEM(self->sort_indexes, j);
+        skey.data = index->key_buffer;
+        if (Index_fill_key(index, self->row_buffer, self->row_buffer, &skey)
+                < 0) {
+            goto out;
+        }
+        if (IndexSorter_add(index->sorter, &skey, &sdata) != 0) {
+            goto out;
+        }
+    }
+    ret = 0;
+out:
+    return ret;
+}
+
+/*
+ * Starts sorting the keys for this index as rows are written to the table,
+ * which must be open for writing. Sorted runs are written to files
+ * beginning with the specified prefix; these are returned by
+ * finish_key_sort and can be inserted into the index using merge_keys.
+ */
+static PyObject *
+Index_start_key_sort(Index* self, PyObject *args)
+{
+    PyObject *ret = NULL;
+    PyObject *prefix = NULL;
+    Py_ssize_t sort_buffer_size = 0;
+    Table *table = self->table;
+
+    if (!PyArg_ParseTuple(args, "O!n", &PyBytes_Type, &prefix,
+            &sort_buffer_size)) {
+        goto out;
+    }
+    if (Table_check_write_mode(table) != 0) {
+        goto out;
+    }
+    if (self->sorter != NULL) {
+        PyErr_SetString(WormtableError, "Key sort already started");
+        goto out;
+    }
+    if (sort_buffer_size < 0) {
+        PyErr_SetString(PyExc_ValueError, "sort buffer size cannot be negative");
+        goto out;
+    }
+    if (table->sort_indexes == NULL) {
+        table->sort_indexes = PyList_New(0);
+        if (table->sort_indexes == NULL) {
+            goto out;
+        }
+    }
+    self->sorter = PyMem_Malloc(sizeof(IndexSorter));
+    if (self->sorter == NULL) {
+        PyErr_NoMemory();
+        goto out;
+    }
+    if (IndexSorter_init(self->sorter, (size_t) sort_buffer_size,
+                self->key_buffer_size + table->columns[0]->element_size
+                + SORT_RECORD_HEADER_SIZE, PyBytes_AsString(prefix)) != 0
+            || PyList_Append(table->sort_indexes, (PyObject *) self) != 0) {
+        IndexSorter_free(self->sorter);
+        PyMem_Free(self->sorter);
+        self->sorter = NULL;
+        goto out;
+    }
+    Py_INCREF(Py_None);
+    ret = Py_None;
+out:
+    return ret;
+}
+
+/*
+ * Stops sorting the keys for this index as rows are written, and returns
+ * the list of files containing the sorted runs of keys.
+ */
+static PyObject *
+Index_finish_key_sort(Index* self)
+{
+    PyObject *ret = NULL;
+    PyObject *sort_indexes = self->table->sort_indexes;
+    Py_ssize_t j;
+
+    if (self->sorter == NULL) {
+        PyErr_SetString(WormtableError, "Key sort not started");
+        goto out;
+    }
+    if (self->sorter->num_records > 0) {
+        if (IndexSorter_write_run(self->sorter) != 0) {
+            goto out;
+        }
+    }
+    ret = IndexSorter_detach_runs(self->sorter);
+    IndexSorter_free(self->sorter);
+    PyMem_Free(self->sorter);
+    self->sorter = NULL;
+    if (sort_indexes != NULL) {
+        for (j = 0; j < PyList_GET_SIZE(sort_indexes); j++) {
+            if (PyList_GET_ITEM(sort_indexes, j) == (PyObject *) self) {
+                if (PySequence_DelItem(sort_indexes, j) != 0) {
+                    Py_DECREF(ret);
+                    ret = NULL;
+                }
+                break;
+            }
+        }
+    }
+out:
+    return ret;
+}
+
+static PyObject *
+Index_open(Index* self, PyObject *args)
+{
+    PyObject *ret = NULL;
+    char *db_name = NULL;
+    uint32_t flags = 0;
+    Py_ssize_t gigabyte = 1024 * 1024 * 1024;
+    uint32_t gigs, bytes;
+    int db_ret, mode;
+    DB *pdb;
+    if (!PyArg_ParseTuple(args, "i", &mode)) {
+        goto out;
+    }
+    if (Table_check_read_mode(self->table) != 0) {
+        goto out;
+    }
+    pdb = self->table->db;
+    if (mode == WT_WRITE) {
+        flags = DB_CREATE|DB_TRUNCATE;
+    } else if (mode == WT_READ) {
+        flags = DB_RDONLY|DB_NOMMAP|DB_THREAD;
+    } else {
+        PyErr_Format(PyExc_ValueError, "mode must be WT_READ or WT_WRITE.");
+        goto out;
+    }
+    if (self->db != NULL) {
+        PyErr_Format(WormtableError, "Index already open.");
+        goto out;
+    }
+    db_name = PyBytes_AsString(self->db_filename);
+    if (db_name == NULL) {
+        goto out;
+    }
+    /* Now we create the DB handle, in the table's environment if it
+     * has one, in which case the index shares its cache */
+    db_ret = db_create(&self->db, self->table->env, 0);
+    if (db_ret != 0) {
+        handle_bdb_error(db_ret);
+        self->db = NULL;
+        goto out;
+    }
+    if (self->table->env != NULL) {
+        self->shared_env = 1;
+        self->table->env_handles++;
+    } else {
+        gigs = (uint32_t) (self->cache_size / gigabyte);
+        bytes = (uint32_t) (self->cache_size % gigabyte);
+        db_ret = self->db->set_cachesize(self->db, gigs, bytes, 1);
+        if (db_ret != 0) {
+            handle_bdb_error(db_ret);
+            goto out;
+        }
+    }
+    db_ret = self->db->set_flags(self->db, DB_DUPSORT);
+    if (db_ret != 0) {
+        handle_bdb_error(db_ret);
+        goto out;
+    }
+    db_ret = self->db->set_bt_compress(self->db, NULL, NULL);
+    if (db_ret != 0) {
+        handle_bdb_error(db_ret);
+        goto out;
+    }
+    /* Disable DB error messages */
+    self->db->set_errcall(self->db, NULL);
+    db_ret = self->db->open(self->db, NULL, db_name, NULL, DB_BTREE, flags,
+            WT_DB_FILE_PERMS);
+    if (db_ret != 0) {
+        handle_bdb_error(db_ret);
+        self->db->close(self->db, 0);
+        self->db = NULL;
+        if (self->shared_env) {
+            self->shared_env = 0;
+            Table_release_env(self->table);
+        }
+        goto out;
+    }
+    if (mode == WT_READ) {
+        db_ret = pdb->associate(pdb, NULL, self->db, NULL, 0);
+        if (db_ret != 0) {
+            handle_bdb_error(db_ret);
+            goto out;
+        }
+    }
+    Py_INCREF(Py_None);
+    ret = Py_None;
+out:
+    return ret;
+}
+
+/*
+ * Raises an exception if another thread is using the index with the GIL
+ * released, so that it can be checked before the index is closed.
+ */
+static PyObject *
+Index_check_idle_method(Index* self)
+{
+    PyObject *ret = NULL;
+    if (Index_check_idle(self) != 0) {
+        goto out;
+    }
+    Py_INCREF(Py_None);
+    ret = Py_None;
+out:
+    return ret;
+}
+
+static PyObject *
+Index_close(Index* self)
+{
+    PyObject *ret = NULL;
+    int db_ret;
+    DB *db = self->db;
+    if (db == NULL) {
+        PyErr_SetString(WormtableError, "index closed");
+        goto out;
+    }
+    if (Index_check_idle(self) != 0) {
+        goto out;
+    }
+    db_ret = db->close(db, 0);
+    self->db = NULL;
+    if (self->shared_env && db_ret == 0) {
+        self->shared_env = 0;
+        db_ret = Table_release_env(self->table);
+    }
+    if (db_ret != 0) {
+        handle_bdb_error(db_ret);
+        goto out;
+    }
+    Py_INCREF(Py_None);
+    ret = Py_None;
+out:
+    return ret;
+}
+
+
 static PyMethodDef Index_methods[] = {
-    {"build", (PyCFunction) Index_build, METH_VARARGS, "Build the index" },
+    {"build", (PyCFunction) Index_build, METH_VARARGS|METH_KEYWORDS,
+            "Build the index" },
+    {"sort_keys", (PyCFunction) Index_sort_keys, METH_VARARGS,
+            "Write sorted runs of keys for a range of rows to files for "
+            "one or more indexes" },
+    {"merge_keys", (PyCFunction) Index_merge_keys, METH_VARARGS,
+            "Insert the keys from sorted run files into the index" },
+    {"start_key_sort", (PyCFunction) Index_start_key_sort, METH_VARARGS,
+            "Sort the keys for this index as rows are written to the table" },
+    {"finish_key_sort", (PyCFunction) Index_finish_key_sort, METH_NOARGS,
+            "Return the files of keys sorted as rows were written" },
     {"set_bin_widths", (PyCFunction) Index_set_bin_widths, METH_VARARGS,
         "Sets the bin widths for the columns" },
     {"get_min", (PyCFunction) Index_get_min, METH_VARARGS,
@@ -3549,317 +6331,2553 @@ static PyMethodDef Index_methods[] = {
         "Returns the number of rows in the index with the specified key." },
     {"open", (PyCFunction) Index_open, METH_VARARGS, "Open the index" },
     {"close", (PyCFunction) Index_close, METH_NOARGS, "Close the index" },
+    {"check_idle", (PyCFunction) Index_check_idle_method, METH_NOARGS,
+            "Raise an error if the index is in use by another thread" },
+    {NULL}  /* Sentinel */
+};
+
+
+static PyTypeObject IndexType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    "_wormtable.Index",             /* tp_name */
+    sizeof(Index),             /* tp_basicsize */
+    0,                         /* tp_itemsize */
+    (destructor)Index_dealloc, /* tp_dealloc */
+    0,                         /* tp_print */
+    0,                         /* tp_getattr */
+    0,                         /* tp_setattr */
+    0,                         /* tp_reserved */
+    0,                         /* tp_repr */
+    0,                         /* tp_as_number */
+    0,                         /* tp_as_sequence */
+    0,                         /* tp_as_mapping */
+    0,                         /* tp_hash  */
+    0,                         /* tp_call */
+    0,                         /* tp_str */
+    0,                         /* tp_getattro */
+    0,                         /* tp_setattro */
+    0,                         /* tp_as_buffer */
+    Py_TPFLAGS_DEFAULT,        /* tp_flags */
+    "Index objects",           /* tp_doc */
+    0,                     /* tp_traverse */
+    0,                     /* tp_clear */
+    0,                     /* tp_richcompare */
+    0,                     /* tp_weaklistoffset */
+    0,                     /* tp_iter */
+    0,                     /* tp_iternext */
+    Index_methods,             /* tp_methods */
+    Index_members,             /* tp_members */
+    0,                         /* tp_getset */
+    0,                         /* tp_base */
+    0,                         /* tp_dict */
+    0,                         /* tp_descr_get */
+    0,                         /* tp_descr_set */
+    0,                         /* tp_dictoffset */
+    (initproc)Index_init,      /* tp_init */
+};
+
+
+
+
+/*==========================================================
+ * RowFilter
+ *==========================================================
+ */
+
+static void
+RowFilter_free(RowFilter *self)
+{
+    uint32_t j;
+    if (self->instructions != NULL) {
+        for (j = 0; j < self->num_instructions; j++) {
+            PyMem_Free(self->instructions[j].char_value);
+        }
+        PyMem_Free(self->instructions);
+    }
+    if (self->columns != NULL) {
+        Table_free_columns(self->columns, self->num_columns);
+    }
+    PyMem_Free(self->starts);
+    PyMem_Free(self->read_columns);
+    PyMem_Free(self->decoded);
+    PyMem_Free(self->missing);
+    PyMem_Free(self->projection);
+    PyMem_Free(self->projection_missing);
+}
+
+/*
+ * Returns the index of the specified table column within the filter's
+ * columns, adding it if necessary.
+ */
+static uint32_t
+RowFilter_add_column(RowFilter *self, uint32_t table_column)
+{
+    uint32_t j;
+    for (j = 0; j < self->num_columns; j++) {
+        if (self->read_columns[j] == table_column) {
+            break;
+        }
+    }
+    if (j == self->num_columns) {
+        self->read_columns[j] = table_column;
+        self->num_columns++;
+    }
+    return j;
+}
+
+/*
+ * Sets the constant for the specified instruction from the specified
+ * Python value, which must be an int, float or bytes object.
+ */
+static int
+RowFilter_set_constant(RowFilter *self, FilterInstruction *inst,
+        PyObject *value)
+{
+    int ret = -1;
+    int overflow = 0;
+    char *s;
+    Py_ssize_t size;
+
+    if (PyBytes_Check(value)) {
+        if (PyBytes_AsStringAndSize(value, &s, &size) != 0) {
+            goto out;
+        }
+        inst->char_value = PyMem_Malloc(size + 1);
+        if (inst->char_value == NULL) {
+            PyErr_NoMemory();
+            goto out;
+        }
+        memcpy(inst->char_value, s, size);
+        inst->char_size = size;
+        inst->constant_type = WT_CHAR;
+    } else if (PyFloat_Check(value)) {
+        inst->float_value = PyFloat_AsDouble(value);
+        inst->constant_type = WT_FLOAT;
+    } else if (PyNumber_Check(value)) {
+        inst->int_value = PyLong_AsLongLongAndOverflow(value, &overflow);
+        if (inst->int_value == -1 && PyErr_Occurred()) {
+            goto out;
+        }
+        inst->float_value = PyLong_AsDouble(value);
+        inst->uint_value = (uint64_t) inst->int_value;
+        inst->constant_type = WT_INT;
+        if (overflow < 0) {
+            PyErr_SetString(PyExc_OverflowError, "Filter constant too small");
+            goto out;
+        }
+        if (overflow > 0) {
+            inst->uint_value = PyLong_AsUnsignedLongLong(value);
+            inst->constant_type = WT_UINT;
+        }
+        if (PyErr_Occurred()) {
+            goto out;
+        }
+    } else {
+        PyErr_SetString(PyExc_TypeError, "Unsupported filter constant");
+        goto out;
+    }
+    ret = 0;
+out:
+    return ret;
+}
+
+/*
+ * Initialises the specified filter from a program, which is a list
+ * of tuples describing the instructions in postfix order:
+ *
+ * (WT_FILTER_CMP, column, element, cmp, value)
+ * (WT_FILTER_MISSING, column, element)
+ * (WT_FILTER_CONTAINS, column, value)
+ * (WT_FILTER_AND,), (WT_FILTER_OR,) and (WT_FILTER_NOT,)
+ *
+ * Columns are positions within the specified table and an element of
+ * -1 refers to the only element of a scalar column. The specified
+ * columns are the cursor's projection and its copies of these columns.
+ */
+static int
+RowFilter_init(RowFilter *self, Table *table, PyObject *program,
+        uint32_t *read_columns, Column **columns, uint32_t num_read_columns)
+{
+    int ret = -1;
+    uint32_t j, k;
+    int depth = 0;
+    int type, cmp;
+    unsigned int column;
+    int element;
+    PyObject *t, *value;
+    FilterInstruction *inst;
+    Column *col = NULL;
+    uint32_t n = (uint32_t) PyList_GET_SIZE(program);
+
+    memset(self, 0, sizeof(RowFilter));
+    if (n == 0) {
+        PyErr_SetString(PyExc_ValueError, "Empty filter program");
+        goto out;
+    }
+    self->instructions = PyMem_Malloc(n * sizeof(FilterInstruction));
+    self->read_columns = PyMem_Malloc(n * sizeof(uint32_t));
+    self->starts = PyMem_Malloc(n * sizeof(uint32_t));
+    if (self->instructions == NULL || self->read_columns == NULL
+            || self->starts == NULL) {
+        PyErr_NoMemory();
+        goto out;
+    }
+    memset(self->instructions, 0, n * sizeof(FilterInstruction));
+    self->num_instructions = n;
+    for (j = 0; j < n; j++) {
+        inst = &self->instructions[j];
+        t = PyList_GET_ITEM(program, j);
+        if (!PyTuple_Check(t) || PyTuple_GET_SIZE(t) < 1) {
+            PyErr_SetString(PyExc_ValueError, "Bad filter instruction");
+            goto out;
+        }
+        type = (int) PyLong_AsLong(PyTuple_GET_ITEM(t, 0));
+        if (type == -1 && PyErr_Occurred()) {
+            goto out;
+        }
+        inst->type = type;
+        inst->element = -1;
+        column = 0;
+        value = NULL;
+        if (type == WT_FILTER_CMP) {
+            if (!PyArg_ParseTuple(t, "iIiiO", &type, &column, &element, &cmp,
+                    &value)) {
+                goto out;
+            }
+            if (cmp < WT_FILTER_LT || cmp > WT_FILTER_GE) {
+                PyErr_SetString(PyExc_ValueError, "Bad filter comparison");
+                goto out;
+            }
+            inst->element = element;
+            inst->cmp = cmp;
+            depth++;
+        } else if (type == WT_FILTER_MISSING) {
+            if (!PyArg_ParseTuple(t, "iIi", &type, &column, &element)) {
+                goto out;
+            }
+            inst->element = element;
+            depth++;
+        } else if (type == WT_FILTER_CONTAINS) {
+            if (!PyArg_ParseTuple(t, "iIO", &type, &column, &value)) {
+                goto out;
+            }
+            depth++;
+        } else if (type == WT_FILTER_AND || type == WT_FILTER_OR) {
+            depth--;
+        } else if (type != WT_FILTER_NOT) {
+            PyErr_SetString(PyExc_ValueError, "Bad filter instruction");
+            goto out;
+        }
+        if (depth < 1) {
+            PyErr_SetString(PyExc_ValueError, "Filter stack underflow");
+            goto out;
+        }
+        /* The operands of NOT, AND and OR end at the previous instruction,
+         * and the left operand of AND and OR ends just before the start of
+         * the right operand. */
+        self->starts[j] = j;
+        if (type == WT_FILTER_NOT) {
+            self->starts[j] = self->starts[j - 1];
+        } else if (type == WT_FILTER_AND || type == WT_FILTER_OR) {
+            self->starts[j] = self->starts[self->starts[j - 1] - 1];
+        }
+        if (type == WT_FILTER_CMP || type == WT_FILTER_MISSING
+                || type == WT_FILTER_CONTAINS) {
+            if (column >= table->num_columns) {
+                PyErr_SetString(PyExc_ValueError,
+                        "Column positions out of bounds");
+                goto out;
+            }
+            col = table->columns[column];
+            if (inst->element < -1 || (inst->element >= 0
+                    && col->element_type == WT_CHAR)) {
+                PyErr_SetString(PyExc_ValueError, "Bad filter element");
+                goto out;
+            }
+            inst->column = RowFilter_add_column(self, column);
+        }
+        if (value != NULL) {
+            if (RowFilter_set_constant(self, inst, value) != 0) {
+                goto out;
+            }
+            if ((col->element_type == WT_CHAR)
+                    != (inst->constant_type == WT_CHAR)) {
+                PyErr_SetString(PyExc_TypeError,
+                        "Filter constant does not match column type");
+                goto out;
+            }
+        }
+    }
+    if (depth != 1) {
+        PyErr_SetString(PyExc_ValueError, "Malformed filter program");
+        goto out;
+    }
+    self->columns = PyMem_Malloc(self->num_columns * sizeof(Column *));
+    self->decoded = PyMem_Malloc(self->num_columns * sizeof(int));
+    self->missing = PyMem_Malloc(self->num_columns * sizeof(int));
+    self->projection = PyMem_Malloc(num_read_columns * sizeof(int32_t));
+    self->projection_missing = PyMem_Malloc(num_read_columns * sizeof(int));
+    if (self->columns == NULL || self->decoded == NULL
+            || self->missing == NULL || self->projection == NULL
+            || self->projection_missing == NULL) {
+        PyErr_NoMemory();
+        goto out;
+    }
+    memset(self->columns, 0, self->num_columns * sizeof(Column *));
+    memset(self->decoded, 0, self->num_columns * sizeof(int));
+    self->projection_size = num_read_columns;
+    for (k = 0; k < num_read_columns; k++) {
+        self->projection[k] = -1;
+    }
+    for (j = 0; j < self->num_columns; j++) {
+        for (k = 0; k < num_read_columns; k++) {
+            if (read_columns[k] == self->read_columns[j]
+                    && self->columns[j] == NULL) {
+                self->projection[k] = (int32_t) j;
+                self->columns[j] = columns[k];
+                Py_INCREF(self->columns[j]);
+            }
+        }
+        if (self->columns[j] == NULL) {
+            self->columns[j] = Table_copy_column(table,
+                    table->columns[self->read_columns[j]]);
+            if (self->columns[j] == NULL) {
+                goto out;
+            }
+        }
+    }
+    ret = 0;
+out:
+    return ret;
+}
+
+/*
+ * Compares element j of the specified column with the constant in the
+ * specified instruction using the specified comparison, returning the
+ * result. NaN values are unordered, and so are only unequal to other
+ * values.
+ */
+static int
+RowFilter_compare(FilterInstruction *inst, Column *col, uint32_t j, int cmp)
+{
+    int c = 0;
+    int unordered = 0;
+    int64_t iv;
+    uint64_t uv;
+    double a, b;
+    Py_ssize_t size;
+
+    if (col->element_type == WT_CHAR) {
+        size = col->num_buffered_elements;
+        c = memcmp(col->element_buffer, inst->char_value,
+                WT_MIN(size, inst->char_size));
+        if (c == 0) {
+            c = (size > inst->char_size) - (size < inst->char_size);
+        }
+    } else if (col->element_type == WT_FLOAT
+            || inst->constant_type == WT_FLOAT) {
+        if (col->element_type == WT_FLOAT) {
+            a = ((double *) col->element_buffer)[j];
+        } else if (col->element_type == WT_INT) {
+            a = (double) ((int64_t *) col->element_buffer)[j];
+        } else {
+            a = (double) ((uint64_t *) col->element_buffer)[j];
+        }
+        b = inst->float_value;
+        unordered = a != a || b != b;
+        c = (a > b) - (a < b);
+    } else if (col->element_type == WT_INT) {
+        iv = ((int64_t *) col->element_buffer)[j];
+        if (inst->constant_type == WT_UINT) {
+            c = -1;
+        } else {
+            c = (iv > inst->int_value) - (iv < inst->int_value);
+        }
+    } else {
+        uv = ((uint64_t *) col->element_buffer)[j];
+        if (inst->constant_type == WT_INT && inst->int_value < 0) {
+            c = 1;
+        } else {
+            c = (uv > inst->uint_value) - (uv < inst->uint_value);
+        }
+    }
+    if (unordered) {
+        return cmp == WT_FILTER_NE;
+    }
+    switch (cmp) {
+        case WT_FILTER_LT:
+            return c < 0;
+        case WT_FILTER_LE:
+            return c <= 0;
+        case WT_FILTER_EQ:
+            return c == 0;
+        case WT_FILTER_NE:
+            return c != 0;
+        case WT_FILTER_GT:
+            return c > 0;
+        default:
+            return c >= 0;
+    }
+}
+
+/*
+ * Returns true if the specified column contains the constant in the
+ * specified instruction. For char columns, this is a substring test.
+ */
+static int
+RowFilter_contains(FilterInstruction *inst, Column *col)
+{
+    int ret = 0;
+    uint32_t j;
+    Py_ssize_t k;
+    Py_ssize_t size = col->num_buffered_elements;
+    char *v = (char *) col->element_buffer;
+
+    if (col->element_type == WT_CHAR) {
+        for (k = 0; k + inst->char_size <= size && !ret; k++) {
+            ret = memcmp(v + k, inst->char_value, inst->char_size) == 0;
+        }
+    } else {
+        for (j = 0; j < (uint32_t) size && !ret; j++) {
+            ret = RowFilter_compare(inst, col, j, WT_FILTER_EQ);
+        }
+    }
+    return ret;
+}
+
+/*
+ * Decodes the specified filter column from the row if this has not
+ * already been done. Returns -1 if an error occurs.
+ */
+static int
+RowFilter_decode_column(RowFilter *self, Table *table, void *row_buffer,
+        void *row, uint32_t j)
+{
+    int ret = 0;
+    if (!self->decoded[j]) {
+        ret = Table_extract_elements(table, self->columns[j], row_buffer,
+                row);
+        if (ret >= 0) {
+            self->missing[j] = ret == WT_MISSING_VALUE;
+            self->decoded[j] = 1;
+            ret = 0;
+        }
+    }
+    return ret;
+}
+
+/*
+ * Evaluates the subexpression ending at instruction k for the specified
+ * row, returning 1 if it is true, 0 if it is false and -1 if an error
+ * occurs.
+ */
+static int
+RowFilter_evaluate_instruction(RowFilter *self, Table *table,
+        void *row_buffer, void *row, uint32_t k)
+{
+    int ret = 0;
+    FilterInstruction *inst = &self->instructions[k];
+    Column *col = self->columns[inst->column];
+    uint32_t element = inst->element < 0 ? 0 : (uint32_t) inst->element;
+    int missing = 0;
+
+    if (inst->type == WT_FILTER_CMP || inst->type == WT_FILTER_MISSING
+            || inst->type == WT_FILTER_CONTAINS) {
+        if (RowFilter_decode_column(self, table, row_buffer, row,
+                    inst->column) != 0) {
+            ret = -1;
+            goto out;
+        }
+        missing = self->missing[inst->column];
+    }
+    switch (inst->type) {
+        case WT_FILTER_CMP:
+            if (!missing && element < col->num_buffered_elements) {
+                ret = RowFilter_compare(inst, col, element, inst->cmp);
+            }
+            break;
+        case WT_FILTER_MISSING:
+            ret = missing;
+            if (inst->element >= 0) {
+                ret = ret || element >= col->num_buffered_elements;
+            }
+            break;
+        case WT_FILTER_CONTAINS:
+            if (!missing) {
+                ret = RowFilter_contains(inst, col);
+            }
+            break;
+        case WT_FILTER_NOT:
+            ret = RowFilter_evaluate_instruction(self, table, row_buffer,
+                    row, k - 1);
+            if (ret >= 0) {
+                ret = !ret;
+            }
+            break;
+        default:
+            /* AND and OR; only evaluate the right operand if needed */
+            ret = RowFilter_evaluate_instruction(self, table, row_buffer,
+                    row, self->starts[k - 1] - 1);
+            if (ret >= 0 && ret == (inst->type == WT_FILTER_AND)) {
+                ret = RowFilter_evaluate_instruction(self, table,
+                        row_buffer, row, k - 1);
+            }
+            break;
+    }
+out:
+    return ret;
+}
+
+/*
+ * Evaluates the filter for the specified row returned by
+ * Table_retrieve_row. Comparisons involving missing values, or elements
+ * beyond the end of a column, are false. Returns 1 if the row passes the
+ * filter, 0 if it does not and -1 if an error occurs.
+ */
+static int
+RowFilter_evaluate(RowFilter *self, Table *table, void *row_buffer,
+        void *row)
+{
+    memset(self->decoded, 0, self->num_columns * sizeof(int));
+    return RowFilter_evaluate_instruction(self, table, row_buffer, row,
+            self->num_instructions - 1);
+}
+
+/*
+ * Returns an array with an entry for each column in the cursor's
+ * projection, giving the missing value status of the column if it has
+ * already been decoded by the filter for the current row and -1
+ * otherwise (see Table_decode_column). Returns NULL if the filter is NULL.
+ */
+static int *
+RowFilter_get_projection_missing(RowFilter *self)
+{
+    uint32_t k;
+    int32_t j;
+    if (self == NULL) {
+        return NULL;
+    }
+    for (k = 0; k < self->projection_size; k++) {
+        j = self->projection[k];
+        self->projection_missing[k] = -1;
+        if (j >= 0 && self->decoded[j]) {
+            self->projection_missing[k] = self->missing[j];
+        }
+    }
+    return self->projection_missing;
+}
+
+/*
+ * Returns a new filter for the specified table compiled from the
+ * specified program for a cursor with the specified projection, or NULL
+ * if an error occurs.
+ */
+static RowFilter *
+RowFilter_alloc(Table *table, PyObject *program, uint32_t *read_columns,
+        Column **columns, uint32_t num_read_columns)
+{
+    RowFilter *ret = NULL;
+    RowFilter *filter = PyMem_Malloc(sizeof(RowFilter));
+    if (filter == NULL) {
+        PyErr_NoMemory();
+        goto out;
+    }
+    if (RowFilter_init(filter, table, program, read_columns, columns,
+                num_read_columns) != 0) {
+        RowFilter_free(filter);
+        PyMem_Free(filter);
+        goto out;
+    }
+    ret = filter;
+out:
+    return ret;
+}
+
+/*==========================================================
+ * RowAggregator
+ *==========================================================
+ */
+
+/*
+ * Updates the statistics with the elements in the element buffer of the
+ * specified column, which must not be missing. Each value of a char
+ * column counts as a single element.
+ */
+static void
+ColumnStats_update(ColumnStats *self, Column *col)
+{
+    int j;
+    uint64_t u;
+    int64_t v;
+    double x;
+
+    if (col->element_type == WT_CHAR) {
+        self->count++;
+        return;
+    }
+    for (j = 0; j < col->num_buffered_elements; j++) {
+        if (col->element_type == WT_UINT) {
+            u = ((uint64_t *) col->element_buffer)[j];
+            self->uint_sum += u;
+            if (self->uint_sum < u) {
+                self->sum_carry++;
+            }
+            if (self->count == 0 || u < self->uint_min) {
+                self->uint_min = u;
+            }
+            if (self->count == 0 || u > self->uint_max) {
+                self->uint_max = u;
+            }
+        } else if (col->element_type == WT_INT) {
+            v = ((int64_t *) col->element_buffer)[j];
+            if (v > 0 && self->int_sum > INT64_MAX - v) {
+                self->sum_carry++;
+            } else if (v < 0 && self->int_sum < INT64_MIN - v) {
+                self->sum_carry--;
+            }
+            /* Add modulo 2^64 to avoid signed overflow */
+            self->int_sum = (int64_t) ((uint64_t) self->int_sum
+                    + (uint64_t) v);
+            if (self->count == 0 || v < self->int_min) {
+                self->int_min = v;
+            }
+            if (self->count == 0 || v > self->int_max) {
+                self->int_max = v;
+            }
+        } else {
+            x = ((double *) col->element_buffer)[j];
+            self->float_sum += x;
+            if (self->count == 0 || x < self->float_min) {
+                self->float_min = x;
+            }
+            if (self->count == 0 || x > self->float_max) {
+                self->float_max = x;
+            }
+        }
+        self->count++;
+    }
+}
+
+/*
+ * Returns the exact sum of the integer elements in the statistics of the
+ * specified column as a Python integer.
+ */
+static PyObject *
+ColumnStats_get_int_sum(ColumnStats *self, Column *col)
+{
+    PyObject *ret = NULL;
+    PyObject *low = NULL;
+    PyObject *high = NULL;
+    PyObject *shift = NULL;
+    PyObject *shifted = NULL;
+
+    if (col->element_type == WT_UINT) {
+        low = PyLong_FromUnsignedLongLong(
+                (unsigned long long) self->uint_sum);
+    } else {
+        low = PyLong_FromLongLong((long long) self->int_sum);
+    }
+    if (low == NULL || self->sum_carry == 0) {
+        ret = low;
+        low = NULL;
+        goto out;
+    }
+    high = PyLong_FromLongLong((long long) self->sum_carry);
+    shift = PyLong_FromLong(64);
+    if (high == NULL || shift == NULL) {
+        goto out;
+    }
+    shifted = PyNumber_Lshift(high, shift);
+    if (shifted == NULL) {
+        goto out;
+    }
+    ret = PyNumber_Add(shifted, low);
+out:
+    Py_XDECREF(low);
+    Py_XDECREF(high);
+    Py_XDECREF(shift);
+    Py_XDECREF(shifted);
+    return ret;
+}
+
+/*
+ * Returns the tuple (count, sum, min, max) for the statistics of the
+ * specified column. The sum, min and max are None for char columns, and
+ * min and max are None if there are no values.
+ */
+static PyObject *
+ColumnStats_get_python(ColumnStats *self, Column *col)
+{
+    PyObject *ret = NULL;
+    PyObject *sum;
+    unsigned long long count = (unsigned long long) self->count;
+
+    if (col->element_type == WT_CHAR) {
+        ret = Py_BuildValue("(KOOO)", count, Py_None, Py_None, Py_None);
+    } else if (self->count == 0) {
+        if (col->element_type == WT_FLOAT) {
+            ret = Py_BuildValue("(KdOO)", count, 0.0, Py_None, Py_None);
+        } else {
+            ret = Py_BuildValue("(KiOO)", count, 0, Py_None, Py_None);
+        }
+    } else if (col->element_type == WT_UINT) {
+        sum = ColumnStats_get_int_sum(self, col);
+        if (sum != NULL) {
+            ret = Py_BuildValue("(KNKK)", count, sum,
+                    (unsigned long long) self->uint_min,
+                    (unsigned long long) self->uint_max);
+        }
+    } else if (col->element_type == WT_INT) {
+        sum = ColumnStats_get_int_sum(self, col);
+        if (sum != NULL) {
+            ret = Py_BuildValue("(KNLL)", count, sum,
+                    (long long) self->int_min, (long long) self->int_max);
+        }
+    } else {
+        ret = Py_BuildValue("(Kddd)", count, self->float_sum,
+                self->float_min, self->float_max);
+    }
+    return ret;
+}
+
+static void
+RowAggregator_free(RowAggregator *self)
+{
+    uint32_t j;
+    if (self->group_values != NULL) {
+        for (j = 0; j < self->num_group_columns; j++) {
+            PyMem_Free(self->group_values[j]);
+        }
+        PyMem_Free(self->group_values);
+    }
+    PyMem_Free(self->bin_widths);
+    PyMem_Free(self->group_num_elements);
+    PyMem_Free(self->group_missing);
+    PyMem_Free(self->stats);
+    Py_XDECREF(self->group_key);
+    Py_XDECREF(self->results);
+}
+
+/*
+ * Initialises the specified aggregator over the specified columns, which
+ * are the decoding state of a cursor. The bin widths are a list with a
+ * float for each group column.
+ */
+static int
+RowAggregator_init(RowAggregator *self, Column **columns,
+        uint32_t num_columns, PyObject *bin_widths)
+{
+    int ret = -1;
+    uint32_t j;
+    uint32_t num_group_columns = (uint32_t) PyList_GET_SIZE(bin_widths);
+    uint32_t num_stats = num_columns - num_group_columns;
+    double w;
+    Column *col;
+
+    memset(self, 0, sizeof(RowAggregator));
+    if (num_group_columns > num_columns) {
+        PyErr_SetString(PyExc_ValueError, "Too many group columns");
+        goto out;
+    }
+    self->results = PyList_New(0);
+    if (self->results == NULL) {
+        goto out;
+    }
+    self->bin_widths = PyMem_Malloc(num_group_columns * sizeof(double));
+    self->group_values = PyMem_Malloc(num_group_columns * sizeof(void *));
+    self->group_num_elements = PyMem_Malloc(num_group_columns * sizeof(int));
+    self->group_missing = PyMem_Malloc(num_group_columns * sizeof(int));
+    self->stats = PyMem_Malloc(num_stats * sizeof(ColumnStats));
+    if (self->bin_widths == NULL || self->group_values == NULL
+            || self->group_num_elements == NULL
+            || self->group_missing == NULL || self->stats == NULL) {
+        PyErr_NoMemory();
+        goto out;
+    }
+    memset(self->group_values, 0, num_group_columns * sizeof(void *));
+    self->columns = columns;
+    self->num_columns = num_columns;
+    self->num_group_columns = num_group_columns;
+    for (j = 0; j < num_group_columns; j++) {
+        col = columns[j];
+        w = PyFloat_AsDouble(PyList_GET_ITEM(bin_widths, j));
+        if (w == -1.0 && PyErr_Occurred()) {
+            goto out;
+        }
+        if (w < 0.0 || (w > 0.0 && (col->element_type == WT_CHAR
+                    || (col->element_type != WT_FLOAT && w < 1.0)))) {
+            PyErr_SetString(PyExc_ValueError, "Bad bin width");
+            goto out;
+        }
+        self->bin_widths[j] = w;
+        self->group_values[j] = PyMem_Malloc(
+                Column_get_max_num_elements(col)
+                * Column_get_native_element_size(col));
+        if (self->group_values[j] == NULL) {
+            PyErr_NoMemory();
+            goto out;
+        }
+    }
+    ret = 0;
+out:
+    return ret;
+}
+
+/*
+ * Starts a new group using the values of the group columns for the
+ * current row.
+ */
+static int
+RowAggregator_start_group(RowAggregator *self)
+{
+    int ret = -1;
+    uint32_t j;
+    Column *col;
+    PyObject *key = NULL;
+    PyObject *v;
+
+    key = PyTuple_New(self->num_group_columns);
+    if (key == NULL) {
+        goto out;
+    }
+    for (j = 0; j < self->num_group_columns; j++) {
+        col = self->columns[j];
+        v = Column_get_python_elements(col, self->group_missing[j]);
+        if (v == NULL) {
+            goto out;
+        }
+        PyTuple_SET_ITEM(key, j, v);
+        self->group_num_elements[j] = col->num_buffered_elements;
+        memcpy(self->group_values[j], col->element_buffer,
+                col->num_buffered_elements
+                * Column_get_native_element_size(col));
+    }
+    memset(self->stats, 0, (self->num_columns - self->num_group_columns)
+            * sizeof(ColumnStats));
+    self->num_rows = 0;
+    self->group_key = key;
+    key = NULL;
+    ret = 0;
+out:
+    Py_XDECREF(key);
+    return ret;
+}
+
+/*
+ * Appends the tuple (key, num_rows, stats) for the current group to the
+ * results, where stats is a tuple of the statistics for each of the
+ * aggregated columns.
+ */
+static int
+RowAggregator_finish_group(RowAggregator *self)
+{
+    int ret = -1;
+    uint32_t j;
+    uint32_t ng = self->num_group_columns;
+    PyObject *stats = NULL;
+    PyObject *t = NULL;
+    PyObject *v;
+
+    stats = PyTuple_New(self->num_columns - ng);
+    if (stats == NULL) {
+        goto out;
+    }
+    for (j = ng; j < self->num_columns; j++) {
+        v = ColumnStats_get_python(&self->stats[j - ng], self->columns[j]);
+        if (v == NULL) {
+            goto out;
+        }
+        PyTuple_SET_ITEM(stats, j - ng, v);
+    }
+    t = Py_BuildValue("(OKO)", self->group_key,
+            (unsigned long long) self->num_rows, stats);
+    if (t == NULL) {
+        goto out;
+    }
+    if (PyList_Append(self->results, t) != 0) {
+        goto out;
+    }
+    Py_CLEAR(self->group_key);
+    ret = 0;
+out:
+    Py_XDECREF(stats);
+    Py_XDECREF(t);
+    return ret;
+}
+
+/*
+ * Adds the specified row returned by Table_retrieve_row to the
+ * aggregates, finishing the current group and starting a new one if the
+ * values of the group columns have changed. See Table_decode_column for
+ * the meaning of decoded, which may be NULL.
+ */
+static int
+RowAggregator_add_row(RowAggregator *self, Table *table, void *row_buffer,
+        void *row, int *decoded)
+{
+    int ret = -1;
+    int wt_ret, missing;
+    int same = self->group_key != NULL;
+    uint32_t j;
+    uint32_t ng = self->num_group_columns;
+    Column *col;
+
+    for (j = 0; j < ng; j++) {
+        col = self->columns[j];
+        wt_ret = Table_decode_column(table, self->columns, decoded, j,
+                row_buffer, row);
+        if (wt_ret < 0) {
+            goto out;
+        }
+        missing = wt_ret == WT_MISSING_VALUE;
+        if (self->bin_widths[j] > 0.0 && !missing) {
+            if (col->truncate_elements(col, self->bin_widths[j]) != 0) {
+                goto out;
+            }
+        }
+        same = same && missing == self->group_missing[j]
+            && (missing || (col->num_buffered_elements
+                    == self->group_num_elements[j]
+                && memcmp(col->element_buffer, self->group_values[j],
+                    col->num_buffered_elements
+                    * Column_get_native_element_size(col)) == 0));
+        self->group_missing[j] = missing;
+    }
+    if (!same) {
+        if (self->group_key != NULL) {
+            if (RowAggregator_finish_group(self) != 0) {
+                goto out;
+            }
+        }
+        if (RowAggregator_start_group(self) != 0) {
+            goto out;
+        }
+    }
+    for (j = ng; j < self->num_columns; j++) {
+        col = self->columns[j];
+        wt_ret = Table_decode_column(table, self->columns, decoded, j,
+                row_buffer, row);
+        if (wt_ret < 0) {
+            goto out;
+        }
+        if (wt_ret != WT_MISSING_VALUE) {
+            ColumnStats_update(&self->stats[j - ng], col);
+        }
+    }
+    self->num_rows++;
+    ret = 0;
+out:
+    return ret;
+}
+
+/*
+ * Finishes the last group and returns a new reference to the list of
+ * results. If there are no group columns, there is always exactly one
+ * group, even if no rows were added.
+ */
+static PyObject *
+RowAggregator_finish(RowAggregator *self)
+{
+    PyObject *ret = NULL;
+    if (self->group_key == NULL && self->num_group_columns == 0) {
+        if (RowAggregator_start_group(self) != 0) {
+            goto out;
+        }
+    }
+    if (self->group_key != NULL) {
+        if (RowAggregator_finish_group(self) != 0) {
+            goto out;
+        }
+    }
+    Py_INCREF(self->results);
+    ret = self->results;
+out:
+    return ret;
+}
+
+/*==========================================================
+ * TableRowIterator object
+ *==========================================================
+ */
+
+static void
+TableRowIterator_dealloc(TableRowIterator* self)
+{
+    if (self->cursor != NULL) {
+        if (self->table != NULL) {
+            if (self->table->db != NULL) {
+                self->cursor->close(self->cursor);
+            }
+        }
+    }
+    Py_XDECREF(self->table);
+    Py_XDECREF(self->id_column);
+    if (self->min_key != NULL) {
+        PyMem_Free(self->min_key);
+    }
+    if (self->max_key != NULL) {
+        PyMem_Free(self->max_key);
+    }
+    if (self->read_columns != NULL) {
+        PyMem_Free(self->read_columns);
+    }
+    if (self->row_buffer != NULL) {
+        PyMem_Free(self->row_buffer);
+    }
+    if (self->columns != NULL) {
+        Table_free_columns(self->columns, self->num_read_columns);
+    }
+    if (self->filter != NULL) {
+        RowFilter_free(self->filter);
+        PyMem_Free(self->filter);
+    }
+    Py_TYPE(self)->tp_free((PyObject*)self);
+}
+
+static int
+TableRowIterator_init(TableRowIterator *self, PyObject *args, PyObject *kwds)
+{
+    int j;
+    int ret = -1;
+    long k;
+    static char *kwlist[] = {"table", "columns", NULL};
+    PyObject *v = NULL;
+    PyObject *columns = NULL;
+    Table *table = NULL;
+    Column *id_col = NULL;
+
+    self->started = 0;
+    self->completed = 0;
+    self->batch_size = 0;
+    self->read_columns = NULL;
+    self->table = NULL;
+    self->min_key = NULL;
+    self->min_row_id = 0;
+    self->max_key = NULL;
+    self->row_buffer = NULL;
+    self->columns = NULL;
+    self->id_column = NULL;
+    self->filter = NULL;
+    self->cursor = NULL;
+    self->sequential = 0;
+    self->scan_offset = 0;
+    self->scan_row_id = 0;
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O!O!", kwlist,
+            &TableType, &table,
+            &PyList_Type, &columns)) {
+        goto out;
+    }
+    self->table = table;
+    Py_INCREF(self->table);
+    if (Table_check_read_mode(self->table) != 0) {
+        goto out;
+    }
+    self->num_read_columns = PyList_GET_SIZE(columns);
+    if (self->num_read_columns < 1) {
+        PyErr_SetString(PyExc_ValueError, "At least one read column required");
+        goto out;
+    }
+    self->read_columns = PyMem_Malloc(self->num_read_columns
+            * sizeof(uint32_t));
+    if (self->read_columns == NULL) {
+        PyErr_NoMemory();
+        goto out;
+    }
+    for (j = 0; j < self->num_read_columns; j++) {
+        v = PyList_GET_ITEM(columns, j);
+        if (!PyNumber_Check(v)) {
+            PyErr_SetString(PyExc_ValueError, "Column positions must be int");
+            goto out;
+        }
+        k = PyLong_AsLong(v);
+        if (k < 0 || k >= self->table->num_columns) {
+            PyErr_SetString(PyExc_ValueError, "Column positions out of bounds");
+            goto out;
+        }
+        self->read_columns[j] = (uint32_t) k;
+    }
+    id_col = self->table->columns[0];
+    self->min_key = PyMem_Malloc(id_col->element_size);
+    self->max_key = PyMem_Malloc(id_col->element_size);
+    self->row_buffer = PyMem_Malloc(self->table->row_buffer_size);
+    if (self->min_key == NULL || self->max_key == NULL
+            || self->row_buffer == NULL) {
+        PyErr_NoMemory();
+        goto out;
+    }
+    self->columns = Table_copy_columns(self->table, self->read_columns,
+            self->num_read_columns);
+    if (self->columns == NULL) {
+        goto out;
+    }
+    self->id_column = Table_copy_column(self->table, id_col);
+    if (self->id_column == NULL) {
+        goto out;
+    }
+    ret = 0;
+out:
+    return ret;
+}
+
+
+
+static PyMemberDef TableRowIterator_members[] = {
+    {NULL}  /* Sentinel */
+};
+
+
+/*
+ * Sets up a sequential scan of the mapped data file starting from the
+ * row identified by min_key. Rows are stored in the data file in
+ * row_id order, so the primary DB is only consulted to find the offset
+ * of the first row when we are not starting from row 0.
+ */
+static int
+TableRowIterator_start_scan(TableRowIterator *self)
+{
+    int ret = -1;
+    int db_ret;
+    DB *db = self->table->db;
+    DBT key, data;
+    char record[OFFSET_LEN_RECORD_SIZE];
+
+    self->scan_offset = 0;
+    self->scan_row_id = 0;
+    if (self->min_key_size != 0 && self->min_row_id != 0) {
+        memset(&key, 0, sizeof(DBT));
+        memset(&data, 0, sizeof(DBT));
+        key.data = self->min_key;
+        key.size = self->min_key_size;
+        data.data = record;
+        data.ulen = OFFSET_LEN_RECORD_SIZE;
+        data.flags = DB_DBT_USERMEM;
+        self->table->num_users++;
+        Py_BEGIN_ALLOW_THREADS
+        db_ret = db->get(db, NULL, &key, &data, 0);
+        Py_END_ALLOW_THREADS
+        self->table->num_users--;
+        if (db_ret == DB_NOTFOUND) {
+            /* min_key is beyond the last row, so there's nothing to read */
+            self->scan_offset = self->table->data_map_size;
+        } else if (db_ret != 0) {
+            handle_bdb_error(db_ret);
+            goto out;
+        } else {
+            if (data.size != OFFSET_LEN_RECORD_SIZE) {
+                PyErr_Format(PyExc_SystemError,
+                        "offset/len record size mismatch");
+                goto out;
+            }
+            self->scan_offset = unpack_uint(data.data, sizeof(uint64_t));
+            self->scan_row_id = self->min_row_id;
+        }
+    }
+    ret = 0;
+out:
+    return ret;
+}
+
+/*
+ * Advances the sequential scan, setting row to point to the next row in
+ * the mapped data file and writing its key into the iterator's row buffer.
+ * Returns 1 if a row was found, 0 if we have reached the end of the
+ * file and -1 if an error occured.
+ */
+static int
+TableRowIterator_next_scan_row(TableRowIterator *self, void **row)
+{
+    int ret = -1;
+    Table *table = self->table;
+    Column *id_col = self->id_column;
+    uint32_t key_size = id_col->element_size;
+    uint32_t len = 0;
+    char *v;
+
+    if (self->scan_offset >= table->data_map_size) {
+        ret = 0;
+        goto out;
+    }
+    if (self->scan_offset + table->fixed_region_size - key_size
+            > table->data_map_size) {
+        PyErr_Format(PyExc_SystemError, "row outside data file");
+        goto out;
+    }
+    /* See Table_retrieve_row; the key bytes before the offset are not read */
+    v = (char *) table->data_map + self->scan_offset - key_size;
+    if (Table_get_row_length(table, v, &len) != 0) {
+        goto out;
+    }
+    if (self->scan_offset + len > table->data_map_size) {
+        PyErr_Format(PyExc_SystemError, "row outside data file");
+        goto out;
+    }
+    if (Column_set_row_id(id_col, self->scan_row_id) != 0) {
+        goto out;
+    }
+    if (Column_update_row(id_col, self->row_buffer, 0) != 0) {
+        goto out;
+    }
+    *row = v;
+    self->scan_offset += len;
+    self->scan_row_id++;
+    ret = 1;
+out:
+    return ret;
+}
+
+/*
+ * Advances the iterator to the next row in the range, setting row to
+ * point to it. Returns 1 if a row was found, 0 if iteration is complete
+ * and -1 if an error occured.
+ */
+static int
+TableRowIterator_next_row(TableRowIterator *self, void **row)
+{
+    int ret = -1;
+    int db_ret, wt_ret;
+    DB *db;
+    DBT key, data;
+    uint32_t flags;
+    void *row_key = NULL;
+    uint32_t key_size = self->table->columns[0]->element_size;
+    int max_exceeded = 0;
+    if (Table_check_read_mode(self->table) != 0) {
+        goto out;
+    }
+    memset(&key, 0, sizeof(DBT));
+    memset(&data, 0, sizeof(DBT));
+    flags = DB_NEXT;
+    if (!self->started) {
+        /* it's the first time through the loop, so set up the scan. We
+         * read the mapped data file directly if possible, and otherwise
+         * use a cursor over the primary DB */
+        self->started = 1;
+        self->sequential = self->table->data_map != NULL;
+        if (self->sequential) {
+            if (TableRowIterator_start_scan(self) != 0) {
+                goto out;
+            }
+        } else {
+            db = self->table->db;
+            db_ret = db->cursor(db, NULL, &self->cursor, 0);
+            if (db_ret != 0) {
+                handle_bdb_error(db_ret);
+                goto out;
+            }
+            if (self->min_key_size != 0) {
+                key.data = self->min_key;
+                key.size = self->min_key_size;
+                flags = DB_SET_RANGE;
+            }
+        }
+    }
+    if (self->sequential) {
+        wt_ret = TableRowIterator_next_scan_row(self, row);
+        if (wt_ret < 0) {
+            goto out;
+        }
+        if (wt_ret == 1) {
+            row_key = self->row_buffer;
+        }
+    } else {
+        self->table->num_users++;
+        Py_BEGIN_ALLOW_THREADS
+        db_ret = self->cursor->get(self->cursor, &key, &data, flags);
+        Py_END_ALLOW_THREADS
+        self->table->num_users--;
+        if (db_ret == 0) {
+            if (Table_retrieve_row(self->table, &key, &data, self->row_buffer,
+                        row) != 0) {
+                goto out;
+            }
+            row_key = key.data;
+        } else if (db_ret != DB_NOTFOUND) {
+            handle_bdb_error(db_ret);
+            goto out;
+        }
+    }
+    ret = 0;
+    if (row_key != NULL) {
+        /* Now, check if we've hit or gone past max_key */
+        if (self->max_key_size > 0) {
+            if (key_size != self->max_key_size) {
+                PyErr_Format(PyExc_SystemError, "key size mismatch.");
+                ret = -1;
+                goto out;
+            }
+            max_exceeded = memcmp(self->max_key, row_key, key_size) <= 0;
+        }
+        if (!max_exceeded) {
+            ret = 1;
+        }
+    }
+    if (ret == 0) {
+        /* Iteration is finished - free the cursor */
+        if (self->cursor != NULL) {
+            self->cursor->close(self->cursor);
+            self->cursor = NULL;
+        }
+        self->completed = 1;
+    }
+out:
+    return ret;
+}
+
+/*
+ * Returns 0 if no other thread is reading from the iterator. Otherwise
+ * -1 is returned with the appropriate Python exception set.
+ */
+static int
+TableRowIterator_check_idle(TableRowIterator *self)
+{
+    int ret = -1;
+    if (self->busy) {
+        PyErr_Format(WormtableError, "Iterator in use by another thread.");
+        goto out;
+    }
+    ret = 0;
+out:
+    return ret;
+}
+
+/*
+ * Advances the iterator to the next row in the range that passes the
+ * filter, if there is one. Returns 1 if a row was found, 0 if
+ * iteration is complete and -1 if an error occured.
+ */
+static int
+TableRowIterator_advance(TableRowIterator *self, void **row)
+{
+    int ret = -1;
+    int passed = 0;
+    if (TableRowIterator_check_idle(self) != 0) {
+        goto out;
+    }
+    /* Other threads may run while rows are read with the GIL released */
+    self->busy = 1;
+    ret = 0;
+    while (!passed) {
+        ret = TableRowIterator_next_row(self, row);
+        if (ret != 1) {
+            break;
+        }
+        passed = 1;
+        if (self->filter != NULL) {
+            passed = RowFilter_evaluate(self->filter, self->table,
+                    self->row_buffer, *row);
+            if (passed < 0) {
+                ret = -1;
+                break;
+            }
+        }
+    }
+    self->busy = 0;
+out:
+    return ret;
+}
+
+/*
+ * Returns a list of up to batch_size rows, or NULL if iteration is
+ * complete.
+ */
+static PyObject *
+TableRowIterator_next_batch(TableRowIterator *self)
+{
+    PyObject *ret = NULL;
+    PyObject *batch = NULL;
+    PyObject *t;
+    void *row = NULL;
+    uint32_t j;
+    int wt_ret;
+
+    batch = PyList_New(0);
+    if (batch == NULL) {
+        goto out;
+    }
+    for (j = 0; j < self->batch_size && !self->completed; j++) {
+        wt_ret = TableRowIterator_advance(self, &row);
+        if (wt_ret < 0) {
+            goto out;
+        }
+        if (wt_ret == 1) {
+            t = Table_get_row_tuple(self->table, self->row_buffer, row,
+                    self->columns,
+                    RowFilter_get_projection_missing(self->filter),
+                    self->num_read_columns);
+            if (t == NULL) {
+                goto out;
+            }
+            if (PyList_Append(batch, t) != 0) {
+                Py_DECREF(t);
+                goto out;
+            }
+            Py_DECREF(t);
+        }
+    }
+    if (PyList_GET_SIZE(batch) > 0) {
+        ret = batch;
+        batch = NULL;
+    }
+out:
+    Py_XDECREF(batch);
+    return ret;
+}
+
+static PyObject *
+TableRowIterator_next(TableRowIterator *self)
+{
+    PyObject *ret = NULL;
+    void *row = NULL;
+    if (!self->completed) {
+        if (self->batch_size > 0) {
+            ret = TableRowIterator_next_batch(self);
+        } else if (TableRowIterator_advance(self, &row) == 1) {
+            ret = Table_get_row_tuple(self->table, self->row_buffer, row,
+                    self->columns,
+                    RowFilter_get_projection_missing(self->filter),
+                    self->num_read_columns);
+        }
+    }
+    return ret;
+}
+
+static PyObject *
+TableRowIterator_set_min(TableRowIterator *self, PyObject *args)
+{
+    PyObject *ret = NULL;
+    Column *id_col = NULL;
+    unsigned PY_LONG_LONG row_id = 0;
+    /* TODO: This is unsatisfactory as it doesn't check for overflow;
+     * -1 is accepted as a valid index value.
+     */
+    if (TableRowIterator_check_idle(self) != 0) {
+        goto out;
+    }
+    if (!PyArg_ParseTuple(args, "K", &row_id)) {
+        goto out;
+    }
+    if (Table_check_read_mode(self->table) != 0) {
+        goto out;
+    }
+    id_col = self->table->columns[0];
+    if (Column_set_row_id(id_col, (uint64_t) row_id) != 0) {
+        goto out;
+    }
+    /* this is safe because this column must be at offset 0 */
+    if (Column_update_row(id_col, self->min_key, 0) != 0) {
+        goto out;
+    }
+    self->min_key_size = id_col->element_size;
+    self->min_row_id = (uint64_t) row_id;
+    Py_INCREF(Py_None);
+    ret = Py_None;
+out:
+    return ret;
+}
+
+static PyObject *
+TableRowIterator_set_max(TableRowIterator *self, PyObject *args)
+{
+    PyObject *ret = NULL;
+    Column *id_col = NULL;
+    unsigned PY_LONG_LONG row_id = 0;
+    /* TODO: This is unsatisfactory as it doesn't check for overflow;
+     * -1 is accepted as a valid index value.
+     */
+    if (TableRowIterator_check_idle(self) != 0) {
+        goto out;
+    }
+    if (!PyArg_ParseTuple(args, "K", &row_id)) {
+        goto out;
+    }
+    if (Table_check_read_mode(self->table) != 0) {
+        goto out;
+    }
+    id_col = self->table->columns[0];
+    if (Column_set_row_id(id_col, (uint64_t) row_id) != 0) {
+        goto out;
+    }
+    /* this is safe because this column must be at offset 0 */
+    if (Column_update_row(id_col, self->max_key, 0) != 0) {
+        goto out;
+    }
+    self->max_key_size = id_col->element_size;
+    Py_INCREF(Py_None);
+    ret = Py_None;
+out:
+    return ret;
+}
+
+
+static PyObject *
+TableRowIterator_set_batch_size(TableRowIterator *self, PyObject *args)
+{
+    PyObject *ret = NULL;
+    unsigned int batch_size = 0;
+    if (TableRowIterator_check_idle(self) != 0) {
+        goto out;
+    }
+    if (!PyArg_ParseTuple(args, "I", &batch_size)) {
+        goto out;
+    }
+    self->batch_size = (uint32_t) batch_size;
+    Py_INCREF(Py_None);
+    ret = Py_None;
+out:
+    return ret;
+}
+
+static PyObject *
+TableRowIterator_set_filter(TableRowIterator *self, PyObject *args)
+{
+    PyObject *ret = NULL;
+    PyObject *program = NULL;
+    RowFilter *filter = NULL;
+    if (TableRowIterator_check_idle(self) != 0) {
+        goto out;
+    }
+    if (!PyArg_ParseTuple(args, "O!", &PyList_Type, &program)) {
+        goto out;
+    }
+    filter = RowFilter_alloc(self->table, program, self->read_columns,
+            self->columns, self->num_read_columns);
+    if (filter == NULL) {
+        goto out;
+    }
+    if (self->filter != NULL) {
+        RowFilter_free(self->filter);
+        PyMem_Free(self->filter);
+    }
+    self->filter = filter;
+    Py_INCREF(Py_None);
+    ret = Py_None;
+out:
+    return ret;
+}
+
+static PyObject *
+TableRowIterator_read_arrays(TableRowIterator *self, PyObject *args)
+{
+    PyObject *ret = NULL;
+    PyObject *arrays = NULL;
+    PyObject *masks = NULL;
+    Table *table = self->table;
+    Py_buffer *array_bufs = NULL;
+    Py_buffer *mask_bufs = NULL;
+    Py_ssize_t num_rows;
+    Py_ssize_t n = 0;
+    uint32_t m = self->num_read_columns;
+    void *row = NULL;
+    int wt_ret;
+
+    if (!PyArg_ParseTuple(args, "O!O!", &PyList_Type, &arrays,
+            &PyList_Type, &masks)) {
+        goto out;
+    }
+    array_bufs = PyMem_Malloc(m * sizeof(Py_buffer));
+    mask_bufs = PyMem_Malloc(m * sizeof(Py_buffer));
+    if (array_bufs == NULL || mask_bufs == NULL) {
+        PyErr_NoMemory();
+        goto out;
+    }
+    num_rows = Table_get_arrays(table, self->read_columns, m, arrays, masks,
+            array_bufs, mask_bufs, 0);
+    if (num_rows < 0) {
+        goto out;
+    }
+    while (n < num_rows && !self->completed) {
+        wt_ret = TableRowIterator_advance(self, &row);
+        if (wt_ret < 0) {
+            goto out;
+        }
+        if (wt_ret == 1) {
+            if (Table_copy_row_to_arrays(table, self->row_buffer, row,
+                    self->columns,
+                    RowFilter_get_projection_missing(self->filter), m,
+                    array_bufs, mask_bufs, n) != 0) {
+                goto out;
+            }
+            n++;
+        }
+    }
+    ret = PyLong_FromSsize_t(n);
+out:
+    if (array_bufs != NULL && mask_bufs != NULL) {
+        Table_release_arrays(table, m, array_bufs, mask_bufs);
+    }
+    PyMem_Free(array_bufs);
+    PyMem_Free(mask_bufs);
+    return ret;
+}
+
+/*
+ * Consumes the remaining rows of the iterator, returning a list of
+ * aggregates for the groups defined by the first read columns, where
+ * there is one group column for each of the specified bin widths (see
+ * RowAggregator).
+ */
+static PyObject *
+TableRowIterator_aggregate(TableRowIterator *self, PyObject *args)
+{
+    PyObject *ret = NULL;
+    RowAggregator aggregator;
+    PyObject *bin_widths = NULL;
+    void *row = NULL;
+    int wt_ret;
+
+    memset(&aggregator, 0, sizeof(RowAggregator));
+    if (!PyArg_ParseTuple(args, "O!", &PyList_Type, &bin_widths)) {
+        goto out;
+    }
+    if (RowAggregator_init(&aggregator, self->columns,
+                self->num_read_columns, bin_widths) != 0) {
+        goto out;
+    }
+    while (!self->completed) {
+        wt_ret = TableRowIterator_advance(self, &row);
+        if (wt_ret < 0) {
+            goto out;
+        }
+        if (wt_ret == 1) {
+            if (RowAggregator_add_row(&aggregator, self->table,
+                    self->row_buffer, row,
+                    RowFilter_get_projection_missing(self->filter)) != 0) {
+                goto out;
+            }
+        }
+    }
+    ret = RowAggregator_finish(&aggregator);
+out:
+    RowAggregator_free(&aggregator);
+    return ret;
+}
+
+static PyMethodDef TableRowIterator_methods[] = {
+    {"set_min", (PyCFunction) TableRowIterator_set_min, METH_VARARGS, "Set the minimum key" },
+    {"set_max", (PyCFunction) TableRowIterator_set_max, METH_VARARGS, "Set the maximum key" },
+    {"set_batch_size", (PyCFunction) TableRowIterator_set_batch_size,
+            METH_VARARGS, "Return lists of up to this many rows" },
+    {"set_filter", (PyCFunction) TableRowIterator_set_filter,
+            METH_VARARGS, "Only return rows that pass this filter program" },
+    {"read_arrays", (PyCFunction) TableRowIterator_read_arrays,
+            METH_VARARGS, "Read rows into arrays, returning the number read" },
+    {"aggregate", (PyCFunction) TableRowIterator_aggregate,
+            METH_VARARGS, "Aggregate the remaining rows, returning a list" },
+    {NULL}  /* Sentinel */
+};
+
+
+static PyTypeObject TableRowIteratorType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    "_wormtable.TableRowIterator",             /* tp_name */
+    sizeof(TableRowIterator),             /* tp_basicsize */
+    0,                         /* tp_itemsize */
+    (destructor)TableRowIterator_dealloc, /* tp_dealloc */
+    0,                         /* tp_print */
+    0,                         /* tp_getattr */
+    0,                         /* tp_setattr */
+    0,                         /* tp_reserved */
+    0,                         /* tp_repr */
+    0,                         /* tp_as_number */
+    0,                         /* tp_as_sequence */
+    0,                         /* tp_as_mapping */
+    0,                         /* tp_hash  */
+    0,                         /* tp_call */
+    0,                         /* tp_str */
+    0,                         /* tp_getattro */
+    0,                         /* tp_setattro */
+    0,                         /* tp_as_buffer */
+    Py_TPFLAGS_DEFAULT,        /* tp_flags */
+    "TableRowIterator objects",           /* tp_doc */
+    0,                     /* tp_traverse */
+    0,                     /* tp_clear */
+    0,                     /* tp_richcompare */
+    0,                     /* tp_weaklistoffset */
+    PyObject_SelfIter,               /* tp_iter */
+    (iternextfunc) TableRowIterator_next, /* tp_iternext */
+    TableRowIterator_methods,             /* tp_methods */
+    TableRowIterator_members,             /* tp_members */
+    0,                         /* tp_getset */
+    0,                         /* tp_base */
+    0,                         /* tp_dict */
+    0,                         /* tp_descr_get */
+    0,                         /* tp_descr_set */
+    0,                         /* tp_dictoffset */
+    (initproc)TableRowIterator_init,      /* tp_init */
+};
+
+
+
+/*==========================================================
+ * IndexRowIterator object
+ *==========================================================
+ */
+
+static void
+IndexRowIterator_free_probes(IndexRowIterator* self)
+{
+    Py_ssize_t j;
+    if (self->probes != NULL) {
+        for (j = 0; j < self->num_probes; j++) {
+            Py_XDECREF(self->probes[j].value);
+        }
+        PyMem_Free(self->probes);
+    }
+    PyMem_Free(self->probe_keys);
+    self->probes = NULL;
+    self->probe_keys = NULL;
+    self->num_probes = 0;
+}
+
+static void
+IndexRowIterator_dealloc(IndexRowIterator* self)
+{
+    if (self->cursor != NULL) {
+        if (self->index != NULL) {
+            if (self->index->db != NULL) {
+                self->cursor->close(self->cursor);
+            }
+        }
+    }
+    Py_XDECREF(self->index);
+    if (self->min_key != NULL) {
+        PyMem_Free(self->min_key);
+    }
+    if (self->max_key != NULL) {
+        PyMem_Free(self->max_key);
+    }
+    if (self->read_columns != NULL) {
+        PyMem_Free(self->read_columns);
+    }
+    if (self->row_buffer != NULL) {
+        PyMem_Free(self->row_buffer);
+    }
+    if (self->columns != NULL) {
+        Table_free_columns(self->columns, self->num_read_columns);
+    }
+    if (self->filter != NULL) {
+        RowFilter_free(self->filter);
+        PyMem_Free(self->filter);
+    }
+    if (self->key_columns != NULL) {
+        Table_free_columns(self->key_columns, self->index->num_columns);
+    }
+    IndexRowIterator_free_probes(self);
+    Py_TYPE(self)->tp_free((PyObject*)self);
+
+}
+
+static int
+IndexRowIterator_init(IndexRowIterator *self, PyObject *args, PyObject *kwds)
+{
+    int j;
+    int ret = -1;
+    long k;
+    static char *kwlist[] = {"index", "columns", NULL};
+    PyObject *v = NULL;
+    PyObject *columns = NULL;
+    Index *index = NULL;
+
+    self->completed = 0;
+    self->batch_size = 0;
+    self->read_columns = NULL;
+    self->index = NULL;
+    self->cursor = NULL;
+    self->min_key = NULL;
+    self->max_key = NULL;
+    self->row_buffer = NULL;
+    self->columns = NULL;
+    self->filter = NULL;
+    self->key_columns = NULL;
+    self->probes = NULL;
+    self->probe_keys = NULL;
+    self->num_probes = 0;
+    self->current_probe = 0;
+    self->probe_started = 0;
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O!O!", kwlist,
+            &IndexType, &index,
+            &PyList_Type, &columns)) {
+        goto out;
+    }
+    self->index = index;
+    Py_INCREF(self->index);
+    if (Index_check_read_mode(self->index) != 0) {
+        goto out;
+    }
+    self->num_read_columns = PyList_GET_SIZE(columns);
+    if (self->num_read_columns < 1) {
+        PyErr_SetString(PyExc_ValueError, "At least one read column required");
+        goto out;
+    }
+    self->read_columns = PyMem_Malloc(self->num_read_columns
+            * sizeof(uint32_t));
+    if (self->read_columns == NULL) {
+        PyErr_NoMemory();
+        goto out;
+    }
+    for (j = 0; j < self->num_read_columns; j++) {
+        v = PyList_GET_ITEM(columns, j);
+        if (!PyNumber_Check(v)) {
+            PyErr_SetString(PyExc_ValueError, "Column indexes must be int");
+            goto out;
+        }
+        k = PyLong_AsLong(v);
+        if (k < 0 || k >= self->index->table->num_columns) {
+            PyErr_SetString(PyExc_ValueError, "Column indexes out of bounds");
+            goto out;
+        }
+        self->read_columns[j] = (uint32_t) k;
+    }
+    self->min_key = PyMem_Malloc(self->index->key_buffer_size);
+    self->max_key = PyMem_Malloc(self->index->key_buffer_size);
+    self->row_buffer = PyMem_Malloc(self->index->table->row_buffer_size);
+    if (self->min_key == NULL || self->max_key == NULL
+            || self->row_buffer == NULL) {
+        PyErr_NoMemory();
+        goto out;
+    }
+    self->columns = Table_copy_columns(self->index->table, self->read_columns,
+            self->num_read_columns);
+    if (self->columns == NULL) {
+        goto out;
+    }
+    if (Index_covers_columns(self->index, self->read_columns,
+                self->num_read_columns)) {
+        self->key_columns = Table_copy_columns(self->index->table,
+                self->index->columns, self->index->num_columns);
+        if (self->key_columns == NULL) {
+            goto out;
+        }
+    }
+    self->min_key_size = 0;
+    self->max_key_size = 0;
+    ret = 0;
+out:
+
+    return ret;
+}
+
+
+
+static PyMemberDef IndexRowIterator_members[] = {
     {NULL}  /* Sentinel */
 };
 
 
-static PyTypeObject IndexType = {
-    PyVarObject_HEAD_INIT(NULL, 0)
-    "_wormtable.Index",             /* tp_name */
-    sizeof(Index),             /* tp_basicsize */
-    0,                         /* tp_itemsize */
-    (destructor)Index_dealloc, /* tp_dealloc */
-    0,                         /* tp_print */
-    0,                         /* tp_getattr */
-    0,                         /* tp_setattr */
-    0,                         /* tp_reserved */
-    0,                         /* tp_repr */
-    0,                         /* tp_as_number */
-    0,                         /* tp_as_sequence */
-    0,                         /* tp_as_mapping */
-    0,                         /* tp_hash  */
-    0,                         /* tp_call */
-    0,                         /* tp_str */
-    0,                         /* tp_getattro */
-    0,                         /* tp_setattro */
-    0,                         /* tp_as_buffer */
-    Py_TPFLAGS_DEFAULT,        /* tp_flags */
-    "Index objects",           /* tp_doc */
-    0,                     /* tp_traverse */
-    0,                     /* tp_clear */
-    0,                     /* tp_richcompare */
-    0,                     /* tp_weaklistoffset */
-    0,                     /* tp_iter */
-    0,                     /* tp_iternext */
-    Index_methods,             /* tp_methods */
-    Index_members,             /* tp_members */
-    0,                         /* tp_getset */
-    0,                         /* tp_base */
-    0,                         /* tp_dict */
-    0,                         /* tp_descr_get */
-    0,                         /* tp_descr_set */
-    0,                         /* tp_dictoffset */
-    (initproc)Index_init,      /* tp_init */
-};
+/*
+ * Sets the DBT for the primary data in a call to pget. When the rows are
+ * read from the index keys the primary data is not needed, and so none
+ * is retrieved.
+ */
+static void
+IndexRowIterator_init_primary_data(IndexRowIterator *self, DBT *data)
+{
+    memset(data, 0, sizeof(DBT));
+    if (self->key_columns != NULL) {
+        data->flags = DB_DBT_PARTIAL;
+    }
+}
+
+/*
+ * Sets row to point to the row for the specified keys returned by pget.
+ * If all of the columns read are covered by the index key the row is
+ * reconstructed from the keys, and the data file is not read.
+ */
+static int
+IndexRowIterator_retrieve_row(IndexRowIterator *self, DBT *secondary_key,
+        DBT *primary_key, DBT *primary_data, void **row)
+{
+    int ret = -1;
+    if (self->key_columns != NULL) {
+        if (Index_key_to_row(self->index, self->key_columns, secondary_key,
+                    primary_key, self->row_buffer) != 0) {
+            goto out;
+        }
+        *row = self->row_buffer;
+    } else {
+        if (Table_retrieve_row(self->index->table, primary_key, primary_data,
+                    self->row_buffer, row) != 0) {
+            goto out;
+        }
+    }
+    ret = 0;
+out:
+    return ret;
+}
+
+/*
+ * Marks the index and table as in use while the cursor is read with the
+ * GIL released, so that they cannot be closed by other threads.
+ */
+static void
+IndexRowIterator_enter(IndexRowIterator *self)
+{
+    self->index->num_users++;
+    self->index->table->num_users++;
+}
 
+static void
+IndexRowIterator_exit(IndexRowIterator *self)
+{
+    self->index->num_users--;
+    self->index->table->num_users--;
+}
+
+/*
+ * Advances the iterator to the next row whose key has the current probe
+ * key as a prefix, moving on to the next probe key when there are no
+ * more. The cursor is positioned at the first key for each probe using
+ * DB_SET_RANGE. Returns 1 if a row was found, 0 if iteration is complete
+ * and -1 if an error occured.
+ */
+static int
+IndexRowIterator_next_probe_row(IndexRowIterator *self, void **row)
+{
+    int ret = -1;
+    int db_ret;
+    DB *db;
+    DBT primary_key, primary_data, secondary_key;
+    uint32_t flags;
+    ProbeKey *probe;
+
+    if (Index_check_read_mode(self->index) != 0) {
+        goto out;
+    }
+    if (self->cursor == NULL) {
+        db = self->index->db;
+        db_ret = db->cursor(db, NULL, &self->cursor, 0);
+        if (db_ret != 0) {
+            handle_bdb_error(db_ret);
+            goto out;
+        }
+    }
+    ret = 0;
+    while (ret == 0 && self->current_probe < self->num_probes) {
+        probe = &self->probes[self->current_probe];
+        memset(&primary_key, 0, sizeof(DBT));
+        IndexRowIterator_init_primary_data(self, &primary_data);
+        memset(&secondary_key, 0, sizeof(DBT));
+        flags = DB_NEXT;
+        if (!self->probe_started) {
+            secondary_key.data = probe->key;
+            secondary_key.size = probe->key_size;
+            flags = DB_SET_RANGE;
+            self->probe_started = 1;
+        }
+        IndexRowIterator_enter(self);
+        Py_BEGIN_ALLOW_THREADS
+        db_ret = self->cursor->pget(self->cursor, &secondary_key,
+                &primary_key, &primary_data, flags);
+        Py_END_ALLOW_THREADS
+        IndexRowIterator_exit(self);
+        if (db_ret == 0 && secondary_key.size >= probe->key_size
+                && memcmp(secondary_key.data, probe->key,
+                    probe->key_size) == 0) {
+            if (IndexRowIterator_retrieve_row(self, &secondary_key,
+                        &primary_key, &primary_data, row) != 0) {
+                ret = -1;
+                goto out;
+            }
+            ret = 1;
+        } else if (db_ret == 0 || db_ret == DB_NOTFOUND) {
+            self->current_probe++;
+            self->probe_started = 0;
+        } else {
+            handle_bdb_error(db_ret);
+            ret = -1;
+            goto out;
+        }
+    }
+    if (ret == 0) {
+        self->cursor->close(self->cursor);
+        self->cursor = NULL;
+        self->completed = 1;
+    }
+out:
+    return ret;
+}
+
+/*
+ * Advances the iterator to the next row in the range, setting row to
+ * point to it. Returns 1 if a row was found, 0 if iteration is complete
+ * and -1 if an error occured.
+ */
+static int
+IndexRowIterator_next_row(IndexRowIterator *self, void **row)
+{
+    int ret = -1;
+    int db_ret, cmp;
+    DB *db;
+    DBT primary_key, primary_data, secondary_key;
+    uint32_t flags, cmp_size;
+    int max_exceeded = 0;
+
+    if (Index_check_read_mode(self->index) != 0) {
+        goto out;
+    }
+    memset(&primary_key, 0, sizeof(DBT));
+    IndexRowIterator_init_primary_data(self, &primary_data);
+    memset(&secondary_key, 0, sizeof(DBT));
+    flags = DB_NEXT;
+    if (self->cursor == NULL) {
+        /* it's the first time through the loop, so set up the cursor */
+        db = self->index->db;
+        db_ret = db->cursor(db, NULL, &self->cursor, 0);
+        if (db_ret != 0) {
+            handle_bdb_error(db_ret);
+            goto out;
+        }
+        if (self->min_key_size != 0) {
+            secondary_key.data = self->min_key;
+            secondary_key.size = self->min_key_size;
+            flags = DB_SET_RANGE;
+        }
+    }
+    IndexRowIterator_enter(self);
+    Py_BEGIN_ALLOW_THREADS
+    db_ret = self->cursor->pget(self->cursor, &secondary_key, &primary_key,
+            &primary_data, flags);
+    Py_END_ALLOW_THREADS
+    IndexRowIterator_exit(self);
+    ret = 0;
+    if (db_ret == 0) {
+        if (IndexRowIterator_retrieve_row(self, &secondary_key, &primary_key,
+                    &primary_data, row) != 0) {
+            ret = -1;
+            goto out;
+        }
+        /* Now, check if we've hit or gone past max_key */
+        if (self->max_key_size > 0) {
+            cmp_size = self->max_key_size;
+            if (secondary_key.size < cmp_size) {
+                cmp_size = secondary_key.size;
+            }
+            cmp = memcmp(self->max_key, secondary_key.data, cmp_size);
+            max_exceeded = cmp <= 0;
+            if (secondary_key.size < self->max_key_size) {
+                max_exceeded = cmp < 0;
+            }
+        }
+        if (!max_exceeded) {
+            ret = 1;
+        }
+    } else if (db_ret != DB_NOTFOUND) {
+        handle_bdb_error(db_ret);
+        ret = -1;
+        goto out;
+    }
+    if (ret == 0) {
+        /* Iteration is finished - free the cursor */
+        self->cursor->close(self->cursor);
+        self->cursor = NULL;
+        self->completed = 1;
+    }
+out:
+    return ret;
+}
 
+/*
+ * Returns 0 if no other thread is reading from the iterator. Otherwise
+ * -1 is returned with the appropriate Python exception set.
+ */
+static int
+IndexRowIterator_check_idle(IndexRowIterator *self)
+{
+    int ret = -1;
+    if (self->busy) {
+        PyErr_Format(WormtableError, "Iterator in use by another thread.");
+        goto out;
+    }
+    ret = 0;
+out:
+    return ret;
+}
 
+/*
+ * Advances the iterator to the next row in the range that passes the
+ * filter, if there is one. Returns 1 if a row was found, 0 if
+ * iteration is complete and -1 if an error occured.
+ */
+static int
+IndexRowIterator_advance(IndexRowIterator *self, void **row)
+{
+    int ret = -1;
+    int passed = 0;
+    if (IndexRowIterator_check_idle(self) != 0) {
+        goto out;
+    }
+    /* Other threads may run while rows are read with the GIL released */
+    self->busy = 1;
+    ret = 0;
+    while (!passed) {
+        if (self->probes != NULL) {
+            ret = IndexRowIterator_next_probe_row(self, row);
+        } else {
+            ret = IndexRowIterator_next_row(self, row);
+        }
+        if (ret != 1) {
+            break;
+        }
+        passed = 1;
+        if (self->filter != NULL) {
+            passed = RowFilter_evaluate(self->filter, self->index->table,
+                    self->row_buffer, *row);
+            if (passed < 0) {
+                ret = -1;
+                break;
+            }
+        }
+    }
+    self->busy = 0;
+out:
+    return ret;
+}
 
-/*==========================================================
- * TableRowIterator object
- *==========================================================
+/*
+ * Returns the tuple of values for the specified row, or the pair
+ * (probe, row) when looking up probe keys.
  */
+static PyObject *
+IndexRowIterator_get_row(IndexRowIterator *self, void *row)
+{
+    PyObject *ret = NULL;
+    PyObject *t = Table_get_row_tuple(self->index->table, self->row_buffer,
+            row, self->columns,
+            RowFilter_get_projection_missing(self->filter),
+            self->num_read_columns);
+    if (t == NULL || self->probes == NULL) {
+        ret = t;
+    } else {
+        ret = Py_BuildValue("(OO)", self->probes[self->current_probe].value,
+                t);
+        Py_DECREF(t);
+    }
+    return ret;
+}
 
-static void
-TableRowIterator_dealloc(TableRowIterator* self)
+/*
+ * Returns a list of up to batch_size rows, or NULL if iteration is
+ * complete.
+ */
+static PyObject *
+IndexRowIterator_next_batch(IndexRowIterator *self)
 {
-    if (self->cursor != NULL) {
-        if (self->table != NULL) {
-            if (self->table->db != NULL) {
-                self->cursor->close(self->cursor);
+    PyObject *ret = NULL;
+    PyObject *batch = NULL;
+    PyObject *t;
+    void *row = NULL;
+    uint32_t j;
+    int wt_ret;
+
+    batch = PyList_New(0);
+    if (batch == NULL) {
+        goto out;
+    }
+    for (j = 0; j < self->batch_size && !self->completed; j++) {
+        wt_ret = IndexRowIterator_advance(self, &row);
+        if (wt_ret < 0) {
+            goto out;
+        }
+        if (wt_ret == 1) {
+            t = IndexRowIterator_get_row(self, row);
+            if (t == NULL) {
+                goto out;
+            }
+            if (PyList_Append(batch, t) != 0) {
+                Py_DECREF(t);
+                goto out;
             }
+            Py_DECREF(t);
         }
     }
-    Py_XDECREF(self->table);
-    if (self->min_key != NULL) {
-        PyMem_Free(self->min_key);
-    }
-    if (self->max_key != NULL) {
-        PyMem_Free(self->max_key);
-    }
-    if (self->read_columns != NULL) {
-        PyMem_Free(self->read_columns);
+    if (PyList_GET_SIZE(batch) > 0) {
+        ret = batch;
+        batch = NULL;
     }
-    Py_TYPE(self)->tp_free((PyObject*)self);
+out:
+    Py_XDECREF(batch);
+    return ret;
 }
 
-static int
-TableRowIterator_init(TableRowIterator *self, PyObject *args, PyObject *kwds)
+static PyObject *
+IndexRowIterator_next(IndexRowIterator *self)
 {
-    int j;
-    int ret = -1;
-    long k;
-    static char *kwlist[] = {"table", "columns", NULL};
-    PyObject *v = NULL;
-    PyObject *columns = NULL;
-    Table *table = NULL;
-    Column *id_col = NULL;
-
-    self->completed = 0;
-    self->read_columns = NULL;
-    self->table = NULL;
-    self->min_key = NULL;
-    self->max_key = NULL;
-    self->cursor = NULL;
-    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O!O!", kwlist,
-            &TableType, &table,
-            &PyList_Type, &columns)) {
-        goto out;
+    PyObject *ret = NULL;
+    void *row = NULL;
+    if (!self->completed) {
+        if (self->batch_size > 0) {
+            ret = IndexRowIterator_next_batch(self);
+        } else if (IndexRowIterator_advance(self, &row) == 1) {
+            ret = IndexRowIterator_get_row(self, row);
+        }
     }
-    self->table = table;
-    Py_INCREF(self->table);
-    if (Table_check_read_mode(self->table) != 0) {
+    return ret;
+}
+
+
+static PyObject *
+IndexRowIterator_set_min(IndexRowIterator *self, PyObject *args)
+{
+    PyObject *ret = NULL;
+    int size;
+    if (IndexRowIterator_check_idle(self) != 0) {
         goto out;
     }
-    self->num_read_columns = PyList_GET_SIZE(columns);
-    if (self->num_read_columns < 1) {
-        PyErr_SetString(PyExc_ValueError, "At least one read column required");
+    size = Index_set_key(self->index, args, self->min_key);
+    if (size < 0) {
         goto out;
     }
-    self->read_columns = PyMem_Malloc(self->num_read_columns
-            * sizeof(uint32_t));
-    if (self->read_columns == NULL) {
-        PyErr_NoMemory();
+    self->min_key_size = size;
+    ret = Py_BuildValue("");
+out:
+    return ret;
+}
+
+static PyObject *
+IndexRowIterator_set_max(IndexRowIterator *self, PyObject *args)
+{
+    PyObject *ret = NULL;
+    int size;
+    if (IndexRowIterator_check_idle(self) != 0) {
         goto out;
     }
-    for (j = 0; j < self->num_read_columns; j++) {
-        v = PyList_GET_ITEM(columns, j);
-        if (!PyNumber_Check(v)) {
-            PyErr_SetString(PyExc_ValueError, "Column positions must be int");
-            goto out;
-        }
-        k = PyLong_AsLong(v);
-        if (k < 0 || k >= self->table->num_columns) {
-            PyErr_SetString(PyExc_ValueError, "Column positions out of bounds");
-            goto out;
-        }
-        self->read_columns[j] = (uint32_t) k;
-    }
-    id_col = self->table->columns[0];
-    self->min_key = PyMem_Malloc(id_col->element_size);
-    self->max_key = PyMem_Malloc(id_col->element_size);
-    if (self->min_key == NULL || self->max_key == NULL) {
-        PyErr_NoMemory();
+    size = Index_set_key(self->index, args, self->max_key);
+    if (size < 0) {
         goto out;
     }
-    ret = 0;
+    self->max_key_size = size;
+    ret = Py_BuildValue("");
 out:
     return ret;
 }
 
+static int
+probe_key_compare(const void *a, const void *b)
+{
+    const ProbeKey *pa = (const ProbeKey *) a;
+    const ProbeKey *pb = (const ProbeKey *) b;
+    int ret = memcmp(pa->key, pb->key, WT_MIN(pa->key_size, pb->key_size));
+    if (ret == 0) {
+        ret = (pa->key_size > pb->key_size) - (pa->key_size < pb->key_size);
+    }
+    return ret;
+}
 
+/*
+ * Orders probes by key and then by their position in the list of probes,
+ * so that the first of several probes with the same key sorts first.
+ */
+static int
+probe_position_compare(const void *a, const void *b)
+{
+    const ProbeKey *pa = (const ProbeKey *) a;
+    const ProbeKey *pb = (const ProbeKey *) b;
+    int ret = probe_key_compare(a, b);
+    if (ret == 0) {
+        ret = (pa->position > pb->position) - (pa->position < pb->position);
+    }
+    return ret;
+}
 
-static PyMemberDef TableRowIterator_members[] = {
-    {NULL}  /* Sentinel */
-};
-
-
+/*
+ * Sets the keys to look up, which are a list of (value, key) pairs. The
+ * iterator then returns the rows for each distinct key in key order,
+ * paired with the value for the key, instead of iterating over a range.
+ */
 static PyObject *
-TableRowIterator_next_iter(TableRowIterator *self)
+IndexRowIterator_set_probes(IndexRowIterator *self, PyObject *args)
 {
     PyObject *ret = NULL;
-    PyObject *t = NULL;
-    PyObject *value;
-    Column *col;
-    int db_ret, j, wt_ret;
-    DB *db;
-    DBT key, data;
-    uint32_t flags;
-    int max_exceeded = 0;
-    if (Table_check_read_mode(self->table) != 0) {
+    PyObject *probes = NULL;
+    PyObject *item, *key;
+    ProbeKey *keys = NULL;
+    char *storage = NULL;
+    char *p;
+    size_t storage_size = 0;
+    size_t storage_used = 0;
+    Py_ssize_t n, j, k;
+    Py_ssize_t num_keys = 0;
+    int size;
+
+    if (IndexRowIterator_check_idle(self) != 0) {
         goto out;
     }
-    memset(&key, 0, sizeof(DBT));
-    memset(&data, 0, sizeof(DBT));
-    flags = DB_NEXT;
-    if (self->cursor == NULL) {
-        /* it's the first time through the loop, so set up the cursor */
-        db = self->table->db;
-        db_ret = db->cursor(db, NULL, &self->cursor, 0);
-        if (db_ret != 0) {
-            handle_bdb_error(db_ret);
+    if (!PyArg_ParseTuple(args, "O!", &PyList_Type, &probes)) {
+        goto out;
+    }
+    n = PyList_GET_SIZE(probes);
+    keys = PyMem_Malloc((n + 1) * sizeof(ProbeKey));
+    if (keys == NULL) {
+        PyErr_NoMemory();
+        goto out;
+    }
+    for (j = 0; j < n; j++) {
+        item = PyList_GET_ITEM(probes, j);
+        if (!PyTuple_Check(item) || PyTuple_GET_SIZE(item) != 2) {
+            PyErr_SetString(PyExc_ValueError, "Probes must be pairs");
             goto out;
         }
-        if (self->min_key_size != 0) {
-            key.data = self->min_key;
-            key.size = self->min_key_size;
-            flags = DB_SET_RANGE;
-        }
-    }
-    db_ret = self->cursor->get(self->cursor, &key, &data, flags);
-    if (db_ret == 0) {
-        if (Table_retrieve_row(self->table, &key, &data) != 0) {
+        key = PyTuple_GetSlice(item, 1, 2);
+        if (key == NULL) {
             goto out;
         }
-        /* Now, check if we've hit or gone past max_key */
-        if (self->max_key_size > 0) {
-            if (key.size != self->max_key_size) {
-                PyErr_Format(PyExc_SystemError, "key size mismatch.");
-                goto out;
-            }
-            max_exceeded = memcmp(self->max_key, key.data, key.size) <= 0;
+        size = Index_set_key(self->index, key, self->index->key_buffer);
+        Py_DECREF(key);
+        if (size < 0) {
+            goto out;
         }
-        if (!max_exceeded) {
-            t = PyTuple_New(self->num_read_columns);
-            if (t == NULL) {
+        if (storage_used + size > storage_size) {
+            storage_size = 2 * storage_size + self->index->key_buffer_size;
+            p = PyMem_Realloc(storage, storage_size);
+            if (p == NULL) {
                 PyErr_NoMemory();
                 goto out;
             }
-            for (j = 0; j < self->num_read_columns; j++) {
-                col = self->table->columns[self->read_columns[j]];
-                wt_ret = Column_extract_elements(col, self->table->row_buffer);
-                if (wt_ret < 0) {
-                    Py_DECREF(t);
-                    goto out;
-                }
-                value = Column_get_python_elements(col,
-                        wt_ret == WT_MISSING_VALUE);
-                if (value == NULL) {
-                    Py_DECREF(t);
-                    goto out;
-                }
-                PyTuple_SET_ITEM(t, j, value);
-            }
-            ret = t;
+            storage = p;
         }
-    } else if (db_ret != DB_NOTFOUND) {
-        handle_bdb_error(db_ret);
-        goto out;
+        memcpy(storage + storage_used, self->index->key_buffer, size);
+        keys[j].offset = storage_used;
+        keys[j].key_size = (uint32_t) size;
+        keys[j].position = j;
+        keys[j].value = PyTuple_GET_ITEM(item, 0);
+        Py_INCREF(keys[j].value);
+        storage_used += size;
+        num_keys++;
     }
-    if (ret == NULL) {
-        /* Iteration is finished - free the cursor */
+    for (j = 0; j < n; j++) {
+        keys[j].key = storage + keys[j].offset;
+    }
+    qsort(keys, n, sizeof(ProbeKey), probe_position_compare);
+    /* Remove duplicate keys, keeping the first value */
+    k = 0;
+    for (j = 0; j < n; j++) {
+        if (k > 0 && probe_key_compare(&keys[k - 1], &keys[j]) == 0) {
+            Py_DECREF(keys[j].value);
+        } else {
+            keys[k] = keys[j];
+            k++;
+        }
+    }
+    IndexRowIterator_free_probes(self);
+    if (self->cursor != NULL) {
         self->cursor->close(self->cursor);
         self->cursor = NULL;
-        self->completed = 1;
     }
+    self->probes = keys;
+    self->probe_keys = storage;
+    self->num_probes = k;
+    self->current_probe = 0;
+    self->probe_started = 0;
+    self->completed = 0;
+    keys = NULL;
+    storage = NULL;
+    Py_INCREF(Py_None);
+    ret = Py_None;
 out:
+    if (keys != NULL) {
+        for (j = 0; j < num_keys; j++) {
+            Py_DECREF(keys[j].value);
+        }
+        PyMem_Free(keys);
+    }
+    PyMem_Free(storage);
     return ret;
 }
 
+/*
+ * Sets the minimum key and restarts iteration from the first key greater
+ * than or equal to it, so that a single iterator can be used to read
+ * several ranges of the index.
+ */
 static PyObject *
-TableRowIterator_next(TableRowIterator *self)
+IndexRowIterator_seek(IndexRowIterator *self, PyObject *args)
+{
+    PyObject *ret = IndexRowIterator_set_min(self, args);
+    if (ret != NULL) {
+        if (self->cursor != NULL) {
+            self->cursor->close(self->cursor);
+            self->cursor = NULL;
+        }
+        self->completed = 0;
+    }
+    return ret;
+}
+
+
+static PyObject *
+IndexRowIterator_set_batch_size(IndexRowIterator *self, PyObject *args)
 {
     PyObject *ret = NULL;
-    if (!self->completed) {
-        ret = TableRowIterator_next_iter(self);
+    unsigned int batch_size = 0;
+    if (IndexRowIterator_check_idle(self) != 0) {
+        goto out;
+    }
+    if (!PyArg_ParseTuple(args, "I", &batch_size)) {
+        goto out;
     }
+    self->batch_size = (uint32_t) batch_size;
+    Py_INCREF(Py_None);
+    ret = Py_None;
+out:
     return ret;
 }
 
 static PyObject *
-TableRowIterator_set_min(TableRowIterator *self, PyObject *args)
+IndexRowIterator_set_filter(IndexRowIterator *self, PyObject *args)
 {
     PyObject *ret = NULL;
-    Column *id_col = NULL;
-    unsigned PY_LONG_LONG row_id = 0;
-    /* TODO: This is unsatisfactory as it doesn't check for overflow;
-     * -1 is accepted as a valid index value.
-     */
-    if (!PyArg_ParseTuple(args, "K", &row_id)) {
+    PyObject *program = NULL;
+    RowFilter *filter = NULL;
+    if (IndexRowIterator_check_idle(self) != 0) {
+        goto out;
+    }
+    if (!PyArg_ParseTuple(args, "O!", &PyList_Type, &program)) {
+        goto out;
+    }
+    filter = RowFilter_alloc(self->index->table, program,
+            self->read_columns, self->columns, self->num_read_columns);
+    if (filter == NULL) {
+        goto out;
+    }
+    if (self->filter != NULL) {
+        RowFilter_free(self->filter);
+        PyMem_Free(self->filter);
+    }
+    self->filter = filter;
+    if (self->key_columns != NULL && !Index_covers_columns(self->index,
+                filter->read_columns, filter->num_columns)) {
+        /* the filter needs columns that are only in the data file */
+        Table_free_columns(self->key_columns, self->index->num_columns);
+        self->key_columns = NULL;
+    }
+    Py_INCREF(Py_None);
+    ret = Py_None;
+out:
+    return ret;
+}
+
+static PyObject *
+IndexRowIterator_read_arrays(IndexRowIterator *self, PyObject *args)
+{
+    PyObject *ret = NULL;
+    PyObject *arrays = NULL;
+    PyObject *masks = NULL;
+    Table *table = self->index->table;
+    Py_buffer *array_bufs = NULL;
+    Py_buffer *mask_bufs = NULL;
+    Py_ssize_t num_rows;
+    Py_ssize_t n = 0;
+    uint32_t m = self->num_read_columns;
+    void *row = NULL;
+    int wt_ret;
+
+    if (!PyArg_ParseTuple(args, "O!O!", &PyList_Type, &arrays,
+            &PyList_Type, &masks)) {
         goto out;
     }
-    if (Table_check_read_mode(self->table) != 0) {
+    array_bufs = PyMem_Malloc(m * sizeof(Py_buffer));
+    mask_bufs = PyMem_Malloc(m * sizeof(Py_buffer));
+    if (array_bufs == NULL || mask_bufs == NULL) {
+        PyErr_NoMemory();
         goto out;
     }
-    id_col = self->table->columns[0];
-    if (Column_set_row_id(id_col, (uint64_t) row_id) != 0) {
+    num_rows = Table_get_arrays(table, self->read_columns, m, arrays, masks,
+            array_bufs, mask_bufs, 0);
+    if (num_rows < 0) {
         goto out;
     }
-    /* this is safe because this column must be at offset 0 */
-    if (Column_update_row(id_col, self->min_key, 0) != 0) {
-        goto out;
+    while (n < num_rows && !self->completed) {
+        wt_ret = IndexRowIterator_advance(self, &row);
+        if (wt_ret < 0) {
+            goto out;
+        }
+        if (wt_ret == 1) {
+            if (Table_copy_row_to_arrays(table, self->row_buffer, row,
+                    self->columns,
+                    RowFilter_get_projection_missing(self->filter), m,
+                    array_bufs, mask_bufs, n) != 0) {
+                goto out;
+            }
+            n++;
+        }
     }
-    self->min_key_size = id_col->element_size;
-    Py_INCREF(Py_None);
-    ret = Py_None;
+    ret = PyLong_FromSsize_t(n);
 out:
+    if (array_bufs != NULL && mask_bufs != NULL) {
+        Table_release_arrays(table, m, array_bufs, mask_bufs);
+    }
+    PyMem_Free(array_bufs);
+    PyMem_Free(mask_bufs);
     return ret;
 }
 
+/*
+ * Consumes the remaining rows of the iterator, returning a list of
+ * aggregates for the groups defined by the first read columns, where
+ * there is one group column for each of the specified bin widths (see
+ * RowAggregator).
+ */
 static PyObject *
-TableRowIterator_set_max(TableRowIterator *self, PyObject *args)
+IndexRowIterator_aggregate(IndexRowIterator *self, PyObject *args)
 {
     PyObject *ret = NULL;
-    Column *id_col = NULL;
-    unsigned PY_LONG_LONG row_id = 0;
-    /* TODO: This is unsatisfactory as it doesn't check for overflow;
-     * -1 is accepted as a valid index value.
-     */
-    if (!PyArg_ParseTuple(args, "K", &row_id)) {
-        goto out;
-    }
-    if (Table_check_read_mode(self->table) != 0) {
+    RowAggregator aggregator;
+    PyObject *bin_widths = NULL;
+    void *row = NULL;
+    int wt_ret;
+
+    memset(&aggregator, 0, sizeof(RowAggregator));
+    if (!PyArg_ParseTuple(args, "O!", &PyList_Type, &bin_widths)) {
         goto out;
     }
-    id_col = self->table->columns[0];
-    if (Column_set_row_id(id_col, (uint64_t) row_id) != 0) {
+    if (RowAggregator_init(&aggregator, self->columns,
+                self->num_read_columns, bin_widths) != 0) {
         goto out;
     }
-    /* this is safe because this column must be at offset 0 */
-    if (Column_update_row(id_col, self->max_key, 0) != 0) {
-        goto out;
+    while (!self->completed) {
+        wt_ret = IndexRowIterator_advance(self, &row);
+        if (wt_ret < 0) {
+            goto out;
+        }
+        if (wt_ret == 1) {
+            if (RowAggregator_add_row(&aggregator, self->index->table,
+                    self->row_buffer, row,
+                    RowFilter_get_projection_missing(self->filter)) != 0) {
+                goto out;
+            }
+        }
     }
-    self->max_key_size = id_col->element_size;
-    Py_INCREF(Py_None);
-    ret = Py_None;
+    ret = RowAggregator_finish(&aggregator);
 out:
+    RowAggregator_free(&aggregator);
     return ret;
 }
 
-
-static PyMethodDef TableRowIterator_methods[] = {
-    {"set_min", (PyCFunction) TableRowIterator_set_min, METH_VARARGS, "Set the minimum key" },
-    {"set_max", (PyCFunction) TableRowIterator_set_max, METH_VARARGS, "Set the maximum key" },
+static PyMethodDef IndexRowIterator_methods[] = {
+    {"set_min", (PyCFunction) IndexRowIterator_set_min, METH_VARARGS, "Set the minimum key" },
+    {"set_max", (PyCFunction) IndexRowIterator_set_max, METH_VARARGS, "Set the maximum key" },
+    {"seek", (PyCFunction) IndexRowIterator_seek, METH_VARARGS,
+            "Set the minimum key and restart iteration from it" },
+    {"set_probes", (PyCFunction) IndexRowIterator_set_probes, METH_VARARGS,
+            "Look up the rows for these keys instead of a range" },
+    {"set_batch_size", (PyCFunction) IndexRowIterator_set_batch_size,
+            METH_VARARGS, "Return lists of up to this many rows" },
+    {"set_filter", (PyCFunction) IndexRowIterator_set_filter,
+            METH_VARARGS, "Only return rows that pass this filter program" },
+    {"read_arrays", (PyCFunction) IndexRowIterator_read_arrays,
+            METH_VARARGS, "Read rows into arrays, returning the number read" },
+    {"aggregate", (PyCFunction) IndexRowIterator_aggregate,
+            METH_VARARGS, "Aggregate the remaining rows, returning a list" },
     {NULL}  /* Sentinel */
 };
 
 
-static PyTypeObject TableRowIteratorType = {
+static PyTypeObject IndexRowIteratorType = {
     PyVarObject_HEAD_INIT(NULL, 0)
-    "_wormtable.TableRowIterator",             /* tp_name */
-    sizeof(TableRowIterator),             /* tp_basicsize */
+    "_wormtable.IndexRowIterator",             /* tp_name */
+    sizeof(IndexRowIterator),             /* tp_basicsize */
     0,                         /* tp_itemsize */
-    (destructor)TableRowIterator_dealloc, /* tp_dealloc */
+    (destructor)IndexRowIterator_dealloc, /* tp_dealloc */
     0,                         /* tp_print */
     0,                         /* tp_getattr */
     0,                         /* tp_setattr */
@@ -3875,33 +8893,31 @@ static PyTypeObject TableRowIteratorType = {
     0,                         /* tp_setattro */
     0,                         /* tp_as_buffer */
     Py_TPFLAGS_DEFAULT,        /* tp_flags */
-    "TableRowIterator objects",           /* tp_doc */
+    "IndexRowIterator objects",           /* tp_doc */
     0,                     /* tp_traverse */
     0,                     /* tp_clear */
     0,                     /* tp_richcompare */
     0,                     /* tp_weaklistoffset */
     PyObject_SelfIter,               /* tp_iter */
-    (iternextfunc) TableRowIterator_next, /* tp_iternext */
-    TableRowIterator_methods,             /* tp_methods */
-    TableRowIterator_members,             /* tp_members */
+    (iternextfunc) IndexRowIterator_next, /* tp_iternext */
+    IndexRowIterator_methods,             /* tp_methods */
+    IndexRowIterator_members,             /* tp_members */
     0,                         /* tp_getset */
     0,                         /* tp_base */
     0,                         /* tp_dict */
     0,                         /* tp_descr_get */
     0,                         /* tp_descr_set */
     0,                         /* tp_dictoffset */
-    (initproc)TableRowIterator_init,      /* tp_init */
+    (initproc)IndexRowIterator_init,      /* tp_init */
 };
 
-
-
 /*==========================================================
- * IndexRowIterator object
+ * IndexKeyIterator object
  *==========================================================
  */
 
 static void
-IndexRowIterator_dealloc(IndexRowIterator* self)
+IndexKeyIterator_dealloc(IndexKeyIterator* self)
 {
     if (self->cursor != NULL) {
         if (self->index != NULL) {
@@ -3911,37 +8927,19 @@ IndexRowIterator_dealloc(IndexRowIterator* self)
         }
     }
     Py_XDECREF(self->index);
-    if (self->min_key != NULL) {
-        PyMem_Free(self->min_key);
-    }
-    if (self->max_key != NULL) {
-        PyMem_Free(self->max_key);
-    }
-    if (self->read_columns != NULL) {
-        PyMem_Free(self->read_columns);
-    }
     Py_TYPE(self)->tp_free((PyObject*)self);
-
 }
 
 static int
-IndexRowIterator_init(IndexRowIterator *self, PyObject *args, PyObject *kwds)
+IndexKeyIterator_init(IndexKeyIterator *self, PyObject *args, PyObject *kwds)
 {
-    int j;
     int ret = -1;
-    long k;
-    static char *kwlist[] = {"index", "columns", NULL};
-    PyObject *v = NULL;
-    PyObject *columns = NULL;
+    static char *kwlist[] = {"index", NULL};
     Index *index = NULL;
-
-    self->completed = 0;
-    self->read_columns = NULL;
     self->index = NULL;
     self->cursor = NULL;
-    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O!O!", kwlist,
-            &IndexType, &index,
-            &PyList_Type, &columns)) {
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O!", kwlist,
+            &IndexType, &index)) {
         goto out;
     }
     self->index = index;
@@ -3949,71 +8947,48 @@ IndexRowIterator_init(IndexRowIterator *self, PyObject *args, PyObject *kwds)
     if (Index_check_read_mode(self->index) != 0) {
         goto out;
     }
-    self->num_read_columns = PyList_GET_SIZE(columns);
-    if (self->num_read_columns < 1) {
-        PyErr_SetString(PyExc_ValueError, "At least one read column required");
-        goto out;
-    }
-    self->read_columns = PyMem_Malloc(self->num_read_columns
-            * sizeof(uint32_t));
-    if (self->read_columns == NULL) {
-        PyErr_NoMemory();
-        goto out;
-    }
-    for (j = 0; j < self->num_read_columns; j++) {
-        v = PyList_GET_ITEM(columns, j);
-        if (!PyNumber_Check(v)) {
-            PyErr_SetString(PyExc_ValueError, "Column indexes must be int");
-            goto out;
-        }
-        k = PyLong_AsLong(v);
-        if (k < 0 || k >= self->index->table->num_columns) {
-            PyErr_SetString(PyExc_ValueError, "Column indexes out of bounds");
-            goto out;
-        }
-        self->read_columns[j] = (uint32_t) k;
-    }
-    self->min_key = PyMem_Malloc(self->index->key_buffer_size);
-    self->max_key = PyMem_Malloc(self->index->key_buffer_size);
-    if (self->min_key == NULL || self->max_key == NULL) {
-        PyErr_NoMemory();
-        goto out;
-    }
-    self->min_key_size = 0;
-    self->max_key_size = 0;
     ret = 0;
 out:
-
     return ret;
 }
 
-
-
-static PyMemberDef IndexRowIterator_members[] = {
+static PyMemberDef IndexKeyIterator_members[] = {
     {NULL}  /* Sentinel */
 };
 
 
+/*
+ * Returns 0 if no other thread is reading from the iterator. Otherwise
+ * -1 is returned with the appropriate Python exception set.
+ */
+static int
+IndexKeyIterator_check_idle(IndexKeyIterator *self)
+{
+    int ret = -1;
+    if (self->busy) {
+        PyErr_Format(WormtableError, "Iterator in use by another thread.");
+        goto out;
+    }
+    ret = 0;
+out:
+    return ret;
+}
+
 static PyObject *
-IndexRowIterator_next_iter(IndexRowIterator *self)
+IndexKeyIterator_next(IndexKeyIterator *self)
 {
     PyObject *ret = NULL;
-    PyObject *t = NULL;
-    PyObject *value;
-    Column *col;
-    int db_ret, j, cmp, wt_ret;
+    int db_ret;
     DB *db;
-    DBT primary_key, primary_data, secondary_key;
-    uint32_t flags, cmp_size;
-    int max_exceeded = 0;
-
+    DBT key, data;
+    if (IndexKeyIterator_check_idle(self) != 0) {
+        goto out;
+    }
     if (Index_check_read_mode(self->index) != 0) {
         goto out;
     }
-    memset(&primary_key, 0, sizeof(DBT));
-    memset(&primary_data, 0, sizeof(DBT));
-    memset(&secondary_key, 0, sizeof(DBT));
-    flags = DB_NEXT;
+    memset(&key, 0, sizeof(DBT));
+    memset(&data, 0, sizeof(DBT));
     if (self->cursor == NULL) {
         /* it's the first time through the loop, so set up the cursor */
         db = self->index->db;
@@ -4022,55 +8997,19 @@ IndexRowIterator_next_iter(IndexRowIterator *self)
             handle_bdb_error(db_ret);
             goto out;
         }
-        if (self->min_key_size != 0) {
-            secondary_key.data = self->min_key;
-            secondary_key.size = self->min_key_size;
-            flags = DB_SET_RANGE;
-        }
     }
-    db_ret = self->cursor->pget(self->cursor, &secondary_key, &primary_key,
-            &primary_data, flags);
+    self->busy = 1;
+    self->index->num_users++;
+    Py_BEGIN_ALLOW_THREADS
+    db_ret = self->cursor->get(self->cursor, &key, &data, DB_NEXT_NODUP);
+    Py_END_ALLOW_THREADS
+    self->index->num_users--;
+    self->busy = 0;
     if (db_ret == 0) {
-        if (Table_retrieve_row(self->index->table, &primary_key,
-                    &primary_data) != 0) {
+        ret = Index_key_to_python(self->index, key.data, key.size);
+        if (ret == NULL) {
             goto out;
         }
-        /* Now, check if we've hit or gone past max_key */
-        if (self->max_key_size > 0) {
-            cmp_size = self->max_key_size;
-            if (secondary_key.size < cmp_size) {
-                cmp_size = secondary_key.size;
-            }
-            cmp = memcmp(self->max_key, secondary_key.data, cmp_size);
-            max_exceeded = cmp <= 0;
-            if (secondary_key.size < self->max_key_size) {
-                max_exceeded = cmp < 0;
-            }
-        }
-        if (!max_exceeded) {
-            t = PyTuple_New(self->num_read_columns);
-            if (t == NULL) {
-                PyErr_NoMemory();
-                goto out;
-            }
-            for (j = 0; j < self->num_read_columns; j++) {
-                col = self->index->table->columns[self->read_columns[j]];
-                wt_ret = Column_extract_elements(col,
-                        self->index->table->row_buffer);
-                if (wt_ret < 0) {
-                    Py_DECREF(t);
-                    goto out;
-                }
-                value = Column_get_python_elements(col,
-                        wt_ret == WT_MISSING_VALUE);
-                if (value == NULL) {
-                    Py_DECREF(t);
-                    goto out;
-                }
-                PyTuple_SET_ITEM(t, j, value);
-            }
-            ret = t;
-        }
     } else if (db_ret != DB_NOTFOUND) {
         handle_bdb_error(db_ret);
         goto out;
@@ -4079,65 +9018,22 @@ IndexRowIterator_next_iter(IndexRowIterator *self)
         /* Iteration is finished - free the cursor */
         self->cursor->close(self->cursor);
         self->cursor = NULL;
-        self->completed = 1;
-    }
-out:
-    return ret;
-}
-
-static PyObject *
-IndexRowIterator_next(IndexRowIterator *self)
-{
-    PyObject *ret = NULL;
-    if (!self->completed) {
-        ret = IndexRowIterator_next_iter(self);
-    }
-    return ret;
-}
-
-
-static PyObject *
-IndexRowIterator_set_min(IndexRowIterator *self, PyObject *args)
-{
-    PyObject *ret = NULL;
-    int size = Index_set_key(self->index, args, self->min_key);
-    if (size < 0) {
-        goto out;
-    }
-    self->min_key_size = size;
-    ret = Py_BuildValue("");
-out:
-    return ret;
-}
-
-static PyObject *
-IndexRowIterator_set_max(IndexRowIterator *self, PyObject *args)
-{
-    PyObject *ret = NULL;
-    int size = Index_set_key(self->index, args, self->max_key);
-    if (size < 0) {
-        goto out;
     }
-    self->max_key_size = size;
-    ret = Py_BuildValue("");
 out:
     return ret;
 }
 
-
-static PyMethodDef IndexRowIterator_methods[] = {
-    {"set_min", (PyCFunction) IndexRowIterator_set_min, METH_VARARGS, "Set the minimum key" },
-    {"set_max", (PyCFunction) IndexRowIterator_set_max, METH_VARARGS, "Set the maximum key" },
+static PyMethodDef IndexKeyIterator_methods[] = {
     {NULL}  /* Sentinel */
 };
 
 
-static PyTypeObject IndexRowIteratorType = {
+static PyTypeObject IndexKeyIteratorType = {
     PyVarObject_HEAD_INIT(NULL, 0)
-    "_wormtable.IndexRowIterator",             /* tp_name */
-    sizeof(IndexRowIterator),             /* tp_basicsize */
+    "_wormtable.IndexKeyIterator",             /* tp_name */
+    sizeof(IndexKeyIterator),             /* tp_basicsize */
     0,                         /* tp_itemsize */
-    (destructor)IndexRowIterator_dealloc, /* tp_dealloc */
+    (destructor)IndexKeyIterator_dealloc, /* tp_dealloc */
     0,                         /* tp_print */
     0,                         /* tp_getattr */
     0,                         /* tp_setattr */
@@ -4153,58 +9049,332 @@ static PyTypeObject IndexRowIteratorType = {
     0,                         /* tp_setattro */
     0,                         /* tp_as_buffer */
     Py_TPFLAGS_DEFAULT,        /* tp_flags */
-    "IndexRowIterator objects",           /* tp_doc */
+    "IndexKeyIterator objects",           /* tp_doc */
     0,                     /* tp_traverse */
     0,                     /* tp_clear */
     0,                     /* tp_richcompare */
     0,                     /* tp_weaklistoffset */
     PyObject_SelfIter,               /* tp_iter */
-    (iternextfunc) IndexRowIterator_next, /* tp_iternext */
-    IndexRowIterator_methods,             /* tp_methods */
-    IndexRowIterator_members,             /* tp_members */
+    (iternextfunc) IndexKeyIterator_next, /* tp_iternext */
+    IndexKeyIterator_methods,             /* tp_methods */
+    IndexKeyIterator_members,             /* tp_members */
     0,                         /* tp_getset */
     0,                         /* tp_base */
     0,                         /* tp_dict */
     0,                         /* tp_descr_get */
     0,                         /* tp_descr_set */
     0,                         /* tp_dictoffset */
-    (initproc)IndexRowIterator_init,      /* tp_init */
+    (initproc)IndexKeyIterator_init,      /* tp_init */
 };
 
 /*==========================================================
- * IndexKeyIterator object
+ * VCFRecordParser object
  *==========================================================
  */
 
+static int
+vcf_field_compare(const void *a, const void *b)
+{
+    const VCFField *fa = (const VCFField *) a;
+    const VCFField *fb = (const VCFField *) b;
+    return strcmp(fa->name, fb->name);
+}
+
+/*
+ * Returns the field with the specified name, or NULL if there is none.
+ */
+static VCFField *
+vcf_find_field(VCFField *fields, uint32_t num_fields, char *name)
+{
+    VCFField key;
+    key.name = name;
+    return (VCFField *) bsearch(&key, fields, num_fields, sizeof(VCFField),
+            vcf_field_compare);
+}
+
+static int
+vcf_is_space(char c)
+{
+    return c == ' ' || c == '\t' || c == '\n' || c == '\r' || c == '\v'
+            || c == '\f';
+}
+
+/*
+ * Returns the next whitespace delimited field in the string at *s,
+ * terminating it and advancing *s past it, or NULL if there are no
+ * more fields. This splits in the same way as bytes.split().
+ */
+static char *
+vcf_next_field(char **s)
+{
+    char *ret = NULL;
+    char *v = *s;
+    while (*v != '\0' && vcf_is_space(*v)) {
+        v++;
+    }
+    if (*v != '\0') {
+        ret = v;
+        while (*v != '\0' && !vcf_is_space(*v)) {
+            v++;
+        }
+        if (*v != '\0') {
+            *v = '\0';
+            v++;
+        }
+    }
+    *s = v;
+    return ret;
+}
+
+/*
+ * Returns the next token in the string at *s delimited by the specified
+ * separator, terminating it and advancing *s past it. *s is set to NULL
+ * after the last token. This splits in the same way as bytes.split(sep).
+ */
+static char *
+vcf_next_token(char **s, char sep)
+{
+    char *ret = *s;
+    char *v = strchr(ret, sep);
+    if (v != NULL) {
+        *v = '\0';
+        v++;
+    }
+    *s = v;
+    return ret;
+}
+
+/*
+ * Reads an integer in the range min_value <= v < max_value from the
+ * specified Python object.
+ */
+static int
+vcf_get_index(PyObject *value, long min_value, long max_value,
+        uint32_t *index)
+{
+    int ret = -1;
+    long k = PyLong_AsLong(value);
+    if (k == -1 && PyErr_Occurred()) {
+        goto out;
+    }
+    if (k < min_value || k >= max_value) {
+        PyErr_SetString(PyExc_ValueError, "VCF field index out of bounds");
+        goto out;
+    }
+    *index = (uint32_t) k;
+    ret = 0;
+out:
+    return ret;
+}
+
 static void
-IndexKeyIterator_dealloc(IndexKeyIterator* self)
+VCFRecordParser_dealloc(VCFRecordParser* self)
 {
-    if (self->cursor != NULL) {
-        if (self->index != NULL) {
-            if (self->index->db != NULL) {
-                self->cursor->close(self->cursor);
+    Py_XDECREF(self->table);
+    Py_XDECREF(self->names);
+    PyMem_Free(self->info_fields);
+    PyMem_Free(self->format_keys);
+    PyMem_Free(self->genotype_columns);
+    PyMem_Free(self->line);
+    PyMem_Free(self->values);
+    PyMem_Free(self->format);
+    PyMem_Free(self->tokens);
+    Py_TYPE(self)->tp_free((PyObject*)self);
+}
+
+/*
+ * Allocates an array of fields from the specified dict mapping names to
+ * values in the range min_value <= v < max_value, sorted by name.
+ */
+static int
+VCFRecordParser_alloc_fields(VCFRecordParser *self, PyObject *dict,
+        long min_value, long max_value, VCFField **fields,
+        uint32_t *num_fields)
+{
+    int ret = -1;
+    PyObject *name, *value;
+    Py_ssize_t pos = 0;
+    Py_ssize_t n = PyDict_Size(dict);
+    uint32_t j = 0;
+    VCFField *f = PyMem_Malloc((n + 1) * sizeof(VCFField));
+
+    if (f == NULL) {
+        PyErr_NoMemory();
+        goto out;
+    }
+    while (PyDict_Next(dict, &pos, &name, &value)) {
+        if (!PyBytes_Check(name)) {
+            PyErr_SetString(PyExc_TypeError, "VCF field names must be bytes");
+            goto out;
+        }
+        if (PyList_Append(self->names, name) != 0) {
+            goto out;
+        }
+        f[j].name = PyBytes_AS_STRING(name);
+        if (vcf_get_index(value, min_value, max_value, &f[j].value) != 0) {
+            goto out;
+        }
+        j++;
+    }
+    qsort(f, j, sizeof(VCFField), vcf_field_compare);
+    *fields = f;
+    *num_fields = j;
+    f = NULL;
+    ret = 0;
+out:
+    PyMem_Free(f);
+    return ret;
+}
+
+/*
+ * Sets up the mapping of FORMAT keys to columns for each sample from the
+ * specified list of dicts mapping keys to columns, one for each sample.
+ */
+static int
+VCFRecordParser_set_genotype_columns(VCFRecordParser *self,
+        PyObject *genotype_columns)
+{
+    int ret = -1;
+    PyObject *keys = NULL;
+    PyObject *columns, *name, *value, *k;
+    Py_ssize_t pos;
+    uint32_t j, key, col, num_keys, num_columns;
+    long max_column = (long) self->table->num_columns;
+
+    keys = PyDict_New();
+    if (keys == NULL) {
+        goto out;
+    }
+    self->num_samples = (uint32_t) PyList_GET_SIZE(genotype_columns);
+    for (j = 0; j < self->num_samples; j++) {
+        columns = PyList_GET_ITEM(genotype_columns, j);
+        if (!PyDict_Check(columns)) {
+            PyErr_SetString(PyExc_TypeError, "Genotype columns must be dicts");
+            goto out;
+        }
+        pos = 0;
+        while (PyDict_Next(columns, &pos, &name, &value)) {
+            if (PyDict_GetItem(keys, name) == NULL) {
+                k = PyLong_FromSsize_t(PyDict_Size(keys));
+                if (k == NULL) {
+                    goto out;
+                }
+                if (PyDict_SetItem(keys, name, k) != 0) {
+                    Py_DECREF(k);
+                    goto out;
+                }
+                Py_DECREF(k);
             }
         }
     }
-    Py_XDECREF(self->index);
-    Py_TYPE(self)->tp_free((PyObject*)self);
+    if (VCFRecordParser_alloc_fields(self, keys, 0, PyDict_Size(keys),
+                &self->format_keys, &self->num_format_keys) != 0) {
+        goto out;
+    }
+    num_keys = self->num_format_keys;
+    num_columns = self->num_samples * num_keys;
+    self->genotype_columns = PyMem_Malloc((num_columns + 1)
+            * sizeof(uint32_t));
+    if (self->genotype_columns == NULL) {
+        PyErr_NoMemory();
+        goto out;
+    }
+    memset(self->genotype_columns, 0, num_columns * sizeof(uint32_t));
+    for (j = 0; j < self->num_samples; j++) {
+        columns = PyList_GET_ITEM(genotype_columns, j);
+        pos = 0;
+        while (PyDict_Next(columns, &pos, &name, &value)) {
+            if (vcf_get_index(PyDict_GetItem(keys, name), 0, num_keys,
+                        &key) != 0) {
+                goto out;
+            }
+            if (vcf_get_index(value, 1, max_column, &col) != 0) {
+                goto out;
+            }
+            self->genotype_columns[j * num_keys + key] = col;
+        }
+    }
+    ret = 0;
+out:
+    Py_XDECREF(keys);
+    return ret;
 }
 
 static int
-IndexKeyIterator_init(IndexKeyIterator *self, PyObject *args, PyObject *kwds)
+VCFRecordParser_init(VCFRecordParser *self, PyObject *args, PyObject *kwds)
 {
     int ret = -1;
-    static char *kwlist[] = {"index", NULL};
-    Index *index = NULL;
-    self->index = NULL;
-    self->cursor = NULL;
-    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O!", kwlist,
-            &IndexType, &index)) {
+    static char *kwlist[] = {"table", "fixed_columns", "info_columns",
+            "genotype_columns", "truncate", NULL};
+    Table *table = NULL;
+    PyObject *fixed_columns = NULL;
+    PyObject *info_columns = NULL;
+    PyObject *genotype_columns = NULL;
+    PyObject *item;
+    Py_ssize_t j;
+    uint32_t field, col;
+    long max_column;
+    int truncate = 0;
+
+    self->table = NULL;
+    self->names = NULL;
+    memset(self->fixed_columns, 0, sizeof(self->fixed_columns));
+    self->info_fields = NULL;
+    self->num_info_fields = 0;
+    self->format_keys = NULL;
+    self->num_format_keys = 0;
+    self->genotype_columns = NULL;
+    self->num_samples = 0;
+    self->line = NULL;
+    self->line_size = 0;
+    self->values = NULL;
+    self->format = NULL;
+    self->tokens = NULL;
+    self->max_tokens = 0;
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O!O!O!O!|i", kwlist,
+            &TableType, &table, &PyList_Type, &fixed_columns,
+            &PyDict_Type, &info_columns, &PyList_Type, &genotype_columns,
+            &truncate)) {
         goto out;
     }
-    self->index = index;
-    Py_INCREF(self->index);
-    if (Index_check_read_mode(self->index) != 0) {
+    self->table = table;
+    Py_INCREF(self->table);
+    self->truncate = truncate;
+    if (Table_check_write_mode(self->table) != 0) {
+        goto out;
+    }
+    max_column = (long) self->table->num_columns;
+    self->names = PyList_New(0);
+    if (self->names == NULL) {
+        goto out;
+    }
+    for (j = 0; j < PyList_GET_SIZE(fixed_columns); j++) {
+        item = PyList_GET_ITEM(fixed_columns, j);
+        if (!PyTuple_Check(item) || PyTuple_GET_SIZE(item) != 2) {
+            PyErr_SetString(PyExc_TypeError,
+                    "Fixed columns must be (field, column) tuples");
+            goto out;
+        }
+        if (vcf_get_index(PyTuple_GET_ITEM(item, 0), 0,
+                    VCF_NUM_FIXED_FIELDS, &field) != 0) {
+            goto out;
+        }
+        if (vcf_get_index(PyTuple_GET_ITEM(item, 1), 1, max_column,
+                    &col) != 0) {
+            goto out;
+        }
+        self->fixed_columns[field] = col;
+    }
+    if (VCFRecordParser_alloc_fields(self, info_columns, 1, max_column,
+                &self->info_fields, &self->num_info_fields) != 0) {
+        goto out;
+    }
+    if (VCFRecordParser_set_genotype_columns(self, genotype_columns) != 0) {
+        goto out;
+    }
+    self->values = PyMem_Malloc(self->table->num_columns * sizeof(char *));
+    if (self->values == NULL) {
+        PyErr_NoMemory();
         goto out;
     }
     ret = 0;
@@ -4212,62 +9382,209 @@ out:
     return ret;
 }
 
-static PyMemberDef IndexKeyIterator_members[] = {
+static PyMemberDef VCFRecordParser_members[] = {
     {NULL}  /* Sentinel */
 };
 
+/*
+ * Makes sure that there is space for the specified number of FORMAT
+ * tokens.
+ */
+static int
+VCFRecordParser_reserve_tokens(VCFRecordParser *self, uint32_t num_tokens)
+{
+    int ret = -1;
+    int32_t *format;
+    char **tokens;
+    uint32_t n = 2 * num_tokens;
+
+    if (num_tokens > self->max_tokens) {
+        format = PyMem_Realloc(self->format, n * sizeof(int32_t));
+        if (format == NULL) {
+            PyErr_NoMemory();
+            goto out;
+        }
+        self->format = format;
+        tokens = PyMem_Realloc(self->tokens, n * sizeof(char *));
+        if (tokens == NULL) {
+            PyErr_NoMemory();
+            goto out;
+        }
+        self->tokens = tokens;
+        self->max_tokens = n;
+    }
+    ret = 0;
+out:
+    return ret;
+}
+
+/*
+ * Splits the current line in place, setting values[j] to point to the
+ * token for column j, or NULL if the value is missing. Values are
+ * chosen in the same way as by wormtable.vcf2wt.VCFRowParser.
+ */
+static int
+VCFRecordParser_parse(VCFRecordParser *self)
+{
+    int ret = -1;
+    static char flag_value[] = "1";
+    char *fields[VCF_FORMAT_FIELD];
+    char *cursor = self->line;
+    char *s, *field, *value, *sample, *token;
+    uint32_t j, k, col, num_format, num_tokens;
+    int32_t key;
+    VCFField *f;
+
+    memset(self->values, 0, self->table->num_columns * sizeof(char *));
+    for (j = 0; j < VCF_FORMAT_FIELD; j++) {
+        fields[j] = vcf_next_field(&cursor);
+        if (fields[j] == NULL) {
+            PyErr_SetString(PyExc_ValueError, "Too few fields in VCF line");
+            goto out;
+        }
+    }
+    for (j = 0; j < VCF_NUM_FIXED_FIELDS; j++) {
+        col = self->fixed_columns[j];
+        field = fields[j];
+        if (col != 0 && strcmp(field, VCF_MISSING_VALUE) != 0) {
+            if (self->truncate && (j == VCF_REF_FIELD || j == VCF_ALT_FIELD)
+                    && strlen(field) > VCF_MAX_ALLELE_SIZE) {
+                field[VCF_MAX_ALLELE_SIZE - 1] = '+';
+                field[VCF_MAX_ALLELE_SIZE] = '\0';
+            }
+            self->values[col] = field;
+        }
+    }
+    s = fields[VCF_INFO_FIELD];
+    while (s != NULL) {
+        token = vcf_next_token(&s, ';');
+        value = strchr(token, '=');
+        if (value != NULL) {
+            *value = '\0';
+            value++;
+            if (strchr(value, '=') != NULL) {
+                value = flag_value;
+            }
+        } else {
+            /* This is a Flag column */
+            value = flag_value;
+        }
+        f = vcf_find_field(self->info_fields, self->num_info_fields, token);
+        if (f != NULL) {
+            self->values[f->value] = value;
+        }
+    }
+    s = vcf_next_field(&cursor);
+    if (s != NULL) {
+        num_format = 0;
+        while (s != NULL) {
+            token = vcf_next_token(&s, ':');
+            if (VCFRecordParser_reserve_tokens(self, num_format + 1) != 0) {
+                goto out;
+            }
+            f = vcf_find_field(self->format_keys, self->num_format_keys,
+                    token);
+            self->format[num_format] = f == NULL ? -1 : (int32_t) f->value;
+            num_format++;
+        }
+        j = 0;
+        sample = vcf_next_field(&cursor);
+        while (sample != NULL) {
+            if (j >= self->num_samples) {
+                PyErr_SetString(PyExc_ValueError,
+                        "More samples in VCF line than in header");
+                goto out;
+            }
+            num_tokens = 0;
+            s = sample;
+            while (s != NULL) {
+                token = vcf_next_token(&s, ':');
+                if (num_tokens < num_format) {
+                    self->tokens[num_tokens] = token;
+                }
+                num_tokens++;
+            }
+            if (num_tokens == num_format) {
+                for (k = 0; k < num_format; k++) {
+                    key = self->format[k];
+                    token = self->tokens[k];
+                    col = key < 0 ? 0 : self->genotype_columns[
+                            j * self->num_format_keys + key];
+                    if (col != 0 && strcmp(token, VCF_MISSING_VALUE) != 0
+                            && strcmp(token, ".,.") != 0) {
+                        self->values[col] = token;
+                    }
+                }
+            }
+            j++;
+            sample = vcf_next_field(&cursor);
+        }
+    }
+    ret = 0;
+out:
+    return ret;
+}
 
 static PyObject *
-IndexKeyIterator_next(IndexKeyIterator *self)
+VCFRecordParser_append(VCFRecordParser *self, PyObject *args)
 {
     PyObject *ret = NULL;
-    int db_ret;
-    DB *db;
-    DBT key, data;
-    if (Index_check_read_mode(self->index) != 0) {
+    PyObject *line = NULL;
+    Table *table = self->table;
+    Py_ssize_t size;
+    uint32_t j;
+
+    if (!PyArg_ParseTuple(args, "O!", &PyBytes_Type, &line)) {
         goto out;
     }
-    memset(&key, 0, sizeof(DBT));
-    memset(&data, 0, sizeof(DBT));
-    if (self->cursor == NULL) {
-        /* it's the first time through the loop, so set up the cursor */
-        db = self->index->db;
-        db_ret = db->cursor(db, NULL, &self->cursor, 0);
-        if (db_ret != 0) {
-            handle_bdb_error(db_ret);
-            goto out;
-        }
+    if (Table_check_write_mode(table) != 0) {
+        goto out;
     }
-    db_ret = self->cursor->get(self->cursor, &key, &data, DB_NEXT_NODUP);
-    if (db_ret == 0) {
-        ret = Index_key_to_python(self->index, key.data, key.size);
-        if (ret == NULL) {
+    size = PyBytes_GET_SIZE(line) + 1;
+    if ((size_t) size > self->line_size) {
+        PyMem_Free(self->line);
+        self->line_size = 0;
+        self->line = PyMem_Malloc(size);
+        if (self->line == NULL) {
+            PyErr_NoMemory();
             goto out;
         }
-    } else if (db_ret != DB_NOTFOUND) {
-        handle_bdb_error(db_ret);
+        self->line_size = (size_t) size;
+    }
+    /* copy the terminating NUL also */
+    memcpy(self->line, PyBytes_AS_STRING(line), size);
+    if (VCFRecordParser_parse(self) != 0) {
         goto out;
     }
-    if (ret == NULL) {
-        /* Iteration is finished - free the cursor */
-        self->cursor->close(self->cursor);
-        self->cursor = NULL;
+    for (j = 1; j < table->num_columns; j++) {
+        if (self->values[j] != NULL) {
+            if (Table_insert_encoded(table, table->columns[j],
+                        self->values[j]) != 0) {
+                goto out;
+            }
+        }
+    }
+    if (Table_write_row(table) != 0) {
+        goto out;
     }
+    Py_INCREF(Py_None);
+    ret = Py_None;
 out:
     return ret;
 }
 
-static PyMethodDef IndexKeyIterator_methods[] = {
+static PyMethodDef VCFRecordParser_methods[] = {
+    {"append", (PyCFunction) VCFRecordParser_append, METH_VARARGS,
+            "Parse a VCF line and append the row to the table" },
     {NULL}  /* Sentinel */
 };
 
-
-static PyTypeObject IndexKeyIteratorType = {
+static PyTypeObject VCFRecordParserType = {
     PyVarObject_HEAD_INIT(NULL, 0)
-    "_wormtable.IndexKeyIterator",             /* tp_name */
-    sizeof(IndexKeyIterator),             /* tp_basicsize */
+    "_wormtable.VCFRecordParser",             /* tp_name */
+    sizeof(VCFRecordParser),             /* tp_basicsize */
     0,                         /* tp_itemsize */
-    (destructor)IndexKeyIterator_dealloc, /* tp_dealloc */
+    (destructor)VCFRecordParser_dealloc, /* tp_dealloc */
     0,                         /* tp_print */
     0,                         /* tp_getattr */
     0,                         /* tp_setattr */
@@ -4283,22 +9600,22 @@ static PyTypeObject IndexKeyIteratorType = {
     0,                         /* tp_setattro */
     0,                         /* tp_as_buffer */
     Py_TPFLAGS_DEFAULT,        /* tp_flags */
-    "IndexKeyIterator objects",           /* tp_doc */
+    "VCFRecordParser objects",           /* tp_doc */
     0,                     /* tp_traverse */
     0,                     /* tp_clear */
     0,                     /* tp_richcompare */
     0,                     /* tp_weaklistoffset */
-    PyObject_SelfIter,               /* tp_iter */
-    (iternextfunc) IndexKeyIterator_next, /* tp_iternext */
-    IndexKeyIterator_methods,             /* tp_methods */
-    IndexKeyIterator_members,             /* tp_members */
+    0,                     /* tp_iter */
+    0,                     /* tp_iternext */
+    VCFRecordParser_methods,             /* tp_methods */
+    VCFRecordParser_members,             /* tp_members */
     0,                         /* tp_getset */
     0,                         /* tp_base */
     0,                         /* tp_dict */
     0,                         /* tp_descr_get */
     0,                         /* tp_descr_set */
     0,                         /* tp_dictoffset */
-    (initproc)IndexKeyIterator_init,      /* tp_init */
+    (initproc)VCFRecordParser_init,      /* tp_init */
 };
 
 /*==========================================================
@@ -4417,6 +9734,14 @@ init_wormtable(void)
     Py_INCREF(&IndexKeyIteratorType);
     PyModule_AddObject(module, "IndexKeyIterator",
             (PyObject *) &IndexKeyIteratorType);
+    /* VCFRecordParser */
+    VCFRecordParserType.tp_new = PyType_GenericNew;
+    if (PyType_Ready(&VCFRecordParserType) < 0) {
+        INITERROR;
+    }
+    Py_INCREF(&VCFRecordParserType);
+    PyModule_AddObject(module, "VCFRecordParser",
+            (PyObject *) &VCFRecordParserType);
 
     WormtableError = PyErr_NewException("_wormtable.WormtableError",
             NULL, NULL);
@@ -4433,6 +9758,19 @@ init_wormtable(void)
     PyModule_AddIntConstant(module, "WT_READ", WT_READ);
     PyModule_AddIntConstant(module, "WT_WRITE", WT_WRITE);
 
+    PyModule_AddIntConstant(module, "WT_FILTER_CMP", WT_FILTER_CMP);
+    PyModule_AddIntConstant(module, "WT_FILTER_MISSING", WT_FILTER_MISSING);
+    PyModule_AddIntConstant(module, "WT_FILTER_CONTAINS", WT_FILTER_CONTAINS);
+    PyModule_AddIntConstant(module, "WT_FILTER_AND", WT_FILTER_AND);
+    PyModule_AddIntConstant(module, "WT_FILTER_OR", WT_FILTER_OR);
+    PyModule_AddIntConstant(module, "WT_FILTER_NOT", WT_FILTER_NOT);
+    PyModule_AddIntConstant(module, "WT_FILTER_LT", WT_FILTER_LT);
+    PyModule_AddIntConstant(module, "WT_FILTER_LE", WT_FILTER_LE);
+    PyModule_AddIntConstant(module, "WT_FILTER_EQ", WT_FILTER_EQ);
+    PyModule_AddIntConstant(module, "WT_FILTER_NE", WT_FILTER_NE);
+    PyModule_AddIntConstant(module, "WT_FILTER_GT", WT_FILTER_GT);
+    PyModule_AddIntConstant(module, "WT_FILTER_GE", WT_FILTER_GE);
+
     PyModule_AddIntConstant(module, "WT_VAR_1_MAX_ELEMENTS",
             WT_VAR_1_MAX_ELEMENTS);
     PyModule_AddIntConstant(module, "WT_VAR_2_MAX_ELEMENTS",
@@ -4,33 +4,15 @@
 Perform a simple sliding window over chromosomes in a VCF. Within each
 non-overlapping window we calculate the means of a specified numeric columns
 (e.g. QUAL,INFO_DP). In the case that the requested value is a tuple (e.g.
-allele frequency (AF) from GATK) just take the first value.
+allele frequency (AF) from GATK) the mean is over all of its values.
 """
 
 from __future__ import print_function
 from __future__ import division 
 
-import re
-import sys
-import math
 import wormtable as wt
 import argparse
 
-def increment(val, dat):
-    if val is not None:
-        dat['c'] += 1
-        if isinstance(val, tuple):
-            dat['t'] += val[0]
-        else:
-            dat['t'] += val
-
-
-def getmean(tot, count):
-    if count == 0:
-        return 'NA'
-    else:
-        return tot/count
-
 
 class SlidingWindow(object):
     """
@@ -49,24 +31,10 @@ class SlidingWindow(object):
             for window in self.__chriter(chrom):
                 yield window
 
-    def __chriter(self, chrom):        
-        cols = ["POS"] + self.__cols
-        start = self.__index.min_key(chrom)[1]
-        end = self.__index.max_key(chrom)[1]
-        stop = chrom, end + 1
-        n = 1 + math.ceil((end - start) / self.__wsize)
-        dat = {n:{'c':0, 't':0} for n in self.__cols}
-        j = 0
-        for row in self.__index.cursor(cols, start=(chrom,start), stop=stop):
-            pos = row[0]
-            vals = row[1:]
-            for i in range(len(self.__cols)):
-                increment(vals[i], dat[self.__cols[i]])
-            if pos >= start + j * self.__wsize:
-                yield([chrom, start+j * self.__wsize] + 
-                        [getmean(dat[n]['t'], dat[n]['c']) for n in dat])
-                dat = {n:{'c':0, 't':0} for n in self.__cols}
-                j += 1
+    def __chriter(self, chrom):
+        agg = [("mean", c) for c in self.__cols]
+        for pos, means in self.__index.windows(chrom, self.__wsize, agg=agg):
+            yield [chrom, pos] + ['NA' if m is None else m for m in means]
     
     def close(self):
         """
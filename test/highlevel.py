@@ -25,12 +25,15 @@ import wormtable as wt
 import os
 import sys
 import math
+import array
 import random
 import shutil
 import os.path
 import unittest
 import tempfile
 import itertools
+import threading
+import multiprocessing
 
 from xml.etree import ElementTree
 
@@ -56,6 +59,20 @@ def histogram(l, width):
             d[v] = 1
     return d
 
+def read_shared_table(args):
+    """
+    Returns the rows in the table and index in the specified home directory,
+    opened in the specified shared environment. This is run in worker
+    processes.
+    """
+    homedir, env_home, index_name = args
+    with wt.open_table(homedir, env_home=env_home) as t:
+        cols = t.columns()
+        rows = list(t.cursor(cols))
+        with t.open_index(index_name) as i:
+            index_rows = list(i.cursor(cols))
+    return rows, index_rows
+
 class WormtableTest(unittest.TestCase):
     """
     Superclass of all wormtable tests. Create a homedir for working in
@@ -264,6 +281,40 @@ class TableBuildTest(WormtableTest):
             self.assertEqual(None, r[j])
         t.close()
 
+    def test_append_table(self):
+        self.make_random_table()
+        source = self._table
+        homedir = tempfile.mkdtemp(prefix="wthl_")
+        schema = os.path.join(homedir, "schema.xml")
+        try:
+            source.write_schema(schema)
+            t = wt.Table(os.path.join(homedir, "dest"))
+            t.read_schema(schema)
+            self.assertRaises(ValueError, t.append_table, source)
+            t.open("w")
+            t.append([None, 1])
+            t.append_table(source)
+            t.append_table(source)
+            self.assertEqual(len(t), 1 + 2 * len(source))
+            t.close()
+            t.open("r")
+            self.assertEqual(len(t), 1 + 2 * len(source))
+            self.assertEqual(t[0][1], 1)
+            rows = list(source)
+            for j, r in enumerate(t.cursor(range(1, len(source.columns())),
+                    start=1)):
+                self.assertEqual(r, rows[j % len(rows)][1:])
+            self.assertEqual([r[0] for r in t], list(range(len(t))))
+            t.close()
+            u = wt.Table(os.path.join(homedir, "other"))
+            u.add_id_column(4)
+            u.add_uint_column("uint")
+            u.open("w")
+            self.assertRaises(ValueError, u.append_table, source)
+            u.close()
+        finally:
+            shutil.rmtree(homedir)
+
 
 
 
@@ -325,6 +376,743 @@ class IndexBuildTest(WormtableTest):
         self.assertEqual(m1, m3)
 
 
+class IndexSortBuildTest(WormtableTest):
+    """
+    Tests building indexes by sorting keys with various buffer sizes.
+    """
+    def setUp(self):
+        super(IndexSortBuildTest, self).setUp()
+        self._table = wt.Table(self._homedir)
+        t = self._table
+        t.add_id_column(4)
+        t.add_uint_column("u1", size=1)
+        t.add_int_column("i2", size=2)
+        t.add_char_column("charv")
+        t.open("w")
+        for j in range(500):
+            u = None if random.random() < 0.1 else random.randint(0, 20)
+            i = random.randint(-100, 100)
+            n = random.randint(0, 5)
+            s = "".join(random.choice("ab") for k in range(n)).encode()
+            t.append([None, u, i, s])
+        t.close()
+        t.open("r")
+
+    def build_index(self, name, colspec, sort_buffer_size):
+        i = wt.Index(self._table, name)
+        for c in colspec:
+            i.add_key_column(self._table.get_column(c))
+        i.open("w")
+        i.build(sort_buffer_size=sort_buffer_size)
+        i.close()
+        i.open("r")
+        rows = list(i.cursor(self._table.columns()))
+        keys = list(i.keys())
+        i.close()
+        i.delete()
+        return keys, rows
+
+    def test_sort_buffer_sizes(self):
+        for colspec in [["u1"], ["charv"], ["u1", "i2"], ["charv", "u1"]]:
+            keys, rows = self.build_index("unsorted", colspec, 0)
+            expected = sorted(self._table,
+                key=lambda r: [ColumnValue(self._table.get_column(c), r)
+                    for c in colspec] + [r[0]])
+            self.assertEqual(rows, expected)
+            for size in [1, 100, 1000, "1K", "64M"]:
+                k, r = self.build_index("sorted", colspec, size)
+                self.assertEqual(keys, k)
+                self.assertEqual(rows, r)
+        # All temporary files must be removed.
+        files = os.listdir(self._homedir)
+        self.assertFalse(any("sort" in f for f in files))
+        self.assertRaises(ValueError, self.build_index, "x", ["u1"], -1)
+
+    def test_parallel_build(self):
+        for colspec in [["u1"], ["charv", "i2"]]:
+            keys, rows = self.build_index("serial", colspec, 0)
+            for num_jobs, size in [(2, 100), (3, "64M")]:
+                i = wt.Index(self._table, "parallel")
+                for c in colspec:
+                    i.add_key_column(self._table.get_column(c))
+                i.open("w")
+                processed = []
+                i.build(processed.append, sort_buffer_size=size,
+                        num_jobs=num_jobs)
+                i.close()
+                self.assertEqual(processed[-1], len(self._table))
+                self.assertEqual(processed, sorted(processed))
+                i.open("r")
+                self.assertEqual(keys, list(i.keys()))
+                self.assertEqual(rows, list(i.cursor(self._table.columns())))
+                i.close()
+                i.delete()
+        files = os.listdir(self._homedir)
+        self.assertFalse(any("sort" in f for f in files))
+        i = wt.Index(self._table, "x")
+        i.add_key_column(self._table.get_column("u1"))
+        i.open("w")
+        self.assertRaises(ValueError, i.build, num_jobs=0)
+        i.close()
+
+
+class BuildIndexesTest(IndexSortBuildTest):
+    """
+    Tests building several indexes in a single pass over the table.
+    """
+    def test_build_indexes(self):
+        t = self._table
+        colspecs = [["u1"], ["charv", "i2"], ["i2"], ["u1", "charv"]]
+        expected = [self.build_index("serial", c, 0) for c in colspecs]
+        for size, num_jobs in [(0, 1), (100, 1), ("64M", 1), (100, 2),
+                (1, 3)]:
+            indexes = []
+            for j, colspec in enumerate(colspecs):
+                i = wt.Index(t, "index_{0}".format(j))
+                for c in colspec:
+                    i.add_key_column(t.get_column(c))
+                i.open("w")
+                indexes.append(i)
+            processed = []
+            t.build_indexes(indexes, processed.append, 1, size, num_jobs)
+            if num_jobs == 1:
+                self.assertEqual(processed, list(range(1, len(t) + 1)))
+            else:
+                # The keys for all indexes are extracted in a single pass
+                self.assertEqual(processed[-1], len(t))
+                self.assertEqual(processed, sorted(processed))
+            for i, (keys, rows) in zip(indexes, expected):
+                i.close()
+                i.open("r")
+                self.assertEqual(keys, list(i.keys()))
+                self.assertEqual(rows, list(i.cursor(t.columns())))
+                i.close()
+                i.delete()
+        files = os.listdir(self._homedir)
+        self.assertFalse(any("sort" in f for f in files))
+        t.build_indexes([])
+        i = wt.Index(t, "closed")
+        i.add_key_column(t.get_column("u1"))
+        self.assertRaises(ValueError, t.build_indexes, [i])
+
+
+class AddIndexTest(IndexSortBuildTest):
+    """
+    Tests building indexes as rows are appended to a table.
+    """
+    def test_add_index(self):
+        t = self._table
+        colspecs = [["u1"], ["charv", "i2"], ["u1", "charv"]]
+        expected = [self.build_index("serial", c, 0) for c in colspecs]
+        homedir = os.path.join(self._homedir, "copy")
+        for size in [100, "64M"]:
+            os.mkdir(homedir)
+            copy = wt.Table(homedir)
+            for c in t.columns():
+                copy.add_column(c.get_name(), c.get_description(),
+                        c.get_type(), c.get_element_size(),
+                        c.get_num_elements())
+            copy.open("w")
+            for j, colspec in enumerate(colspecs):
+                i = wt.Index(copy, "index_{0}".format(j))
+                for c in colspec:
+                    i.add_key_column(copy.get_column(c))
+                copy.add_index(i, size)
+            for row in t:
+                copy.append([None] + list(row[1:]))
+            copy.close()
+            copy = wt.open_table(homedir)
+            self.assertEqual(list(t), list(copy))
+            for j, (keys, rows) in enumerate(expected):
+                i = copy.open_index("index_{0}".format(j))
+                self.assertEqual(keys, list(i.keys()))
+                self.assertEqual(rows, list(i.cursor(copy.columns())))
+                i.close()
+            copy.close()
+            files = os.listdir(homedir)
+            self.assertFalse(any("sort" in f for f in files))
+            shutil.rmtree(homedir)
+        os.mkdir(homedir)
+        copy = wt.Table(homedir)
+        copy.add_id_column()
+        copy.add_uint_column("u1")
+        copy.open("w")
+        i = wt.Index(copy, "u1")
+        i.add_key_column(copy.get_column("u1"))
+        copy.append([None, 1])
+        self.assertRaises(ValueError, copy.add_index, i)
+        copy.close()
+        self.assertRaises(ValueError, t.add_index, i)
+
+
+class ThreadedCursorTest(WormtableTest):
+    """
+    Tests reading from a table and index using cursors in several threads.
+    """
+    def setUp(self):
+        super(ThreadedCursorTest, self).setUp()
+        self.make_random_table()
+        i = wt.Index(self._table, "uint")
+        i.add_key_column(self._table.get_column("uint"))
+        i.open("w")
+        i.build()
+        i.close()
+        self._index = self._table.open_index("uint")
+
+    def tearDown(self):
+        self._index.close()
+        super(ThreadedCursorTest, self).tearDown()
+
+    def test_threads(self):
+        t = self._table
+        n = len(t)
+        num_threads = 4
+        bounds = [n * j // num_threads for j in range(num_threads + 1)]
+        cols = t.columns()
+        expected = list(t.cursor(cols))
+        index_expected = list(self._index.cursor(cols))
+        results = {}
+        def table_worker(j):
+            rows = list(t.cursor(cols, bounds[j], bounds[j + 1]))
+            results[("table", j)] = rows
+        def index_worker(j):
+            results[("index", j)] = list(self._index.cursor(cols))
+        threads = [threading.Thread(target=table_worker, args=(j,))
+                for j in range(num_threads)]
+        threads += [threading.Thread(target=index_worker, args=(j,))
+                for j in range(num_threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        rows = []
+        for j in range(num_threads):
+            rows.extend(results[("table", j)])
+            self.assertEqual(results[("index", j)], index_expected)
+        self.assertEqual(rows, expected)
+
+    def test_close_while_reading(self):
+        if not hasattr(sys, "setswitchinterval"):
+            return
+        t = self._table
+        error = wt.tables._wormtable.WormtableError
+        cursor = self._index.cursor(t.columns())
+        started = threading.Event()
+        def reader():
+            started.set()
+            for row in cursor:
+                pass
+        interval = sys.getswitchinterval()
+        # With a long switch interval this thread only gets the GIL back
+        # when the reader releases it to read a row.
+        thread = threading.Thread(target=reader)
+        sys.setswitchinterval(1000)
+        try:
+            thread.start()
+            started.wait()
+            self.assertRaises(error, t.close)
+            self.assertRaises(error, self._index.close)
+            self.assertRaises(error, next, cursor)
+            self.assertTrue(t.is_open())
+            self.assertTrue(self._index.is_open())
+        finally:
+            sys.setswitchinterval(interval)
+            thread.join()
+        self.assertRaises(StopIteration, next, cursor)
+        self.assertEqual(len(list(self._index.cursor(["uint"]))), len(t))
+
+
+class InterleavedCursorTest(WormtableTest):
+    """
+    Tests consuming several cursors on the same table in lockstep.
+    """
+    def setUp(self):
+        super(InterleavedCursorTest, self).setUp()
+        self.make_random_table()
+        i = wt.Index(self._table, "uint")
+        i.add_key_column(self._table.get_column("uint"))
+        i.open("w")
+        i.build()
+        i.close()
+        self._index = self._table.open_index("uint")
+
+    def tearDown(self):
+        self._index.close()
+        super(InterleavedCursorTest, self).tearDown()
+
+    def test_interleaved(self):
+        t = self._table
+        cols = t.columns()
+        expected = list(t.cursor(cols))
+        index_expected = list(self._index.cursor(cols))
+        cursors = [t.cursor(cols), self._index.cursor(cols),
+                t.cursor(cols[:1]), self._index.cursor(cols)]
+        rows = list(zip(*cursors))
+        self.assertEqual(len(rows), len(expected))
+        for r, e, ie in zip(rows, expected, index_expected):
+            self.assertEqual(r[0], e)
+            self.assertEqual(r[1], ie)
+            self.assertEqual(r[2], e[:1])
+            self.assertEqual(r[3], ie)
+
+    def test_interleaved_batches(self):
+        t = self._table
+        cols = t.columns()
+        expected = list(t.cursor(cols))
+        cursors = [iter(t.cursor(cols, batch_size=3)),
+                iter(t.cursor(cols, batch_size=5))]
+        rows = [[], []]
+        done = [False, False]
+        while not all(done):
+            for j, c in enumerate(cursors):
+                if not done[j]:
+                    try:
+                        rows[j].extend(next(c))
+                    except StopIteration:
+                        done[j] = True
+        rows1, rows2 = rows
+        self.assertEqual(rows1, expected)
+        self.assertEqual(rows2, expected)
+
+
+class SharedCacheTest(WormtableTest):
+    """
+    Tests opening a table and its indexes with a shared cache.
+    """
+    def setUp(self):
+        super(SharedCacheTest, self).setUp()
+        self.make_random_table()
+        self._names = ["uint", "int", "char"]
+        for name in self._names:
+            i = wt.Index(self._table, name)
+            i.add_key_column(self._table.get_column(name))
+            i.open("w")
+            i.build()
+            i.close()
+        self._table.close()
+        self._table = None
+
+    def test_env_cache_size(self):
+        t = wt.Table(self._homedir)
+        self.assertEqual(t.get_env_cache_size(), 0)
+        t.set_env_cache_size("2M")
+        self.assertEqual(t.get_env_cache_size(), 2 * 1024 * 1024)
+
+    def test_shared_cache(self):
+        plain = wt.open_table(self._homedir)
+        cols = plain.columns()
+        expected = list(plain.cursor(cols))
+        index_expected = {}
+        for name in self._names:
+            with plain.open_index(name) as i:
+                index_expected[name] = list(i.cursor(cols))
+        plain.close()
+        t = wt.open_table(self._homedir, env_cache_size="4M")
+        self.assertEqual(t.get_env_cache_size(), 4 * 1024 * 1024)
+        indexes = [t.open_index(name) for name in self._names]
+        self.assertEqual(list(t.cursor(cols)), expected)
+        self.assertEqual(t[0], expected[0])
+        for name, i in zip(self._names, indexes):
+            self.assertEqual(list(i.cursor(cols)), index_expected[name])
+        # Indexes can be closed before or after the table.
+        indexes[0].close()
+        t.close()
+        for i in indexes[1:]:
+            i.close()
+        # The table can then be reopened.
+        t = wt.open_table(self._homedir, env_cache_size="4M")
+        self.assertEqual(list(t.cursor(cols)), expected)
+        t.close()
+
+    def test_env_home(self):
+        env_home = tempfile.mkdtemp(prefix="wtenv_")
+        try:
+            t = wt.open_table(self._homedir, env_cache_size="4M",
+                    env_home=env_home)
+            self.assertEqual(t.get_env_home(), env_home)
+            cols = t.columns()
+            expected = list(t.cursor(cols))
+            with t.open_index("uint") as i:
+                index_expected = list(i.cursor(cols))
+            num_workers = 3
+            args = [(self._homedir, t.get_env_home(), "uint")
+                    for j in range(num_workers)]
+            pool = multiprocessing.Pool(num_workers)
+            try:
+                results = pool.map(read_shared_table, args)
+            finally:
+                pool.terminate()
+                pool.join()
+            t.close()
+            for rows, index_rows in results:
+                self.assertEqual(rows, expected)
+                self.assertEqual(index_rows, index_expected)
+        finally:
+            shutil.rmtree(env_home)
+
+
+
+class FilterTest(WormtableTest):
+    """
+    Tests filtering the rows returned by cursors.
+    """
+    def setUp(self):
+        super(FilterTest, self).setUp()
+        self.make_random_table()
+        i = wt.Index(self._table, "int")
+        i.add_key_column(self._table.get_column("int"))
+        i.open("w")
+        i.build()
+        i.close()
+        self._index = self._table.open_index("int")
+
+    def tearDown(self):
+        self._index.close()
+        super(FilterTest, self).tearDown()
+
+    def verify_filter(self, where, predicate):
+        t = self._table
+        cols = t.columns()
+        names = [c.get_name() for c in cols]
+        def f(row):
+            return predicate(dict(zip(names, row)))
+        expected = [r for r in t.cursor(cols) if f(r)]
+        self.assertEqual(list(t.cursor(cols, where=where)), expected)
+        rows = []
+        for batch in t.cursor(cols, batch_size=3, where=where):
+            rows.extend(batch)
+        self.assertEqual(rows, expected)
+        expected = [r for r in self._index.cursor(cols) if f(r)]
+        self.assertEqual(list(self._index.cursor(cols, where=where)),
+                expected)
+
+    def test_comparisons(self):
+        for v in [-1, 0, 3, 5, 10, 11]:
+            self.verify_filter("uint < {0}".format(v),
+                    lambda r: r["uint"] is not None and r["uint"] < v)
+            self.verify_filter("int >= {0}".format(v),
+                    lambda r: r["int"] is not None and r["int"] >= v)
+            self.verify_filter("{0} == int".format(v),
+                    lambda r: r["int"] == v)
+            self.verify_filter("int != {0}".format(v),
+                    lambda r: r["int"] is not None and r["int"] != v)
+            self.verify_filter("float > {0}".format(v + 0.5),
+                    lambda r: r["float"] is not None and r["float"] > v + 0.5)
+            self.verify_filter("1 <= uint < {0}".format(v),
+                    lambda r: r["uint"] is not None and 1 <= r["uint"] < v)
+        self.verify_filter("char == '005'", lambda r: r["char"] == b"005")
+        self.verify_filter("char > b'004'",
+                lambda r: r["char"] is not None and r["char"] > b"004")
+
+    def test_missing(self):
+        for name in ["uint", "int", "float", "char", "uintv"]:
+            self.verify_filter("{0} is None".format(name),
+                    lambda r: r[name] is None)
+            self.verify_filter("{0} is not None".format(name),
+                    lambda r: r[name] is not None)
+
+    def test_boolean(self):
+        self.verify_filter("uint > 3 and int < 5 or char is None",
+                lambda r: (r["uint"] is not None and r["uint"] > 3
+                    and r["int"] is not None and r["int"] < 5)
+                    or r["char"] is None)
+        self.verify_filter("not (uint > 3 or int is None)",
+                lambda r: not ((r["uint"] is not None and r["uint"] > 3)
+                    or r["int"] is None))
+
+    def test_elements(self):
+        def element(r, j):
+            v = r["uintv"]
+            return v[j] if v is not None and len(v) > j else None
+        self.verify_filter("uintv[1] == 0", lambda r: element(r, 1) == 0)
+        self.verify_filter("uintv[3] is None", lambda r: element(r, 3) is None)
+        self.verify_filter("0 in uintv",
+                lambda r: r["uintv"] is not None and 0 in r["uintv"])
+        self.verify_filter("'5' in char",
+                lambda r: r["char"] is not None and b"5" in r["char"])
+        self.verify_filter("'5' not in char",
+                lambda r: not (r["char"] is not None and b"5" in r["char"]))
+
+    def test_col(self):
+        self.verify_filter("col('uint') > 5",
+                lambda r: r["uint"] is not None and r["uint"] > 5)
+
+    def test_projection(self):
+        t = self._table
+        where = "uint > 3 or char is None and int < 5"
+        expected = [r for r in t.cursor(t.columns(), where=where)]
+        projections = [["uint"], ["char", "float"], ["int", "uint", "int"],
+                ["float"], ["uintv", "char", "uint", "char"]]
+        for names in projections:
+            positions = [t.get_column(n).get_position() for n in names]
+            rows = [tuple(r[j] for j in positions) for r in expected]
+            self.assertEqual(list(t.cursor(names, where=where)), rows)
+            rows = [tuple(r[j] for j in positions) for r in
+                    self._index.cursor(t.columns(), where=where)]
+            self.assertEqual(list(self._index.cursor(names, where=where)),
+                    rows)
+
+    def test_covering(self):
+        t = self._table
+        names = ["row_id", "int"]
+        for where in ["int > 3", "int is None", "uint > 3", "char is None"]:
+            rows = [r[:1] + r[2:3] for r in
+                    self._index.cursor(t.columns(), where=where)]
+            self.assertEqual(list(self._index.cursor(names, where=where)),
+                    rows)
+
+    def test_errors(self):
+        t = self._table
+        cols = t.columns()
+        bad = ["uint +", "uint", "uint + 1 > 2", "uint > int", "nocol > 1",
+                "uint == None", "uint > 'x'", "char > 1", "uintv > 1",
+                "uintv[-1] > 1", "char[0] == 1", "uint in uintv",
+                "uint is 1"]
+        for where in bad:
+            self.assertRaises(ValueError, t.cursor, cols, where=where)
+            self.assertRaises(ValueError, self._index.cursor, cols,
+                    where=where)
+
+
+class AggregateTest(WormtableTest):
+    """
+    Tests computing aggregates over the rows of tables and indexes.
+    """
+    def setUp(self):
+        super(AggregateTest, self).setUp()
+        self.make_random_table()
+        i = wt.Index(self._table, "uint+int")
+        i.add_key_column(self._table.get_column("uint"))
+        i.add_key_column(self._table.get_column("int"))
+        i.open("w")
+        i.build()
+        i.close()
+        self._index = self._table.open_index("uint+int")
+        columns = ["uint", "int", "float", "uintv", "floatv"]
+        self._aggregates = [(f, c) for f in wt.AGGREGATE_FUNCTIONS
+                for c in columns] + [("count", "char")]
+
+    def tearDown(self):
+        self._index.close()
+        super(AggregateTest, self).tearDown()
+
+    def aggregate(self, rows):
+        """
+        Returns the aggregates computed in Python over the specified rows,
+        which contain the values of the aggregated columns.
+        """
+        ret = []
+        for j, (function, column) in enumerate(self._aggregates):
+            values = []
+            for row in rows:
+                v = row[j]
+                if v is not None:
+                    values.extend(v if isinstance(v, tuple) else [v])
+            if function == "count":
+                ret.append(len(values))
+            elif function == "sum":
+                ret.append(sum(values))
+            elif len(values) == 0:
+                ret.append(None)
+            elif function == "mean":
+                ret.append(sum(values) / len(values))
+            elif function == "min":
+                ret.append(min(values))
+            else:
+                ret.append(max(values))
+        return tuple(ret)
+
+    def assertValuesEqual(self, values, expected):
+        self.assertEqual(len(values), len(expected))
+        for v, e in zip(values, expected):
+            if isinstance(e, float):
+                self.assertAlmostEqual(v, e, places=3)
+            else:
+                self.assertEqual(v, e)
+
+    def test_table(self):
+        t = self._table
+        cols = [c for f, c in self._aggregates]
+        self.assertValuesEqual(t.aggregate(self._aggregates),
+                self.aggregate(list(t.cursor(cols))))
+        n = len(t)
+        for start, stop in [(0, 0), (0, n // 2), (n // 3, n), (n, n)]:
+            self.assertValuesEqual(
+                    t.aggregate(self._aggregates, start, stop),
+                    self.aggregate(list(t.cursor(cols, start, stop))))
+        where = "uint > 3 and char is not None"
+        self.assertValuesEqual(t.aggregate(self._aggregates, where=where),
+                self.aggregate(list(t.cursor(cols, where=where))))
+
+    def test_index(self):
+        i = self._index
+        cols = [c for f, c in self._aggregates]
+        self.assertValuesEqual(i.aggregate(self._aggregates),
+                self.aggregate(list(i.cursor(cols))))
+        self.assertValuesEqual(
+                i.aggregate(self._aggregates, start=(2,), stop=(6,)),
+                self.aggregate(list(i.cursor(cols, start=(2,), stop=(6,)))))
+
+    def verify_groups(self, groups, rows, key, num_group_columns):
+        n = num_group_columns
+        expected = [(k, self.aggregate([r[n:] for r in group]))
+                for k, group in itertools.groupby(rows, key)]
+        self.assertEqual([k for k, v in groups], [k for k, v in expected])
+        for (k, v), (l, e) in zip(groups, expected):
+            self.assertValuesEqual(v, e)
+
+    def test_group_by(self):
+        i = self._index
+        cols = [c for f, c in self._aggregates]
+        rows = list(i.cursor(["uint", "int"] + cols))
+        self.verify_groups(i.aggregate(self._aggregates, group_by=1),
+                [r[:1] + r[2:] for r in rows], lambda r: r[:1], 1)
+        self.verify_groups(i.aggregate(self._aggregates, group_by=2),
+                rows, lambda r: r[:2], 2)
+        def key(r):
+            return (r[0], None if r[1] is None else r[1] - r[1] % 3)
+        where = "float < 5"
+        rows = list(i.cursor(["uint", "int"] + cols, where=where))
+        groups = i.aggregate(self._aggregates, group_by=2, bin_width=3,
+                where=where)
+        self.verify_groups(groups, rows, key, 2)
+        self.assertEqual(i.aggregate(self._aggregates, group_by=1,
+                start=(100,)), [])
+
+    def verify_windows(self, u, width, step, start, stop=None, where=None):
+        i = self._index
+        cols = [c for f, c in self._aggregates]
+        rows = [r for r in i.cursor(["uint", "int"] + cols, start=(u,),
+                stop=(u + 1,), where=where) if r[1] is not None]
+        windows = list(i.windows(u, width, step, agg=self._aggregates,
+                start=start, stop=stop, where=where))
+        if stop is None:
+            stop = i.max_key(u)[1] + 1
+        self.assertEqual([s for s, v in windows],
+                list(range(start, stop, step)))
+        for s, v in windows:
+            e = min(s + width, stop)
+            self.assertValuesEqual(v,
+                    self.aggregate([r[2:] for r in rows if s <= r[1] < e]))
+        numpy = wt.tables.numpy
+        if numpy is not None:
+            cols = ["uint", "int", "float"]
+            windows = list(i.windows(u, width, step, cols, start=start,
+                stop=stop, where=where))
+            for s, arrays in windows:
+                e = min(s + width, stop)
+                expected = i.read_columns(cols, start=(u, s), stop=(u, e),
+                        where=where)
+                for a, b in zip(arrays, expected):
+                    self.assertEqual(a.tolist(), b.tolist())
+
+    def test_windows(self):
+        for u in range(4):
+            for width, step in [(1, 1), (3, 3), (4, 2), (5, 3), (2, 4)]:
+                self.verify_windows(u, width, step, 0, 11)
+                self.verify_windows(u, width, step, 1, 8, where="float > 2")
+            self.verify_windows(u, 3, 2, 0)
+
+    def test_window_errors(self):
+        i = self._index
+        agg = [("sum", "float")]
+        self.assertRaises(ValueError, i.windows, 1, 10)
+        self.assertRaises(ValueError, i.windows, 1, 10, columns=["uint"],
+                agg=agg)
+        self.assertRaises(ValueError, i.windows, (1, 2), 10, agg=agg)
+        self.assertRaises(ValueError, i.windows, 1, 0, agg=agg)
+        self.assertRaises(ValueError, i.windows, 1, 10, -1, agg=agg)
+        self.assertRaises(ValueError, i.windows, 1, 2.5, agg=agg)
+        self.assertRaises(ValueError, i.windows, 1, 2, 0.5, agg=agg)
+        t = self._table
+        b = wt.Index(t, "binned")
+        b.add_key_column(t.get_column("uint"))
+        b.add_key_column(t.get_column("int"), 2)
+        b.open("w")
+        b.build()
+        b.close()
+        b.open("r")
+        self.assertRaises(ValueError, b.windows, 1, 3, agg=agg, start=0)
+        self.assertRaises(ValueError, b.windows, 1, 4, 3, agg=agg, start=0)
+        self.assertRaises(ValueError, b.windows, 1, 4, agg=agg, start=1)
+        self.assertRaises(ValueError, b.windows, 1, 4, agg=agg, start=0,
+                stop=7)
+        self.assertEqual([s for s, v in b.windows(1, 4, agg=agg, start=0,
+                stop=8)], [0, 4])
+        b.close()
+        b.delete()
+
+    def test_missing_windows(self):
+        homedir = tempfile.mkdtemp(prefix="wthl_")
+        try:
+            t = wt.Table(homedir)
+            t.add_id_column(4)
+            t.add_uint_column("uint")
+            t.add_int_column("int")
+            t.open("w")
+            for j in range(10):
+                t.append([None, j % 2, None if j % 2 == 0 else j])
+            t.close()
+            t.open("r")
+            i = wt.Index(t, "uint+int")
+            i.add_key_column(t.get_column("uint"))
+            i.add_key_column(t.get_column("int"))
+            i.open("w")
+            i.build()
+            i.close()
+            i.open("r")
+            agg = [("count", "int")]
+            self.assertEqual(list(i.windows(0, 2, agg=agg)), [])
+            self.assertEqual(list(i.windows(0, 2, agg=agg, start=0)), [])
+            self.assertEqual([s for s, v in i.windows(1, 2, agg=agg)],
+                    [1, 3, 5, 7, 9])
+            i.close()
+            t.close()
+        finally:
+            shutil.rmtree(homedir)
+
+    def test_large_sums(self):
+        homedir = tempfile.mkdtemp(prefix="wthl_")
+        try:
+            t = wt.Table(homedir)
+            t.add_id_column(4)
+            t.add_uint_column("u8", size=8)
+            t.add_int_column("i8", size=8)
+            t.open("w")
+            umax = 2**64 - 2
+            imax = 2**63 - 2
+            rows = [(umax, imax), (umax, imax), (1, -imax), (umax, -imax),
+                    (0, -imax), (0, -imax)]
+            for u, i in rows:
+                t.append([None, u, i])
+            t.close()
+            t.open("r")
+            aggregates = [("sum", "u8"), ("sum", "i8")]
+            self.assertEqual(t.aggregate(aggregates),
+                    tuple(sum(r[j] for r in rows) for j in range(2)))
+            self.assertEqual(t.aggregate(aggregates, stop=2),
+                    (2 * umax, 2 * imax))
+            t.close()
+        finally:
+            shutil.rmtree(homedir)
+
+    def test_errors(self):
+        t = self._table
+        i = self._index
+        for aggregates in [[("median", "uint")], [("sum", "char")],
+                [("count", "nocolumn")]]:
+            self.assertRaises((ValueError, KeyError), t.aggregate, aggregates)
+            self.assertRaises((ValueError, KeyError), i.aggregate, aggregates)
+        aggregates = [("sum", "uint")]
+        self.assertRaises(ValueError, i.aggregate, aggregates, group_by=3)
+        self.assertRaises(ValueError, i.aggregate, aggregates, group_by=-1)
+        self.assertRaises(ValueError, i.aggregate, aggregates, bin_width=10)
+        self.assertRaises(ValueError, i.aggregate, aggregates, group_by=1,
+                bin_width=0)
+        self.assertRaises(ValueError, i.aggregate, aggregates, group_by=1,
+                bin_width=0.5)
+
+
 class ColumnValue(object):
     """
     A class that represents a value from a given column. This class
@@ -361,6 +1149,73 @@ class ColumnValue(object):
     def __hash__(self):
         return self.__value.__hash__()
 
+
+class LookupManyTest(WormtableTest):
+    """
+    Tests looking up many keys in an index.
+    """
+    def setUp(self):
+        super(LookupManyTest, self).setUp()
+        self.make_random_table()
+        for name in ["uint", "uint+int"]:
+            i = wt.Index(self._table, name)
+            for col in name.split("+"):
+                i.add_key_column(self._table.get_column(col))
+            i.open("w")
+            i.build()
+            i.close()
+        self._index = self._table.open_index("uint+int")
+        self._uint_index = self._table.open_index("uint")
+
+    def tearDown(self):
+        self._index.close()
+        self._uint_index.close()
+        super(LookupManyTest, self).tearDown()
+
+    def verify_lookup(self, index, keys, key_function, where=None):
+        cols = ["row_id", "float", "char"]
+        expected = [(key_function(r), r[2:]) for r in
+                index.cursor(["uint", "int"] + cols, where=where)
+                if key_function(r) in keys]
+        self.assertEqual(list(index.lookup_many(keys, cols, where=where)),
+                expected)
+        pairs = []
+        for batch in index.lookup_many(keys, cols, batch_size=7, where=where):
+            pairs.extend(batch)
+        self.assertEqual(pairs, expected)
+
+    def test_keys(self):
+        values = [None] + list(range(12))
+        keys = [(u, v) for u in values for v in values]
+        random.shuffle(keys)
+        for n in [0, 1, 10, len(keys)]:
+            self.verify_lookup(self._index, keys[:n], lambda r: (r[0], r[1]))
+        self.verify_lookup(self._index, keys[:20] + keys[:20] + [(100, 1)],
+                lambda r: (r[0], r[1]))
+        self.verify_lookup(self._index, keys[:50], lambda r: (r[0], r[1]),
+                where="float < 5")
+
+    def test_prefixes(self):
+        keys = [(u,) for u in [None, 5, 0, 100, 3, 5]]
+        self.verify_lookup(self._index, keys, lambda r: (r[0],))
+        keys = [None, 5, 0, 100, 3, 5]
+        self.verify_lookup(self._uint_index, keys, lambda r: r[0])
+
+    def test_equal_keys(self):
+        # True and 1 are different values that encode to the same key
+        n = len(list(self._uint_index.cursor(["row_id"], start=1, stop=2)))
+        for keys in [[True, 1], [1, True], [True, 1, True] * 10]:
+            pairs = list(self._uint_index.lookup_many(keys, ["row_id"]))
+            self.assertEqual(len(pairs), n)
+            for key, row in pairs:
+                self.assertIs(key, keys[0])
+
+    def test_errors(self):
+        cols = ["row_id"]
+        self.assertRaises(ValueError, self._index.lookup_many,
+                [(1, 2, 3)], cols)
+
+
 class IndexIntegrityTest(WormtableTest):
     """
     Tests the integrity of indexes by building a small table with a
@@ -474,6 +1329,94 @@ class IndexIntegrityTest(WormtableTest):
                 self.assertRaises(StopIteration, next, cursor)
             i.close()
 
+    def test_batched_cursors(self):
+        read_cols = self._table.columns()
+        for i in self._indexes:
+            i.open("r")
+            rows = list(i.cursor(read_cols))
+            for batch_size in [1, 2, 3, len(rows), len(rows) + 1]:
+                batches = list(i.cursor(read_cols, batch_size=batch_size))
+                self.assertTrue(all(len(b) == batch_size for b in batches[:-1]))
+                self.assertTrue(0 < len(batches[-1]) <= batch_size)
+                self.assertEqual(rows, [r for b in batches for r in b])
+            self.assertRaises(ValueError, i.cursor, read_cols, batch_size=0)
+            i.close()
+
+    def test_covering_cursors(self):
+        t = self._table
+        read_cols = t.columns()
+        expected = []
+        for i in self._indexes:
+            i.open("r")
+            cols = [t.get_column(0)] + i.key_columns()
+            positions = [c.get_position() for c in cols]
+            rows = [tuple(r[k] for k in positions)
+                    for r in i.cursor(read_cols)]
+            keys = list(i.keys())
+            start = keys[len(keys) // 2]
+            l = [tuple(r[k] for k in positions)
+                    for r in i.cursor(read_cols, start=start)]
+            expected.append((cols, rows, start, l))
+            i.close()
+        # Reading only the key columns does not read the data file, so
+        # the cursors still work when it is empty.
+        t.close()
+        with open(t.get_data_path(), "r+b") as f:
+            f.truncate(0)
+        t.open("r")
+        for i, (cols, rows, start, l) in zip(self._indexes, expected):
+            i.open("r")
+            self.assertEqual(rows, list(i.cursor(cols)))
+            self.assertEqual([r[::-1] for r in rows],
+                    list(i.cursor(cols[::-1])))
+            self.assertEqual(l, list(i.cursor(cols, start=start)))
+            error = wt.tables._wormtable.WormtableError
+            self.assertRaises(error, list, i.cursor(read_cols))
+            i.close()
+
+
+class GetRowsTest(WormtableTest):
+    """
+    Tests retrieving many rows from a table by row id.
+    """
+    def setUp(self):
+        super(GetRowsTest, self).setUp()
+        self.make_random_table()
+
+    def test_get_rows(self):
+        t = self._table
+        n = len(t)
+        rows = [t[j] for j in range(n)]
+        ids = list(range(n))
+        random.shuffle(ids)
+        self.assertEqual(t.get_rows(ids), [rows[j] for j in ids])
+        self.assertEqual(t.get_rows([]), [])
+        ids = [random.randint(0, n - 1) for j in range(2 * n)]
+        self.assertEqual(t.get_rows(ids), [rows[j] for j in ids])
+        ids = [0, n - 1, -1, -n, 3, 2, 3, 3]
+        self.assertEqual(t.get_rows(ids), [rows[j] for j in ids])
+        self.assertEqual(t[2:n // 2], rows[2:n // 2])
+        self.assertEqual(t[::-3], rows[::-3])
+
+    def test_columns(self):
+        t = self._table
+        n = len(t)
+        cols = ["char", "row_id", "uintv", "char"]
+        positions = [t.get_column(c).get_position() for c in cols]
+        ids = [random.randint(0, n - 1) for j in range(n)]
+        rows = t.get_rows(ids, cols)
+        self.assertEqual(rows,
+                [tuple(t[j][k] for k in positions) for j in ids])
+
+    def test_errors(self):
+        t = self._table
+        n = len(t)
+        for ids in [[n], [0, n + 1], [-n - 1]]:
+            self.assertRaises(IndexError, t.get_rows, ids)
+        self.assertRaises(TypeError, t.get_rows, ["0"])
+        self.assertRaises(TypeError, t.get_rows, [1.0])
+        self.assertRaises(KeyError, t.get_rows, [0], ["nocolumn"])
+
 
 class BinnedIndexIntegrityTest(WormtableTest):
     """
@@ -1066,6 +2009,236 @@ class TableCursorTest(WormtableTest):
             pass
         self.assertRaises(StopIteration, next, cursor)
 
+    def test_batches(self):
+        t = self._table
+        cols = [c.get_name() for c in t.columns()]
+        for batch_size in [1, 2, 3, len(t), len(t) + 1]:
+            batches = list(t.cursor(cols, batch_size=batch_size))
+            self.assertTrue(all(len(b) == batch_size for b in batches[:-1]))
+            self.assertEqual(t[:], [r for b in batches for r in b])
+            start = random.randint(0, len(t))
+            stop = random.randint(start, len(t))
+            batches = list(t.cursor(cols, start=start, stop=stop,
+                    batch_size=batch_size))
+            self.assertEqual(t[start:stop], [r for b in batches for r in b])
+        cursor = t.cursor(cols, start=len(t), batch_size=10)
+        self.assertRaises(StopIteration, next, cursor)
+        self.assertRaises(ValueError, t.cursor, cols, batch_size=0)
+
+
+class ReadColumnsTest(WormtableTest):
+    """
+    Tests reading columns into numpy arrays.
+    """
+    def setUp(self):
+        super(ReadColumnsTest, self).setUp()
+        if wt.tables.numpy is None:
+            self.skipTest("numpy not available")
+        self._table = wt.Table(self._homedir)
+        t = self._table
+        t.add_id_column(4)
+        t.add_uint_column("u1", size=1)
+        t.add_uint_column("u3", size=3, num_elements=2)
+        t.add_int_column("i2", size=2)
+        t.add_int_column("i5", size=5)
+        t.add_float_column("f2", size=2, num_elements=3)
+        t.add_float_column("f8", size=8)
+        t.add_char_column("char", num_elements=3)
+        t.add_int_column("intv", num_elements=wt.WT_VAR_1)
+        t.open("w")
+        def g():
+            return random.random() < 0.25
+        for j in range(num_random_test_rows):
+            t.append([None,
+                None if g() else random.randint(0, 250),
+                None if g() else (j, random.randint(0, 2**20)),
+                None if g() else random.randint(-2**14, 2**14),
+                None if g() else random.randint(-2**38, 2**38),
+                None if g() else (0.5, -1.25, random.randint(0, 100)),
+                None if g() else random.uniform(-1e9, 1e9),
+                b"abc", [j]])
+        t.close()
+        t.open("r")
+        i = wt.Index(t, "u1")
+        i.add_key_column(t.get_column("u1"))
+        i.open("w")
+        i.build()
+        i.close()
+        self._index = i
+
+    def verify_arrays(self, names, rows, arrays):
+        self.assertEqual(len(names), len(arrays))
+        for j, a in enumerate(arrays):
+            col = self._table.get_column(names[j])
+            self.assertEqual(a.dtype, col.get_dtype())
+            self.assertEqual(len(a), len(rows))
+            for r, v, d in zip(rows, a, a.data):
+                if r[j] is None:
+                    self.assertTrue(wt.tables.numpy.all(v.mask))
+                    if col.get_type() == wt.WT_FLOAT:
+                        self.assertTrue(wt.tables.numpy.all(
+                            wt.tables.numpy.isnan(d)))
+                elif col.get_num_elements() == 1:
+                    self.assertFalse(v is wt.tables.numpy.ma.masked)
+                    self.assertEqual(r[j], v)
+                else:
+                    self.assertFalse(wt.tables.numpy.any(v.mask))
+                    self.assertEqual(r[j], tuple(v))
+
+    def test_table(self):
+        t = self._table
+        names = ["row_id", "u1", "u3", "i2", "i5", "f2", "f8"]
+        self.verify_arrays(names, t[:], t.read_columns(names))
+        self.verify_arrays(names[::-1], list(t.cursor(names[::-1])),
+                t.read_columns(names[::-1]))
+        for j in range(10):
+            start = random.randint(0, len(t))
+            stop = random.randint(start, len(t))
+            arrays = t.read_columns(names, start=start, stop=stop)
+            self.verify_arrays(names, t[start:stop], arrays)
+        arrays = t.read_columns(names, start=len(t), stop=2 * len(t))
+        self.verify_arrays(names, [], arrays)
+
+    def test_index(self):
+        i = self._index
+        i.open("r")
+        names = ["u1", "u3", "f2", "row_id"]
+        rows = list(i.cursor(names))
+        self.verify_arrays(names, rows, i.read_columns(names))
+        rows = list(i.cursor(names, start=10, stop=100))
+        self.verify_arrays(names, rows, i.read_columns(names, 10, 100))
+        chunk_size = wt.tables.ARRAY_CHUNK_SIZE
+        try:
+            for n in [1, 7, len(self._table)]:
+                wt.tables.ARRAY_CHUNK_SIZE = n
+                self.verify_arrays(names, rows,
+                        i.read_columns(names, 10, 100))
+        finally:
+            wt.tables.ARRAY_CHUNK_SIZE = chunk_size
+        i.close()
+
+    def test_unsupported_columns(self):
+        t = self._table
+        for name in ["char", "intv"]:
+            self.assertRaises(ValueError, t.read_columns, [name])
+            self.assertRaises(ValueError, t.get_column(name).get_dtype)
+        numpy = wt.tables.numpy
+        cursor = t.cursor(["i5"])
+        a = numpy.zeros(10, dtype="i4")
+        m = numpy.zeros(10, dtype=bool)
+        self.assertRaises(TypeError, cursor.read_arrays, [a], [m])
+        a = numpy.zeros(10, dtype="f8")
+        self.assertRaises(TypeError, cursor.read_arrays, [a], [m])
+        a = numpy.zeros(10, dtype="i8")
+        self.assertRaises(ValueError, cursor.read_arrays, [a], [m[:5]])
+        self.assertRaises(ValueError, cursor.read_arrays, [a], [])
+        self.assertEqual(cursor.read_arrays([a], [None]), 10)
+
+
+class AppendColumnsTest(WormtableTest):
+    """
+    Tests appending blocks of rows from arrays of column values.
+    """
+    def setUp(self):
+        super(AppendColumnsTest, self).setUp()
+        self._table = wt.Table(self._homedir)
+        t = self._table
+        t.add_id_column(4)
+        t.add_uint_column("u1", size=1)
+        t.add_uint_column("u3", size=3, num_elements=2)
+        t.add_int_column("i2", size=2)
+        t.add_float_column("f2", size=2, num_elements=3)
+        t.add_float_column("f8", size=8)
+        t.add_char_column("char", num_elements=3)
+        t.open("w")
+
+    def test_buffers(self):
+        t = self._table
+        n = 20
+        u1 = array.array("B", [j % 200 for j in range(n)])
+        i2 = array.array("l", [j - 10 for j in range(n)])
+        f8 = array.array("d", [j / 4 for j in range(n)])
+        masks = [None, [j % 3 == 0 for j in range(n)], None]
+        self.assertEqual(t.append_columns(["u1", "i2", "f8"], [u1, i2, f8],
+            masks), n)
+        t.append([None, 1, None, 2, None, None, b"abc"])
+        self.assertEqual(t.append_columns([], []), 0)
+        self.assertEqual(len(t), n + 1)
+        t.close()
+        t.open("r")
+        rows = t[:]
+        self.assertEqual(len(rows), n + 1)
+        for j in range(n):
+            i = None if j % 3 == 0 else j - 10
+            self.assertEqual(rows[j], (j, u1[j], None, i, None, f8[j], None))
+        self.assertEqual(rows[n], (n, 1, None, 2, None, None, b"abc"))
+
+    def test_errors(self):
+        t = self._table
+        u = array.array("l", [0, 1, 2])
+        self.assertRaises(OverflowError, t.append_columns, ["u1"],
+                [array.array("l", [0, 256])])
+        self.assertRaises(OverflowError, t.append_columns, ["u1"],
+                [array.array("l", [0, -1])])
+        self.assertRaises(OverflowError, t.append_columns, ["i2"],
+                [array.array("l", [2**15])])
+        self.assertRaises(ValueError, t.append_columns, ["char"], [u])
+        self.assertRaises(ValueError, t.append_columns, ["u1", "i2"],
+                [u, array.array("l", [0])])
+        self.assertRaises(ValueError, t.append_columns, ["u1"], [u, u])
+        self.assertRaises(TypeError, t.append_columns, ["u1"],
+                [array.array("d", [0])])
+        self.assertRaises(ValueError, t.append_columns, ["u3"], [u])
+        self.assertEqual(len(t), 0)
+        t.append_columns(["u1"], [array.array("l", [1, 2])])
+        self.assertRaises(OverflowError, t.append_columns, ["u1"],
+                [array.array("l", [3, 4, 300, 5])])
+        self.assertEqual(len(t), 2)
+        t.close()
+        t.open("r")
+        self.assertEqual([r[1] for r in t], [1, 2])
+
+    def test_errors_keep_row(self):
+        t = self._table
+        llo = t.get_ll_object()
+        llo.insert_elements(1, 7)
+        u = array.array("l", [0, 1, 2])
+        self.assertRaises(ValueError, t.append_columns, ["char"], [u])
+        self.assertRaises(TypeError, t.append_columns, ["u1"],
+                [array.array("d", [0])])
+        self.assertRaises(OverflowError, t.append_columns, ["u1"],
+                [array.array("l", [0, 256])])
+        llo.insert_elements(3, -1)
+        t.append([])
+        t.close()
+        t.open("r")
+        self.assertEqual(t[0], (0, 7, None, -1, None, None, None))
+
+    def test_numpy(self):
+        numpy = wt.tables.numpy
+        if numpy is None:
+            self.skipTest("numpy not available")
+        t = self._table
+        n = 100
+        u3 = numpy.arange(2 * n).reshape(n, 2)
+        f2 = numpy.ma.array(numpy.ones((n, 3)) / 2, mask=False)
+        f2[5, 1] = numpy.ma.masked
+        f8 = numpy.ma.array(numpy.arange(n) / 8, mask=numpy.arange(n) % 2)
+        t.append_columns(["u3", "f2", "f8"], [u3, f2, f8])
+        t.append_columns(["u1"], [numpy.arange(n) % 256],
+                [numpy.arange(n) < 10])
+        t.close()
+        t.open("r")
+        self.assertEqual(len(t), 2 * n)
+        for j, r in enumerate(t.cursor(["u3", "f2", "f8"], stop=n)):
+            self.assertEqual(r[0], tuple(u3[j]))
+            self.assertEqual(r[1], None if j == 5 else (0.5, 0.5, 0.5))
+            self.assertEqual(r[2], None if j % 2 else j / 8)
+        v = [r[0] for r in t.cursor(["u1"], start=n)]
+        self.assertEqual(v, [None] * 10 + list(range(10, n)))
+        a = t.read_columns(["f8"], stop=n)[0]
+        self.assertTrue(numpy.all(a.mask == f8.mask))
+
 
 class FloatTest(WormtableTest):
     """
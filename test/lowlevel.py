@@ -884,6 +884,35 @@ class TestDatabaseCharIntegrity(TestDatabaseChar):
             r = self._database.get_row(j)
             self.assertEqual(self.rows[j], r)
 
+    def test_row_iterator_insertion_order(self):
+        """
+        Tests that rows are read back correctly by the row iterator when
+        variable columns are inserted in arbitrary order and overwritten.
+        """
+        rb = self._row_buffer
+        db = self._database
+        cols = []
+        for j in range(1, len(self._columns)):
+            if self._columns[j].is_variable():
+                cols.append(j)
+        rows = []
+        for j in range(self.num_random_test_rows):
+            row = [None for c in self._columns]
+            row[0] = j
+            random.shuffle(cols)
+            for k in cols + cols[:random.randint(0, len(cols))]:
+                row[k] = random_string(random.randint(0, 50)).encode()
+                rb.insert_elements(k, row[k])
+            rb.commit_row()
+            rows.append(tuple(row))
+        self.open_reading()
+        ri = _wormtable.TableRowIterator(db, list(range(self.num_columns)))
+        self.assertEqual(rows, [r for r in ri])
+        for j in range(len(rows)):
+            ri = _wormtable.TableRowIterator(db, list(range(self.num_columns)))
+            ri.set_min(j)
+            self.assertEqual(rows[j:], [r for r in ri])
+
 
 class TestIndexIntegrity(object):
     """
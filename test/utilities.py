@@ -21,6 +21,7 @@ from __future__ import print_function
 from __future__ import division
 
 import wormtable as wt
+import wormtable.vcf2wt as vcf2wt
 
 import unittest
 import random
@@ -30,6 +31,9 @@ import os.path
 import gzip
 import sys
 import io
+import zlib
+import struct
+import itertools
 from xml.etree import ElementTree
 
 EXAMPLE_VCF ="test/data/example.vcf"
@@ -58,6 +62,57 @@ TRANSCRIPT_ID = "transcript_id"
 
 
 
+def write_bgzf(filename, data, block_size=1000):
+    """
+    Writes the specified data to the specified file in BGZF format, using
+    small blocks so that lines span several blocks. Returns the list of
+    the offsets of the blocks in the file.
+    """
+    offsets = []
+    with open(filename, "wb") as f:
+        for j in range(0, len(data) + 1, block_size):
+            offsets.append(f.tell())
+            chunk = data[j: j + block_size]
+            c = zlib.compressobj(6, zlib.DEFLATED, -15)
+            compressed = c.compress(chunk) + c.flush()
+            f.write(struct.pack("<4BI2BH2BHH", 31, 139, 8, 4, 0, 0, 255, 6,
+                    66, 67, 2, len(compressed) + 25))
+            f.write(compressed)
+            f.write(struct.pack("<2I", zlib.crc32(chunk) & 0xffffffff,
+                    len(chunk)))
+    return offsets
+
+def write_tabix_index(filename, data, block_size=1000):
+    """
+    Writes the specified VCF data to the specified file in BGZF format
+    and writes a tabix index for it to filename.tbi, with one bin
+    for each reference sequence.
+    """
+    offsets = write_bgzf(filename, data, block_size)
+    voffset = lambda p: (offsets[p // block_size] << 16) | (p % block_size)
+    names = []
+    regions = {}
+    pos = 0
+    for line in data.splitlines(True):
+        if not line.startswith(b"#"):
+            name = line.split(b"\t")[0]
+            if name not in regions:
+                names.append(name)
+                regions[name] = [pos, pos]
+            regions[name][1] = pos + len(line)
+        pos += len(line)
+    l_nm = sum(len(name) + 1 for name in names)
+    s = b"TBI\1" + struct.pack("<8i", len(names), 2, 1, 2, 0, ord("#"), 0,
+            l_nm)
+    s += b"".join(name + b"\0" for name in names)
+    for name in names:
+        begin, end = regions[name]
+        s += struct.pack("<iIi2Qi", 1, 4681, 1, voffset(begin), voffset(end),
+                0)
+    with gzip.open(filename + ".tbi", "wb") as f:
+        f.write(s)
+
+
 class UtilityTest(unittest.TestCase):
     """
     Superclass of all wormtable tests. Create a homedir for working in
@@ -117,6 +172,24 @@ class TestInputMethods(object):
         shutil.rmtree(self._homedir)
         os.mkdir(self._homedir)
 
+    def _test_bgzf_input(self, input_file):
+        original = os.path.join(self._homedir, "original")
+        zipped = os.path.join(self._homedir, "zipped")
+        self.run_command([input_file, original, "-q"])
+        bgzf = os.path.join(self._homedir, "input.gz")
+        with open(input_file, "rb") as f:
+            data = f.read()
+        write_bgzf(bgzf, data)
+        with gzip.open(bgzf, "rb") as f:
+            self.assertEqual(f.read(), data)
+        self.run_command([bgzf, zipped, "-qf"])
+        with wt.open_table(original) as t1:
+            with wt.open_table(zipped) as t2:
+                self.assertEqual(len(t1), len(t2))
+                self.assert_tables_equal(t1, t2)
+        shutil.rmtree(self._homedir)
+        os.mkdir(self._homedir)
+
     def _test_stdin_input(self, input_file):
         to = os.path.join(self._homedir, "original")
         ts = os.path.join(self._homedir, "stdin")
@@ -130,6 +203,36 @@ class TestInputMethods(object):
         os.mkdir(self._homedir)
 
 
+class TestBGZFReader(UtilityTest):
+    """
+    Test that lines read from BGZF files are the same as those read from
+    the uncompressed data.
+    """
+    def test_lines(self):
+        bgzf = os.path.join(self._homedir, "input.gz")
+        data = b"a\rb\nc\x0bd\x0c\n\n\x1cend"
+        for block_size in [1, 2, 3, 1000]:
+            write_bgzf(bgzf, data, block_size)
+            with open(bgzf, "rb") as f:
+                r = wt.cli.BGZFReader(f, 2)
+                lines = list(r)
+                r.close()
+            self.assertEqual(lines, io.BytesIO(data).readlines())
+
+    def test_truncated(self):
+        bgzf = os.path.join(self._homedir, "input.gz")
+        write_bgzf(bgzf, b"0123456789\n" * 100)
+        with open(bgzf, "rb") as f:
+            s = f.read()
+        for size in [1, 10, 17, 20, len(s) - 1]:
+            with open(bgzf, "wb") as f:
+                f.write(s[:size])
+            with open(bgzf, "rb") as f:
+                r = wt.cli.BGZFReader(f, 2)
+                self.assertRaises(IOError, r.readlines)
+                r.close()
+
+
 class Vcf2wtTest(UtilityTest):
     """
     Class for testing vcf2wt.
@@ -200,6 +303,10 @@ class Vcf2wtTestInputMethods(Vcf2wtTest, TestInputMethods):
         self._test_gzipped_input(EXAMPLE_VCF)
         self._test_gzipped_input(SAMPLE_VCF)
 
+    def test_bgzf(self):
+        self._test_bgzf_input(EXAMPLE_VCF)
+        self._test_bgzf_input(SAMPLE_VCF)
+
     def test_stdin(self):
         self._test_stdin_input(EXAMPLE_VCF)
         self._test_stdin_input(SAMPLE_VCF)
@@ -226,6 +333,209 @@ class TestSchemaGeneration(Vcf2wtTest):
         self.__test_schema_generator(EXAMPLE_VCF)
         self.__test_schema_generator(SAMPLE_VCF)
 
+
+class TestSchemaInference(Vcf2wtTest):
+    """
+    Test that tables built with an inferred schema hold the same values
+    as tables built with the default schema, in smaller rows.
+    """
+    def assert_values_equal(self, column, v1, v2):
+        """
+        Verifies that the specified values are equal, allowing for single
+        element columns becoming scalar and for floats being stored in
+        less precision.
+        """
+        if column.get_type() == wt.WT_CHAR or v1 is None or v2 is None:
+            self.assertEqual(v1, v2)
+        else:
+            if not isinstance(v1, tuple):
+                v1 = (v1,)
+            if not isinstance(v2, tuple):
+                v2 = (v2,)
+            self.assertEqual(len(v1), len(v2))
+            for x, y in zip(v1, v2):
+                self.assertTrue(abs(x - y) <= 1e-3 * abs(x))
+
+    def test_inference(self):
+        original = os.path.join(self._homedir, "original")
+        inferred = os.path.join(self._homedir, "inferred")
+        schema = os.path.join(self._homedir, "schema.xml")
+        for vcf in [EXAMPLE_VCF, SAMPLE_VCF]:
+            self.run_command([vcf, original, "-qf"])
+            self.run_command([vcf, schema, "-qfg", "--infer-schema"])
+            root = ElementTree.parse(schema).getroot()
+            self.assertEqual(root.tag, "schema")
+            self.run_command([vcf, inferred, "-qf", "--infer-schema"])
+            with wt.open_table(original) as t1:
+                with wt.open_table(inferred) as t2:
+                    self.assertEqual(len(t1), len(t2))
+                    self.assertLess(t2.get_fixed_region_size(),
+                            t1.get_fixed_region_size())
+                    names = [c.get_name() for c in t2.columns()]
+                    for c in t1.columns():
+                        if c.get_name() not in names:
+                            # Omitted columns contain only missing values
+                            for v in t1.cursor([c]):
+                                self.assertEqual(v[0], None)
+                    for c in t2.columns()[1:]:
+                        c1 = t1.get_column(c.get_name())
+                        self.assertLessEqual(c.get_element_size(),
+                                c1.get_element_size())
+                        rows = zip(t1.cursor([c1]), t2.cursor([c]))
+                        for r1, r2 in rows:
+                            self.assert_values_equal(c1, r1[0], r2[0])
+            # Sampling the rows keeps all the columns
+            self.run_command([vcf, inferred, "-qf", "--infer-schema=1000"])
+            with wt.open_table(original) as t1:
+                with wt.open_table(inferred) as t2:
+                    self.assertEqual(len(t1.columns()), len(t2.columns()))
+        self.assertRaises(SystemExit, self.run_command,
+                [SAMPLE_VCF, inferred, "-qf", "--infer-schema=-1"])
+        self.assertRaises(SystemExit, self.run_command,
+                [SAMPLE_VCF, inferred, "-qf", "--infer-schema", "-s", schema])
+        for options in [[inferred], [schema, "-g"]]:
+            with open(SAMPLE_VCF, "rb") as f:
+                self.assertRaises(SystemExit, self.run_command,
+                        ["-", "-qf", "--infer-schema"] + options, stdin=f)
+
+    def test_sampled_inference(self):
+        vcf = os.path.join(self._homedir, "input.vcf")
+        inferred = os.path.join(self._homedir, "inferred")
+        header = [
+            b"##fileformat=VCFv4.1",
+            b'##INFO=<ID=I,Number=1,Type=Integer,Description="I">',
+            b'##INFO=<ID=F,Number=1,Type=Float,Description="F">',
+            b'##INFO=<ID=V,Number=.,Type=Integer,Description="V">',
+            b"#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO"]
+        info = [(1, 0.5, [1, 2]), (2, 0.25, [3, 4]),
+                (1000, 0.123456, [5, 6, 7]), (-1, 1e10, [8])]
+        records = ["1\t{0}\t.\tA\tC\t.\t.\tI={1};F={2};V={3}".format(
+                j + 1, i, f, ",".join(str(x) for x in v)).encode()
+                for j, (i, f, v) in enumerate(info)]
+        with open(vcf, "wb") as f:
+            f.write(b"\n".join(header + records) + b"\n")
+        # The rows after the first two hold values outside the range of
+        # the sampled rows.
+        self.run_command([vcf, inferred, "-qf", "--infer-schema=2"])
+        with wt.open_table(inferred) as t:
+            self.assertEqual(len(t), len(info))
+            rows = list(t.cursor(["INFO.I", "INFO.F", "INFO.V"]))
+            for (i, f, v), r in zip(info, rows):
+                self.assertEqual(r[0], i)
+                self.assertTrue(abs(r[1] - f) <= 1e-6 * abs(f))
+                self.assertEqual(r[2], tuple(v))
+
+
+class TestIndexedBuild(Vcf2wtTest):
+    """
+    Test building indexes while the table is written.
+    """
+    def test_index(self):
+        cols = ["CHROM+POS", "REF", "QUAL[5.0]"]
+        args = [SAMPLE_VCF, self._homedir, "-qf"]
+        for c in cols:
+            args += ["--index", c]
+        self.run_command(args)
+        with wt.open_table(self._homedir) as t:
+            self.assertEqual(sorted(t.indexes()), sorted(cols))
+            for c in cols:
+                with t.open_index(c) as i:
+                    self.assertEqual(i.get_colspec(), c)
+                    self.assertEqual(sum(i.counter().values()), len(t))
+            with t.open_index("CHROM+POS") as i:
+                keys = list(i.keys())
+            rows = [(r[0], r[1]) for r in t.cursor(["CHROM", "POS"])]
+            self.assertEqual(keys, sorted(rows))
+        self.assertRaises(SystemExit, self.run_command,
+                [SAMPLE_VCF, self._homedir, "-qf", "-i", "NOTACOLUMN"])
+
+class TestParallelBuild(Vcf2wtTest):
+    """
+    Test that parsing the VCF using several worker processes gives the
+    same table as parsing it directly into the table's rows.
+    """
+    def test_jobs(self):
+        original = os.path.join(self._homedir, "original")
+        parallel = os.path.join(self._homedir, "parallel")
+        for vcf, options in itertools.product([EXAMPLE_VCF, SAMPLE_VCF],
+                [[], ["-t"]]):
+            self.run_command([vcf, original, "-qf"] + options)
+            for jobs in ["1", "2", "3"]:
+                self.run_command([vcf, parallel, "-qf", "--jobs", jobs]
+                        + options)
+                with wt.open_table(original) as t1:
+                    with wt.open_table(parallel) as t2:
+                        self.assertEqual(len(t1), len(t2))
+                        self.assert_tables_equal(t1, t2)
+        self.assertRaises(SystemExit, self.run_command,
+                [SAMPLE_VCF, parallel, "-qf", "--jobs", "0"])
+
+    def test_chunks(self):
+        original = os.path.join(self._homedir, "original")
+        parallel = os.path.join(self._homedir, "parallel")
+        zvcf = os.path.join(self._homedir, "input.vcf.gz")
+        with open(SAMPLE_VCF, "rb") as f:
+            with gzip.open(zvcf, "wb") as z:
+                z.write(f.read())
+        self.run_command([SAMPLE_VCF, original, "-qf"])
+        chunk_size = vcf2wt.PARSE_CHUNK_SIZE
+        # Use chunks smaller than the lines, and of a few lines
+        for size in [1, 100, 5000]:
+            vcf2wt.PARSE_CHUNK_SIZE = size
+            try:
+                for source in [SAMPLE_VCF, zvcf]:
+                    self.run_command([source, parallel, "-qf", "--jobs=3"])
+                    with wt.open_table(original) as t1:
+                        with wt.open_table(parallel) as t2:
+                            self.assertEqual(len(t1), len(t2))
+                            self.assert_tables_equal(t1, t2)
+            finally:
+                vcf2wt.PARSE_CHUNK_SIZE = chunk_size
+
+class TestRegionsParallelBuild(Vcf2wtTest):
+    """
+    Test that converting the regions of a tabix-indexed VCF in several
+    worker processes gives the same table as converting it serially.
+    """
+    def test_regions(self):
+        original = os.path.join(self._homedir, "original")
+        parallel = os.path.join(self._homedir, "parallel")
+        vcf = os.path.join(self._homedir, "input.vcf")
+        bgzf = vcf + ".gz"
+        for source, options in itertools.product([EXAMPLE_VCF, SAMPLE_VCF],
+                [[], ["-t"]]):
+            # Put the records in several reference sequences, so that
+            # there are several regions in the index.
+            with open(source, "rb") as f:
+                lines = f.readlines()
+            header = [l for l in lines if l.startswith(b"#")]
+            records = lines[len(header):]
+            for j in range(len(records)):
+                records[j] = str(j * 3 // len(records)).encode() + \
+                        records[j][records[j].index(b"\t"):]
+            data = b"".join(header + records)
+            with open(vcf, "wb") as f:
+                f.write(data)
+            write_tabix_index(bgzf, data)
+            self.run_command([vcf, original, "-qf"] + options)
+            for jobs in ["1", "2", "3"]:
+                self.run_command([bgzf, parallel, "-qf",
+                        "--regions-parallel", jobs] + options)
+                with wt.open_table(original) as t1:
+                    with wt.open_table(parallel) as t2:
+                        self.assertEqual(len(t1), len(t2))
+                        self.assert_tables_equal(t1, t2)
+        self.assertRaises(SystemExit, self.run_command,
+                [bgzf, parallel, "-qf", "--regions-parallel", "0"])
+        self.assertRaises(SystemExit, self.run_command,
+                [vcf, parallel, "-qf", "--regions-parallel", "2"])
+        self.assertRaises(SystemExit, self.run_command,
+                [bgzf, parallel, "-qf", "--regions-parallel", "2", "-j", "2"])
+        os.unlink(bgzf + ".tbi")
+        self.assertRaises(SystemExit, self.run_command,
+                [bgzf, parallel, "-qf", "--regions-parallel", "2"])
+
+
 class WtadminTest(UtilityTest):
     """
     Class for testing wtadmin
@@ -365,6 +675,29 @@ class WtadminTest(UtilityTest):
             self.assertEqual([col.get_name() for col in i.key_columns()], [c])
             i.close()
 
+    def test_add_multiple_indexes(self):
+        cols = ["CHROM+POS", "REF", "ALT", "QUAL[5.0]"]
+        for args in [["-q"], ["-qf", "--jobs=2"], ["-qf", "-b", "0"]]:
+            s = self.run_add(cols + args)
+            self.assertEqual(s, "")
+            for c in cols:
+                with self._table.open_index(c) as i:
+                    self.assertEqual(i.get_colspec(), c)
+                    self.assertEqual(sum(i.counter().values()),
+                            len(self._table))
+        self.assertRaises(SystemExit, self.run_add, cols + ["-q"])
+        self.assertRaises(SystemExit, self.run_add,
+                ["REF", "ALT", "-qf", "--name=x"])
+
+    def test_add_index_jobs(self):
+        c = "CHROM+POS"
+        self.run_add([c, "-q", "--jobs=3", "--sort-buffer-size=1K"])
+        with self._table.open_index(c) as i:
+            keys = list(i.keys())
+        rows = [(r[0], r[1]) for r in self._table.cursor(["CHROM", "POS"])]
+        self.assertEqual(keys, sorted(rows))
+        self.assertRaises(SystemExit, self.run_add, [c, "-qf", "--jobs=0"])
+
     def test_hist(self):
         cols = ["CHROM", "REF", "ALT"]
         for c in cols:
@@ -470,6 +803,10 @@ class Gtf2wtTestInputMethods(Gtf2wtTest, TestInputMethods):
         self._test_gzipped_input(EXAMPLE_GTF)
         self._test_gzipped_input(SAMPLE_GTF)
 
+    def test_bgzf(self):
+        self._test_bgzf_input(EXAMPLE_GTF)
+        self._test_bgzf_input(SAMPLE_GTF)
+
     def test_stdin(self):
         self._test_stdin_input(EXAMPLE_GTF)
         self._test_stdin_input(SAMPLE_GTF)
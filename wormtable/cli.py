@@ -24,8 +24,14 @@ from __future__ import division
 
 import gzip
 import os
+import re
 import sys
 import time
+import zlib
+import struct
+import collections
+import multiprocessing
+import multiprocessing.pool
 
 import wormtable as wt
 
@@ -39,6 +45,24 @@ def add_version_argument(parser):
         version='%(prog)s {}'.format(wt.__version__))
 
 
+def parse_colspec(table, index, colspec):
+    """
+    Parses the specified column specification and adds the key columns
+    and bin widths specified within to the specified index on the
+    specified table.
+    """
+    for c in colspec.split("+"):
+        col_name = c
+        bin_width = 0
+        m = re.search("\[.*\]$", c)
+        if m is not None:
+            g = m.group(0)
+            col_name = c[:m.start(0)]
+            bin_width = float(g.strip("[]"))
+        col = table.get_column(col_name)
+        index.add_key_column(col, bin_width)
+
+
 class ProgressMonitor(object):
     """
     Class representing a progress monitor for a terminal based interface.
@@ -82,12 +106,279 @@ To convert this file to wormtable, you must decompress it first using gunzip.
 """
 
 
+# The gzip header fields of a BGZF block, up to the BC extra subfield.
+BGZF_HEADER = struct.Struct("<4BI2BH2BH")
+# The approximate number of compressed bytes inflated in each task.
+BGZF_CHUNK_SIZE = 1024 * 1024
+
+
+def is_bgzf(filename):
+    """
+    Returns True if the specified file is in BGZF (blocked gzip) format.
+    """
+    with open(filename, "rb") as f:
+        s = f.read(BGZF_HEADER.size)
+    ret = False
+    if len(s) == BGZF_HEADER.size:
+        t = BGZF_HEADER.unpack(s)
+        # gzip magic, deflate, FEXTRA set and a 2 byte BC subfield
+        ret = t[:3] == (31, 139, 8) and (t[3] & 4) != 0 and t[7] >= 6 \
+                and t[8:] == (66, 67, 2)
+    return ret
+
+
+def read_bgzf_block(f):
+    """
+    Reads the next BGZF block from the specified file, returning b"" at
+    the end of the file.
+    """
+    block = f.read(BGZF_HEADER.size)
+    if len(block) > 0:
+        if len(block) != BGZF_HEADER.size:
+            raise IOError("Truncated BGZF block")
+        t = BGZF_HEADER.unpack(block)
+        if t[:3] != (31, 139, 8) or t[8:] != (66, 67, 2):
+            raise IOError("Invalid BGZF block")
+        # BSIZE follows the BC subfield header, and is one less than
+        # the size of the block
+        s = f.read(2)
+        if len(s) != 2:
+            raise IOError("Truncated BGZF block")
+        size = struct.unpack("<H", s)[0] + 1 - BGZF_HEADER.size - 2
+        if size < 8 + t[7] - 6:
+            # the extra subfields and the CRC and ISIZE fields must fit
+            raise IOError("Invalid BGZF block")
+        rest = f.read(size)
+        if len(rest) != size:
+            raise IOError("Truncated BGZF block")
+        block += s + rest
+    return block
+
+
+def read_bgzf_region(filename, begin, end):
+    """
+    Returns an iterator over the lines in the specified BGZF file from the
+    virtual offset begin up to the virtual offset end, as used in tabix
+    indexes. Virtual offsets are the offset of a block in the file shifted
+    left by 16 bits plus an offset within the decompressed block.
+    """
+    with open(filename, "rb") as f:
+        f.seek(begin >> 16)
+        tail = b""
+        done = False
+        first = True
+        while not done:
+            offset = f.tell()
+            block = read_bgzf_block(f)
+            if len(block) == 0:
+                break
+            data = _inflate_bgzf_blocks([block])
+            if offset >= end >> 16:
+                data = data[:end & 0xffff]
+                done = True
+            if first:
+                data = data[begin & 0xffff:]
+                first = False
+            lines, tail = split_lines(tail + data)
+            for line in lines:
+                yield line
+        if len(tail) > 0:
+            yield tail
+
+
+def read_tabix_index(filename):
+    """
+    Reads the specified tabix index (in .tbi or .csi format) and returns
+    a list of (name, begin, end) tuples giving the virtual offsets of the
+    first and last records for each reference sequence in the index, in
+    the order of the index. Sequences without records are omitted.
+    """
+    with gzip.open(filename, "rb") as f:
+        data = f.read()
+    magic = data[:4]
+    if magic == b"TBI\1":
+        n_ref, l_nm = struct.unpack_from("<i24xi", data, 4)
+        names = data[36: 36 + l_nm]
+        pos = 36 + l_nm
+        # the pseudo-bin holding metadata for each reference
+        meta_bin = 37450
+    elif magic == b"CSI\1":
+        min_shift, depth, l_aux = struct.unpack_from("<3i", data, 4)
+        names = b""
+        if l_aux >= 28:
+            l_nm = struct.unpack_from("<i", data, 40)[0]
+            names = data[44: 44 + l_nm]
+        pos = 16 + l_aux
+        n_ref = struct.unpack_from("<i", data, pos)[0]
+        pos += 4
+        meta_bin = ((1 << (3 * depth + 3)) - 1) // 7 + 1
+    else:
+        raise ValueError("Unknown tabix index format")
+    names = names.split(b"\0")
+    regions = []
+    for j in range(n_ref):
+        begin = None
+        end = None
+        n_bin = struct.unpack_from("<i", data, pos)[0]
+        pos += 4
+        for k in range(n_bin):
+            bin_id = struct.unpack_from("<I", data, pos)[0]
+            # CSI stores the linear offset of each bin before the chunks
+            pos += 4 if magic == b"TBI\1" else 12
+            n_chunk = struct.unpack_from("<i", data, pos)[0]
+            pos += 4
+            chunks = struct.unpack_from("<{0}Q".format(2 * n_chunk), data,
+                    pos)
+            pos += 16 * n_chunk
+            if bin_id != meta_bin and n_chunk > 0:
+                b = min(chunks[0::2])
+                e = max(chunks[1::2])
+                begin = b if begin is None else min(begin, b)
+                end = e if end is None else max(end, e)
+        if magic == b"TBI\1":
+            n_intv = struct.unpack_from("<i", data, pos)[0]
+            pos += 4 + 8 * n_intv
+        if begin is not None:
+            name = names[j] if j < len(names) else str(j).encode()
+            regions.append((name, begin, end))
+    return regions
+
+
+def split_lines(data):
+    """
+    Splits the specified data into lines ending in b"\n", as readline
+    does, returning the list of complete lines and the remaining data
+    after the last newline.
+    """
+    lines = data.split(b"\n")
+    tail = lines.pop()
+    return [line + b"\n" for line in lines], tail
+
+
+def _inflate_bgzf_blocks(blocks):
+    """
+    Returns the decompressed contents of the specified list of BGZF blocks.
+    This is run in a thread pool; zlib releases the GIL while inflating.
+    """
+    chunks = []
+    for block in blocks:
+        xlen = BGZF_HEADER.unpack_from(block)[7]
+        crc, size = struct.unpack_from("<2I", block, len(block) - 8)
+        try:
+            data = zlib.decompress(block[12 + xlen:-8], -15)
+        except zlib.error:
+            raise IOError("Corrupt BGZF block")
+        if len(data) != size or zlib.crc32(data) & 0xffffffff != crc:
+            raise IOError("Corrupt BGZF block")
+        chunks.append(data)
+    return b"".join(chunks)
+
+
+class BGZFReader(object):
+    """
+    A read-only file object for BGZF (blocked gzip) files, which consist of
+    independently compressed blocks. Blocks are read on the calling thread
+    and inflated ahead of the reader by a pool of threads, with at most a
+    few chunks of decompressed data held for each thread.
+    """
+    def __init__(self, f, num_threads=None):
+        if num_threads is None:
+            num_threads = multiprocessing.cpu_count()
+        self.__file = f
+        self.__pool = multiprocessing.pool.ThreadPool(num_threads)
+        self.__max_pending = 2 * num_threads
+        self.__pending = collections.deque()
+        self.__lines = collections.deque()
+        self.__tail = b""
+        self.__eof = False
+
+    def __read_blocks(self):
+        """
+        Reads about BGZF_CHUNK_SIZE bytes of whole blocks from the file,
+        returning the list of blocks.
+        """
+        blocks = []
+        size = 0
+        while size < BGZF_CHUNK_SIZE:
+            block = read_bgzf_block(self.__file)
+            if len(block) == 0:
+                break
+            blocks.append(block)
+            size += len(block)
+        return blocks
+
+    def __fill(self):
+        """
+        Adds the lines from the next chunk of decompressed data to the line
+        buffer, returning False if there is no more data.
+        """
+        while not self.__eof and len(self.__pending) < self.__max_pending:
+            blocks = self.__read_blocks()
+            if len(blocks) == 0:
+                self.__eof = True
+            else:
+                self.__pending.append(self.__pool.apply_async(
+                        _inflate_bgzf_blocks, (blocks,)))
+        ret = False
+        if len(self.__pending) > 0:
+            data = self.__tail + self.__pending.popleft().get()
+            lines, self.__tail = split_lines(data)
+            self.__lines.extend(lines)
+            ret = True
+        elif len(self.__tail) > 0:
+            self.__lines.append(self.__tail)
+            self.__tail = b""
+            ret = True
+        return ret
+
+    def readline(self):
+        """
+        Returns the next line, or b"" at the end of the file.
+        """
+        ret = b""
+        while len(self.__lines) == 0 and self.__fill():
+            pass
+        if len(self.__lines) > 0:
+            ret = self.__lines.popleft()
+        return ret
+
+    def readlines(self, hint=-1):
+        """
+        Returns a list of the next lines, stopping once their total size
+        reaches hint if it is positive.
+        """
+        lines = []
+        size = 0
+        while hint <= 0 or size < hint:
+            line = self.readline()
+            if len(line) == 0:
+                break
+            lines.append(line)
+            size += len(line)
+        return lines
+
+    def __iter__(self):
+        line = self.readline()
+        while len(line) > 0:
+            yield line
+            line = self.readline()
+
+    def close(self):
+        """
+        Stops the decompression threads and closes the underlying file.
+        """
+        self.__pool.terminate()
+        self.__pool.join()
+        self.__file.close()
+
+
 class FileReader(object):
     """
     A class for reading data files from a variety of sources and
     with progress updating.
     """
     def __init__(self, in_file):
+        self.__input_path = None
         if in_file == '-':
             self.__input_file = sys.stdin
             if sys.version_info[:2] >= (3, 1):
@@ -102,7 +393,11 @@ class FileReader(object):
             self.__input_file_size = None
             self.__progress_file = None
         else:
-            if in_file.endswith(".gz"):
+            if in_file.endswith(".gz") and is_bgzf(in_file):
+                # Decompress the blocks in parallel
+                self.__progress_file = open(in_file, "rb")
+                self.__input_file = BGZFReader(self.__progress_file)
+            elif in_file.endswith(".gz"):
                 # Detect broken GZIP handling in 2.7/3.2 and others and abort
                 # TODO this has been fixed upstream and can be removed at
                 # some point.
@@ -119,6 +414,7 @@ class FileReader(object):
             else:
                 self.__input_file = open(in_file, "rb")
                 self.__progress_file = self.__input_file
+                self.__input_path = in_file
             statinfo = os.stat(in_file)
             self.__input_file_size = statinfo.st_size
         self.__progress_update_rows = 2**32
@@ -145,6 +441,13 @@ class FileReader(object):
         """
         return self.__input_file
 
+    def get_input_path(self):
+        """
+        Returns the path of the input file if it is an uncompressed file,
+        which can be read in parts by other processes, and None otherwise.
+        """
+        return self.__input_path
+
     def set_progress(self, progress):
         """
         If progress is True turn on progress monitoring for this GTF reader.
@@ -28,19 +28,29 @@ from __future__ import print_function
 from __future__ import division
 
 import os
+import ast
 import glob
+import bisect
 import shutil
+import operator
 import collections
+import multiprocessing
 from xml.dom import minidom
 from xml.etree import ElementTree
 
 import _wormtable
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 TABLE_METADATA_VERSION = "0.3"
 INDEX_METADATA_VERSION = "0.4"
 
 DEFAULT_CACHE_SIZE = 16 * 2**20  # 16M
 DEFAULT_CACHE_SIZE_STR = "16M"
+DEFAULT_SORT_BUFFER_SIZE = 64 * 2**20  # 64M
 
 WT_INT = _wormtable.WT_INT
 WT_UINT = _wormtable.WT_UINT
@@ -54,13 +64,385 @@ WT_VAR_2 = _wormtable.WT_VAR_2
 
 KEY_UNSET = "KEY_UNSET"
 
+_FILTER_COMPARISONS = {
+    ast.Lt: _wormtable.WT_FILTER_LT,
+    ast.LtE: _wormtable.WT_FILTER_LE,
+    ast.Eq: _wormtable.WT_FILTER_EQ,
+    ast.NotEq: _wormtable.WT_FILTER_NE,
+    ast.Gt: _wormtable.WT_FILTER_GT,
+    ast.GtE: _wormtable.WT_FILTER_GE,
+}
+
+# The comparison to use when the operands are swapped.
+_FILTER_REVERSED = {
+    _wormtable.WT_FILTER_LT: _wormtable.WT_FILTER_GT,
+    _wormtable.WT_FILTER_LE: _wormtable.WT_FILTER_GE,
+    _wormtable.WT_FILTER_EQ: _wormtable.WT_FILTER_EQ,
+    _wormtable.WT_FILTER_NE: _wormtable.WT_FILTER_NE,
+    _wormtable.WT_FILTER_GT: _wormtable.WT_FILTER_LT,
+    _wormtable.WT_FILTER_GE: _wormtable.WT_FILTER_LE,
+}
+
+# The number of rows read at a time into arrays when the total number
+# of rows is not known in advance.
+ARRAY_CHUNK_SIZE = 2**16
+
+# The functions supported by Table.aggregate and Index.aggregate.
+AGGREGATE_FUNCTIONS = ["count", "sum", "mean", "min", "max"]
+
+
+def _parse_size(size):
+    """
+    Returns the number of bytes represented by the specified size. If
+    size is a string, it can be suffixed with K, M or G to specify units
+    of Kibibytes, Mibibytes or Gibibytes.
+    """
+    if isinstance(size, str):
+        d = {"K":2**10, "M":2**20, "G":2**30}
+        multiplier = 1
+        value = size
+        if size.endswith(tuple(d.keys())):
+            value = size[:-1]
+            multiplier = d[size[-1]]
+        n = int(value) * multiplier
+    else:
+        n = int(size)
+    return n
+
+
+def _read_arrays(iterator, columns, num_rows=None):
+    """
+    Reads the values from the specified row iterator into numpy masked
+    arrays, one for each of the specified columns. If num_rows is
+    specified, exactly this number of rows is expected; otherwise,
+    rows are read in chunks until the iterator is exhausted.
+    """
+    if numpy is None:
+        raise ImportError("numpy is required to read columns into arrays")
+    dtypes = [c.get_dtype() for c in columns]
+    chunk_size = ARRAY_CHUNK_SIZE if num_rows is None else num_rows
+    chunks = []
+    n = chunk_size
+    while n == chunk_size:
+        arrays = []
+        masks = []
+        for c, dtype in zip(columns, dtypes):
+            shape = (chunk_size,)
+            if c.get_num_elements() > 1:
+                shape = (chunk_size, c.get_num_elements())
+            arrays.append(numpy.empty(shape, dtype=dtype))
+            masks.append(numpy.empty(chunk_size, dtype=bool))
+        n = iterator.read_arrays(arrays, masks) if chunk_size > 0 else 0
+        chunks.append((arrays, masks, n))
+        if num_rows is not None:
+            break
+    ret = []
+    for j, c in enumerate(columns):
+        data = numpy.concatenate([a[j][:k] for a, m, k in chunks])
+        mask = numpy.concatenate([m[j][:k] for a, m, k in chunks])
+        if c.get_num_elements() > 1:
+            mask = numpy.repeat(mask, c.get_num_elements()).reshape(data.shape)
+        ret.append(numpy.ma.array(data, mask=mask))
+    return ret
+
+
+def _aggregate_columns(table, aggregates):
+    """
+    Returns the distinct columns of the specified table needed to compute
+    the specified list of (function, column) aggregates, and the position
+    within this list of the column for each aggregate.
+    """
+    columns = []
+    positions = []
+    for function, column in aggregates:
+        if function not in AGGREGATE_FUNCTIONS:
+            raise ValueError("Unknown aggregate function: " + str(function))
+        col = table.translate_columns([column])[0]
+        if col.get_type() == WT_CHAR and function != "count":
+            raise ValueError("Cannot compute the {0} of char column {1}".format(
+                function, col.get_name()))
+        column_positions = [c.get_position() for c in columns]
+        if col.get_position() in column_positions:
+            positions.append(column_positions.index(col.get_position()))
+        else:
+            positions.append(len(columns))
+            columns.append(col)
+    return columns, positions
+
+
+def _aggregate_values(aggregates, positions, stats):
+    """
+    Returns a tuple of the values of the specified aggregates, given the
+    (count, sum, min, max) statistics computed in C for each column.
+    """
+    ret = []
+    for (function, column), j in zip(aggregates, positions):
+        count, total, minimum, maximum = stats[j]
+        if function == "count":
+            v = count
+        elif function == "sum":
+            v = total
+        elif function == "mean":
+            v = None if count == 0 else total / count
+        elif function == "min":
+            v = minimum
+        else:
+            v = maximum
+        ret.append(v)
+    return tuple(ret)
 
-def open_table(homedir, db_cache_size=DEFAULT_CACHE_SIZE_STR):
+
+def _combine_stats(stats):
+    """
+    Combines a list of the (count, sum, min, max) statistics computed for
+    each column over disjoint sets of rows into the statistics for each
+    column over the union of these rows.
+    """
+    ret = []
+    for column_stats in zip(*stats):
+        count = sum(s[0] for s in column_stats)
+        total = column_stats[0][1]
+        if total is not None:
+            total = sum(s[1] for s in column_stats)
+        minima = [s[2] for s in column_stats if s[2] is not None]
+        maxima = [s[3] for s in column_stats if s[3] is not None]
+        ret.append((count, total, min(minima) if minima else None,
+                max(maxima) if maxima else None))
+    return tuple(ret)
+
+
+class _FilterCompiler(object):
+    """
+    Compiles filter expressions over the columns of a table into the
+    programs evaluated by the low-level row iterators. See
+    :meth:`Table.cursor` for the syntax of these expressions.
+    """
+    _NO_CONSTANT = object()
+
+    def __init__(self, table):
+        self.__table = table
+
+    def compile(self, expression):
+        """
+        Returns the program for the specified expression.
+        """
+        try:
+            tree = ast.parse(expression.strip(), mode="eval")
+        except SyntaxError as se:
+            raise ValueError("Invalid filter expression: {0}".format(se))
+        program = []
+        self.__compile_node(tree.body, program)
+        return program
+
+    def __constant(self, node):
+        """
+        Returns the value of the specified node if it is a constant, or
+        _NO_CONSTANT otherwise. Strings are encoded to bytes.
+        """
+        ret = self._NO_CONSTANT
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+            v = self.__constant(node.operand)
+            if isinstance(v, (int, float)):
+                ret = -v
+        elif hasattr(ast, "Constant") and isinstance(node, ast.Constant):
+            ret = node.value
+        elif hasattr(ast, "Num") and isinstance(node, ast.Num):
+            ret = node.n
+        elif hasattr(ast, "Str") and isinstance(node, ast.Str):
+            ret = node.s
+        elif hasattr(ast, "Bytes") and isinstance(node, ast.Bytes):
+            ret = node.s
+        elif isinstance(node, ast.Name) and node.id == "None":
+            ret = None
+        elif hasattr(ast, "NameConstant") and isinstance(node,
+                ast.NameConstant):
+            ret = node.value
+        if isinstance(ret, str) and not isinstance(ret, bytes):
+            ret = ret.encode()
+        return ret
+
+    def __column_name(self, node):
+        """
+        Returns the column name referred to by the specified node, or None.
+        """
+        ret = None
+        if isinstance(node, ast.Name):
+            ret = node.id
+        elif isinstance(node, ast.Attribute):
+            prefix = self.__column_name(node.value)
+            if prefix is not None:
+                ret = prefix + "." + node.attr
+        elif isinstance(node, ast.Call) and isinstance(node.func, ast.Name) \
+                and node.func.id == "col" and len(node.args) == 1:
+            name = self.__constant(node.args[0])
+            if isinstance(name, bytes):
+                ret = name.decode()
+        return ret
+
+    def __column(self, node):
+        """
+        Returns the (column, element) pair referred to by the specified
+        node, or None if it does not refer to a column. The element is -1
+        unless the column is subscripted.
+        """
+        ret = None
+        if isinstance(node, ast.Subscript):
+            index = node.slice
+            if hasattr(ast, "Index") and isinstance(index, ast.Index):
+                index = index.value
+            element = self.__constant(index)
+            name = self.__column_name(node.value)
+            if name is not None:
+                col = self.__get_column(name)
+                n = col.get_num_elements()
+                if not isinstance(element, int) or element < 0:
+                    raise ValueError("Column subscripts must be "
+                            "non-negative integers")
+                if col.get_type() == WT_CHAR or (n > 0 and element >= n):
+                    raise ValueError("Bad subscript for column " + name)
+                ret = col, element
+        else:
+            name = self.__column_name(node)
+            if name is not None:
+                ret = self.__get_column(name), -1
+        return ret
+
+    def __get_column(self, name):
+        try:
+            return self.__table.get_column(name)
+        except KeyError:
+            raise ValueError("Unknown column in filter: " + name)
+
+    def __compile_comparison(self, left, op, right, program):
+        """
+        Appends the instructions for a single comparison to the program.
+        """
+        if isinstance(op, (ast.Is, ast.IsNot)):
+            colref = self.__column(left)
+            if colref is None or self.__constant(right) is not None:
+                raise ValueError("'is' may only be used to compare a "
+                        "column with None")
+            col, element = colref
+            program.append((_wormtable.WT_FILTER_MISSING,
+                col.get_position(), element))
+            if isinstance(op, ast.IsNot):
+                program.append((_wormtable.WT_FILTER_NOT,))
+        elif isinstance(op, (ast.In, ast.NotIn)):
+            value = self.__constant(left)
+            colref = self.__column(right)
+            if colref is None or colref[1] != -1 or value is None \
+                    or value is self._NO_CONSTANT:
+                raise ValueError("'in' may only be used to test if a "
+                        "constant is in a column")
+            col = colref[0]
+            self.__check_constant(col, value)
+            program.append((_wormtable.WT_FILTER_CONTAINS,
+                col.get_position(), value))
+            if isinstance(op, ast.NotIn):
+                program.append((_wormtable.WT_FILTER_NOT,))
+        elif type(op) in _FILTER_COMPARISONS:
+            cmp = _FILTER_COMPARISONS[type(op)]
+            colref = self.__column(left)
+            value = self.__constant(right)
+            if colref is None:
+                colref = self.__column(right)
+                value = self.__constant(left)
+                cmp = _FILTER_REVERSED[cmp]
+            if colref is None or value is self._NO_CONSTANT:
+                raise ValueError("Comparisons must be between a column "
+                        "and a constant")
+            if value is None:
+                raise ValueError("Use 'is None' to test for missing values")
+            col, element = colref
+            if element == -1 and col.get_type() != WT_CHAR \
+                    and col.get_num_elements() != 1:
+                raise ValueError("Columns with more than one element must "
+                        "be subscripted in comparisons")
+            self.__check_constant(col, value)
+            program.append((_wormtable.WT_FILTER_CMP, col.get_position(),
+                element, cmp, value))
+        else:
+            raise ValueError("Unsupported comparison in filter")
+
+    def __check_constant(self, col, value):
+        if col.get_type() == WT_CHAR:
+            if not isinstance(value, bytes):
+                raise ValueError("Column {0} must be compared with a "
+                        "string".format(col.get_name()))
+        elif not isinstance(value, (int, float)):
+            raise ValueError("Column {0} must be compared with a "
+                    "number".format(col.get_name()))
+
+    def __compile_node(self, node, program):
+        """
+        Appends the instructions for the specified node to the program.
+        """
+        if isinstance(node, ast.BoolOp):
+            op = _wormtable.WT_FILTER_AND
+            if isinstance(node.op, ast.Or):
+                op = _wormtable.WT_FILTER_OR
+            self.__compile_node(node.values[0], program)
+            for value in node.values[1:]:
+                self.__compile_node(value, program)
+                program.append((op,))
+        elif isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+            self.__compile_node(node.operand, program)
+            program.append((_wormtable.WT_FILTER_NOT,))
+        elif isinstance(node, ast.Compare):
+            left = node.left
+            for j, (op, right) in enumerate(zip(node.ops, node.comparators)):
+                self.__compile_comparison(left, op, right, program)
+                if j > 0:
+                    program.append((_wormtable.WT_FILTER_AND,))
+                left = right
+        else:
+            raise ValueError("Unsupported filter expression")
+
+
+def _sort_index_keys(args):
+    """
+    Writes sorted runs of the keys for a range of rows in several indexes
+    to temporary files in a single pass over the rows, returning the number
+    of rows in the range and the list of files for each index. This is run
+    in worker processes when building indexes in parallel, and so the
+    table must be opened independently.
+    """
+    homedir, db_cache_size, keys, prefix, sort_buffer_size, start, stop = args
+    table = open_table(homedir, db_cache_size)
+    try:
+        indexes = []
+        for cols, bin_widths in keys:
+            index = _wormtable.Index(table.get_ll_object(), b"", cols,
+                    DEFAULT_CACHE_SIZE)
+            index.set_bin_widths(bin_widths)
+            indexes.append(index)
+        files = indexes[0].sort_keys(prefix, sort_buffer_size, start, stop,
+                indexes[1:])
+    finally:
+        table.close()
+    return stop - start, files
+
+
+def open_table(homedir, db_cache_size=DEFAULT_CACHE_SIZE_STR,
+        env_cache_size=None, env_home=None):
     """
     Returns a table opened in read mode with cache size
     set to the specified value. This is the recommended
     interface when opening tables for reading.
 
+    If env_cache_size is specified, the table and all indexes subsequently
+    opened on it share a single Berkeley DB cache of this size, and
+    db_cache_size is ignored. Otherwise, the table and each of its
+    indexes have their own caches.
+
+    If env_home is specified, the shared cache is backed by files in
+    this directory, and is also shared by all other processes that open
+    tables with the same env_home. This allows worker processes to share
+    a single warm cache rather than each reading the table into their
+    own. The directory must exist, and the cache size is set by the first
+    process to use it. The path can be passed to worker processes using
+    :meth:`Table.get_env_home`.
+
     See :ref:`performance-cache` for details on setting cache sizes.
     The cache size may be either an integer specifying the size in
     bytes or a string with the optional suffixes K, M or G.
@@ -69,6 +451,12 @@ def open_table(homedir, db_cache_size=DEFAULT_CACHE_SIZE_STR):
     :type homedir: str
     :param db_cache_size: The Berkeley DB cache size for the table.
     :type db_cache_size: str or int.
+    :param env_cache_size: The size of the cache shared by the table and
+        its indexes.
+    :type env_cache_size: str or int.
+    :param env_home: The directory holding the cache shared between
+        processes.
+    :type env_home: str
     """
     t = Table(homedir)
     if not t.exists():
@@ -76,6 +464,10 @@ def open_table(homedir, db_cache_size=DEFAULT_CACHE_SIZE_STR):
               "wormtable format.".format(homedir)
         raise IOError(msg)
     t.set_db_cache_size(db_cache_size)
+    if env_cache_size is not None:
+        t.set_env_cache_size(env_cache_size)
+    if env_home is not None:
+        t.set_env_home(env_home)
     t.open("r")
     return t
 
@@ -155,6 +547,27 @@ class Column(object):
         """
         return self.__ll_object.num_elements
 
+    def get_dtype(self):
+        """
+        Returns the numpy dtype string used to represent values from this
+        column in arrays. Only fixed size numeric columns can be
+        represented in this way; a ValueError is raised for other columns.
+        """
+        t = self.get_type()
+        if t == WT_CHAR or self.get_num_elements() in [WT_VAR_1, WT_VAR_2]:
+            raise ValueError("Column '{0}' is not a fixed size numeric "
+                    "column".format(self.get_name()))
+        size = self.get_element_size()
+        if t == WT_FLOAT:
+            s = "f{0}".format(size)
+        else:
+            if size > 4:
+                size = 8
+            elif size == 3:
+                size = 4
+            s = "{0}{1}".format("u" if t == WT_UINT else "i", size)
+        return s
+
     def format_value(self, v):
         """
         Formats the specified value from this column for printing.
@@ -343,18 +756,7 @@ class Database(object):
         :param db_cache_size: the size of the cache
         :type db_cache_size: str or int
         """
-        if isinstance(db_cache_size, str):
-            s = db_cache_size
-            d = {"K":2**10, "M":2**20, "G":2**30}
-            multiplier = 1
-            value = s
-            if s.endswith(tuple(d.keys())):
-                value = s[:-1]
-                multiplier = d[s[-1]]
-            n = int(value)
-            self.__db_cache_size = n * multiplier
-        else:
-            self.__db_cache_size = int(db_cache_size)
+        self.__db_cache_size = _parse_size(db_cache_size)
 
     def write_metadata(self, filename):
         """
@@ -428,7 +830,9 @@ class Database(object):
     def close(self):
         """
         Closes this database object, freeing underlying resources.
+        Raises a WormtableError if it is in use by another thread.
         """
+        self.__ll_object.check_idle()
         try:
             self.__ll_object.close()
             if self.__open_mode == WT_WRITE:
@@ -482,6 +886,64 @@ class Table(Database):
         self.__total_row_size = 0
         self.__min_row_size = 0
         self.__max_row_size = 0
+        self.__pending_indexes = []
+        self.__env_cache_size = 0
+        self.__env_home = None
+
+    def get_env_cache_size(self):
+        """
+        Returns the size in bytes of the cache shared by this table and
+        its indexes, or 0 if they do not share a cache.
+        """
+        return self.__env_cache_size
+
+    def set_env_cache_size(self, env_cache_size):
+        """
+        Sets the size of the cache shared by this table and its indexes
+        when it is opened for reading. If env_cache_size is a string, it
+        can be suffixed with K, M or G to specify units of Kibibytes,
+        Mibibytes or Gibibytes. If it is 0, the table and each index have
+        their own caches, with sizes given by their db cache sizes.
+
+        This must be called before the table is opened, and has no effect
+        on a table that is already open.
+
+        See :ref:`performance-cache` for details on setting cache sizes.
+
+        :param env_cache_size: the size of the shared cache
+        :type env_cache_size: str or int
+        """
+        self.__env_cache_size = _parse_size(env_cache_size)
+
+    def get_env_home(self):
+        """
+        Returns the directory holding the cache shared between processes
+        that open this table, or None if the cache is not shared between
+        processes.
+        """
+        return self.__env_home
+
+    def set_env_home(self, env_home):
+        """
+        Sets the directory holding the cache shared by this table and
+        its indexes with other processes that open tables using the same
+        directory. This must be called before the table is opened for
+        reading. See :func:`open_table` for details.
+
+        :param env_home: the directory holding the shared cache
+        :type env_home: str
+        """
+        self.__env_home = env_home
+
+    def _get_ll_path(self, path):
+        """
+        Returns the specified path encoded for the low-level objects.
+        Paths are made absolute when the table is opened in a shared
+        environment, since relative paths are resolved from its home.
+        """
+        if self.__env_home is not None:
+            path = os.path.abspath(path)
+        return path.encode()
 
     def get_data_path(self):
         """
@@ -549,11 +1011,14 @@ class Table(Database):
             db_file = self.get_db_build_path().encode()
             data_file = self.get_data_build_path().encode()
         else:
-            db_file = self.get_db_path().encode()
-            data_file = self.get_data_path().encode()
+            db_file = self._get_ll_path(self.get_db_path())
+            data_file = self._get_ll_path(self.get_data_path())
+        env_home = self.__env_home
+        if env_home is not None:
+            env_home = env_home.encode()
         ll_cols = [c.get_ll_object() for c in self.__columns]
         t = _wormtable.Table(db_file, data_file, ll_cols,
-                self.get_db_cache_size())
+                self.get_db_cache_size(), self.get_env_cache_size(), env_home)
         return t
 
     def get_fixed_region_size(self):
@@ -622,8 +1087,10 @@ class Table(Database):
         db = description
         if isinstance(description, str):
             db = description.encode()
-        col = _wormtable.Column(nb, db, element_type, size, num_elements)
-        self.__columns.append(Column(col))
+        col = Column(_wormtable.Column(nb, db, element_type, size,
+                num_elements))
+        self.__column_name_map[col.get_name()] = len(self.__columns)
+        self.__columns.append(col)
 
     # Methods for accessing the columns
     def columns(self):
@@ -811,6 +1278,71 @@ class Table(Database):
         t.commit_row()
         self.__num_rows += 1
 
+    def append_columns(self, columns, arrays, masks=None):
+        """
+        Appends a block of rows to this table from the specified arrays of
+        column values. There must be one array for each of the specified
+        columns, each containing one value (or one row of values, for
+        columns with more than one element) for each row to be appended.
+        Columns that are not specified are missing in the appended rows.
+        Only fixed size numeric columns may be appended in this way. This
+        is much more efficient than calling :meth:`.append` for each
+        row when a large number of rows are to be added.
+
+        The arrays may be numpy arrays or any other object supporting
+        the buffer protocol with a suitable numeric type. If *masks* is
+        specified it must contain one entry for each column, which is
+        either None or a sequence of booleans with one value for each row;
+        values for rows with a true mask value are stored as missing. If
+        numpy masked arrays are provided, their masks are used when
+        *masks* is not specified. All values are checked before any rows
+        are appended, so that no rows are appended if any value is out of
+        range for its column.
+
+        :param columns: the columns to append values to
+        :type columns: sequence of column identifiers
+        :param arrays: the values for each column
+        :type arrays: sequence of arrays
+        :param masks: the missing value masks for each column
+        :type masks: sequence of arrays or None
+        :return: the number of rows appended
+        :rtype: int
+        """
+        cols = self.translate_columns(columns)
+        arrays = list(arrays)
+        if masks is None:
+            masks = [None for c in cols]
+        masks = list(masks)
+        if len(arrays) != len(cols) or len(masks) != len(cols):
+            raise ValueError("An array must be provided for each column")
+        for j, c in enumerate(cols):
+            a = arrays[j]
+            if numpy is not None:
+                if masks[j] is None and numpy.ma.isMaskedArray(a):
+                    m = numpy.ma.getmaskarray(a)
+                    if m.ndim > 1:
+                        m = m.reshape(m.shape[0], -1).any(axis=1)
+                    if m.any():
+                        masks[j] = m
+                if isinstance(a, numpy.ndarray):
+                    a = numpy.ascontiguousarray(numpy.ma.getdata(a))
+                    if a.dtype.kind not in "iuf":
+                        a = a.astype(c.get_dtype())
+                    arrays[j] = a
+            if masks[j] is not None:
+                if numpy is not None:
+                    masks[j] = numpy.ascontiguousarray(masks[j], dtype=bool)
+                else:
+                    masks[j] = bytes(bytearray(bool(v) for v in masks[j]))
+        positions = [c.get_position() for c in cols]
+        t = self.get_ll_object()
+        try:
+            n = t.insert_arrays(positions, arrays, masks)
+        finally:
+            # Some rows may have been written before an IO error
+            self.__num_rows = t.num_rows
+        return n
+
     def append_encoded(self, row):
         """
         Appends the specified row to this table.
@@ -824,6 +1356,26 @@ class Table(Database):
         t.commit_row()
         self.__num_rows += 1
 
+    def append_table(self, table):
+        """
+        Appends all of the rows in the specified table, which must be open
+        for reading and have the same columns as this table. Rows are
+        copied without being decoded, and are given new row ids following
+        the rows already in this table. This is much more efficient than
+        appending the rows one at a time, and so can be used to combine
+        tables that have been written in parallel.
+
+        :param table: the table to append rows from
+        :type table: :class:`Table`
+        """
+        self.verify_open(WT_WRITE)
+        table.verify_open(WT_READ)
+        t = self.get_ll_object()
+        try:
+            t.append_table(table.get_ll_object())
+        finally:
+            self.__num_rows = t.num_rows
+
 
     def __len__(self):
         """
@@ -845,7 +1397,7 @@ class Table(Database):
         ret = None
         n = len(self)
         if isinstance(key, slice):
-            ret = [self[j] for j in range(*key.indices(n))]
+            ret = self.get_rows(range(*key.indices(n)))
         elif isinstance(key, int):
             k = key
             if k < 0:
@@ -857,6 +1409,37 @@ class Table(Database):
             raise TypeError("table positions must be integers")
         return ret
 
+    def get_rows(self, row_ids, columns=None):
+        """
+        Returns a list of the rows with the specified ids, in the order
+        given, retrieving only the specified columns (or all columns, if
+        *columns* is None). Rows are returned as tuples, as for
+        :meth:`.cursor`, and negative ids count back from the end of the
+        table as for ``t[row_id]``. The rows are located in sorted order
+        using a single cursor on the table and rows that are adjacent
+        in the data file are read together, so this is much more efficient
+        than looking up a large number of rows one at a time.
+
+        :param row_ids: the ids of the rows to retrieve
+        :type row_ids: sequence of int
+        :param columns: columns to retrieve from the table
+        :type columns: sequence of column identifiers
+        """
+        self.verify_open(WT_READ)
+        n = len(self)
+        ids = []
+        for row_id in row_ids:
+            k = operator.index(row_id)
+            if k < 0:
+                k = n + k
+            if k < 0 or k >= n:
+                raise IndexError("table position out of range")
+            ids.append(k)
+        cols = self.columns() if columns is None else \
+                self.translate_columns(columns)
+        return self.get_ll_object().get_rows(ids,
+                [c.get_position() for c in cols])
+
     def __update_stats(self):
         """
         Updates the statistics about the underlying database.
@@ -869,21 +1452,77 @@ class Table(Database):
 
     def close(self):
         """
-        Closes this table freeing all underlying resources.
+        Closes this table freeing all underlying resources. If indexes
+        have been added using :meth:`.add_index`, these are built before
+        the table is closed.
         """
         self.verify_open()
+        self.get_ll_object().check_idle()
         mode = self.get_open_mode()
         if mode == WT_WRITE:
             self.__update_stats()
+        pending = self.__pending_indexes
+        self.__pending_indexes = []
+        prefixes = []
         try:
-            Database.close(self)
+            sorted_files = []
+            try:
+                for index, llo in pending:
+                    prefixes.append(index.get_db_build_path())
+                    sorted_files.append(llo.finish_key_sort())
+            finally:
+                Database.close(self)
+            if len(pending) > 0:
+                self.__columns = []
+                self.__column_name_map = {}
+                self.open("r")
+                try:
+                    for (index, llo), files in zip(pending, sorted_files):
+                        index.open("w")
+                        try:
+                            index.get_ll_object().merge_keys(files)
+                        finally:
+                            index.close()
+                finally:
+                    Database.close(self)
         finally:
             self.__num_rows = 0
             self.__columns = []
             self.__column_name_map = {}
-
-
-    def cursor(self, columns, start=0, stop=None):
+            for prefix in prefixes:
+                for f in glob.glob(prefix + ".sort_*"):
+                    os.unlink(f)
+
+    def add_index(self, index, sort_buffer_size=DEFAULT_SORT_BUFFER_SIZE):
+        """
+        Builds the specified index as rows are appended to this table,
+        which must be open for writing with no rows appended yet. The keys
+        for each row are sorted as the row is written, using a buffer of
+        up to sort_buffer_size bytes, and the index is built from these
+        sorted keys when the table is closed. This avoids reading
+        the table again after it has been written, as is required by
+        :meth:`Index.build`. The index must not be open, and its key
+        columns must have been added.
+
+        :param index: the index to build
+        :type index: :class:`Index`
+        :param sort_buffer_size: the size of the sort buffer
+        :type sort_buffer_size: str or int
+        """
+        self.verify_open(WT_WRITE)
+        index.verify_closed()
+        if self.get_ll_object().num_rows != 0:
+            raise ValueError("Indexes must be added before rows are appended")
+        cols = [c.get_position() for c in index.key_columns()]
+        llo = _wormtable.Index(self.get_ll_object(), b"", cols,
+                DEFAULT_CACHE_SIZE, WT_WRITE)
+        llo.set_bin_widths(index.bin_widths())
+        prefix = index.get_db_build_path().encode()
+        llo.start_key_sort(prefix, _parse_size(sort_buffer_size))
+        self.__pending_indexes.append((index, llo))
+
+
+    def cursor(self, columns, start=0, stop=None, batch_size=None, where=None):
         """
         Returns a cursor over the rows in this table, retrieving only
         the specified columns. Rows are returned as Tuple objects, with the
@@ -900,12 +1539,38 @@ class Table(Database):
         the *start* <= row_id < stop. Note that *start* is inclusive, and
         *stop* is exclusive.
 
+        If *batch_size* is specified, the cursor returns lists of up to
+        *batch_size* rows at a time rather than individual rows. This
+        is considerably more efficient when iterating over many rows.
+
+        If *where* is specified, only rows for which this filter expression
+        is true are returned. Filters are evaluated in C before any Python
+        objects are created for the row, and so selective scans are
+        much faster than testing each row in Python. A filter is a Python
+        expression comparing columns with constants, such as::
+
+            QUAL > 30 and FILTER == "PASS" and INFO.DP is not None
+
+        Columns are referred to by name; names that are not valid Python
+        identifiers can be given as ``col("name")``. The comparison
+        operators ``<``, ``<=``, ``==``, ``!=``, ``>`` and ``>=`` may be
+        combined using ``and``, ``or`` and ``not``. Elements of columns
+        with more than one element are compared using subscripts, as in
+        ``AF[0] > 0.5``. Missing values are tested using ``is None``
+        and ``is not None``, and ``v in column`` tests if any element of
+        a column is equal to ``v`` (or, for char columns, if ``v`` is a
+        substring). Comparisons involving missing values are false.
+
         :param columns: columns to retrieve from the table
         :type columns: sequence of column identifiers
         :param start: the row id of the first row returned
         :type start: int
         :param stop: the row id of the last row returned, minus 1.
         :type stop: int
+        :param batch_size: the maximum number of rows in each list returned.
+        :type batch_size: int
+        :param where: a filter expression that returned rows must satisfy.
+        :type where: str
         """
         self.verify_open(WT_READ)
         col_pos = [c.get_position() for c in self.translate_columns(columns)]
@@ -913,8 +1578,153 @@ class Table(Database):
         tri.set_min(start)
         if stop is not None:
             tri.set_max(stop)
+        if batch_size is not None:
+            if batch_size < 1:
+                raise ValueError("batch_size must be positive")
+            tri.set_batch_size(batch_size)
+        if where is not None:
+            tri.set_filter(_FilterCompiler(self).compile(where))
         return tri
 
+    def read_columns(self, columns, start=0, stop=None, where=None):
+        """
+        Returns the values of the specified columns for the rows in
+        this table as a list of numpy masked arrays, one for each column.
+        Only fixed size numeric columns may be read in this way. Missing
+        values are masked; for floating point columns, missing values are
+        also stored as NaN. Columns with more than one element are returned
+        as two dimensional arrays with one row for each row in the table.
+        This is much more efficient than iterating over rows using
+        :meth:`.cursor` when a large number of rows are needed.
+
+        The *columns*, *start*, *stop* and *where* arguments are interpreted
+        in the same way as for :meth:`.cursor`. This method requires numpy.
+
+        :param columns: columns to retrieve from the table
+        :type columns: sequence of column identifiers
+        :param start: the row id of the first row returned
+        :type start: int
+        :param stop: the row id of the last row returned, minus 1.
+        :type stop: int
+        :param where: a filter expression that returned rows must satisfy.
+        :type where: str
+        """
+        cols = self.translate_columns(columns)
+        n = len(self)
+        if stop is None or stop > n:
+            stop = n
+        num_rows = max(0, stop - start)
+        if where is not None:
+            num_rows = None
+        cursor = self.cursor(cols, start, stop, where=where)
+        return _read_arrays(cursor, cols, num_rows)
+
+    def aggregate(self, aggregates, start=0, stop=None, where=None):
+        """
+        Returns a tuple of the values of the specified aggregates over
+        the rows in this table. Aggregates are computed in C as the rows
+        are read, and so this is much faster than iterating over the
+        rows using :meth:`.cursor`. Each aggregate is a
+        ``(function, column)`` pair, where the function is one
+        of ``"count"``, ``"sum"``, ``"mean"``, ``"min"`` or ``"max"``
+        and the column is a column identifier as for :meth:`.cursor`. For
+        example::
+
+            count, mean = t.aggregate([("count", "QUAL"), ("mean", "QUAL")])
+
+        Missing values are ignored, so that ``"count"`` is the number of
+        non-missing values in the column. Every element of a column with
+        more than one element is included. The mean, min and max of a
+        column with no values are None. Only ``"count"`` may be computed
+        for char columns.
+
+        The *start*, *stop* and *where* arguments are interpreted in the
+        same way as for :meth:`.cursor`.
+
+        :param aggregates: the aggregates to compute
+        :type aggregates: sequence of (function, column) pairs
+        :param start: the row id of the first row aggregated
+        :type start: int
+        :param stop: the row id of the last row aggregated, minus 1.
+        :type stop: int
+        :param where: a filter expression that aggregated rows must satisfy.
+        :type where: str
+        """
+        cols, positions = _aggregate_columns(self, aggregates)
+        cursor = self.cursor(cols, start, stop, where=where)
+        [(key, num_rows, stats)] = cursor.aggregate([])
+        return _aggregate_values(aggregates, positions, stats)
+
+    def build_indexes(self, indexes, progress_callback=None, callback_rows=100,
+            sort_buffer_size=DEFAULT_SORT_BUFFER_SIZE, num_jobs=1):
+        """
+        Builds the specified indexes, each of which must be open for
+        writing, in a single pass over this table, which must be open for
+        reading. This is much more
+        efficient than building each index in turn using :meth:`Index.build`
+        when there are several indexes to build. The arguments are
+        interpreted in the same way as for :meth:`Index.build`, except that
+        the sort buffer is shared equally among the indexes. If num_jobs
+        is greater than 1, the worker processes each extract the keys for
+        all of the indexes from their ranges of rows in a single pass.
+
+        :param indexes: the indexes to build
+        :type indexes: sequence of :class:`Index`
+        """
+        indexes = list(indexes)
+        if num_jobs < 1:
+            raise ValueError("num_jobs must be positive")
+        for index in indexes:
+            index.verify_open(WT_WRITE)
+        if num_jobs > 1:
+            if len(indexes) > 0:
+                self.__build_indexes_parallel(indexes, progress_callback,
+                        _parse_size(sort_buffer_size), num_jobs)
+        elif len(indexes) > 0:
+            llo = indexes[0].get_ll_object()
+            others = [index.get_ll_object() for index in indexes[1:]]
+            n = _parse_size(sort_buffer_size)
+            if progress_callback is not None:
+                llo.build(progress_callback, callback_rows,
+                        sort_buffer_size=n, indexes=others)
+            else:
+                llo.build(sort_buffer_size=n, indexes=others)
+
+    def __build_indexes_parallel(self, indexes, progress_callback,
+            sort_buffer_size, num_jobs):
+        """
+        Builds the specified indexes using the specified number of worker
+        processes to extract and sort the keys.
+        """
+        num_rows = len(self)
+        num_chunks = max(1, min(num_rows, 4 * num_jobs))
+        bounds = [num_rows * j // num_chunks for j in range(num_chunks + 1)]
+        keys = [([c.get_position() for c in index.key_columns()],
+                index.bin_widths()) for index in indexes]
+        prefix = indexes[0].get_db_build_path()
+        tasks = [(self.get_homedir(), self.get_db_cache_size(), keys,
+                "{0}.{1}".format(prefix, j).encode(), sort_buffer_size,
+                bounds[j], bounds[j + 1]) for j in range(num_chunks)]
+        pool = multiprocessing.Pool(num_jobs)
+        try:
+            files = [[] for index in indexes]
+            processed_rows = 0
+            for rows, run_files in pool.imap_unordered(_sort_index_keys,
+                    tasks):
+                for index_files, f in zip(files, run_files):
+                    index_files.extend(f)
+                processed_rows += rows
+                if progress_callback is not None:
+                    progress_callback(processed_rows)
+            pool.close()
+            for index, index_files in zip(indexes, files):
+                index.get_ll_object().merge_keys(index_files)
+        finally:
+            pool.terminate()
+            pool.join()
+            for f in glob.glob(prefix + ".*.sort_*"):
+                os.unlink(f)
+
     def indexes(self):
         """
         Returns an interator over the names of the indexes in this table.
@@ -931,7 +1741,9 @@ class Table(Database):
     def open_index(self, index_name, db_cache_size=DEFAULT_CACHE_SIZE_STR):
         """
         Returns an index with the specified name opened in read mode with
-        the specified db_cache_size.
+        the specified db_cache_size. If the table was opened with a shared
+        cache (see :func:`open_table`), the index uses this cache and
+        db_cache_size is ignored.
 
         See :ref:`performance-cache` for details on setting cache sizes.
         The cache size may be either an integer specifying the size in
@@ -1006,9 +1818,9 @@ class Index(Database):
         Returns a new instance of _wormtable.Index using ether the build or
         permanent locations for the db.
         """
-        filename = self.get_db_path().encode()
+        filename = self.__table._get_ll_path(self.get_db_path())
         if build:
-            filename = self.get_db_build_path().encode()
+            filename = self.__table._get_ll_path(self.get_db_build_path())
         cols = [c.get_position() for c in self.__key_columns]
         i = _wormtable.Index(self.__table.get_ll_object(), filename,
                 cols, self.get_db_cache_size())
@@ -1063,16 +1875,30 @@ class Index(Database):
             self.__key_columns.append(col)
             self.__bin_widths.append(bin_width)
 
-    def build(self, progress_callback=None, callback_rows=100):
+    def build(self, progress_callback=None, callback_rows=100,
+            sort_buffer_size=DEFAULT_SORT_BUFFER_SIZE, num_jobs=1):
         """
         Builds this index. If progress_callback is not None, invoke this
         calback after every callback_rows have been processed.
-        """
-        llo = self.get_ll_object()
-        if progress_callback is not None:
-            llo.build(progress_callback, callback_rows)
-        else:
-            llo.build()
+
+        The keys are first sorted using a buffer of up to sort_buffer_size
+        bytes, with temporary files in the table's home directory used to
+        hold sorted runs of keys if they do not all fit in the buffer. The
+        keys are then inserted into the index in sorted order, which
+        requires much less cache than inserting them in table order. If
+        sort_buffer_size is 0, keys are inserted directly in table order.
+        The sort buffer size may be either an integer specifying the size
+        in bytes or a string with the optional suffixes K, M or G.
+
+        If num_jobs is greater than 1, the rows of the table are split
+        into ranges and the keys for these ranges are extracted and sorted
+        by num_jobs worker processes in parallel, each using a sort buffer
+        of sort_buffer_size bytes. The sorted keys are then merged and
+        inserted into the index. In this case, the progress callback is
+        invoked as each range of rows is completed.
+        """
+        self.__table.build_indexes([self], progress_callback,
+                callback_rows, sort_buffer_size, num_jobs)
 
     def open(self, mode):
         """
@@ -1089,6 +1915,7 @@ class Index(Database):
         """
         Closes this Index.
         """
+        self.get_ll_object().check_idle()
         try:
             Database.close(self)
         finally:
@@ -1138,7 +1965,8 @@ class Index(Database):
         return IndexCounter(self)
 
 
-    def cursor(self, columns, start=KEY_UNSET, stop=KEY_UNSET):
+    def cursor(self, columns, start=KEY_UNSET, stop=KEY_UNSET,
+            batch_size=None, where=None):
         """
         Returns a cursor over the rows in the table in the order defined
         by this index, retrieving only the specified columns. Rows are
@@ -1158,12 +1986,21 @@ class Index(Database):
         be provided; a single value of the relevant type is considered to
         be the same as a singleton tuple consisting of this value.
 
+        If *batch_size* is specified, the cursor returns lists of up to
+        *batch_size* rows at a time rather than individual rows. If *where*
+        is specified, only rows satisfying this filter expression are
+        returned; see :meth:`Table.cursor` for details.
+
         :param columns: columns to retrieve from the table
         :type columns: sequence of column identifiers
         :param start: the key prefix that is less than or equal to all keys
             in returned rows.
         :param stop: the key prefix that is greater than all keys in returned
             rows.
+        :param batch_size: the maximum number of rows in each list returned.
+        :type batch_size: int
+        :param where: a filter expression that returned rows must satisfy.
+        :type where: str
         """
         self.verify_open(WT_READ)
         col_pos = [c.get_position() for c in
@@ -1177,8 +2014,275 @@ class Index(Database):
         if stop != KEY_UNSET:
             key = self.key_to_ll(stop)
             iri.set_max(key)
+        if batch_size is not None:
+            if batch_size < 1:
+                raise ValueError("batch_size must be positive")
+            iri.set_batch_size(batch_size)
+        if where is not None:
+            iri.set_filter(_FilterCompiler(self.__table).compile(where))
+        return iri
+
+    def lookup_many(self, keys, columns, batch_size=None, where=None):
+        """
+        Returns an iterator over the rows in the table with the specified
+        keys, retrieving only the specified columns. This is a much more
+        efficient way to find the rows for a large number of keys than
+        using a separate :meth:`.cursor` for each. The iterator returns
+        ``(key, row)`` pairs, where *key* is the value from *keys* that
+        matches the index key of the row, and *row* is a tuple as returned
+        by :meth:`.cursor`. Each key may be a prefix of the index key, in
+        which case all rows with this prefix are returned. Keys are
+        looked up in sorted order using a single cursor, and so the pairs
+        are returned in index key order rather than in the order of *keys*.
+        Keys that occur more than once, or that are equal as index keys
+        (such as ``5`` and ``5.0``), are only looked up once and are
+        paired with the first such value in *keys*. Keys that do not match
+        any rows are omitted. The *batch_size* and
+        *where* arguments are interpreted in the same way as for
+        :meth:`.cursor`. For example, on an index on ``CHROM+POS``::
+
+            for site, (ref, alt) in i.lookup_many(sites, ["REF", "ALT"]):
+                print(site, ref, alt)
+
+        :param keys: the keys (or key prefixes) to look up.
+        :param columns: columns to retrieve from the table
+        :type columns: sequence of column identifiers
+        :param batch_size: the maximum number of pairs in each list returned.
+        :type batch_size: int
+        :param where: a filter expression that returned rows must satisfy.
+        :type where: str
+        """
+        iri = self.cursor(columns, batch_size=batch_size, where=where)
+        iri.set_probes([(k, self.key_to_ll(k)) for k in keys])
         return iri
 
+    def read_columns(self, columns, start=KEY_UNSET, stop=KEY_UNSET,
+            where=None):
+        """
+        Returns the values of the specified columns for the rows in the
+        table in the order defined by this index as a list of numpy masked
+        arrays, one for each column. The *columns*, *start*, *stop* and
+        *where* arguments are interpreted in the same way as for
+        :meth:`.cursor`.
+        See :meth:`Table.read_columns` for details of the arrays returned.
+
+        :param columns: columns to retrieve from the table
+        :type columns: sequence of column identifiers
+        :param start: the key prefix that is less than or equal to all keys
+            in returned rows.
+        :param stop: the key prefix that is greater than all keys in returned
+            rows.
+        :param where: a filter expression that returned rows must satisfy.
+        :type where: str
+        """
+        cols = self.__table.translate_columns(columns)
+        cursor = self.cursor(cols, start, stop, where=where)
+        return _read_arrays(cursor, cols)
+
+    def aggregate(self, aggregates, group_by=None, bin_width=None,
+            start=KEY_UNSET, stop=KEY_UNSET, where=None):
+        """
+        Returns the values of the specified aggregates over the rows in
+        the table, optionally grouped by a prefix of the key of this
+        index. The *aggregates*, *start*, *stop* and *where* arguments
+        are interpreted in the same way as for :meth:`Table.aggregate`
+        and :meth:`.cursor`.
+
+        If *group_by* is None, a tuple of the values of the aggregates
+        over all the rows in the range is returned. Otherwise, the rows
+        are grouped by the values of the first *group_by* key columns,
+        and a list of ``(key, values)`` pairs is returned in key order,
+        where *key* is a tuple of the values of these columns and *values*
+        is the tuple of aggregates over the rows in the group. If
+        *bin_width* is specified, the values of the last of these
+        columns are grouped into bins of this width, and the key holds
+        the start of each bin. For example, on an index on
+        ``CHROM+POS``::
+
+            i.aggregate([("mean", "INFO.DP")], group_by=1)
+            i.aggregate([("count", "QUAL"), ("sum", "QUAL")], group_by=2,
+                    bin_width=10000)
+
+        return the mean of ``INFO.DP`` for each chromosome, and the count
+        and sum of ``QUAL`` for each 10kb window of each chromosome.
+
+        :param aggregates: the aggregates to compute
+        :type aggregates: sequence of (function, column) pairs
+        :param group_by: the number of key columns to group rows by.
+        :type group_by: int
+        :param bin_width: the width of the bins of the last group column.
+        :type bin_width: float
+        :param start: the key prefix that is less than or equal to all keys
+            in aggregated rows.
+        :param stop: the key prefix that is greater than all keys in
+            aggregated rows.
+        :param where: a filter expression that aggregated rows must satisfy.
+        :type where: str
+        """
+        cols, positions = _aggregate_columns(self.__table, aggregates)
+        n = 0 if group_by is None else group_by
+        if n < 0 or n > len(self.__key_columns):
+            raise ValueError("group_by must be between 0 and the number "
+                    "of key columns")
+        bin_widths = [float(w) for w in self.__bin_widths[:n]]
+        if bin_width is not None:
+            if n == 0:
+                raise ValueError("bin_width requires group_by")
+            w = bin_widths[-1]
+            if bin_width <= 0 or (w != 0 and bin_width % w != 0):
+                raise ValueError("bin_width must be a positive multiple "
+                        "of the bin width of the key column")
+            bin_widths[-1] = float(bin_width)
+        cursor = self.cursor(self.__key_columns[:n] + cols, start, stop,
+                where=where)
+        results = cursor.aggregate(bin_widths)
+        if group_by is None:
+            ret = _aggregate_values(aggregates, positions, results[0][2])
+        else:
+            ret = [(key, _aggregate_values(aggregates, positions, stats))
+                    for key, num_rows, stats in results]
+        return ret
+
+    def windows(self, prefix, width, step=None, columns=None, agg=None,
+            start=None, stop=None, where=None):
+        """
+        Returns an iterator over windows of rows for which the key column
+        following the specified *prefix* lies in an interval of the
+        specified *width*, such as windows over ``POS`` within a given
+        ``CHROM`` of an index on ``CHROM+POS``. The windows start at
+        *start*, *start* + *step*, *start* + 2 *step*, and so on, where
+        *step* defaults to *width*; if *step* is less than *width*, the
+        windows overlap. Windows start before *stop*, and rows with
+        values greater than or equal to *stop* are not included. By
+        default, the windows cover all the rows with the specified
+        prefix.
+
+        If *agg* is specified, it is a list of ``(function, column)``
+        pairs interpreted as for :meth:`.aggregate`, and the iterator
+        returns ``(window_start, values)`` pairs, where *values* is the
+        tuple of aggregates over the rows in the window. Otherwise, the
+        iterator returns ``(window_start, arrays)`` pairs, where *arrays*
+        are the values of the specified *columns* for the rows in the
+        window as numpy masked arrays (see :meth:`Table.read_columns`).
+        For example::
+
+            for pos, (mean,) in i.windows("1", 10000, agg=[("mean", "QUAL")]):
+                print(pos, mean)
+
+        If the key column is binned in the index, *width*, *step*,
+        *start* and *stop* must be multiples of its bin width.
+
+        Each window is found by repositioning the cursor on the index,
+        and so rows between windows are not read. The rows in the parts
+        of the range shared by overlapping windows are only read once.
+
+        :param prefix: the key prefix shared by the rows in all windows.
+        :param width: the width of each window.
+        :param step: the distance between the starts of adjacent windows.
+        :param columns: columns to retrieve from the table
+        :type columns: sequence of column identifiers
+        :param agg: the aggregates to compute for each window
+        :type agg: sequence of (function, column) pairs
+        :param start: the start of the first window.
+        :param stop: the value of the key column that all rows in the
+            windows are less than.
+        :param where: a filter expression that rows in the windows must
+            satisfy.
+        :type where: str
+        """
+        self.verify_open(WT_READ)
+        if (columns is None) == (agg is None):
+            raise ValueError("Exactly one of columns and agg must be specified")
+        if not isinstance(prefix, tuple):
+            prefix = (prefix,)
+        n = len(prefix)
+        key_columns = self.__key_columns
+        if n >= len(key_columns):
+            raise ValueError("The prefix must be shorter than the index key")
+        if key_columns[n].get_type() == WT_CHAR:
+            raise ValueError("Cannot make windows over a char column")
+        step = width if step is None else step
+        if width <= 0 or step <= 0:
+            raise ValueError("width and step must be positive")
+        if key_columns[n].get_type() != WT_FLOAT:
+            if width % 1 != 0 or step % 1 != 0:
+                raise ValueError("width and step must be integers for an "
+                        "integer key column")
+            width, step = int(width), int(step)
+        w = self.__bin_widths[n]
+        if w != 0:
+            bounds = [v for v in [width, step, start, stop] if v is not None]
+            if any(v % w != 0 for v in bounds):
+                raise ValueError("width, step, start and stop must be "
+                        "multiples of the bin width of the key column")
+        def value(key):
+            return key if len(key_columns) == 1 else key[n]
+        def ll_key(v):
+            return self.key_to_ll(prefix + (v,) if len(key_columns) > 1 else v)
+        if stop is None:
+            last = value(self.max_key(*prefix))
+            if last is None:
+                # All values in the key column are missing.
+                return iter([])
+        if start is None:
+            start = value(self.min_key(*prefix))
+            if start is None:
+                raise ValueError("start must be specified when there are "
+                        "missing values in the key column")
+        starts = []
+        s = start
+        if stop is None:
+            stop = last + 1
+            if key_columns[n].get_type() == WT_FLOAT:
+                stop = last + step
+            while s <= last:
+                starts.append(s)
+                s += step
+        else:
+            while s < stop:
+                starts.append(s)
+                s += step
+        if agg is not None:
+            cols, positions = _aggregate_columns(self.__table, agg)
+        else:
+            cols = self.__table.translate_columns(columns)
+            positions = None
+        iri = _wormtable.IndexRowIterator(self.get_ll_object(),
+                [c.get_position() for c in cols])
+        if where is not None:
+            iri.set_filter(_FilterCompiler(self.__table).compile(where))
+        ends = [min(s + width, stop) for s in starts]
+        return self.__windows(iri, cols, agg, positions, starts, ends, ll_key)
+
+    def __windows(self, iri, cols, agg, positions, starts, ends, ll_key):
+        """
+        Returns an iterator over the windows with the specified starts and
+        ends using the specified row iterator (see :meth:`.windows`).
+        """
+        # The windows are made from the segments between adjacent window
+        # boundaries, each of which is read at most once.
+        bounds = sorted(set(starts) | set(ends))
+        segments = {}
+        for s, e in zip(starts, ends):
+            j = bisect.bisect_left(bounds, s)
+            k = bisect.bisect_left(bounds, e)
+            for m in [m for m in segments if m < j]:
+                del segments[m]
+            for m in range(j, k):
+                if m not in segments:
+                    iri.set_max(ll_key(bounds[m + 1]))
+                    iri.seek(ll_key(bounds[m]))
+                    if agg is not None:
+                        segments[m] = iri.aggregate([])[0][2]
+                    else:
+                        segments[m] = _read_arrays(iri, cols)
+            window = [segments[m] for m in range(j, k)]
+            if agg is not None:
+                stats = _combine_stats(window)
+                yield s, _aggregate_values(agg, positions, stats)
+            else:
+                yield s, [numpy.ma.concatenate([w[c] for w in window])
+                        for c in range(len(cols))]
 
     def key_to_ll(self, v):
         """
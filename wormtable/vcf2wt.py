@@ -33,9 +33,15 @@ from __future__ import division
 import os
 import sys
 import shutil
+import struct
+import decimal
 import argparse
+import itertools
 import tempfile
+import collections
+import multiprocessing
 
+import _wormtable
 import wormtable as wt
 import wormtable.cli as cli
 
@@ -89,6 +95,256 @@ FLAG = b"Flag"
 CHARACTER = b"Character"
 STRING = b"String"
 
+# The approximate number of bytes of input lines read in each chunk when
+# the VCF is read by worker processes.
+PARSE_CHUNK_SIZE = 4 * 1024 * 1024
+
+# The struct formats for the float sizes considered when inferring a schema.
+FLOAT_FORMATS = {2: "<e", 4: "<f", 8: "<d"}
+
+
+def _float_fits(token, size):
+    """
+    Returns True if the float value written as the specified string in
+    the VCF can be recovered exactly at the precision it is written with
+    from a float of the specified size.
+    """
+    x = float(token)
+    if x != x or x in (float("inf"), float("-inf")):
+        return True
+    fmt = FLOAT_FORMATS[size]
+    try:
+        y = struct.unpack(fmt, struct.pack(fmt, x))[0]
+    except (OverflowError, struct.error):
+        # Half precision is not supported by struct in older Pythons.
+        return False
+    digits = -decimal.Decimal(token.decode()).as_tuple().exponent
+    return round(y, digits) == round(x, digits)
+
+
+class ColumnStatistics(object):
+    """
+    Class recording the values observed in a column when inferring a
+    schema, which are the encoded strings parsed from the VCF. If sampled
+    is True, only some of the rows are observed, and the inferred column
+    must also hold values in the rows that were not.
+    """
+    def __init__(self, column, sampled=False):
+        self.__column = column
+        self.__sampled = sampled
+        self.__num_values = 0
+        self.__min_length = None
+        self.__max_length = None
+        self.__min_value = None
+        self.__max_value = None
+        self.__float_sizes = None
+
+    def update(self, value):
+        """
+        Updates the statistics for the specified encoded value.
+        """
+        self.__num_values += 1
+        t = self.__column.get_type()
+        if t == wt.WT_CHAR or self.__column.get_num_elements() == 1:
+            tokens = [value]
+        else:
+            tokens = value.replace(b";", b",").split(b",")
+        n = len(value) if t == wt.WT_CHAR else len(tokens)
+        if self.__min_length is None:
+            self.__min_length = n
+            self.__max_length = n
+        self.__min_length = min(self.__min_length, n)
+        self.__max_length = max(self.__max_length, n)
+        if t in (wt.WT_INT, wt.WT_UINT):
+            for tok in tokens:
+                try:
+                    v = int(tok)
+                except ValueError:
+                    continue
+                if self.__min_value is None:
+                    self.__min_value = v
+                    self.__max_value = v
+                self.__min_value = min(self.__min_value, v)
+                self.__max_value = max(self.__max_value, v)
+        elif t == wt.WT_FLOAT:
+            for tok in tokens:
+                if self.__float_sizes is None:
+                    self.__float_sizes = [size for size in
+                            sorted(FLOAT_FORMATS)
+                            if size <= self.__column.get_element_size()]
+                try:
+                    self.__float_sizes = [size for size in
+                            self.__float_sizes if _float_fits(tok, size)]
+                except (ValueError, decimal.InvalidOperation):
+                    pass
+
+    def get_num_values(self):
+        """
+        Returns the number of non-missing values observed.
+        """
+        return self.__num_values
+
+    def get_num_elements(self):
+        """
+        Returns the smallest number of elements that holds all the values
+        observed. Variable columns become fixed if all values have the
+        same number of elements, unless the rows are sampled.
+        """
+        n = self.__column.get_num_elements()
+        if self.__sampled:
+            return n
+        if n in (wt.WT_VAR_1, wt.WT_VAR_2) and self.__min_length is not None:
+            if self.__min_length == self.__max_length > 0:
+                n = self.__min_length
+        return n
+
+    def get_type_and_size(self):
+        """
+        Returns the smallest element type and size that holds all the values
+        observed, using the limits of the candidate columns. If the rows
+        are sampled, integer columns keep their type and are given one
+        more byte than the values observed need, up to their original
+        size, and float columns keep their original size.
+        """
+        t = self.__column.get_type()
+        size = self.__column.get_element_size()
+        if t in (wt.WT_INT, wt.WT_UINT) and self.__min_value is not None:
+            u = t
+            if not self.__sampled and self.__min_value >= 0:
+                u = wt.WT_UINT
+            for k in range(1, 9):
+                c = _wormtable.Column(b"", b"", u, k, 1)
+                if c.min_element <= self.__min_value and \
+                        self.__max_value <= c.max_element:
+                    if self.__sampled:
+                        k = min(k + 1, size)
+                    t, size = u, k
+                    break
+        elif t == wt.WT_FLOAT and self.__float_sizes and not self.__sampled:
+            size = self.__float_sizes[0]
+        return t, size
+
+
+class VCFRowParser(object):
+    """
+    Class that parses lines of a VCF file into rows for a table, mapping
+    the fields in each line to the positions of the corresponding columns.
+    Parsers are pickled and sent to worker processes when converting
+    regions in parallel, and so hold no reference to the input file or
+    the table.
+    """
+    def __init__(self, num_columns, fixed_columns, info_columns,
+            genotype_columns, truncate):
+        self.__num_columns = num_columns
+        self.__fixed_columns = fixed_columns
+        self.__info_columns = info_columns
+        self.__genotype_columns = genotype_columns
+        self.__truncate = truncate
+
+    def parse(self, s):
+        """
+        Returns the row for the specified line as a list of the encoded
+        string values for each column, which are None if missing.
+        """
+        row = [None for j in range(self.__num_columns)]
+        info_columns = self.__info_columns
+        genotype_columns = self.__genotype_columns
+        ref_index = 3
+        alt_index = 4
+        l = s.split()
+        # Read in the fixed columns
+        for vcf_index, wt_index in self.__fixed_columns:
+            if l[vcf_index] != MISSING_VALUE:
+                row[wt_index] = l[vcf_index]
+                if vcf_index in (ref_index, alt_index) and self.__truncate:
+                    # truncate the REF/ALT column if necessary; this is a
+                    # temporary workaround until more sophisticated
+                    # truncation on a per column basis is implemented.
+                    if len(l[vcf_index]) > 254:
+                        row[wt_index] = l[vcf_index][:253] + b'+'
+        # Now process the info columns.
+        for mapping in l[7].split(b";"):
+            tokens = mapping.split(b"=")
+            name = tokens[0]
+            if name in info_columns:
+                col = info_columns[name]
+                if len(tokens) == 2:
+                    row[col] = tokens[1]
+                else:
+                    # This is a Flag column.
+                    row[col] = b"1"
+        # Process the genotype columns, if they exist
+        if len(l) > 8:
+            j = 0
+            fmt = l[8].split(b":")
+            for genotype_values in l[9:]:
+                tokens = genotype_values.split(b":")
+                if len(tokens) == len(fmt):
+                    for k in range(len(fmt)):
+                        if fmt[k] in genotype_columns[j]:
+                            col = genotype_columns[j][fmt[k]]
+                            tok = tokens[k]
+                            # FIXME this is a hack to detect missing values
+                            # in genotype columns. I'm not sure why anybody
+                            # would do this, but we need it to parse the
+                            # example VCF from the 1000genomes site.
+                            if tok != MISSING_VALUE and tok != b".,.":
+                                row[col] = tok
+                j += 1
+        return row
+
+    def get_ll_parser(self, table):
+        """
+        Returns a low-level parser that parses lines in the same way as
+        this parser and appends the rows directly to the specified table,
+        which must be open for writing.
+        """
+        return _wormtable.VCFRecordParser(table.get_ll_object(),
+                self.__fixed_columns, self.__info_columns,
+                self.__genotype_columns, int(self.__truncate))
+
+def _read_lines(task):
+    """
+    Reads the lines that begin between the specified byte offsets of an
+    uncompressed file in a worker process, returning the list of lines.
+    """
+    source, begin, end = task
+    lines = []
+    with open(source, "rb") as f:
+        if begin > 0:
+            # The line containing begin - 1 belongs to the previous chunk
+            f.seek(begin - 1)
+            f.readline()
+        start = f.tell()
+        if start < end:
+            data = f.read(end - start)
+            if not data.endswith(b"\n"):
+                data += f.readline()
+            lines, tail = cli.split_lines(data)
+            if len(tail) > 0:
+                lines.append(tail)
+    return lines
+
+def _convert_region(task):
+    """
+    Converts the lines between the specified virtual offsets of a BGZF
+    VCF into a new table in a worker process, returning the home
+    directory of the table.
+    """
+    source, begin, end, schema, homedir, db_cache_size, parser = task
+    table = wt.Table(homedir)
+    table.read_schema(schema)
+    table.set_db_cache_size(db_cache_size)
+    table.open("w")
+    try:
+        ll_parser = parser.get_ll_parser(table)
+        for line in cli.read_bgzf_region(source, begin, end):
+            ll_parser.append(line)
+    finally:
+        table.close()
+    return homedir
+
+
 class VCFReader(cli.FileReader):
     """
     A class for reading VCF files.
@@ -210,6 +466,47 @@ class VCFReader(cli.FileReader):
             for s in genotype_descriptions:
                 self.add_column(table, genotype, s)
 
+    def infer_schema(self, table, sample_rows=0):
+        """
+        Reads the rows of the VCF file and adds the smallest columns that
+        hold the values observed to the specified table. If sample_rows
+        is greater than zero, only the first sample_rows rows are read,
+        and the columns leave room for larger values in later rows;
+        otherwise, all rows are read and columns in which all values are
+        missing are omitted.
+        """
+        default = wt.Table(table.get_homedir())
+        self.generate_schema(default)
+        columns = default.columns()
+        column_map = {}
+        for j, c in enumerate(columns):
+            column_map[c.get_name().encode()] = j
+        stats = [ColumnStatistics(c, sample_rows > 0) for c in columns]
+        rows = self.rows(column_map)
+        if sample_rows > 0:
+            rows = itertools.islice(rows, sample_rows)
+        num_rows = 0
+        for row in rows:
+            num_rows += 1
+            for value, s in zip(row, stats):
+                if value is not None:
+                    s.update(value)
+        id_column = columns[0]
+        size = id_column.get_element_size()
+        if sample_rows == 0:
+            for k in range(1, size):
+                c = _wormtable.Column(b"", b"", wt.WT_UINT, k, 1)
+                if num_rows <= c.max_element + 1:
+                    size = k
+                    break
+        table.add_id_column(size)
+        for c, s in zip(columns[1:], stats[1:]):
+            if sample_rows == 0 and s.get_num_values() == 0:
+                continue
+            element_type, element_size = s.get_type_and_size()
+            table.add_column(c.get_name(), c.get_description(), element_type,
+                    element_size, s.get_num_elements())
+
     def read_header(self):
         """
         Read header lines, parse version and column names
@@ -222,10 +519,10 @@ class VCFReader(cli.FileReader):
         self.parse_header_line(self.__header.pop())
 
 
-    def rows(self, table_columns):
+    def get_row_parser(self, table_columns):
         """
-        Returns an iterator over the rows in this VCF file. Each row is a
-        dictionary mapping column positions to their encoded string values.
+        Returns a VCFRowParser for the table with the specified mapping of
+        column names to positions.
         """
         # First we construct the mappings from the various parts of the
         # VCF row to the corresponding column index in the wormtable
@@ -250,72 +547,128 @@ class VCFReader(cli.FileReader):
                     name = split[-1]
                     index = self.__genotypes.index(g)
                     genotype_columns[index][name] = v
-        ref_index = 3
-        alt_index = 4
-        # Now we are ready to process the file.
+        return VCFRowParser(num_columns, fixed_columns, info_columns,
+                genotype_columns, self.__truncate)
+
+    def rows(self, table_columns):
+        """
+        Returns an iterator over the rows in this VCF file. Each row is a
+        list of the encoded string values for each column position.
+        """
+        parser = self.get_row_parser(table_columns)
+        rows = (parser.parse(s) for s in self.get_input_file())
+        return self.__monitor(rows)
+
+    def lines(self):
+        """
+        Returns an iterator over the unparsed lines for the rows in this
+        VCF file.
+        """
+        return self.__monitor(self.get_input_file())
+
+    def __monitor(self, iterator):
+        """
+        Returns an iterator over the items in the specified iterator,
+        updating the progress monitor as they are consumed.
+        """
         update_rows = self.get_progress_update_rows()
         num_rows = 0
-        for s in self.get_input_file():
-            row = [None for j in range(num_columns)]
-            l = s.split()
-            # Read in the fixed columns
-            for vcf_index, wt_index in fixed_columns:
-                if l[vcf_index] != MISSING_VALUE:
-                    row[wt_index] = l[vcf_index]
-                    if vcf_index in (ref_index, alt_index) and self.__truncate:
-                        # truncate the REF/ALT column if necessary; this is a
-                        # temporary workaround until more sophisticated
-                        # truncation on a per column basis is implemented.
-                        if len(l[vcf_index]) > 254:
-                            row[wt_index] = l[vcf_index][:253] + b'+'
-            # Now process the info columns.
-            for mapping in l[7].split(b";"):
-                tokens = mapping.split(b"=")
-                name = tokens[0]
-                if name in info_columns:
-                    col = info_columns[name]
-                    if len(tokens) == 2:
-                        row[col] = tokens[1]
-                    else:
-                        # This is a Flag column.
-                        row[col] = b"1"
-            # Process the genotype columns, if they exist
-            if len(l) > 8:
-                j = 0
-                fmt = l[8].split(b":")
-                for genotype_values in l[9:]:
-                    tokens = genotype_values.split(b":")
-                    if len(tokens) == len(fmt):
-                        for k in range(len(fmt)):
-                            if fmt[k] in genotype_columns[j]:
-                                col = genotype_columns[j][fmt[k]]
-                                tok = tokens[k]
-                                # FIXME this is a hack to detect missing values
-                                # in genotype columns. I'm not sure why anybody
-                                # would do this, but we need it to parse the
-                                # example VCF from the 1000genomes site.
-                                if tok != MISSING_VALUE and tok != b".,.":
-                                    row[col] = tok
-                    j += 1
-            yield row
+        for item in iterator:
+            yield item
             num_rows += 1
             if num_rows % update_rows == 0:
                 self.update_progress()
         self.finish_progress()
 
+    def line_chunks(self, num_jobs=1):
+        """
+        Returns an iterator over lists of the unparsed lines for the rows
+        in this VCF file, in input order. If num_jobs is greater than 1
+        and the input is an uncompressed file, the chunks of lines are
+        read and split by this many worker processes.
+        """
+        if num_jobs > 1 and self.get_input_path() is not None:
+            chunks = self.__parallel_line_chunks(num_jobs)
+        else:
+            f = self.get_input_file()
+            chunks = iter(lambda: f.readlines(PARSE_CHUNK_SIZE), [])
+        for lines in chunks:
+            yield lines
+            self.update_progress()
+        self.finish_progress()
+
+    def __parallel_line_chunks(self, num_jobs):
+        """
+        Returns an iterator over the chunks of lines read from the input
+        file by the specified number of worker processes. Only a few chunks
+        for each worker are read ahead of the chunks returned.
+        """
+        f = self.get_input_file()
+        source = self.get_input_path()
+        size = os.path.getsize(source)
+        offsets = list(range(f.tell(), size, PARSE_CHUNK_SIZE)) + [size]
+        tasks = collections.deque((source, offsets[j], offsets[j + 1])
+                for j in range(len(offsets) - 1))
+        pool = multiprocessing.Pool(num_jobs)
+        try:
+            pending = collections.deque()
+            while len(tasks) > 0 or len(pending) > 0:
+                while len(tasks) > 0 and len(pending) < 2 * num_jobs:
+                    task = tasks.popleft()
+                    pending.append((task[2],
+                            pool.apply_async(_read_lines, (task,))))
+                end, result = pending.popleft()
+                lines = result.get()
+                # Keep the input file in step for the progress monitor
+                f.seek(end)
+                yield lines
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
 
 class VCFWriter(object):
     """
     Class that writes VCF rows to a wormtable.
     """
-    def __init__(self, table):
+    def __init__(self, table, colspecs=()):
         self.__table = table
+        self.__ll_parser = None
         self.__table.read_metadata()
         self.__table.open("w")
+        for colspec in colspecs:
+            index = wt.Index(self.__table, colspec)
+            cli.parse_colspec(self.__table, index, colspec)
+            self.__table.add_index(index)
 
     def append(self, row):
         self.__table.append_encoded(row)
 
+    def set_row_parser(self, parser):
+        """
+        Sets the VCFRowParser used to parse the lines passed to append_line.
+        """
+        self.__ll_parser = parser.get_ll_parser(self.__table)
+
+    def append_line(self, line):
+        self.__ll_parser.append(line)
+
+    def append_lines(self, lines):
+        """
+        Parses the specified lines and appends the rows to the table.
+        """
+        append = self.__ll_parser.append
+        for line in lines:
+            append(line)
+
+    def append_table(self, table):
+        """
+        Appends the rows of the specified table, which must have the same
+        columns and be open for reading.
+        """
+        self.__table.append_table(table)
+
     def close(self):
         self.__table.close()
 
@@ -333,6 +686,12 @@ class ProgramRunner(object):
         self.__quiet = args.quiet
         self.__schema = args.schema
         self.__truncate = args.truncate
+        self.__colspecs = args.index
+        self.__num_jobs = args.jobs
+        self.__num_regions_jobs = args.regions_parallel
+        self.__infer_schema = args.infer_schema
+        self.__source = args.SOURCE
+        self.__regions = None
         self.__tmp_dirs = []
         self.__tmp_files = []
         self.__table = None
@@ -350,6 +709,9 @@ class ProgramRunner(object):
     def generate_schema(self):
         """
         Reads the header of the input VCF and generates a schema file.
+        If we are inferring the schema, the rows are also read and, if
+        we are writing a table, the reader is reopened so that the rows
+        can be read again.
         """
         fd, schema_file = tempfile.mkstemp(suffix=".xml", prefix="vcf2wt_")
         self.__tmp_files.append(schema_file)
@@ -357,7 +719,16 @@ class ProgramRunner(object):
         tmpdir = tempfile.mkdtemp(suffix=".wt", prefix="vcf2wt_")
         self.__tmp_dirs.append(tmpdir)
         table = wt.Table(tmpdir)
-        self.__reader.generate_schema(table)
+        if self.__infer_schema is None:
+            self.__reader.generate_schema(table)
+        else:
+            self.__reader.set_progress(self.__progress
+                    and self.__infer_schema == 0)
+            self.__reader.set_truncate_REF_ALT(self.__truncate)
+            self.__reader.infer_schema(table, self.__infer_schema)
+            if not self.__generate_schema:
+                self.__reader.close()
+                self.__reader = VCFReader(self.__source)
         table.write_schema(schema_file)
         self.__schema = schema_file
 
@@ -373,6 +744,13 @@ class ProgramRunner(object):
         self.__column_map = {}
         for c in self.__table.columns():
             self.__column_map[c.get_name().encode()] = c.get_position()
+        for colspec in self.__colspecs:
+            index = wt.Index(self.__table, colspec)
+            try:
+                cli.parse_colspec(self.__table, index, colspec)
+            except (KeyError, ValueError):
+                self.__table.close()
+                self.error("Invalid colspec '{0}'".format(colspec))
         self.__table.close()
 
     def write_table(self):
@@ -382,18 +760,103 @@ class ProgramRunner(object):
         """
         self.__reader.set_progress(self.__progress)
         self.__reader.set_truncate_REF_ALT(self.__truncate)
-        self.__writer = VCFWriter(self.__table)
-        for r in self.__reader.rows(self.__column_map):
-            self.__writer.append(r)
+        self.__writer = VCFWriter(self.__table, self.__colspecs)
+        if self.__num_regions_jobs is not None:
+            self.write_regions()
+        elif self.__num_jobs > 1:
+            # Workers read the input in chunks of lines, which are parsed
+            # directly into the table's row buffer here.
+            self.__writer.set_row_parser(
+                    self.__reader.get_row_parser(self.__column_map))
+            for lines in self.__reader.line_chunks(self.__num_jobs):
+                self.__writer.append_lines(lines)
+        else:
+            # Lines are parsed directly into the table's row buffer
+            self.__writer.set_row_parser(
+                    self.__reader.get_row_parser(self.__column_map))
+            for line in self.__reader.lines():
+                self.__writer.append_line(line)
         self.__reader.close()
         self.__reader = None
         self.__writer.close()
         self.__writer = None
 
+    def get_regions(self):
+        """
+        Returns the list of (name, begin, end) regions in the tabix index
+        of the source VCF, sorted by position in the file.
+        """
+        if self.__source == '-' or not cli.is_bgzf(self.__source):
+            self.error("--regions-parallel requires a bgzipped VCF")
+        regions = None
+        for suffix in [".tbi", ".csi"]:
+            index_file = self.__source + suffix
+            if os.path.exists(index_file):
+                try:
+                    regions = cli.read_tabix_index(index_file)
+                except (IOError, ValueError, struct.error):
+                    self.error("Cannot read tabix index '{0}'".format(
+                            index_file))
+                break
+        if regions is None:
+            self.error("--regions-parallel requires a tabix index")
+        return sorted(regions, key=lambda r: r[1])
+
+    def write_regions(self):
+        """
+        Converts the regions of the source VCF in the tabix index into
+        separate tables in worker processes, and appends these tables
+        to the destination in file order.
+        """
+        row_parser = self.__reader.get_row_parser(self.__column_map)
+        parent = os.path.dirname(os.path.abspath(self.__destination))
+        tmpdir = tempfile.mkdtemp(prefix="vcf2wt_", dir=parent)
+        self.__tmp_dirs.append(tmpdir)
+        tasks = []
+        for j, (name, begin, end) in enumerate(self.__regions):
+            homedir = os.path.join(tmpdir, "region_{0}.wt".format(j))
+            tasks.append((self.__source, begin, end, self.__schema, homedir,
+                    self.__db_cache_size, row_parser))
+        monitor = None
+        if self.__progress and len(tasks) > 0:
+            monitor = cli.ProgressMonitor(len(tasks), "regions")
+        pool = multiprocessing.Pool(self.__num_regions_jobs)
+        try:
+            for j, homedir in enumerate(pool.imap(_convert_region, tasks)):
+                t = wt.open_table(homedir)
+                try:
+                    self.__writer.append_table(t)
+                finally:
+                    t.close()
+                shutil.rmtree(homedir)
+                if monitor is not None:
+                    monitor.update(j + 1)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+        if monitor is not None:
+            monitor.finish()
+
     def run(self):
         """
         Top level entry point.
         """
+        if self.__num_jobs < 1:
+            self.error("--jobs must be positive")
+        if self.__num_regions_jobs is not None and self.__num_regions_jobs < 1:
+            self.error("--regions-parallel must be positive")
+        if self.__num_regions_jobs is not None and self.__num_jobs != 1:
+            self.error("Cannot use --jobs with --regions-parallel")
+        if self.__infer_schema is not None:
+            if self.__infer_schema < 0:
+                self.error("--infer-schema sample size must be positive")
+            if self.__schema is not None:
+                self.error("Cannot use --infer-schema with --schema")
+            if self.__source == '-':
+                self.error("Cannot use --infer-schema with STDIN")
+        if self.__num_regions_jobs is not None and not self.__generate_schema:
+            self.__regions = self.get_regions()
         if self.__schema is None:
             self.generate_schema()
 
@@ -458,6 +921,30 @@ def vcf2wt_main(args=None):
             occured""")
     parser.add_argument("--cache-size", "-c", default="64M",
         help="cache size in bytes; suffixes K, M and G also supported.")
+    parser.add_argument("--index", "-i", action="append", default=[],
+        metavar="COLSPEC",
+        help="""Build an index with the specified column specification
+            while the table is being written; this option may be given
+            several times. See 'wtadmin add' for the format of
+            column specifications.""")
+    parser.add_argument("--jobs", "-j", type=int, default=1,
+        help="""number of worker processes used to read an uncompressed
+            VCF in chunks of lines, which are parsed as they are written;
+            rows are written in the same order as the input.""")
+    parser.add_argument("--regions-parallel", "-r", type=int, default=None,
+        metavar="N",
+        help="""convert the regions of a bgzipped VCF with a tabix (.tbi or
+            .csi) index using N worker processes, and then concatenate
+            them into DEST. Each reference sequence in the index is a
+            region. Cannot be used with --jobs.""")
+    parser.add_argument("--infer-schema", type=int, nargs="?",
+        const=0, default=None, metavar="SAMPLE_ROWS",
+        help="""Read the rows of the VCF and use the smallest column types
+            that hold all the values observed, omitting columns in which
+            all values are missing. If SAMPLE_ROWS is given, only
+            the first SAMPLE_ROWS rows are read, columns are not
+            omitted, and only the sizes of integer columns are reduced,
+            leaving one byte of headroom.""")
     g = parser.add_mutually_exclusive_group()
     g.add_argument("--generate-schema", "-g", action="store_true",
         default=False,
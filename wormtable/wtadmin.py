@@ -23,7 +23,6 @@ Wormtable administration program.
 from __future__ import print_function
 from __future__ import division
 
-import re
 import os
 import sys
 import argparse
@@ -212,44 +211,39 @@ class AddRunner(ProgramRunner):
     """
     def __init__(self, args):
         super(AddRunner, self).__init__(args)
-        self._colspec = args.COLSPEC
-        self._index_name = args.name
-        if args.name is None:
-            self._index_name = self._colspec
+        self._colspecs = args.COLSPEC
+        self._index_names = list(self._colspecs)
+        if args.name is not None:
+            if len(self._colspecs) != 1:
+                self.error("--name can only be used with a single COLSPEC")
+            self._index_names = [args.name]
         self._quiet = args.quiet
         self._force = args.force
         self._index_db_cache_size = args.cache_size
-        self._index = None
+        self._sort_buffer_size = args.sort_buffer_size
+        self._num_jobs = args.jobs
+        self._indexes = []
 
     def init(self):
         super(AddRunner, self).init()
-        self._index = wt.Index(self._table, self._index_name)
-        if self._index.exists() and not self._force:
-            s = "Index '{0}' exists; use --force to overwrite"
-            self.error(s.format(self._index_name))
-        self.parse_colspec()
-        self._index.set_db_cache_size(self._index_db_cache_size)
-        self._index.open("w")
-
-    def parse_colspec(self):
-        """
-        Parses the specified column specification and adds the key columns
-        and bin widths specified within.
-        """
-        for c in self._colspec.split("+"):
-            col_name = c
-            bin_width = 0
-            m = re.search("\[.*\]$", c)
-            if m is not None:
-                g = m.group(0)
-                col_name = c[:m.start(0)]
-                bin_width = float(g.strip("[]"))
-            col = self._table.get_column(col_name)
-            self._index.add_key_column(col, bin_width)
+        if self._num_jobs < 1:
+            self.error("--jobs must be positive")
+        if len(set(self._index_names)) != len(self._index_names):
+            self.error("Duplicate index names")
+        for name, colspec in zip(self._index_names, self._colspecs):
+            index = wt.Index(self._table, name)
+            if index.exists() and not self._force:
+                s = "Index '{0}' exists; use --force to overwrite"
+                self.error(s.format(name))
+            cli.parse_colspec(self._table, index, colspec)
+            index.set_db_cache_size(self._index_db_cache_size)
+            self._indexes.append(index)
+        for index in self._indexes:
+            index.open("w")
 
     def run(self):
         """
-        Create the index.
+        Create the indexes.
         """
         n = len(self._table)
         f = None
@@ -264,14 +258,15 @@ class AddRunner(ProgramRunner):
         # were kill -9'd that Berkeley DB thinks are still held
         # open.
         f = null if self._quiet else progress
-        self._index.build(f, max(1, int(n / 1000)))
+        self._table.build_indexes(self._indexes, f, max(1, int(n / 1000)),
+                self._sort_buffer_size, self._num_jobs)
         if not self._quiet:
             monitor.finish()
 
     def cleanup(self):
-        if self._index is not None:
-            if self._index.is_open():
-                self._index.close()
+        for index in self._indexes:
+            if index.is_open():
+                index.close()
         super(AddRunner, self).cleanup()
 
 class DumpRunner(ProgramRunner):
@@ -376,8 +371,10 @@ def add_colspec_argument(parser):
     """
     Adds a positional colspec argument to the specified parser.
     """
-    parser.add_argument("COLSPEC",
-        help="""Column specification for the index. A colspec
+    parser.add_argument("COLSPEC", nargs="+",
+        help="""Column specification for the index. Several colspecs
+        may be given, in which case all of the indexes are built in a
+        single pass over the table. A colspec
         is of the form n_1[w_1]+n_2[w_2]+...+n_k[w_k], where n_j is the
         name of the j_th column in the index and w_j is the optional
         width of the bins in the index. If w_j is not provided or
@@ -446,6 +443,14 @@ def wtadmin_main(cmdline_args=None):
                 This option is very important for index build performance and
                 should be set as large as possible; ideally, the entire index
                 should fit into the cache. """)
+    add_parser.add_argument("--sort-buffer-size", "-b", default="64M",
+            help="""memory used to sort keys before they are inserted into
+                the index, in bytes; suffixes K, M and G also supported.
+                Keys that do not fit are sorted using temporary files in
+                HOMEDIR. If 0, keys are inserted in table order.""")
+    add_parser.add_argument("--jobs", "-j", type=int, default=1,
+            help="""number of worker processes used to extract and sort
+                keys; each uses a sort buffer of the specified size.""")
     add_parser.set_defaults(runner=AddRunner)
 
     # dump command